@@ -18,6 +18,27 @@ import io
 import threading
 import time
 from seed_daily_sales import ensure_today_sales
+import sales_rollups
+import customer_sketches
+import sales_analytics
+import product_performance
+import sales_spikes
+import hll
+import sales_columns
+import result_cache
+import closed_periods
+import sales_facts
+import sales_topk
+import order_digests
+import demand_forecast
+import cohorts
+import customer_segments
+import co_purchase
+import keyset
+import low_stock
+import inventory_summary
+import shared_cache
+import sale_events
 
 # Load environment variables
 load_dotenv()
@@ -218,7 +239,7 @@ def get_database_connection():
         # Test the connection
         client.admin.command('ping')
 
-        db = client["saless"]
+        db = client[os.getenv('MONGODB_DATABASE') or 'saless']
         return db
 
     except Exception as e:
@@ -248,6 +269,32 @@ try:
         # Product indexes
         db.products_update.create_index([('category', 1)])
         db.products_update.create_index([('name', 1)])
+
+        # Canonical sale-line facts (projected into the legacy sales collections)
+        sales_facts.ensure_indexes(db)
+
+        # Daily sales rollups (read by the dashboards instead of raw sales)
+        sales_rollups.ensure_indexes(db)
+        # Per-product demand EWMAs (read by the sales-spike alerts)
+        sales_spikes.ensure_indexes(db)
+        # Per-variant demand forecasts (read by the restock advice)
+        demand_forecast.ensure_indexes(db)
+        # Monthly cohort retention documents and the per-customer sales lookups that build them
+        cohorts.ensure_indexes(db)
+        # RFM customer segments (campaign recipients are selected by segment)
+        customer_segments.ensure_indexes(db)
+        # Frequently-bought-together index (offer emails, cart page, worker POS)
+        co_purchase.ensure_indexes(db)
+        # Low-stock variants, kept current by every stock write
+        low_stock.ensure_indexes(db)
+        # Stock quantity and valuation per category, kept current with $inc deltas
+        inventory_summary.ensure_indexes(db)
+        # Cache entries and job state shared by every worker (TTL-expired by MongoDB)
+        shared_cache.ensure_indexes(db)
+        # Keyset-paginated listings (see keyset.py): sort key plus _id tie-break
+        db.products_by_user.create_index([('added_by', 1), ('_id', -1)])
+        db.email_logs.create_index([('sent_at', -1), ('_id', -1)])
+        db.admin_ai_chats.create_index([('updated_at', -1), ('_id', -1)])
         
         debug_log("Database indexes created successfully")
     except Exception as idx_error:
@@ -268,6 +315,8 @@ except Exception as e:
     print("Failed to establish MongoDB connection. Starting with limited functionality.")
     db = None  # We'll handle this case in our routes
 
+# L2 for every cache and job tracker below, so gunicorn workers share them (see shared_cache.py)
+cache_backend = shared_cache.backend(db)
 
 
 import threading
@@ -303,8 +352,80 @@ def start_daily_sales_simulator(min_sales: int = 50, interval_hours: int = 24) -
     _DAILY_SALES_SIM_STARTED = True
 
 
+# Background jobs (sales simulator, snapshot refresher); BACKGROUND_JOBS=0 turns
+# them off, e.g. for benchmarks that need the data to stay put
+BACKGROUND_JOBS = os.getenv('BACKGROUND_JOBS', '1').lower() not in ('0', 'false', 'no')
+
 # Start the daily simulator once when the app module is loaded
-start_daily_sales_simulator(min_sales=50, interval_hours=24)
+if BACKGROUND_JOBS:
+    start_daily_sales_simulator(min_sales=50, interval_hours=24)
+
+# Leases for the periodic jobs below, shared by every worker (see shared_cache.py)
+job_leases = shared_cache.SharedCache('job_leases', cache_backend)
+
+def start_periodic(name, fn, minutes):
+    # Run fn() every `minutes` in a daemon thread. Every worker starts one, but
+    # each period only the worker that takes the shared lease runs it (the same
+    # compare_and_swap lease as the auto-refresh). fn() returns a log line or None.
+    interval = minutes * 60
+
+    def _runner():
+        while True:
+            try:
+                if db is not None and job_leases.compare_and_swap(name, None, os.getpid(), ttl=interval * 0.9):
+                    message = fn()
+                    if message:
+                        debug_log(f"[{name}] {message}")
+            except Exception as e:
+                debug_log(f"[{name}] Error: {e}")
+            time.sleep(interval)
+
+    threading.Thread(target=_runner, daemon=True).start()
+
+
+# Product performance snapshot refresh (served by /api/product-insights and /api/notifications)
+PRODUCT_PERFORMANCE_REFRESH_MINUTES = int(os.getenv('PRODUCT_PERFORMANCE_REFRESH_MINUTES', '15'))
+# Readers rebuild the snapshot inline if the refresher has fallen this far behind
+PRODUCT_PERFORMANCE_MAX_AGE = datetime.timedelta(minutes=2 * PRODUCT_PERFORMANCE_REFRESH_MINUTES)
+# Demand forecast refresh (served by the restock notifications and the dashboard)
+DEMAND_FORECAST_REFRESH_MINUTES = int(os.getenv('DEMAND_FORECAST_REFRESH_MINUTES', '360'))
+# Cohort retention refresh (served by /api/cohorts); only the open month is recomputed
+COHORT_REFRESH_MINUTES = int(os.getenv('COHORT_REFRESH_MINUTES', '60'))
+# RFM segment refresh (read by the offer and festival campaigns)
+CUSTOMER_SEGMENT_REFRESH_MINUTES = int(os.getenv('CUSTOMER_SEGMENT_REFRESH_MINUTES', '360'))
+# Frequently-bought-together index (offer emails, cart page, worker POS)
+CO_PURCHASE_REFRESH_MINUTES = int(os.getenv('CO_PURCHASE_REFRESH_MINUTES', '720'))
+# Catalogue rescans picking up stock written outside the app
+LOW_STOCK_RECONCILE_MINUTES = int(os.getenv('LOW_STOCK_RECONCILE_MINUTES', '60'))
+INVENTORY_RECONCILE_MINUTES = int(os.getenv('INVENTORY_RECONCILE_MINUTES', '60'))
+
+FESTIVAL_BOOSTS = {name: data.get('boost_percentage') for name, data in INDIAN_FESTIVALS.items()
+                   if data.get('boost_percentage') is not None}
+
+def refresh_product_performance():
+    # Recompute the materialized product performance snapshot.
+    product_performance.refresh(db)
+    return 'Snapshot refreshed'
+
+def reconcile_inventory():
+    # Recompute the inventory summary from scratch and report any drift from
+    # the incremental updates (see inventory_summary.py).
+    for source, off in inventory_summary.reconcile(db).items():
+        print(f"[INVENTORY] {source} summary had drifted (stored - actual): {off}")
+
+
+if BACKGROUND_JOBS:
+    start_periodic('PRODUCT PERFORMANCE', refresh_product_performance, PRODUCT_PERFORMANCE_REFRESH_MINUTES)
+    if demand_forecast.available():
+        start_periodic('DEMAND FORECAST',
+                       lambda: f"{demand_forecast.refresh(db, boosts=FESTIVAL_BOOSTS)} forecasts refreshed",
+                       DEMAND_FORECAST_REFRESH_MINUTES)
+    start_periodic('COHORTS', lambda: f"{cohorts.refresh(db)['activity']} months refreshed", COHORT_REFRESH_MINUTES)
+    start_periodic('CUSTOMER SEGMENTS', lambda: f"{customer_segments.refresh(db)} customers scored",
+                   CUSTOMER_SEGMENT_REFRESH_MINUTES)
+    start_periodic('CO-PURCHASE', lambda: f"{co_purchase.rebuild(db)} products indexed", CO_PURCHASE_REFRESH_MINUTES)
+    start_periodic('LOW STOCK', lambda: f"{low_stock.rebuild(db)} low-stock variants", LOW_STOCK_RECONCILE_MINUTES)
+    start_periodic('INVENTORY', reconcile_inventory, INVENTORY_RECONCILE_MINUTES)
 
 # ===== INTELLIGENT NOTIFICATION FUNCTIONS =====
 
@@ -337,186 +458,87 @@ def get_upcoming_festivals():
     return upcoming
 
 def analyze_product_performance():
-    # Analyze product performance over the last 3 months
+    # Serve the materialized product performance snapshot (see product_performance.py).
+    # A background job refreshes it; if it is missing or stale it is rebuilt inline.
     try:
         if db is None:
             return {'top_performers': [], 'poor_performers': [], 'error': 'Database not connected'}
-        
-        three_months_ago = datetime.datetime.now() - datetime.timedelta(days=90)
-        
-        # First, let's get all sales data from the last 3 months
-        sales_data = list(db.products_sold.find({
-            'date': {'$gte': three_months_ago}
-        }))
-        
-        debug_log(f"Found {len(sales_data)} sales records in last 90 days")
-        
-        if not sales_data:
-            # If no recent data, use all available data
-            sales_data = list(db.products_sold.find({}).limit(100))  # Get some data for analysis
-            debug_log(f"No recent sales, using {len(sales_data)} historical records")
-        
-        if not sales_data:
-            return {'top_performers': [], 'poor_performers': [], 'error': 'No sales data found'}
-        
-        # Group sales by product
-        product_stats = {}
-        for sale in sales_data:
-            product_id = str(sale.get('product_id', ''))
-            if not product_id:
-                continue
-                
-            if product_id not in product_stats:
-                product_stats[product_id] = {
-                    'total_revenue': 0,
-                    'total_quantity': 0,
-                    'customers': set(),
-                    'order_count': 0
-                }
-            
-            # Add sale data
-            product_stats[product_id]['total_revenue'] += float(sale.get('total', 0))
-            product_stats[product_id]['total_quantity'] += int(sale.get('quantity', 0))
-            product_stats[product_id]['customers'].add(str(sale.get('user_id', '')))
-            product_stats[product_id]['order_count'] += 1
-        
-        # Get product details and create final results
-        results = []
-        for product_id, stats in product_stats.items():
-            try:
-                # Get product info
-                if len(product_id) == 24:  # ObjectId length
-                    product_info = db.products_update.find_one({'_id': ObjectId(product_id)})
-                else:
-                    product_info = db.products_update.find_one({'_id': product_id})
-                
-                if not product_info:
-                    continue
-                
-                customer_count = len(stats['customers'])
-                
-                results.append({
-                    'product_id': product_id,
-                    'name': product_info.get('name', 'Unknown Product'),
-                    'category': product_info.get('category', 'Unknown'),
-                    'revenue': stats['total_revenue'],
-                    'quantity_sold': stats['total_quantity'],
-                    'customer_count': customer_count,
-                    'order_count': stats['order_count'],
-                    'avg_order_value': stats['total_revenue'] / stats['order_count'] if stats['order_count'] > 0 else 0
-                })
-            except Exception as e:
-                debug_log(f"Error processing product {product_id}: {e}")
-                continue
-        
-        if not results:
-            # Return static Tamil product data for display
-            return {
-                'top_performers': [
-                    {
-                        'name': 'பாசுமதி அரிசி (Basmati Rice)',
-                        'category': 'மளிகை (Groceries)',
-                        'revenue': 145680.50,
-                        'quantity_sold': 425,
-                        'customer_count': 89,
-                        'order_count': 156,
-                        'avg_order_value': 934.10,
-                        'action': 'Increase stock by 45% - High demand product'
-                    },
-                    {
-                        'name': 'தேங்காய் எண்ணெய் (Coconut Oil)',
-                        'category': 'மளிகை (Groceries)',
-                        'revenue': 98450.75,
-                        'quantity_sold': 287,
-                        'customer_count': 76,
-                        'order_count': 132,
-                        'avg_order_value': 745.83,
-                        'action': 'Increase stock by 40% - High demand product'
-                    },
-                    {
-                        'name': 'சாம்பார் பொடி (Sambar Powder)',
-                        'category': 'மளிகை (Groceries)',
-                        'revenue': 76890.25,
-                        'quantity_sold': 398,
-                        'customer_count': 68,
-                        'order_count': 145,
-                        'avg_order_value': 530.28,
-                        'action': 'Increase stock by 38% - High demand product'
-                    },
-                    {
-                        'name': 'முறுக்கு (Murukku)',
-                        'category': 'தின்பண்டங்கள் (Snacks)',
-                        'revenue': 65420.80,
-                        'quantity_sold': 312,
-                        'customer_count': 54,
-                        'order_count': 98,
-                        'avg_order_value': 667.56,
-                        'action': 'Monitor closely - Growing popularity'
-                    }
-                ],
-                'poor_performers': [
-                    {
-                        'name': 'சீடை (Seedai)',
-                        'category': 'தின்பண்டங்கள் (Snacks)',
-                        'revenue': 12340.50,
-                        'quantity_sold': 45,
-                        'customer_count': 12,
-                        'order_count': 18,
-                        'avg_order_value': 685.58,
-                        'action': 'Review pricing strategy'
-                    },
-                    {
-                        'name': 'சந்தனம் (Sandalwood)',
-                        'category': 'தனிப்பட்ட பராமரிப்பு (Personal Care)',
-                        'revenue': 8965.00,
-                        'quantity_sold': 15,
-                        'customer_count': 8,
-                        'order_count': 12,
-                        'avg_order_value': 747.08,
-                        'action': 'Reduce stock by 30% and consider promotion'
-                    }
-                ],
-                'analysis_period': '90 days',
-                'total_products_analyzed': 20
-            }
-        
-        # Sort by customer engagement (customer count is priority, then revenue)
-        results.sort(key=lambda x: (x['customer_count'], x['revenue']), reverse=True)
-        
-        debug_log(f"Analyzed {len(results)} products")
-        
-        # Calculate performance thresholds
-        total_products = len(results)
-        top_20_percent = max(1, total_products // 5)
-        bottom_20_percent = max(1, total_products // 5)
-        
-        # Identify high performers (top 20% by customer engagement)
-        top_performers = results[:top_20_percent]
-        for product in top_performers:
-            if product['customer_count'] >= 3:  # Lower threshold for more results
-                recommended_increase = 30 + (product['customer_count'] * 2)
-                recommended_increase = min(recommended_increase, 50)
-                product['action'] = f"Increase stock by {recommended_increase}% - High demand product"
-            else:
-                product['action'] = "Monitor closely - Growing popularity"
-        
-        # Identify poor performers (bottom 20% by customer engagement and revenue)
-        poor_performers = results[-bottom_20_percent:]
-        for product in poor_performers:
-            if product['customer_count'] <= 1 and product['revenue'] < 50:
-                product['action'] = "Consider reducing stock by 50% - Low demand"
-            elif product['customer_count'] <= 1:
-                product['action'] = "Reduce stock by 30% and consider promotion"
-            else:
-                product['action'] = "Review pricing strategy"
-        
-        debug_log(f"Top performers: {len(top_performers)}, Poor performers: {len(poor_performers)}")
-        
+
+        performance = product_performance.load(db, max_age=PRODUCT_PERFORMANCE_MAX_AGE)
+        if performance is None:
+            performance = product_performance.refresh(db)
+
+        if performance.get('error') or performance.get('top_performers'):
+            return _with_forecast_actions(performance)
+
+        # No sold product matched the catalogue: show static Tamil product data
         return {
-            'top_performers': top_performers,
-            'poor_performers': poor_performers,
+            'top_performers': [
+                {
+                    'name': 'பாசுமதி அரிசி (Basmati Rice)',
+                    'category': 'மளிகை (Groceries)',
+                    'revenue': 145680.50,
+                    'quantity_sold': 425,
+                    'customer_count': 89,
+                    'order_count': 156,
+                    'avg_order_value': 934.10,
+                    'action': 'Increase stock by 45% - High demand product'
+                },
+                {
+                    'name': 'தேங்காய் எண்ணெய் (Coconut Oil)',
+                    'category': 'மளிகை (Groceries)',
+                    'revenue': 98450.75,
+                    'quantity_sold': 287,
+                    'customer_count': 76,
+                    'order_count': 132,
+                    'avg_order_value': 745.83,
+                    'action': 'Increase stock by 40% - High demand product'
+                },
+                {
+                    'name': 'சாம்பார் பொடி (Sambar Powder)',
+                    'category': 'மளிகை (Groceries)',
+                    'revenue': 76890.25,
+                    'quantity_sold': 398,
+                    'customer_count': 68,
+                    'order_count': 145,
+                    'avg_order_value': 530.28,
+                    'action': 'Increase stock by 38% - High demand product'
+                },
+                {
+                    'name': 'முறுக்கு (Murukku)',
+                    'category': 'தின்பண்டங்கள் (Snacks)',
+                    'revenue': 65420.80,
+                    'quantity_sold': 312,
+                    'customer_count': 54,
+                    'order_count': 98,
+                    'avg_order_value': 667.56,
+                    'action': 'Monitor closely - Growing popularity'
+                }
+            ],
+            'poor_performers': [
+                {
+                    'name': 'சீடை (Seedai)',
+                    'category': 'தின்பண்டங்கள் (Snacks)',
+                    'revenue': 12340.50,
+                    'quantity_sold': 45,
+                    'customer_count': 12,
+                    'order_count': 18,
+                    'avg_order_value': 685.58,
+                    'action': 'Review pricing strategy'
+                },
+                {
+                    'name': 'சந்தனம் (Sandalwood)',
+                    'category': 'தனிப்பட்ட பராமரிப்பு (Personal Care)',
+                    'revenue': 8965.00,
+                    'quantity_sold': 15,
+                    'customer_count': 8,
+                    'order_count': 12,
+                    'avg_order_value': 747.08,
+                    'action': 'Reduce stock by 30% and consider promotion'
+                }
+            ],
             'analysis_period': '90 days',
-            'total_products_analyzed': total_products
+            'total_products_analyzed': 20
         }
         
     except Exception as e:
@@ -531,6 +553,37 @@ def analyze_product_performance():
             'total_products_analyzed': 0
         }
 
+def _forecast_advice(forecast):
+    # Restock advice from a product's demand forecast (see demand_forecast.for_products)
+    cover = forecast.get('days_of_cover')
+    festival = f" ({forecast['festival']} demand included)" if forecast.get('festival') else ''
+    if forecast['reorder_qty'] > 0:
+        covers = f", stock covers {cover:.0f} days" if cover is not None else ''
+        return f"Reorder {forecast['reorder_qty']} units - {forecast['demand_7d']:.0f} forecast to sell in 7 days{covers}{festival}"
+    if cover is None:
+        return f"No sales forecast in the next {demand_forecast.HORIZON_DAYS} days - hold reorders and consider promotion"
+    if cover > demand_forecast.HORIZON_DAYS:
+        return f"Stock covers {cover:.0f} days at forecast demand - hold reorders and consider promotion"
+    return f"Stock OK - covers {cover:.0f} days at forecast demand{festival}"
+
+def _with_forecast_actions(performance):
+    # Replace the rule-of-thumb stock actions with forecast-based ones where a forecast exists
+    rows = performance.get('top_performers', []) + performance.get('poor_performers', [])
+    product_ids = [row['product_id'] for row in rows if row.get('product_id')]
+    if not product_ids:
+        return performance
+    try:
+        forecasts = demand_forecast.for_products(db, product_ids)
+    except Exception as e:
+        debug_log(f"Error loading demand forecasts: {e}")
+        return performance
+    for row in rows:
+        forecast = forecasts.get(row.get('product_id'))
+        if forecast:
+            row['action'] = _forecast_advice(forecast)
+            row['forecast'] = forecast
+    return performance
+
 def generate_festival_recommendations():
     # Generate festival-specific product recommendations
     recommendations = []
@@ -620,60 +673,54 @@ def get_admin_notifications():
     return {'notifications': notifications, 'count': len(notifications)}
 
 def get_inventory_alerts():
-    # Generate inventory management alerts
+    # Generate inventory management alerts from the per-product demand EWMAs
+    # (see sales_spikes.py); only products that sold today are examined.
+    # Restock quantities and run-out warnings come from the demand forecasts.
     alerts = []
     
     try:
         # Return empty if database is not connected
-        if db is None or products_sold is None:
+        if db is None:
             return alerts
-            
-        # Check for products with sudden sales spikes
-        seven_days_ago = datetime.datetime.now() - datetime.timedelta(days=7)
-        thirty_days_ago = datetime.datetime.now() - datetime.timedelta(days=30)
-        
-        recent_pipeline = [
-            {'$match': {'date': {'$gte': seven_days_ago}}},
-            {'$group': {
-                '_id': '$product_id',
-                'recent_sales': {'$sum': '$quantity'},
-                'recent_revenue': {'$sum': '$total'}
-            }}
-        ]
-        
-        historical_pipeline = [
-            {'$match': {'date': {'$gte': thirty_days_ago, '$lt': seven_days_ago}}},
-            {'$group': {
-                '_id': '$product_id',
-                'historical_sales': {'$sum': '$quantity'},
-                'historical_revenue': {'$sum': '$total'}
-            }}
-        ]
-        
-        recent_data = {item['_id']: item for item in db.products_sold.aggregate(recent_pipeline)}
-        historical_data = {item['_id']: item for item in db.products_sold.aggregate(historical_pipeline)}
-        
-        # Detect sudden spikes
-        for product_id, recent in recent_data.items():
-            historical = historical_data.get(product_id, {'historical_sales': 0})
-            
-            # Calculate weekly average from historical data
-            weekly_avg = historical['historical_sales'] / 3 if historical['historical_sales'] > 0 else 0
-            
-            # If recent sales are significantly higher than average
-            if weekly_avg > 0 and recent['recent_sales'] > weekly_avg * 2:
-                try:
-                    product_info = db.products_update.find_one({'_id': ObjectId(product_id)})
-                    if product_info:
-                        alerts.append({
-                            'type': 'sales_spike',
-                            'priority': 'high',
-                            'message': f"📈 Sales spike detected for '{product_info['name']}' - {recent['recent_sales']} units this week vs {weekly_avg:.1f} weekly average",
-                            'recommendation': f"Consider increasing stock by 40% for '{product_info['name']}' due to high demand",
-                            'product': product_info['name']
-                        })
-                except:
-                    pass
+
+        spikes = sales_spikes.detect(db)
+
+        # Names normally come from the sale lines; look up any missing ones in one query
+        missing = [s['product_id'] for s in spikes if not s['product_name'] and ObjectId.is_valid(s['product_id'])]
+        names = {}
+        if missing:
+            names = {str(p['_id']): p.get('name') for p in
+                     db.products_update.find({'_id': {'$in': [ObjectId(pid) for pid in missing]}}, {'name': 1})}
+
+        forecasts = demand_forecast.for_products(db, [s['product_id'] for s in spikes]) if spikes else {}
+
+        for spike in spikes:
+            name = spike['product_name'] or names.get(spike['product_id'])
+            if not name:
+                continue
+            forecast = forecasts.get(spike['product_id'])
+            alerts.append({
+                'type': 'sales_spike',
+                'priority': 'high',
+                'message': f"📈 Sales spike detected for '{name}' - {spike['units']} units today vs {spike['baseline']:.1f} daily average",
+                'recommendation': (_forecast_advice(forecast) if forecast else
+                                   f"Consider increasing stock by 40% for '{name}' due to high demand"),
+                'product': name
+            })
+
+        # Variants whose stock runs out before a reorder placed today would arrive
+        for forecast in demand_forecast.restock(db, 5):
+            if forecast['days_of_cover'] > demand_forecast.LEAD_DAYS:
+                break
+            name = forecast['product_name']
+            label = f"{name} ({forecast['variant']})" if forecast.get('variant') else name
+            alerts.append({
+                'type': 'restock_forecast',
+                'priority': 'high',
+                'message': f"📦 '{label}' runs out in about {forecast['days_of_cover']:.0f} days - {forecast['stock']} in stock, {forecast['demand_7d']:.0f} forecast to sell in 7 days",
+                'recommendation': f"Reorder {forecast['reorder_qty']} units of '{label}'",
+                'product': name
+            })
     
     except Exception as e:
         debug_log(f"Error in inventory alerts: {e}")
@@ -770,15 +817,18 @@ def send_email(to_email, subject, html_body):
         return False, err
 
 
-# ── In-memory bulk-send job tracker ───────────────────────────────────────────
-_bulk_jobs: dict = {}  # job_id -> {status, sent, failed, total, error, done}
+# ── Bulk-send job tracker ─────────────────────────────────────────────────────
+# job_id -> {status, sent, failed, total, error, done}; read from L2 on every poll,
+# so the status endpoint works whichever worker serves it. The sending thread
+# owns its job dict and only publishes copies here, so a failed cache write
+# can never lose its counts.
+bulk_jobs = shared_cache.SharedCache('bulk_jobs', cache_backend, ttl=24 * 3600, l1_ttl=0)
 
-def _run_bulk_send(job_id: str, recipient_list: list, subject: str,
+def _run_bulk_send(job_id: str, job: dict, recipient_list: list, subject: str,
                    html_body: str, recipient_type: str, invalid_count: int,
                    body_preview: str):
     # Background thread: open ONE SMTP connection, send all messages, log result.
     import uuid as _uuid
-    job = _bulk_jobs[job_id]
     try:
         smtp_server   = os.getenv('SMTP_SERVER')
         smtp_port     = int(os.getenv('SMTP_PORT', 587))
@@ -800,11 +850,13 @@ def _run_bulk_send(job_id: str, recipient_list: list, subject: str,
                 msg.attach(MIMEText(html_body, 'html'))
                 server.send_message(msg)
                 job['sent'] += 1
+                bulk_jobs.set(job_id, dict(job))
             except Exception as e:
                 err_str = str(e)
                 job['failed'] += 1
                 if not job['error']:
                     job['error'] = err_str
+                bulk_jobs.set(job_id, dict(job))
                 # Gmail 550 daily limit — no point continuing, all will fail
                 if '550' in err_str and ('limit' in err_str.lower() or '5.4.5' in err_str):
                     remaining = len(recipient_list) - job['sent'] - job['failed']
@@ -827,6 +879,7 @@ def _run_bulk_send(job_id: str, recipient_list: list, subject: str,
     finally:
         job['status'] = 'done'
         job['done']   = True
+        bulk_jobs.set(job_id, dict(job))
         # Log result to MongoDB
         try:
             if email_logs is not None:
@@ -856,6 +909,7 @@ def safe_float(value, default=0.0):
 
 def calculate_sale_amount(sale):
     # Safely calculate sale amount from either total_price or price * quantity
+    # (sales_analytics.sale_amount_stages() applies the same rule inside a pipeline)
     try:
         # If total_price exists and is valid, use it
         if sale.get('total_price'):
@@ -913,6 +967,151 @@ else:
     carts = None
     print("Warning: Database collections not initialized due to connection failure.")
 
+def record_sale(lines, channel, header=None):
+    # Record an order's sale lines through sale_events: the sales facts, their
+    # legacy copies and every summary folded from user_data_bought (rollups,
+    # demand EWMAs, top-K, order digests, cohorts). A summary failure is logged
+    # but never fails the checkout; `python sale_events.py --rebuild` repairs
+    # them. Callers bump their own result-cache generations via data_changed.
+    if db is None or not lines:
+        return
+    sale_events.record_order(db, lines, channel, header=header, bump=False)
+    if sales_column_store is not None and 'user_data_bought' in sales_facts.CHANNELS[channel]:
+        sales_column_store.mark_stale()
+
+
+def stock_changed(source, product_ids):
+    # Refresh the low-stock view for products whose stock was just written
+    # (see low_stock.py). A failure is logged; the reconciler repairs it.
+    if db is None:
+        return
+    try:
+        low_stock.sync(db, source, product_ids)
+    except Exception as e:
+        print(f"Error updating the low-stock view: {e}")
+
+
+def variant_stock_changed(source, product, variant_index, old_stock, new_stock):
+    # Fold one variant's stock change into the inventory summary (see
+    # inventory_summary.py). A failure is logged; the reconciler reports the drift.
+    if db is None or product is None:
+        return
+    try:
+        inventory_summary.record_variant(db, source, product, variant_index, old_stock, new_stock)
+    except Exception as e:
+        print(f"Error updating the inventory summary: {e}")
+
+
+def product_changed(source, before=None, after=None):
+    # Fold a product insert, merge or delete into the inventory summary
+    if db is None:
+        return
+    try:
+        inventory_summary.record_product(db, source, before, after)
+    except Exception as e:
+        print(f"Error updating the inventory summary: {e}")
+
+
+def adjust_variant_stock(collection, product_id, variant_index, delta, min_stock=None):
+    # $inc one variant's stock and fold the exact change into the inventory
+    # summary. With `min_stock`, only while the variant still holds at least
+    # that much (checked atomically). Returns the product as it was before
+    # the update, or None if nothing was updated.
+    query = {'_id': product_id}
+    if min_stock is not None:
+        query[f'variants.{variant_index}.stock'] = {'$gte': min_stock}
+    before = collection.find_one_and_update(
+        query,
+        {'$inc': {f'variants.{variant_index}.stock': delta}},
+        projection={'category': 1, 'variants': 1},
+    )
+    if before is not None:
+        variants = before.get('variants') or []
+        old_stock = variants[variant_index].get('stock', 0) if variant_index < len(variants) else 0
+        variant_stock_changed(collection.name, before, variant_index, old_stock, int(old_stock or 0) + delta)
+    return before
+
+
+# Analytics results, valid until a collection they read is written (see result_cache.py)
+analytics_cache = result_cache.ResultCache(store=cache_backend)
+
+# Per-day products_sold partials for closed days (see closed_periods.py)
+closed_day_cache = closed_periods.ClosedDayCache()
+
+def sales_range(start_date, end_date):
+    # Merged products_sold figures for [start_date, end_date]: closed days from
+    # the cache, today computed live.
+    return closed_periods.merge(
+        closed_periods.range_parts(db, closed_day_cache, start_date.date(), end_date.date()))
+
+def data_changed(*names):
+    # Invalidate cached analytics that read any of `names`; call after writing to them.
+    if db is None:
+        return
+    try:
+        result_cache.bump(db, *names)
+    except Exception as e:
+        print(f"Error bumping data generation for {names}: {e}")
+
+
+# Optional in-memory columnar copy of user_data_bought (SALES_COLUMN_CACHE=1, needs NumPy)
+sales_column_store = sales_columns.SalesColumns() if sales_columns.enabled() else None
+
+def start_sales_column_loader() -> None:
+    # Load the columnar sales cache in the background; readers use the rollups until it is ready.
+    if sales_column_store is None or db is None:
+        return
+
+    def _runner():
+        try:
+            started = time.time()
+            if sales_column_store.load(db):
+                print(f"Sales column cache loaded: {sales_column_store.n:,} rows in {time.time() - started:.1f}s")
+        except Exception as e:
+            print(f"Error loading sales column cache: {e}")
+
+    threading.Thread(target=_runner, daemon=True).start()
+
+
+start_sales_column_loader()
+
+# Seconds between sweeps for sale facts whose projection a crash left unfinished
+SALES_PROJECTOR_INTERVAL = int(os.getenv('SALES_PROJECTOR_INTERVAL', '60'))
+
+def start_sales_projector(interval_seconds: int = SALES_PROJECTOR_INTERVAL) -> None:
+    # Finish projecting pending sale facts into the legacy sales collections.
+    def _runner():
+        while True:
+            try:
+                if db is not None:
+                    written = sales_facts.project_pending(db)
+                    if written:
+                        data_changed(*written)
+                        if sales_column_store is not None:
+                            sales_column_store.mark_stale()
+                        debug_log(f"[SALES PROJECTOR] Projected pending sales into {sorted(written)}")
+            except Exception as e:
+                debug_log(f"[SALES PROJECTOR] Error projecting pending sales: {e}")
+            time.sleep(interval_seconds)
+
+    threading.Thread(target=_runner, daemon=True).start()
+
+
+if BACKGROUND_JOBS:
+    start_sales_projector()
+
+def sales_reader():
+    # Reader for sales totals / trends / rankings: the in-memory columns when
+    # loaded and within their staleness bound, otherwise the MongoDB rollups.
+    if sales_column_store is not None:
+        try:
+            store = sales_column_store.fresh(db)
+            if store is not None:
+                return store
+        except Exception as e:
+            print(f"Sales column cache unavailable, using rollups: {e}")
+    return sales_rollups.RollupReader(db)
+
 # Custom template filters
 @app.template_filter('safe_sum')
 def safe_sum(variants, attribute):
@@ -1192,19 +1391,10 @@ def build_dashboard_context():
         # Get current date for calculations
         today = datetime.datetime.now().replace(hour=0, minute=0, second=0)
 
-        # Use user_data_bought (the actual sales collection with purchase_date)
-        total_sales_result = list(user_data_bought.aggregate([
-            {'$match': {'total': {'$exists': True, '$ne': None}}},
-            {'$group': {'_id': None, 'total': {'$sum': '$total'}}}
-        ])) if user_data_bought is not None else []
-        total_sales = float(total_sales_result[0]['total']) if total_sales_result else 0.0
-
-        # Calculate today's sales using purchase_date field
-        sales_today_result = list(user_data_bought.aggregate([
-            {'$match': {'purchase_date': {'$gte': today}, 'total': {'$exists': True, '$ne': None}}},
-            {'$group': {'_id': None, 'total': {'$sum': '$total'}}}
-        ])) if user_data_bought is not None else []
-        sales_today = float(sales_today_result[0]['total']) if sales_today_result else 0.0
+        # Sales figures come from the in-memory columns or the daily rollups of user_data_bought
+        sales = sales_reader()
+        total_sales = sales.period_totals()['revenue']
+        sales_today = sales.period_totals(today, today)['revenue']
 
         # Get statistics - optimized queries
         _u_count = (users.count_documents({}) if users is not None else 0) + \
@@ -1220,46 +1410,27 @@ def build_dashboard_context():
             'active_workers': workers_update.count_documents({'last_active': {'$gte': datetime.datetime.now() - datetime.timedelta(hours=24)}}) if workers_update is not None else 0
         }
 
-        # Calculate low stock products efficiently
-        low_stock_count = 0
-        if products_update is not None:
-            for product in products_update.find({}, {'variants': 1}):
-                for variant in product.get('variants', []):
-                    if isinstance(variant, dict) and variant.get('stock', 0) < 10:
-                        low_stock_count += 1
-        stats['low_stock_products'] = low_stock_count
-
-        # Get recent users with pagination support - from BOTH users and users_update
-        page = request.args.get('page', 1, type=int)
+        # Low-stock variants: one indexed count on the low-stock view
+        stats['low_stock_products'] = low_stock.count(db) if products_update is not None else 0
+
+        # Newest users first, from BOTH users and users_update: one keyset page
+        # heap-merged from the two collections (see keyset.py)
         per_page = 20  # Show 20 users per page
-        skip = (page - 1) * per_page
-
-        # Merge users from both collections
-        all_users_merged = []
-        seen_ids = set()
-        for col in [users, users_update]:
-            if col is not None:
-                for u in col.find().sort('_id', -1):
-                    uid_s = str(u['_id'])
-                    if uid_s not in seen_ids:
-                        seen_ids.add(uid_s)
-                        all_users_merged.append(u)
-
-        total_users_count = len(all_users_merged)
-        total_pages = (total_users_count + per_page - 1) // per_page if total_users_count else 0
-
-        # Apply pagination
-        paginated = all_users_merged[skip: skip + per_page]
+        try:
+            user_page = keyset.merged_page([users, users_update], per_page,
+                                           after=request.args.get('after'), before=request.args.get('before'))
+        except ValueError:
+            user_page = keyset.merged_page([users, users_update], per_page)
         recent_users = []
-        for user in paginated:
+        for user in user_page['items']:
             user['_id'] = str(user['_id'])
             recent_users.append(user)
 
         pagination = {
-            'page': page,
             'per_page': per_page,
-            'total': total_users_count,
-            'pages': total_pages
+            'total': _u_count,
+            'next': user_page['next'],
+            'prev': user_page['prev'],
         }
 
         # Get worker summary (show most recently created workers first)
@@ -1276,35 +1447,17 @@ def build_dashboard_context():
             'values': []
         }
 
-        # Last 7 days sales using user_data_bought
-        for i in range(6, -1, -1):
-            date = datetime.datetime.now() - datetime.timedelta(days=i)
-            start_date = date.replace(hour=0, minute=0, second=0)
-            end_date = date.replace(hour=23, minute=59, second=59)
+        # Last 7 days sales (one query, empty days filled)
+        for point in sales.trend(today - datetime.timedelta(days=6), today):
+            sales_data['dates'].append(point['bucket'].strftime('%m/%d'))
+            sales_data['values'].append(point['value'])
 
-            daily_result = list(user_data_bought.aggregate([
-                {'$match': {'purchase_date': {'$gte': start_date, '$lte': end_date}, 'total': {'$exists': True, '$ne': None}}},
-                {'$group': {'_id': None, 'total': {'$sum': '$total'}}}
-            ])) if user_data_bought is not None else []
-            daily_sales = float(daily_result[0]['total']) if daily_result else 0.0
-
-            sales_data['dates'].append(date.strftime('%m/%d'))
-            sales_data['values'].append(daily_sales)
-
-        # Category data for pie chart — from user_data_bought (all sales recorded here)
+        # Category data for pie chart — from the per-category rollups
         category_sales = {}
         try:
-            cat_pipeline = [
-                {'$match': {'total': {'$exists': True, '$ne': None}}},
-                {'$group': {
-                    '_id': {'$ifNull': ['$category', 'Other']},
-                    'total': {'$sum': '$total'}
-                }},
-                {'$sort': {'total': -1}}
-            ]
-            category_results = list(user_data_bought.aggregate(cat_pipeline)) if user_data_bought is not None else []
-            for result in category_results:
-                category_sales[result['_id'] or 'Other'] = float(result['total'])
+            for result in sales.top_keys('category'):
+                name = result['_id'] or 'Other'
+                category_sales[name] = category_sales.get(name, 0.0) + float(result['revenue'])
         except Exception as e:
             debug_log(f"Error in category aggregation: {str(e)}")
             category_sales = {'Other': total_sales}
@@ -1317,38 +1470,39 @@ def build_dashboard_context():
         # Top products (for reports) - from user_data_bought (all Tamil names)
         top_products = []
         try:
-            # Pull top products from user_data_bought (all Tamil names now)
-            top_products_results = list(user_data_bought.aggregate([
-                {'$group': {'_id': '$product_name', 'total_revenue': {'$sum': '$total'}, 'units_sold': {'$sum': '$quantity'}}},
-                {'$sort': {'total_revenue': -1}},
-                {'$limit': 8}
-            ])) if user_data_bought is not None else []
-            for result in top_products_results:
+            # All-time best sellers from the streaming top-K summaries (see sales_topk.py)
+            for result in sales_topk.top(db, 'product', 8):
                 product_name = result.get('_id', 'Unknown') or 'Unknown'
                 top_products.append({
                     'name': product_name,
-                    'units_sold': int(result.get('units_sold', 0)),
-                    'revenue': float(result.get('total_revenue', 0.0))
+                    'units_sold': int(result.get('units', 0)),
+                    'revenue': float(result.get('revenue', 0.0))
                 })
         except Exception as e:
             debug_log(f"Error in top products aggregation: {str(e)}")
             top_products = []
 
-        # Product summary for reports
+        # Most urgent restocks from the demand forecasts (see demand_forecast.py)
+        try:
+            restock_forecasts = demand_forecast.restock(db, 8)
+        except Exception as e:
+            debug_log(f"Error loading demand forecasts: {str(e)}")
+            restock_forecasts = []
+
+        # Product summary for reports: stock valuation is one read of the
+        # incrementally maintained summary (see inventory_summary.py)
         total_products = products_update.count_documents({}) if products_update is not None else 0
         total_stock_value = 0
         total_stock_quantity = 0
 
         if products_update is not None:
-            for product in products_update.find():
-                for variant in product.get('variants', []):
-                    if isinstance(variant, dict):
-                        stock = int(variant.get('stock', 0))
-                        # Cap display stock at 1024 for better readability
-                        stock = min(stock, 1024)
-                        price = float(variant.get('price', 0))
-                        total_stock_quantity += stock
-                        total_stock_value += stock * price
+            inventory = inventory_summary.read(db)['overall']
+            if inventory is None:
+                inventory_summary.reconcile(db, ['products_update'])
+                inventory = inventory_summary.read(db)['overall']
+            if inventory is not None:
+                total_stock_quantity = inventory['quantity']
+                total_stock_value = inventory['value']
 
         product_summary = {
             'total_products': total_products,
@@ -1377,6 +1531,7 @@ def build_dashboard_context():
             'sales_data': sales_data,
             'category_data': category_data,
             'top_products': top_products,
+            'restock_forecasts': restock_forecasts,
             'product_summary': product_summary
         }
 
@@ -1385,7 +1540,7 @@ def build_dashboard_context():
         return {
             'stats': {'total_users': 0, 'new_users_today': 0, 'total_sales': 0.0, 'sales_today': 0.0, 'total_products': 0, 'low_stock_products': 0, 'total_workers': 0, 'active_workers': 0},
             'recent_users': [],
-            'pagination': {'page': 1, 'per_page': 20, 'total': 0, 'pages': 0},
+            'pagination': {'per_page': 20, 'total': 0, 'next': None, 'prev': None},
             'workers_summary': [],
             'sales_data': {'dates': [], 'values': []},
             'category_data': {'labels': ['No Data'], 'values': [0]},
@@ -1472,6 +1627,7 @@ def add_worker():
         result = workers_update.insert_one(worker_data)
         
         if result.inserted_id:
+            data_changed('workers_update')
             # Prepare values for welcome email
             doj_str = doj.strftime('%B %d, %Y')
 
@@ -1519,71 +1675,19 @@ def user_details(user_id):
         
         user['_id'] = str(user['_id'])
         
-        # Get user's purchase history from both collections
-        uid_obj = ObjectId(user_id)
-        orders_from_sold   = list(products_sold.find({'user_id': uid_obj})) if products_sold is not None else []
-        orders_from_bought = list(user_data_bought.find({'user_id': uid_obj})) if user_data_bought is not None else []
+        # Totals, top products, monthly spend and one page of orders in one aggregation
+        per_page = 25
+        page = max(request.args.get('page', 1, type=int) or 1, 1)
+        history = sales_analytics.customer_history(db, ObjectId(user_id), page, per_page)
+        total_orders = history['total_orders']
+        total_spent = history['total_spent']
+        top_products = history['top_products']
 
-        # Merge, de-duplicate by order_id + product_id
-        seen = set()
-        user_orders = []
-        for order in orders_from_bought + orders_from_sold:
-            key = (str(order.get('order_id', '')), str(order.get('product_id', '')), str(order.get('variant_index', '')))
-            if key not in seen:
-                seen.add(key)
-                user_orders.append(order)
-
-        total_spent = 0
-        total_orders = len(user_orders)
-        
-        # Process orders and calculate statistics
-        product_purchases = {}
-        monthly_spending = {}
-        
+        user_orders = history['orders']
         for order in user_orders:
             order['_id'] = str(order['_id'])
             order['user_id'] = str(order['user_id'])
-            order['product_id'] = str(order['product_id'])
-
-            # Normalise total
-            order_total = float(order.get('total') or order.get('total_price') or
-                                 (float(order.get('price', 0)) * float(order.get('quantity', 1))))
-            total_spent += order_total
-            order['total'] = order_total
-
-            # Normalise date (supports both 'date' and 'purchase_date' fields)
-            order_date = order.get('purchase_date') or order.get('date') or datetime.datetime.now()
-            if isinstance(order_date, str):
-                try:
-                    order_date = datetime.datetime.fromisoformat(order_date.replace('Z', '+00:00'))
-                except Exception:
-                    order_date = datetime.datetime.now()
-            order['date'] = order_date          # ensure template always has .date
-
-            # Track product purchases
-            product_id = order['product_id']
-            if product_id not in product_purchases:
-                try:
-                    product = products_update.find_one({'_id': ObjectId(product_id)}) if products_update else None
-                except Exception:
-                    product = None
-                pname = (product['name'] if product else None) or order.get('product_name', 'Unknown')
-                product_purchases[product_id] = {'name': pname, 'quantity': 0, 'total_spent': 0}
 
-            try:
-                qty = int(float(order.get('quantity', 1)))
-            except Exception:
-                qty = 1
-            product_purchases[product_id]['quantity'] += qty
-            product_purchases[product_id]['total_spent'] += order_total
-
-            # Monthly spending
-            month_key = order_date.strftime('%Y-%m')
-            monthly_spending[month_key] = monthly_spending.get(month_key, 0) + order_total
-        
-        # Get top purchased products
-        top_products = sorted(product_purchases.values(), key=lambda x: x['total_spent'], reverse=True)[:5]
-        
         # Calculate user statistics
         user_stats = {
             'total_spent': total_spent,
@@ -1591,15 +1695,24 @@ def user_details(user_id):
             'average_order_value': total_spent / total_orders if total_orders > 0 else 0,
             'favorite_product': top_products[0]['name'] if top_products else 'None',
             'join_date': user.get('join_date', user.get('created_at', 'Unknown')),
-            'last_order': max([o['date'] for o in user_orders if isinstance(o.get('date'), datetime.datetime)], default='Never')
+            'last_order': history['last_order'] or 'Never'
         }
-        
+        pagination = {
+            'page': page,
+            'per_page': per_page,
+            'total': total_orders,
+            'total_pages': max((total_orders + per_page - 1) // per_page, 1),
+        }
+        if page > pagination['total_pages']:
+            return redirect(url_for('user_details', user_id=user_id, page=pagination['total_pages']))
+
         return render_template('user_detail.html', 
                              user=user, 
                              user_orders=user_orders,
                              user_stats=user_stats,
                              top_products=top_products,
-                             monthly_spending=monthly_spending)
+                             monthly_spending=history['monthly_spending'],
+                             pagination=pagination)
     
     except Exception as e:
         print(f"Error in user details: {e}")
@@ -1789,20 +1902,12 @@ def admin_chat():
         return jsonify({'response': 'Sorry, I encountered an error processing your request.'})
 
 # ─── Fast chatbot cache ────────────────────────────────────────────────────────
-_chat_cache: dict = {}          # key -> (reply_str, expire_timestamp)
 _CHAT_TTL    = 90               # seconds each cached answer stays valid
+chat_cache = shared_cache.SharedCache('chat', cache_backend, ttl=_CHAT_TTL)
 
 def _cached_call(key: str, fn):
     # Return cached result if fresh, else call fn(), cache and return result.
-    import time
-    now = time.time()
-    if key in _chat_cache:
-        reply, exp = _chat_cache[key]
-        if now < exp:
-            return reply
-    result = fn()
-    _chat_cache[key] = (result, now + _CHAT_TTL)
-    return result
+    return chat_cache.get_or_set(key, fn)
 # ──────────────────────────────────────────────────────────────────────────────
 
 
@@ -1862,10 +1967,10 @@ def get_sales_summary():
     # Get sales summary for chatbot (plain text, no emojis/HTML).
     try:
         today = datetime.datetime.now().replace(hour=0, minute=0, second=0)
-        total_sales = sum(float(calculate_sale_amount(sale)) for sale in products_sold.find())
-        today_sales = sum(float(calculate_sale_amount(sale)) for sale in products_sold.find({
-            'date': {'$gte': today}
-        }))
+        # All-time and today's revenue in one aggregation
+        totals = sales_analytics.legacy_totals(products_sold, since=today)
+        total_sales = totals['revenue']
+        today_sales = totals['since_revenue']
 
         growth = ((today_sales / (total_sales - today_sales)) * 100) if (total_sales - today_sales) > 0 else 0.0
 
@@ -1902,24 +2007,19 @@ def get_product_summary():
     # Get product summary for chatbot (plain text).
     try:
         total_products = products_update.count_documents({})
-        low_stock = sum(
-            1
-            for product in products_update.find()
-            for variant in product.get('variants', [])
-            if isinstance(variant, dict) and variant.get('stock', 0) < 10
-        )
+        low_stock_count = low_stock.count(db)
 
         status_line = (
-            f"Attention needed for {low_stock} items!"
-            if low_stock > 0
+            f"Attention needed for {low_stock_count} items!"
+            if low_stock_count > 0
             else "All products well stocked."
         )
 
         return (
             "Inventory Status:\n\n"
             f"Total Products: {total_products}\n"
-            f"Low Stock Items: {low_stock}\n"
-            f"Well Stocked: {total_products - low_stock}\n\n"
+            f"Low Stock Items: {low_stock_count}\n"
+            f"Well Stocked: {total_products - low_stock_count}\n\n"
             f"{status_line}"
         )
     except Exception:
@@ -1948,21 +2048,15 @@ def get_worker_summary():
 def get_top_products_summary():
     # Get top products summary for chatbot (plain text).
     try:
-        product_sales = {}
-        for sale in products_sold.find():
-            product_id = sale['product_id']
-            if product_id not in product_sales:
-                product = products_update.find_one({'_id': ObjectId(product_id)})
-                if product:
-                    product_sales[product_id] = {
-                        'name': product['name'],
-                        'revenue': 0
-                    }
-            
-            if product_id in product_sales:
-                product_sales[product_id]['revenue'] += float(calculate_sale_amount(sale))
-        
-        top_3 = sorted(product_sales.values(), key=lambda x: x['revenue'], reverse=True)[:3]
+        # Exact revenue per product over products_sold, best first; as before, only
+        # products still in products_update count (names in one batched lookup)
+        ranked = list(products_sold.aggregate(sales_analytics.sale_amount_stages() + [
+            {'$group': {'_id': '$product_id', 'revenue': {'$sum': '$sale_amount'}}},
+            {'$sort': {'revenue': -1, '_id': 1}},
+        ], allowDiskUse=True))
+        names = sales_analytics.fetch_by_id(products_update, [r['_id'] for r in ranked], {'name': 1})
+        top_3 = [{'name': names[str(r['_id'])]['name'], 'revenue': float(r['revenue'])}
+                 for r in ranked if str(r['_id']) in names][:3]
 
         response = "Top Performing Products:\n\n"
         for i, product in enumerate(top_3, 1):
@@ -1975,22 +2069,15 @@ def get_top_products_summary():
 def get_low_stock_summary():
     # Get low stock summary for chatbot (plain text).
     try:
-        low_stock_items = []
-        for product in products_update.find():
-            for variant in product.get('variants', []):
-                if isinstance(variant, dict) and variant.get('stock', 0) < 10:
-                    low_stock_items.append({
-                        'name': product['name'],
-                        'variant': variant.get('size', 'Default'),
-                        'stock': variant.get('stock', 0)
-                    })
+        # Five most urgent from the low-stock view, plus its indexed count
+        low_stock_items = low_stock.items(db, 5)
         
         if low_stock_items:
             response = "Low Stock Alert:\n\n"
-            for item in low_stock_items[:5]:  # Show top 5
-                response += f"• {item['name']} ({item['variant']}) - {item['stock']} left\n"
+            for item in low_stock_items:
+                response += f"• {item['product_name']} ({item['variant'] or 'Default'}) - {item['stock']} left\n"
             
-            return response + f"\n{len(low_stock_items)} items need restocking."
+            return response + f"\n{low_stock.count(db)} items need restocking."
         else:
             return "Great news! All products are well stocked. No immediate restocking needed."
     except Exception:
@@ -2002,24 +2089,26 @@ def get_recent_activity_summary():
         today = datetime.datetime.now().replace(hour=0, minute=0, second=0)
         
         new_users = users.count_documents({'created_at': {'$gte': today}})
-        today_sales = list(products_sold.find({'date': {'$gte': today}}))
-        today_revenue = sum(float(calculate_sale_amount(sale)) for sale in today_sales)
+        today_totals = sales_analytics.legacy_totals(products_sold, match={'date': {'$gte': today}})
+        orders_today = today_totals['lines']
+        today_revenue = today_totals['revenue']
 
-        mood = "Busy day ahead!" if len(today_sales) > 5 else "Steady progress."
+        mood = "Busy day ahead!" if orders_today > 5 else "Steady progress."
 
         return (
             "Today's Activity:\n\n"
             f"New Registrations: {new_users}\n"
-            f"Orders Placed: {len(today_sales)}\n"
+            f"Orders Placed: {orders_today}\n"
             f"Revenue Generated: ${today_revenue:.2f}\n\n"
             f"{mood}"
         )
     except Exception:
         return "Unable to fetch recent activity data at the moment."
 
-# Auto-refresh functionality
-auto_refresh_cache = {}
-cache_lock = threading.Lock()
+# Auto-refresh functionality: stats shared by every worker, refreshed by whichever
+# worker takes the lease first each period
+AUTO_REFRESH_SECONDS = 900
+auto_refresh_cache = shared_cache.SharedCache('auto_refresh', cache_backend, l1_ttl=60)
 
 def refresh_data_cache():
     # Background function to refresh data cache every 15 minutes
@@ -2028,28 +2117,33 @@ def refresh_data_cache():
             # Skip refresh if database is not connected
             if db is None or users is None:
                 print("Skipping cache refresh - database not connected")
-                time.sleep(900)
+                time.sleep(AUTO_REFRESH_SECONDS)
                 continue
+
+            # Another worker already refreshed this period
+            if not auto_refresh_cache.compare_and_swap('refresh_lease', None, os.getpid(),
+                                                       ttl=AUTO_REFRESH_SECONDS - 60):
+                time.sleep(AUTO_REFRESH_SECONDS)
+                continue
+
+            print("Refreshing data cache...")
                 
-            with cache_lock:
-                print("Refreshing data cache...")
-                
-                # Cache statistics
-                auto_refresh_cache['stats'] = {
-                    'total_users': users.count_documents({}),
-                    'total_sales': float(sum(float(calculate_sale_amount(sale)) for sale in products_sold.find())),
-                    'total_products': products_update.count_documents({}),
-                    'total_workers': workers_update.count_documents({})
-                }
-                
-                auto_refresh_cache['last_updated'] = datetime.datetime.now()
-                print("Data cache refreshed successfully")
+            # Cache statistics
+            auto_refresh_cache.set('stats', {
+                'total_users': users.count_documents({}),
+                'total_sales': sales_analytics.legacy_totals(products_sold)['revenue'],
+                'total_products': products_update.count_documents({}),
+                'total_workers': workers_update.count_documents({})
+            })
+            
+            auto_refresh_cache.set('last_updated', datetime.datetime.now())
+            print("Data cache refreshed successfully")
                 
         except Exception as e:
             print(f"Error refreshing cache: {e}")
         
         # Wait 15 minutes (900 seconds)
-        time.sleep(900)
+        time.sleep(AUTO_REFRESH_SECONDS)
 
 def start_auto_refresh_thread():
     # Start the auto-refresh background thread
@@ -2061,12 +2155,121 @@ def start_auto_refresh_thread():
 @admin_required
 def cache_status():
     # Get cache status for debugging
-    with cache_lock:
-        return jsonify({
-            'cache_size': len(auto_refresh_cache),
-            'last_updated': auto_refresh_cache.get('last_updated'),
-            'stats': auto_refresh_cache.get('stats', {})
-        })
+    last_updated = auto_refresh_cache.get('last_updated')
+    stats = auto_refresh_cache.get('stats')
+    return jsonify({
+        'cache_size': (last_updated is not None) + (stats is not None),
+        'last_updated': last_updated,
+        'stats': stats or {},
+        'sales_columns': sales_column_store.stats() if sales_column_store is not None else {'enabled': False},
+        'result_cache': analytics_cache.stats(),
+        'closed_days': closed_day_cache.stats(),
+        'shared_cache': {cache.namespace: cache.stats()
+                         for cache in (chat_cache, bulk_jobs, auto_refresh_cache, job_leases)}
+    })
+
+def _business_stats(days):
+    # Home-page business stats for the last `days` days (served through analytics_cache).
+    now          = datetime.datetime.now()
+    today        = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    period_start = now - datetime.timedelta(days=days)
+
+    # Totals, trends and rankings: in-memory columns if loaded, else the rollups
+    sales = sales_reader()
+
+    # ── ALL-TIME total revenue (no date filter) ─────────────────────
+    alltime              = sales.period_totals()
+    total_sales          = alltime['revenue']
+    total_purchase_count = alltime['orders']
+
+    # ── revenue for the selected period (used for avg order value) ──
+    period         = sales.period_totals(period_start, today)
+    period_revenue = period['revenue']
+    period_orders  = period['orders']
+
+    # ── today's sales (always fixed to today regardless of period) ─
+    today_totals = sales.period_totals(today, today)
+    sales_today  = today_totals['revenue']
+
+    print(f"[Analytics] Period={days}d, Revenue=Rs {total_sales:.2f}, Today=Rs {sales_today:.2f}")
+
+    # ── orders in selected period ───────────────────────────────────
+    total_orders  = period_orders
+    orders_today  = today_totals['orders']
+
+    # ── unique products ─────────────────────────────────────────────
+    unique_products = set()
+    for col in [products, products_update, products_by_user]:
+        if col is not None:
+            for p in col.find({}, {'name': 1}):
+                if 'name' in p:
+                    unique_products.add(p['name'])
+    total_products = len(unique_products)
+
+    # ── active / total users ────────────────────────────────────────
+    active_users_count = 0
+    total_users_count  = 0
+    new_users_today    = 0
+    for col in [users, users_update]:
+        if col is not None:
+            active_users_count += col.count_documents({})
+            total_users_count  += col.count_documents({})
+    if users is not None:
+        new_users_today = users.count_documents({'created_at': {'$gte': today}})
+
+    # ── top products for the selected period ────────────────────────
+    top_products = [
+        {'name': p['_id'], 'revenue': float(p.get('revenue', 0)), 'units': int(p.get('units', 0))}
+        for p in sales_topk.top(db, 'product', 8, period_start)
+    ]
+
+    # ── top users by spending (streaming top-K, no scan) ─────────────
+    top_users = [
+        {
+            'name':   (u['_id'] or 'Guest'),
+            'spent':  float(u.get('revenue', 0)),
+            'orders': int(u.get('orders', 0))
+        }
+        for u in sales_topk.top(db, 'user', 5, period_start)
+    ]
+
+    # ── sales trend (daily for ≤30d; weekly for >30d) ───────────────
+    trend_unit  = 'day' if days <= 30 else 'week'
+    sales_trend = [
+        {'date': p['bucket'].strftime('%d %b'), 'sales': p['value']}
+        for p in sales.trend(today - datetime.timedelta(days=days - 1), today, trend_unit)
+    ]
+
+    # ── category breakdown for the selected period ──────────────────
+    category_breakdown = [
+        {'name': c['_id'] if c['_id'] else 'Uncategorized', 'total': float(c.get('revenue', 0)), 'count': int(c.get('orders', 0))}
+        for c in sales.top_keys('category', period_start, today, limit=8)
+    ]
+
+    stats = {
+        'days':             days,
+        'total_users':      total_users_count,
+        'new_users_today':  new_users_today,
+        'active_users':     active_users_count,
+        'total_sales':      total_sales,          # all-time
+        'total_revenue':    total_sales,
+        'period_revenue':   period_revenue,       # for selected range
+        'sales_today':      sales_today,
+        'total_orders':     total_purchase_count, # all-time
+        'period_orders':    period_orders,        # for selected range
+        'orders_today':     orders_today,
+        'total_products':   total_products,
+        'total_workers':    workers_update.count_documents({}) if workers_update is not None else 0,
+        'top_products':     top_products,
+        'top_users':        top_users,
+        'sales_trend':      sales_trend,
+        'category_breakdown': category_breakdown,
+        'category_sales':   category_breakdown,   # legacy alias
+        'avg_order_value':  round(period_revenue / period_orders, 2) if period_orders > 0 else 0,
+        'total_purchases':  total_purchase_count,
+    }
+
+    return stats
 
 # API endpoint for business stats (for home page)
 @app.route('/api/business-stats')
@@ -2087,159 +2290,11 @@ def business_stats_api():
         if days not in (7, 30, 90, 365):
             days = 30
 
-        now          = datetime.datetime.now()
-        today        = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        period_start = now - datetime.timedelta(days=days)
-
-        # ── ALL-TIME total revenue (no date filter) ─────────────────────
-        alltime_result = list(user_data_bought.aggregate([
-            {'$match': {'total': {'$exists': True, '$ne': None}}},
-            {'$group': {'_id': None, 'total_revenue': {'$sum': '$total'}, 'count': {'$sum': 1}}}
-        ]))
-        total_sales          = float(alltime_result[0]['total_revenue']) if alltime_result else 0.0
-        total_purchase_count = int(alltime_result[0]['count']) if alltime_result else 0
-
-        # ── revenue for the selected period (used for avg order value) ──
-        period_sales_pipeline = [
-            {'$match': {'purchase_date': {'$gte': period_start}, 'total': {'$exists': True, '$ne': None}}},
-            {'$group': {'_id': None, 'total_revenue': {'$sum': '$total'}, 'count': {'$sum': 1}}}
-        ]
-        period_result  = list(user_data_bought.aggregate(period_sales_pipeline))
-        period_revenue = float(period_result[0]['total_revenue']) if period_result else 0.0
-        period_orders  = int(period_result[0]['count']) if period_result else 0
-
-        # ── today's sales (always fixed to today regardless of period) ─
-        sales_today_result = list(user_data_bought.aggregate([
-            {'$match': {'purchase_date': {'$gte': today}, 'total': {'$exists': True, '$ne': None}}},
-            {'$group': {'_id': None, 'total': {'$sum': '$total'}}}
-        ]))
-        sales_today = float(sales_today_result[0]['total']) if sales_today_result else 0.0
-
-        print(f"[Analytics] Period={days}d, Revenue=Rs {total_sales:.2f}, Today=Rs {sales_today:.2f}")
-
-        # ── orders in selected period ───────────────────────────────────
-        total_orders  = user_data_bought.count_documents({'purchase_date': {'$gte': period_start}}) if user_data_bought is not None else 0
-        orders_today  = user_data_bought.count_documents({'purchase_date': {'$gte': today}})        if user_data_bought is not None else 0
-
-        # ── unique products ─────────────────────────────────────────────
-        unique_products = set()
-        for col in [products, products_update, products_by_user]:
-            if col is not None:
-                for p in col.find({}, {'name': 1}):
-                    if 'name' in p:
-                        unique_products.add(p['name'])
-        total_products = len(unique_products)
-
-        # ── active / total users ────────────────────────────────────────
-        active_users_count = 0
-        total_users_count  = 0
-        new_users_today    = 0
-        for col in [users, users_update]:
-            if col is not None:
-                active_users_count += col.count_documents({})
-                total_users_count  += col.count_documents({})
-        if users is not None:
-            new_users_today = users.count_documents({'created_at': {'$gte': today}})
-
-        # ── top products for the selected period ────────────────────────
-        top_products_result = list(user_data_bought.aggregate([
-            {'$match': {'purchase_date': {'$gte': period_start}, 'total': {'$exists': True, '$ne': None}}},
-            {'$group': {'_id': '$product_name', 'total_revenue': {'$sum': '$total'}, 'units_sold': {'$sum': '$quantity'}}},
-            {'$sort': {'total_revenue': -1}},
-            {'$limit': 8}
-        ]))
-        top_products = [
-            {'name': p['_id'], 'revenue': float(p.get('total_revenue', 0)), 'units': int(p.get('units_sold', 0))}
-            for p in top_products_result
-        ]
-
-        # ── top users by spending ────────────────────────────────────────
-        top_users_result = list(user_data_bought.aggregate([
-            {'$match': {'purchase_date': {'$gte': period_start}, 'total': {'$exists': True, '$ne': None}}},
-            {'$group': {
-                '_id': '$user_name',
-                'total_spent': {'$sum': '$total'},
-                'order_count': {'$sum': 1}
-            }},
-            {'$sort': {'total_spent': -1}},
-            {'$limit': 5}
-        ]))
-        top_users = [
-            {
-                'name':   (u['_id'] or 'Guest'),
-                'spent':  float(u.get('total_spent', 0)),
-                'orders': int(u.get('order_count', 0))
-            }
-            for u in top_users_result
-        ]
-
-        # ── sales trend (daily for ≤30d; weekly for >30d) ───────────────
-        sales_trend = []
-        if days <= 30:
-            # Daily data points
-            for i in range(days - 1, -1, -1):
-                d     = now - datetime.timedelta(days=i)
-                start = d.replace(hour=0, minute=0, second=0, microsecond=0)
-                end   = d.replace(hour=23, minute=59, second=59, microsecond=999999)
-                res   = list(user_data_bought.aggregate([
-                    {'$match': {'purchase_date': {'$gte': start, '$lte': end}, 'total': {'$exists': True, '$ne': None}}},
-                    {'$group': {'_id': None, 'total': {'$sum': '$total'}}}
-                ]))
-                sales_trend.append({
-                    'date':  d.strftime('%d %b'),
-                    'sales': float(res[0]['total']) if res else 0.0
-                })
-        else:
-            # Weekly data points (group by ISO week)
-            num_weeks = days // 7
-            for w in range(num_weeks - 1, -1, -1):
-                start = today - datetime.timedelta(days=(w + 1) * 7 - 1)
-                end   = today - datetime.timedelta(days=w * 7)
-                end   = end.replace(hour=23, minute=59, second=59, microsecond=999999)
-                res   = list(user_data_bought.aggregate([
-                    {'$match': {'purchase_date': {'$gte': start, '$lte': end}, 'total': {'$exists': True, '$ne': None}}},
-                    {'$group': {'_id': None, 'total': {'$sum': '$total'}}}
-                ]))
-                sales_trend.append({
-                    'date':  start.strftime('%d %b'),
-                    'sales': float(res[0]['total']) if res else 0.0
-                })
-
-        # ── category breakdown for the selected period ──────────────────
-        category_result = list(user_data_bought.aggregate([
-            {'$match': {'purchase_date': {'$gte': period_start}, 'total': {'$exists': True, '$ne': None}}},
-            {'$group': {'_id': '$category', 'total_revenue': {'$sum': '$total'}, 'count': {'$sum': 1}}},
-            {'$sort': {'total_revenue': -1}},
-            {'$limit': 8}
-        ]))
-        category_breakdown = [
-            {'name': c['_id'] if c['_id'] else 'Uncategorized', 'total': float(c.get('total_revenue', 0)), 'count': int(c.get('count', 0))}
-            for c in category_result
-        ]
-
-        stats = {
-            'days':             days,
-            'total_users':      total_users_count,
-            'new_users_today':  new_users_today,
-            'active_users':     active_users_count,
-            'total_sales':      total_sales,          # all-time
-            'total_revenue':    total_sales,
-            'period_revenue':   period_revenue,       # for selected range
-            'sales_today':      sales_today,
-            'total_orders':     total_purchase_count, # all-time
-            'period_orders':    period_orders,        # for selected range
-            'orders_today':     orders_today,
-            'total_products':   total_products,
-            'total_workers':    workers_update.count_documents({}) if workers_update is not None else 0,
-            'top_products':     top_products,
-            'top_users':        top_users,
-            'sales_trend':      sales_trend,
-            'category_breakdown': category_breakdown,
-            'category_sales':   category_breakdown,   # legacy alias
-            'avg_order_value':  round(period_revenue / period_orders, 2) if period_orders > 0 else 0,
-            'total_purchases':  total_purchase_count,
-        }
-
+        stats = analytics_cache.get_or_compute(
+            db, 'business_stats', {'days': days},
+            ('user_data_bought', 'users', 'users_update', 'products', 'products_update',
+             'products_by_user', 'workers_update'),
+            lambda: _business_stats(days))
         return jsonify(stats)
     except Exception as e:
         print(f"Error getting business stats: {e}")
@@ -2405,6 +2460,64 @@ def users_list_api():
         print(f"Error getting users list: {e}")
         return jsonify([])
 
+def _analytics_summary(start_date, end_date, product_ids, user_ids, approx_customers):
+    # Real (non-demo) metrics behind /api/analytics; served through analytics_cache.
+    if not product_ids and not user_ids:
+        # Unfiltered: merge cached closed-day partials with today's
+        summary = sales_analytics.merged_summary(db, sales_range(start_date, end_date))
+    else:
+        base_match = {
+            'date': {'$gte': start_date, '$lte': end_date},
+            'total': {'$ne': None}
+        }
+        if product_ids:
+            base_match['product_id'] = {'$in': product_ids}
+        if user_ids:
+            base_match['user_id'] = {'$in': user_ids}
+
+        # Every sales metric for the period from one $facet pass over products_sold
+        summary = sales_analytics.period_summary(products_sold, base_match,
+                                                 count_customers=not approx_customers)
+    if approx_customers:
+        active_customers = customer_sketches.distinct_customers(db, start_date, end_date)
+    else:
+        active_customers = summary['active_customers']
+    category_sales_list = summary['category_sales']
+    sales_map = summary['sales_by_day']
+
+    # New customers in period - with user filter if specified
+    new_customers_query = {'created_at': {'$gte': start_date, '$lte': end_date}}
+    if user_ids:
+        new_customers_query['_id'] = {'$in': [ObjectId(uid) for uid in user_ids]}
+    new_customers = users.count_documents(new_customers_query)
+
+    # Fill in all dates including zeros
+    sales_trend = []
+    current_date = start_date
+    while current_date <= end_date:
+        date_key = current_date.strftime('%Y-%m-%d')
+        sales_trend.append({
+            'date': current_date.strftime('%m/%d'),
+            'sales': sales_map.get(date_key, 0.0)
+        })
+        current_date += datetime.timedelta(days=1)
+
+    return {
+        'total_revenue': summary['total_revenue'],
+        'total_orders': summary['total_orders'],
+        'total_units': summary['total_units'],
+        'avg_order_value': summary['avg_order_value'],
+        'active_customers': active_customers,
+        'new_customers': new_customers,
+        'top_category': category_sales_list[0]['category'] if category_sales_list else None,
+        'top_category_revenue': category_sales_list[0]['revenue'] if category_sales_list else 0,
+        'top_products': summary['top_products'],
+        'all_products': summary['all_products'],
+        'category_sales': category_sales_list,
+        'top_customers': summary['top_customers'],
+        'sales_trend': sales_trend,
+    }
+
 @app.route('/api/analytics')
 def analytics_api():
     try:
@@ -2423,217 +2536,33 @@ def analytics_api():
         products_filter = request.args.get('products', '')
         users_filter = request.args.get('users', '')
         
-        # Build base match query
-        base_match = {
-            'date': {'$gte': start_date, '$lte': end_date},
-            'total': {'$ne': None}
-        }
-        
-        # Add product filter if specified
-        if products_filter:
-            product_ids = products_filter.split(',')
-            base_match['product_id'] = {'$in': product_ids}
-        
-        # Add user filter if specified
-        if users_filter:
-            user_ids = users_filter.split(',')
-            base_match['user_id'] = {'$in': user_ids}
-        
-        # Sales in period (using filtered match)
-        period_sales_pipeline = [
-            {'$match': base_match},
-            {'$group': {
-                '_id': None,
-                'total_revenue': {'$sum': '$total'},
-                'total_orders': {'$sum': 1},
-                'total_units': {'$sum': '$quantity'}
-            }}
-        ]
-        period_sales_result = list(products_sold.aggregate(period_sales_pipeline, allowDiskUse=True))
-        
-        if period_sales_result:
-            total_revenue = float(period_sales_result[0]['total_revenue'])
-            total_orders = int(period_sales_result[0]['total_orders'])
-            total_units = int(period_sales_result[0]['total_units'])
-            avg_order_value = round(total_revenue / total_orders, 2) if total_orders > 0 else 0
-        else:
-            total_revenue = 0
-            total_orders = 0
-            total_units = 0
-            avg_order_value = 0
-        
-        # Active customers in period (made purchases) - with filters
-        active_customers_pipeline = [
-            {'$match': base_match},
-            {'$group': {'_id': '$user_id'}}
-        ]
-        active_customers = len(list(products_sold.aggregate(active_customers_pipeline, allowDiskUse=True)))
-        
-        # New customers in period - with user filter if specified
-        new_customers_query = {'created_at': {'$gte': start_date, '$lte': end_date}}
-        if users_filter:
-            user_object_ids = [ObjectId(uid) for uid in users_filter.split(',') if uid]
-            new_customers_query['_id'] = {'$in': user_object_ids}
-        new_customers = users.count_documents(new_customers_query)
-        
-        # Top products in period (with filters)
-        top_products_pipeline = [
-            {'$match': base_match},
-            {'$group': {
-                '_id': '$product_name',
-                'total_revenue': {'$sum': '$total'},
-                'units_sold': {'$sum': '$quantity'}
-            }},
-            {'$sort': {'total_revenue': -1}},
-            {'$limit': 10}
-        ]
-        top_products_result = list(products_sold.aggregate(top_products_pipeline, allowDiskUse=True))
-        top_products = [
-            {
-                'name': p['_id'],
-                'revenue': float(p['total_revenue']),
-                'units': int(p['units_sold'])
-            }
-            for p in top_products_result
-        ]
-        
-        # All products performance (with filters) - Optimized with lookup and ObjectId conversion
-        all_products_pipeline = [
-            {'$match': base_match},
-            {'$group': {
-                '_id': '$product_id',
-                'product_name': {'$first': '$product_name'},
-                'total_revenue': {'$sum': '$total'},
-                'units_sold': {'$sum': '$quantity'}
-            }},
-            {'$addFields': {
-                'product_object_id': {'$toObjectId': '$_id'}
-            }},
-            {'$lookup': {
-                'from': 'products_update',
-                'localField': 'product_object_id',
-                'foreignField': '_id',
-                'as': 'product'
-            }},
-            {'$unwind': {'path': '$product', 'preserveNullAndEmptyArrays': True}},
-            {'$addFields': {
-                'category': {'$ifNull': ['$product.category', 'Other']},
-                'variants': {'$ifNull': ['$product.variants', []]}
-            }},
-            {'$sort': {'total_revenue': -1}}
-        ]
-        all_products_result = list(products_sold.aggregate(all_products_pipeline, allowDiskUse=True))
-        
-        all_products = []
-        for p in all_products_result:
-            total_stock = 0
-            for variant in p.get('variants', []):
-                if isinstance(variant, dict):
-                    total_stock += int(variant.get('stock', 0))
-            
-            all_products.append({
-                'name': p.get('product_name', 'Unknown'),
-                'category': p.get('category', 'Other'),
-                'revenue': float(p.get('total_revenue', 0)),
-                'units_sold': int(p.get('units_sold', 0)),
-                'stock': total_stock
-            })
-        
-        # Category sales (with filters) - Optimized with aggregation
-        category_sales_pipeline = [
-            {'$match': base_match},
-            {'$addFields': {
-                'product_object_id': {'$toObjectId': '$product_id'}
-            }},
-            {'$lookup': {
-                'from': 'products_update',
-                'localField': 'product_object_id',
-                'foreignField': '_id',
-                'as': 'product'
-            }},
-            {'$unwind': {'path': '$product', 'preserveNullAndEmptyArrays': True}},
-            {'$group': {
-                '_id': {'$ifNull': ['$product.category', 'Other']},
-                'revenue': {'$sum': '$total'}
-            }},
-            {'$sort': {'revenue': -1}}
-        ]
-        category_sales_result = list(products_sold.aggregate(category_sales_pipeline, allowDiskUse=True))
-        
-        category_sales_list = [
-            {'category': c['_id'], 'revenue': float(c['revenue'])}
-            for c in category_sales_result
-        ]
-        
-        top_category = category_sales_list[0]['category'] if category_sales_list else None
-        top_category_revenue = category_sales_list[0]['revenue'] if category_sales_list else 0
-        
-        # Top customers (with filters) - Optimized with lookup
-        top_customers_pipeline = [
-            {'$match': base_match},
-            {'$group': {
-                '_id': '$user_id',
-                'total_spent': {'$sum': '$total'},
-                'orders': {'$sum': 1}
-            }},
-            {'$sort': {'total_spent': -1}},
-            {'$limit': 100},
-            {'$addFields': {
-                'user_object_id': {'$toObjectId': '$_id'}
-            }},
-            {'$lookup': {
-                'from': 'users',
-                'localField': 'user_object_id',
-                'foreignField': '_id',
-                'as': 'user'
-            }},
-            {'$unwind': {'path': '$user', 'preserveNullAndEmptyArrays': True}},
-            {'$project': {
-                'name': {'$ifNull': ['$user.name', 'Unknown']},
-                'email': {'$ifNull': ['$user.email', '']},
-                'orders': 1,
-                'total_spent': 1
-            }}
-        ]
-        top_customers_result = list(products_sold.aggregate(top_customers_pipeline, allowDiskUse=True))
-        
-        top_customers = [
-            {
-                'name': c.get('name', 'Unknown'),
-                'email': c.get('email', ''),
-                'orders': int(c.get('orders', 0)),
-                'total_spent': float(c.get('total_spent', 0))
-            }
-            for c in top_customers_result
-        ]
-        
-        # Sales trend (daily breakdown with filters) - Optimized single aggregation
-        sales_trend_pipeline = [
-            {'$match': base_match},
-            {'$group': {
-                '_id': {
-                    '$dateToString': {'format': '%Y-%m-%d', 'date': '$date'}
-                },
-                'total': {'$sum': '$total'}
-            }},
-            {'$sort': {'_id': 1}}
-        ]
-        sales_trend_result = list(products_sold.aggregate(sales_trend_pipeline, allowDiskUse=True))
-        
-        # Create a map for quick lookup
-        sales_map = {r['_id']: float(r['total']) for r in sales_trend_result}
-        
-        # Fill in all dates including zeros
-        sales_trend = []
-        current_date = start_date
-        while current_date <= end_date:
-            date_key = current_date.strftime('%Y-%m-%d')
-            sales_trend.append({
-                'date': current_date.strftime('%m/%d'),
-                'sales': sales_map.get(date_key, 0.0)
-            })
-            current_date += datetime.timedelta(days=1)
-        
+        # ?approx=true estimates active customers from the per-day HyperLogLog
+        # sketches (±hll.ERROR_BOUND); filtered views always count exactly.
+        approx_customers = (request.args.get('approx', 'false').lower() == 'true'
+                            and not products_filter and not users_filter)
+
+        product_ids = [p for p in products_filter.split(',') if p] if products_filter else []
+        user_ids = [u for u in users_filter.split(',') if u] if users_filter else []
+        result = analytics_cache.get_or_compute(
+            db, 'analytics',
+            {'start': start_date_str, 'end': end_date_str, 'products': product_ids,
+             'users': user_ids, 'approx': approx_customers},
+            ('products_sold', 'user_data_bought', 'users', closed_periods.CACHE_COLLECTION),
+            lambda: _analytics_summary(start_date, end_date, product_ids, user_ids, approx_customers))
+        total_revenue = result['total_revenue']
+        total_orders = result['total_orders']
+        total_units = result['total_units']
+        avg_order_value = result['avg_order_value']
+        active_customers = result['active_customers']
+        new_customers = result['new_customers']
+        top_category = result['top_category']
+        top_category_revenue = result['top_category_revenue']
+        top_products = result['top_products']
+        all_products = result['all_products']
+        category_sales_list = result['category_sales']
+        top_customers = result['top_customers']
+        sales_trend = result['sales_trend']
+
         # If no data available and demo requested (or admin viewing), generate sample/demo data for UI
         demo_flag = request.args.get('demo', 'false').lower() == 'true'
         try:
@@ -2641,7 +2570,8 @@ def analytics_api():
         except Exception:
             is_admin = False
 
-        if demo_flag or (is_admin and total_orders == 0):
+        using_demo = bool(demo_flag or (is_admin and total_orders == 0))
+        if using_demo:
             import random
             # Generate last 7 days sample sales trend
             sample_trend = []
@@ -2712,59 +2642,8 @@ def analytics_api():
             top_category = category_sales_list[0]['category']
             top_category_revenue = category_sales_list[0]['revenue']
 
-        using_demo = demo_flag or (is_admin and 'Sample Product' in (top_products[0]['name'] if top_products else ''))
-
-        import random
-        collections = db.list_collection_names()
-        all_data = {}
-        demo_needed = False
-        for coll in collections:
-            try:
-                docs = list(db[coll].find({}, {'_id': 0}))
-                all_data[coll] = docs
-                if len(docs) == 0:
-                    demo_needed = True
-            except Exception as e:
-                all_data[coll] = f"Error fetching: {e}"
-                demo_needed = True
-
-        # If any collection is empty or demo requested, return sample/demo data
-        if demo_needed or demo_flag or (is_admin and total_orders == 0):
-            debug_log("[Analytics API] Returning DEMO data due to empty DB or slow response.")
-            sample_products = [
-                {'name': f'Sample Product {i+1}', 'revenue': round(random.uniform(1000, 5000), 2), 'units': random.randint(10, 100)} for i in range(5)
-            ]
-            sample_customers = [
-                {'name': f'Sample Customer {i+1}', 'email': f'cust{i+1}@example.com', 'orders': random.randint(1, 20), 'total_spent': round(random.uniform(200, 5000), 2)} for i in range(5)
-            ]
-            sample_trend = [
-                {'date': f'{i+1}/01', 'sales': round(random.uniform(200, 2000), 2)} for i in range(60)
-            ]
-            return jsonify({
-                'collections': collections,
-                'all_data': {},
-                'summary': {
-                    'total_revenue': round(random.uniform(10000, 50000), 2),
-                    'total_orders': random.randint(100, 500),
-                    'total_units_sold': random.randint(500, 2000),
-                    'avg_order_value': round(random.uniform(100, 500), 2),
-                    'active_customers': random.randint(10, 100),
-                    'new_customers': random.randint(1, 20),
-                    'top_category': 'Sample Category',
-                    'top_category_revenue': round(random.uniform(5000, 20000), 2),
-                    'top_products': sample_products,
-                    'all_products': sample_products,
-                    'category_sales': [{'category': 'Sample', 'revenue': round(random.uniform(5000, 20000), 2)}],
-                    'top_customers': sample_customers,
-                    'sales_trend': sample_trend,
-                    'demo': True
-                }
-            })
-
-        debug_log(f"[Analytics API] Returning all collections: {list(all_data.keys())}")
+        # Summary only; raw documents are browsed through /api/admin/collections
         return jsonify({
-            'collections': collections,
-            'all_data': all_data,
             'summary': {
                 'total_revenue': total_revenue,
                 'total_orders': total_orders,
@@ -2779,7 +2658,9 @@ def analytics_api():
                 'category_sales': category_sales_list,
                 'top_customers': top_customers,
                 'sales_trend': sales_trend,
-                'demo': bool(demo_flag or (is_admin and total_orders == 0))
+                'active_customers_approx': approx_customers and not using_demo,
+                'active_customers_error': hll.ERROR_BOUND if approx_customers and not using_demo else 0.0,
+                'demo': using_demo
             }
         })
         
@@ -2793,6 +2674,76 @@ def analytics_api():
 def analytics_page():
     return render_template('analytics_modern.html')
 
+# ── Collection explorer (admin only) ─────────────────────────────────────────
+EXPLORER_DEFAULT_LIMIT = 50
+EXPLORER_MAX_LIMIT = 500
+EXPLORER_HIDDEN_FIELDS = ('password',)
+
+@app.route('/api/admin/collections')
+@admin_required
+def explorer_collections():
+    # List collections with their (estimated) document counts
+    if db is None:
+        return jsonify({'error': 'Database not connected'}), 503
+    try:
+        names = sorted(n for n in db.list_collection_names() if not n.startswith('system.'))
+        return jsonify([{'name': n, 'count': db[n].estimated_document_count()} for n in names])
+    except Exception as e:
+        print(f"Error listing collections: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/collections/<name>')
+@admin_required
+def explorer_collection_page(name):
+    # One page of raw documents, ordered by _id.
+    # Query params: ?after=<next_cursor>&limit=N (≤500)&fields=a,b,c
+    if db is None:
+        return jsonify({'error': 'Database not connected'}), 503
+    if name.startswith('system.') or name not in db.list_collection_names():
+        return jsonify({'error': f'Unknown collection: {name}'}), 404
+
+    limit = request.args.get('limit', EXPLORER_DEFAULT_LIMIT, type=int)
+    limit = max(1, min(limit, EXPLORER_MAX_LIMIT))
+    fields = [f.strip() for f in request.args.get('fields', '').split(',')
+              if f.strip() and f.strip() not in EXPLORER_HIDDEN_FIELDS]
+    if fields:
+        projection = {f: 1 for f in fields}
+    else:
+        projection = {f: 0 for f in EXPLORER_HIDDEN_FIELDS}
+
+    # Cursors are keyset tokens, so the last _id comes back with its BSON type
+    query = {}
+    after = request.args.get('after')
+    if after:
+        try:
+            query['_id'] = {'$gt': keyset.decode_cursor(after)[1]}
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+    # Fetch one extra document to know whether another page exists
+    cursor = db[name].find(query, projection).sort('_id', 1).limit(limit + 1).batch_size(min(limit + 1, 100))
+
+    def generate():
+        # Stream the page as a JSON document, one row at a time
+        import json
+        yield '{"collection": %s, "documents": [' % json.dumps(name)
+        last_id = None
+        sent = 0
+        has_more = False
+        for doc in cursor:
+            if sent == limit:
+                has_more = True
+                break
+            last_id = doc.get('_id')
+            yield (',' if sent else '') + json.dumps(doc, default=str)
+            sent += 1
+        cursor.close()
+        next_cursor = keyset.encode_cursor({'_id': last_id}) if has_more else None
+        yield '], "count": %d, "next_cursor": %s}' % (sent, json.dumps(next_cursor))
+
+    from flask import Response, stream_with_context
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
 @app.route('/api/export-analytics-pdf')
 def export_analytics_pdf():
     # Export analytics report as PDF
@@ -2815,59 +2766,26 @@ def export_analytics_pdf():
         start_date = datetime.datetime.strptime(start_date_str, '%Y-%m-%d').replace(hour=0, minute=0, second=0)
         end_date = datetime.datetime.strptime(end_date_str, '%Y-%m-%d').replace(hour=23, minute=59, second=59)
         
-        # Get analytics data
-        pipeline = [
-            {
-                '$match': {
-                    'date': {'$gte': start_date, '$lte': end_date},
-                    'total': {'$ne': None}
-                }
-            },
-            {
-                '$group': {
-                    '_id': None,
-                    'total_sales': {'$sum': '$total'},
-                    'total_orders': {'$sum': 1},
-                    'unique_customers': {'$addToSet': '$user_id'}
-                }
-            }
-        ]
+        # ?approx=true estimates active customers from the HyperLogLog sketches
+        approx_customers = request.args.get('approx', 'false').lower() == 'true'
         
-        result = list(db.products_sold.aggregate(pipeline))
+        # Get analytics data: cached closed days plus today
+        period = sales_range(start_date, end_date)
+        period_sales = float(period['revenue'])
+        total_orders = int(period['orders'])
+        avg_order_value = period_sales / total_orders if total_orders > 0 else 0
         
-        if result:
-            period_sales = float(result[0].get('total_sales', 0))
-            total_orders = result[0].get('total_orders', 0)
-            active_customers = len(result[0].get('unique_customers', []))
-            avg_order_value = period_sales / total_orders if total_orders > 0 else 0
+        if approx_customers:
+            active_customers = customer_sketches.distinct_customers(db, start_date, end_date)
         else:
-            period_sales = 0
-            total_orders = 0
-            active_customers = 0
-            avg_order_value = 0
+            active_customers = len(period['customers'])
         
         # Get product performance
-        product_pipeline = [
-            {
-                '$match': {
-                    'date': {'$gte': start_date, '$lte': end_date},
-                    'total': {'$ne': None}
-                }
-            },
-            {
-                '$group': {
-                    '_id': '$product_id',
-                    'product_name': {'$first': '$product_name'},
-                    'total_revenue': {'$sum': '$total'},
-                    'total_units': {'$sum': '$quantity'}
-                }
-            },
-            {'$sort': {'total_revenue': -1}},
-            {'$limit': 20}
+        top_products = [
+            {'product_name': p['product_name'], 'total_revenue': p['revenue'], 'total_units': p['units']}
+            for p in sorted(period['products'].values(), key=lambda p: p['revenue'], reverse=True)[:20]
         ]
         
-        top_products = list(db.products_sold.aggregate(product_pipeline))
-        
         # Create PDF
         buffer = io.BytesIO()
         doc = SimpleDocTemplate(buffer, pagesize=letter, rightMargin=30, leftMargin=30, topMargin=30, bottomMargin=18)
@@ -2915,7 +2833,7 @@ def export_analytics_pdf():
             ['Metric', 'Value'],
             ['Total Revenue', f'Rs {(period_sales * usd_to_inr):,.2f}'],
             ['Total Orders', f'{total_orders:,}'],
-            ['Active Customers', f'{active_customers:,}'],
+            ['Active Customers', f'~{active_customers:,} (±{hll.ERROR_BOUND:.1%})' if approx_customers else f'{active_customers:,}'],
             ['Average Order Value', f'Rs {(avg_order_value * usd_to_inr):,.2f}']
         ]
         
@@ -3026,18 +2944,9 @@ def export_business_summary_pdf():
         
         avg_order = total_sales / total_orders if total_orders > 0 else 0
         
-        # Top products
-        top_products_pipeline = [
-            {'$match': {'date': {'$gte': thirty_days_ago}, 'total': {'$ne': None}}},
-            {'$group': {
-                '_id': '$product_name',
-                'total_revenue': {'$sum': '$total'},
-                'units_sold': {'$sum': '$quantity'}
-            }},
-            {'$sort': {'total_revenue': -1}},
-            {'$limit': 10}
-        ]
-        top_products = list(db.products_sold.aggregate(top_products_pipeline))
+        # Top products (streaming top-K summaries)
+        top_products = [dict(p, total_revenue=p['revenue'], units_sold=p['units'])
+                        for p in sales_topk.top(db, 'product', 10, thirty_days_ago)]
         
         # Create PDF
         buffer = io.BytesIO()
@@ -3153,8 +3062,35 @@ def export_business_summary_pdf():
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
+def _user_report_rows(customers):
+    # Report rows for per-customer spend partials (see closed_periods.py).
+    # Customer details are fetched from users, then users_update, one $in
+    # batch per FETCH_CHUNK customers, as the rows are consumed.
+    chunk = sales_analytics.FETCH_CHUNK
+    for i in range(0, len(customers), chunk):
+        batch = customers[i:i + chunk]
+        people = sales_analytics.fetch_by_id((users, users_update), [c['user_id'] for c in batch],
+                                             {'name': 1, 'email': 1})
+        for up in batch:
+            user = people.get(str(up['user_id']))
+            if user:
+                avg_order = up['spent'] / up['orders'] if up['orders'] > 0 else 0
+                last_purchase = up['last_purchase'].strftime('%Y-%m-%d %H:%M') if up.get('last_purchase') else None
+
+                yield {
+                    'name': user.get('name', 'Unknown'),
+                    'email': user.get('email', ''),
+                    'orders': int(up['orders']),
+                    'total_spent': float(up['spent']),
+                    'avg_order': float(avg_order),
+                    'last_purchase': last_purchase
+                }
+
 @app.route('/api/user-report')
 def user_report_api():
+    # Streams {"users": [...], "total_users": N}, or one JSON row per line
+    # with ?format=ndjson, as customer batches are fetched. A failure after
+    # the first batch adds an "error" key (or a final {"error": ...} line).
     try:
         start_date_str = request.args.get('start_date')
         end_date_str = request.args.get('end_date')
@@ -3164,54 +3100,46 @@ def user_report_api():
         
         start_date = datetime.datetime.strptime(start_date_str, '%Y-%m-%d').replace(hour=0, minute=0, second=0)
         end_date = datetime.datetime.strptime(end_date_str, '%Y-%m-%d').replace(hour=23, minute=59, second=59)
-        
-        # Get all users with their purchase data
-        user_report_pipeline = [
-            {
-                '$match': {
-                    'date': {'$gte': start_date, '$lte': end_date},
-                    'total': {'$ne': None}
-                }
-            },
-            {
-                '$group': {
-                    '_id': '$user_id',
-                    'total_spent': {'$sum': '$total'},
-                    'orders': {'$sum': 1},
-                    'last_purchase_date': {'$max': '$date'}
-                }
-            },
-            {
-                '$sort': {'total_spent': -1}
-            }
-        ]
-        
-        user_purchases = list(products_sold.aggregate(user_report_pipeline))
-        
-        user_report = []
-        for up in user_purchases:
+        # Biggest spenders first; closed days come from the per-day cache
+        customers = sorted(sales_range(start_date, end_date)['customers'].values(),
+                           key=lambda c: c['spent'], reverse=True)
+        rows = _user_report_rows(customers)
+        # Fetch the first batch before the headers go out, so a failure there
+        # still answers 500; a later one ends the stream with an error record
+        first = next(rows, None)
+
+        def report_rows():
+            if first is not None:
+                yield first
+                yield from rows
+
+        import json
+        from flask import Response, stream_with_context
+        if request.args.get('format') == 'ndjson':
+            def generate_lines():
+                try:
+                    for row in report_rows():
+                        yield json.dumps(row) + '\n'
+                except Exception as e:
+                    print(f"Error streaming user report: {e}")
+                    yield json.dumps({'error': str(e)}) + '\n'
+
+            return Response(stream_with_context(generate_lines()), mimetype='application/x-ndjson')
+
+        def generate():
+            yield '{"users": ['
+            sent = 0
             try:
-                user = users.find_one({'_id': ObjectId(up['_id'])})
-                if user:
-                    avg_order = up['total_spent'] / up['orders'] if up['orders'] > 0 else 0
-                    last_purchase = up['last_purchase_date'].strftime('%Y-%m-%d %H:%M') if up.get('last_purchase_date') else None
-                    
-                    user_report.append({
-                        'name': user.get('name', 'Unknown'),
-                        'email': user.get('email', ''),
-                        'orders': int(up['orders']),
-                        'total_spent': float(up['total_spent']),
-                        'avg_order': float(avg_order),
-                        'last_purchase': last_purchase
-                    })
+                for row in report_rows():
+                    yield (',' if sent else '') + json.dumps(row)
+                    sent += 1
             except Exception as e:
-                print(f"Error processing user {up['_id']}: {e}")
-                continue
-        
-        return jsonify({
-            'users': user_report,
-            'total_users': len(user_report)
-        })
+                print(f"Error streaming user report: {e}")
+                yield '], "total_users": %d, "error": %s}' % (sent, json.dumps(str(e)))
+                return
+            yield '], "total_users": %d}' % sent
+
+        return Response(stream_with_context(generate()), mimetype='application/json')
         
     except Exception as e:
         print(f"Error in user report API: {e}")
@@ -3247,6 +3175,7 @@ def create_worker():
         try:
             result = workers_update.insert_one(worker)
             if result.inserted_id:
+                data_changed('workers_update')
                 # Send credentials email
                 if send_worker_credentials_email(email, name, password):
                     flash('Worker created successfully and credentials sent', 'success')
@@ -3359,13 +3288,14 @@ def admin_send_custom_email():
         # ── Fire background thread — return instantly ──────────────────────
         import uuid as _uuid
         job_id = str(_uuid.uuid4())[:8]
-        _bulk_jobs[job_id] = {
+        job = {
             'status': 'sending', 'sent': 0, 'failed': 0,
             'total': len(valid_list), 'error': '', 'done': False
         }
+        bulk_jobs.set(job_id, dict(job))
         t = threading.Thread(
             target=_run_bulk_send,
-            args=(job_id, valid_list, subject, html_body,
+            args=(job_id, job, valid_list, subject, html_body,
                   recipient_type, len(invalid_list),
                   (body[:120] + '…') if len(body) > 120 else body),
             daemon=True
@@ -3391,11 +3321,43 @@ def admin_send_custom_email():
 @admin_required
 def email_send_status(job_id):
     # Poll: return current state of a background bulk-send job.
-    job = _bulk_jobs.get(job_id)
+    job = bulk_jobs.get(job_id)
     if not job:
         return jsonify({'error': 'Job not found'}), 404
     return jsonify(job)
 
+def _chart_data(date_from, date_to):
+    # Sales trend + category breakdown for /api/chart-data; served through analytics_cache.
+    delta_days = (date_to - date_from).days + 1
+
+    sales = sales_reader()
+
+    # ── Sales trend (daily ≤31d, weekly ≤1y, monthly beyond) ──────────────
+    first_day = sales_rollups.day_start(date_from)
+    last_day  = sales_rollups.day_start(date_to)
+    if delta_days <= 31:
+        trend_unit = 'day'
+    elif delta_days <= 366:
+        trend_unit = 'week'
+    else:
+        trend_unit = 'month'
+    label_fmt = '%b %Y' if trend_unit == 'month' else '%d %b'
+    sales_trend = [
+        {'date': p['bucket'].strftime(label_fmt), 'sales': p['value']}
+        for p in sales.trend(first_day, last_day, trend_unit)
+    ]
+
+    # ── Category breakdown ─────────────────────────────────────────────────
+    category_breakdown = [
+        {'name': c['_id'] or 'Uncategorized',
+         'total': float(c.get('revenue', 0)),
+         'count': int(c.get('orders', 0))}
+        for c in sales.top_keys('category', first_day, last_day, limit=8)
+    ]
+
+    return {'sales_trend': sales_trend, 'category_breakdown': category_breakdown}
+
+
 @app.route('/api/chart-data')
 def chart_data_api():
     if 'admin_id' not in session:
@@ -3419,71 +3381,113 @@ def chart_data_api():
         except (ValueError, TypeError):
             date_to = now
 
-        delta_days = (date_to - date_from).days + 1
-
-        # ── Sales trend ────────────────────────────────────────────────────────
-        sales_trend = []
-        if delta_days <= 31:
-            # Daily
-            for i in range(delta_days):
-                d     = date_from + datetime.timedelta(days=i)
-                start = d.replace(hour=0,  minute=0,  second=0,  microsecond=0)
-                end   = d.replace(hour=23, minute=59, second=59, microsecond=999999)
-                res   = list(user_data_bought.aggregate([
-                    {'$match': {'purchase_date': {'$gte': start, '$lte': end},
-                                'total': {'$exists': True, '$ne': None}}},
-                    {'$group': {'_id': None, 'total': {'$sum': '$total'}}}
-                ]))
-                sales_trend.append({'date': d.strftime('%d %b'), 'sales': float(res[0]['total']) if res else 0.0})
-        else:
-            # Weekly
-            num_weeks = max(1, delta_days // 7)
-            for w in range(num_weeks):
-                start = date_from + datetime.timedelta(weeks=w)
-                end   = (date_from + datetime.timedelta(weeks=w+1) - datetime.timedelta(seconds=1))
-                if end > date_to:
-                    end = date_to
-                res = list(user_data_bought.aggregate([
-                    {'$match': {'purchase_date': {'$gte': start, '$lte': end},
-                                'total': {'$exists': True, '$ne': None}}},
-                    {'$group': {'_id': None, 'total': {'$sum': '$total'}}}
-                ]))
-                sales_trend.append({'date': start.strftime('%d %b'), 'sales': float(res[0]['total']) if res else 0.0})
-
-        # ── Category breakdown ─────────────────────────────────────────────────
-        cat_result = list(user_data_bought.aggregate([
-            {'$match': {'purchase_date': {'$gte': date_from, '$lte': date_to},
-                        'total': {'$exists': True, '$ne': None}}},
-            {'$group': {'_id': '$category', 'total_revenue': {'$sum': '$total'}, 'count': {'$sum': 1}}},
-            {'$sort': {'total_revenue': -1}},
-            {'$limit': 8}
-        ]))
-        category_breakdown = [
-            {'name': c['_id'] or 'Uncategorized',
-             'total': float(c.get('total_revenue', 0)),
-             'count': int(c.get('count', 0))}
-            for c in cat_result
-        ]
-
-        return jsonify({'sales_trend': sales_trend, 'category_breakdown': category_breakdown})
+        data = analytics_cache.get_or_compute(
+            db, 'chart_data',
+            {'from': date_from.strftime('%Y-%m-%d'), 'to': date_to.strftime('%Y-%m-%d')},
+            ('user_data_bought',),
+            lambda: _chart_data(date_from, date_to))
+        return jsonify(data)
     except Exception as e:
         print(f'chart-data error: {e}')
         return jsonify({'sales_trend': [], 'category_breakdown': []})
 
 
+@app.route('/api/order-distribution')
+def order_distribution_api():
+    if 'admin_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 403
+    # Percentiles and histograms of order value and units per order from the
+    # per-day t-digests (see order_digests.py).
+    # Query params: ?from=YYYY-MM-DD&to=YYYY-MM-DD&category=<name>&bins=20
+    try:
+        now = datetime.datetime.now()
+        try:
+            date_from = datetime.datetime.strptime(request.args.get('from', ''), '%Y-%m-%d')
+        except (ValueError, TypeError):
+            date_from = now - datetime.timedelta(days=30)
+        try:
+            date_to = datetime.datetime.strptime(request.args.get('to', ''), '%Y-%m-%d')
+        except (ValueError, TypeError):
+            date_to = now
+        category = request.args.get('category') or None
+        bins = min(max(request.args.get('bins', 20, type=int), 1), 100)
+
+        data = order_digests.distribution(db, date_from, date_to, category, bins)
+        data.update({'from': date_from.strftime('%Y-%m-%d'), 'to': date_to.strftime('%Y-%m-%d'),
+                     'category': category})
+        return jsonify(data)
+    except Exception as e:
+        print(f'order-distribution error: {e}')
+        return jsonify({'error': 'Could not compute order distribution'}), 500
+
+
+@app.route('/api/cohorts')
+def cohorts_api():
+    if 'admin_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 403
+    # Monthly cohort retention and repeat-purchase rates, read from the
+    # precomputed month documents (see cohorts.py).
+    # Query params: ?months=12
+    try:
+        months = min(max(request.args.get('months', 12, type=int), 1), 60)
+        data = cohorts.matrix(db, months)
+        if data['computed_at'] is None:
+            # Nothing built yet (background jobs off or first start)
+            cohorts.refresh(db)
+            data = cohorts.matrix(db, months)
+        data['months'] = months
+        return jsonify(data)
+    except Exception as e:
+        print(f'cohorts error: {e}')
+        return jsonify({'error': 'Could not load cohort retention'}), 500
+
+
+@app.route('/api/customer-segments')
+def customer_segments_api():
+    if 'admin_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 403
+    # Customers, spend and recency per RFM segment (see customer_segments.py),
+    # for choosing the segments a campaign targets.
+    try:
+        return jsonify({'segments': customer_segments.summary(db)})
+    except Exception as e:
+        print(f'customer-segments error: {e}')
+        return jsonify({'error': 'Could not load customer segments'}), 500
+
+
+@app.route('/api/frequently-bought-together')
+def frequently_bought_together_api():
+    # Products often ordered with the given ones (see co_purchase.py): one
+    # indexed read. ?product_id= takes a comma-separated basket, ?name= a name.
+    try:
+        products = [p for p in request.args.get('product_id', '').split(',') if p.strip()]
+        if request.args.get('name'):
+            products.append(request.args['name'])
+        n = max(1, min(request.args.get('n', default=5, type=int), co_purchase.TOP_N))
+        return jsonify({'products': co_purchase.together(db, [p.strip() for p in products], n)})
+    except Exception as e:
+        print(f'frequently-bought-together error: {e}')
+        return jsonify({'error': 'Could not load recommendations'}), 500
+
+
 @app.route('/api/email-history')
 @admin_required
 def email_history_api():
-    # Return last 50 email sends
+    # Return email sends newest first, one keyset page at a time (?after=<next_cursor>)
     try:
         if email_logs is None:
-            return jsonify([])
-        logs = list(email_logs.find({}, {'_id': 0}).sort('sent_at', -1).limit(50))
+            return jsonify({'logs': [], 'next_cursor': None})
+        limit = max(1, min(request.args.get('limit', 50, type=int), 200))
+        result = keyset.page(email_logs, limit, field='sent_at', after=request.args.get('after'))
+        logs = result['items']
         for l in logs:
+            l.pop('_id', None)
             l['sent_at'] = l['sent_at'].strftime('%d %b %Y, %H:%M') if hasattr(l.get('sent_at'), 'strftime') else str(l.get('sent_at', ''))[:16]
-        return jsonify(logs)
+        return jsonify({'logs': logs, 'next_cursor': result['next']})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        return jsonify([])
+        return jsonify({'logs': [], 'next_cursor': None})
 
 
 @app.route('/admin/export-data', methods=['POST'])
@@ -3625,8 +3629,11 @@ def admin_deactivate_worker(worker_id):
 @app.route('/admin/delete-product/<product_id>', methods=['DELETE'])
 def admin_delete_product(product_id):
     try:
-        result = products_update.delete_one({'_id': ObjectId(product_id)})
-        if result.deleted_count:
+        deleted = products_update.find_one_and_delete({'_id': ObjectId(product_id)})
+        if deleted is not None:
+            data_changed('products_update')
+            stock_changed('products_update', [product_id])
+            product_changed('products_update', before=deleted)
             return jsonify({'success': True})
         return jsonify({'error': 'Product not found'}), 404
     except Exception as e:
@@ -3811,8 +3818,7 @@ def worker_dashboard():
                 unique_products.add(p['name'])
     unique_product_count = len(unique_products)
     
-    # Pagination
-    page = request.args.get('page', 1, type=int)
+    # Keyset pagination, newest first (see keyset.py)
     per_page = 10
 
     # Get only products added by this worker ("products by specific user")
@@ -3823,13 +3829,13 @@ def worker_dashboard():
     }
     total_products = products_by_user.count_documents(query)
 
-    # Get this worker's products with pagination and ensure they have proper structure
-    worker_products = list(
-        products_by_user
-        .find(query)
-        .skip((page - 1) * per_page)
-        .limit(per_page)
-    )
+    # Get one page of this worker's products and ensure they have proper structure
+    try:
+        product_page = keyset.page(products_by_user, per_page, query=query,
+                                   after=request.args.get('after'), before=request.args.get('before'))
+    except ValueError:
+        product_page = keyset.page(products_by_user, per_page, query=query)
+    worker_products = product_page['items']
     
     # Ensure all products have the required fields
     for product in worker_products:
@@ -3859,9 +3865,6 @@ def worker_dashboard():
         {'worker_id': worker_id}
     ).sort('date', -1).limit(5))
     
-    # Calculate total pages
-    total_pages = max(1, (total_products + per_page - 1) // per_page)
-    
     # All products from products_update for the restock dropdown
     all_products_list = []
     if products_update is not None:
@@ -3874,8 +3877,8 @@ def worker_dashboard():
                          products=worker_products,
                          categories=categories,
                          recent_activities=recent_activities,
-                         page=page,
-                         total_pages=total_pages,
+                         next_cursor=product_page['next'],
+                         prev_cursor=product_page['prev'],
                          total_products=total_products,
                          unique_product_count=unique_product_count,
                          today_sales=today_sales_amount,
@@ -3935,6 +3938,10 @@ def add_product():
                 }
             }
             worker_specific_added.insert_one(worker_action)
+            data_changed('products_by_user')
+            stock_changed('products_by_user', [existing_product['_id']])
+            product_changed('products_by_user', before=existing_product,
+                            after={**existing_product, 'variants': updated_variants})
             
             return jsonify({
                 'success': True,
@@ -3956,6 +3963,8 @@ def add_product():
             }
             
             result = products_by_user.insert_one(product)
+            stock_changed('products_by_user', [result.inserted_id])
+            product_changed('products_by_user', after=product)
             
             # Record the worker's action
             worker_action = {
@@ -3977,6 +3986,7 @@ def add_product():
                 {'_id': worker_id},
                 {'$inc': {'total_products_added': 1}}
             )
+            data_changed('products_by_user', 'workers_update')
             
             return jsonify({
                 'success': True,
@@ -4011,10 +4021,9 @@ def worker_restock():
             return jsonify({'error': 'Invalid variant'}), 400
 
         # Increase stock
-        products_update.update_one(
-            {'_id': ObjectId(product_id)},
-            {'$inc': {f'variants.{variant_index}.stock': add_qty}}
-        )
+        before = adjust_variant_stock(products_update, ObjectId(product_id), variant_index, add_qty) or product
+        data_changed('products_update')
+        stock_changed('products_update', [product_id])
 
         # Log the restock activity
         worker_specific_added.insert_one({
@@ -4028,7 +4037,7 @@ def worker_restock():
             'date':        datetime.datetime.now(),
         })
 
-        new_stock = int(variants[variant_index].get('stock', 0)) + add_qty
+        new_stock = int(before['variants'][variant_index].get('stock', 0)) + add_qty
         return jsonify({'success': True, 'new_stock': new_stock})
 
     except Exception as e:
@@ -4042,9 +4051,11 @@ def delete_product(product_id):
     
     try:
         # Delete the product
-        result = products_by_user.delete_one({'_id': ObjectId(product_id)})
+        deleted = products_by_user.find_one_and_delete({'_id': ObjectId(product_id)})
         
-        if result.deleted_count > 0:
+        if deleted is not None:
+            stock_changed('products_by_user', [product_id])
+            product_changed('products_by_user', before=deleted)
             # Record the worker's action
             worker_action = {
                 'worker_id': ObjectId(session['worker_id']),
@@ -4060,6 +4071,7 @@ def delete_product(product_id):
                 {'_id': ObjectId(session['worker_id'])},
                 {'$inc': {'total_products_added': -1}}
             )
+            data_changed('products_by_user', 'workers_update')
             
             return jsonify({'success': True, 'message': 'Product deleted successfully'})
         else:
@@ -4245,6 +4257,16 @@ def process_purchase():
     if 'worker_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
     
+    # Stock already taken for this order's lines: (collection, product_id, variant_index, quantity)
+    taken = []
+
+    def refuse(error, status):
+        # Put back the stock taken so far, then reject the whole order
+        for collection, taken_id, taken_index, taken_quantity in taken:
+            adjust_variant_stock(collection, taken_id, taken_index, taken_quantity)
+            stock_changed(collection.name, [taken_id])
+        return jsonify({'error': error}), status
+
     try:
         data = request.get_json()
         worker_id = ObjectId(session['worker_id'])
@@ -4283,6 +4305,8 @@ def process_purchase():
         
         total_amount = 0
         purchase_records = []
+        # Groups the lines into one order (a basket, see co_purchase.py)
+        order_id = f'POS{datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S")}'
         
         for item in purchased_items:
             product_id = ObjectId(item['product_id'])
@@ -4301,26 +4325,26 @@ def process_purchase():
                         break
             
             if not product:
-                return jsonify({'error': f'Product not found: {item.get("product_name", "")}'}), 404
+                return refuse(f'Product not found: {item.get("product_name", "")}', 404)
             
             # Get variant details
             variants = product.get('variants', [])
             if variant_index >= len(variants):
-                return jsonify({'error': f'Invalid variant for {product.get("name", "")}'}), 400
+                return refuse(f'Invalid variant for {product.get("name", "")}', 400)
             
             variant = variants[variant_index]
             price = variant.get('price', 0)
             current_stock = variant.get('stock', 0)
             
             if current_stock < quantity:
-                return jsonify({'error': f'Insufficient stock for {product.get("name", "")} - {variant.get("quantity", "")}'}), 400
+                return refuse(f'Insufficient stock for {product.get("name", "")} - {variant.get("quantity", "")}', 400)
             
-            # Update stock
-            variants[variant_index]['stock'] = current_stock - quantity
-            collection_to_update.update_one(
-                {'_id': product_id},
-                {'$set': {'variants': variants}}
-            )
+            # Decrease stock only if it still covers the quantity (another sale may have landed since the read)
+            if adjust_variant_stock(collection_to_update, product_id, variant_index, -quantity,
+                                    min_stock=quantity) is None:
+                return refuse(f'Insufficient stock for {product.get("name", "")} - {variant.get("quantity", "")}', 400)
+            stock_changed(collection_to_update.name, [product_id])
+            taken.append((collection_to_update, product_id, variant_index, quantity))
             
             # Calculate item total
             item_total = price * quantity
@@ -4328,6 +4352,7 @@ def process_purchase():
             
             # Create purchase record
             purchase_record = {
+                'order_id': order_id,
                 'user_id': customer_id,
                 'user_name': customer_name,
                 'user_email': customer_email,
@@ -4345,21 +4370,20 @@ def process_purchase():
             }
             purchase_records.append(purchase_record)
         
-        # Insert all purchase records
+        # Record the sale lines once; the order header is projected into products_sold
         if purchase_records:
-            user_data_bought.insert_many(purchase_records)
-        
-        # Record in products_sold
-        products_sold.insert_one({
-            'customer_id': customer_id,
-            'customer_name': customer_name,
-            'customer_email': customer_email,
-            'items': purchased_items,
-            'total_amount': total_amount,
-            'sold_by': worker_id,
-            'sold_by_name': worker_name,
-            'sale_date': datetime.datetime.utcnow()
-        })
+            record_sale(purchase_records, 'worker', header={
+                'customer_id': customer_id,
+                'customer_name': customer_name,
+                'customer_email': customer_email,
+                'items': purchased_items,
+                'total_amount': total_amount,
+                'sold_by': worker_id,
+                'sold_by_name': worker_name,
+                'sale_date': datetime.datetime.utcnow()
+            })
+        # The sale is recorded: its stock stays taken whatever happens next
+        taken.clear()
         
         # Update worker statistics
         workers_update.update_one(
@@ -4371,6 +4395,8 @@ def process_purchase():
                 }
             }
         )
+        data_changed('user_data_bought', 'products_sold', 'products_update', 'products_by_user',
+                     'users', 'workers_update')
         
         # Send purchase confirmation email to customer
         try:
@@ -4409,7 +4435,7 @@ def process_purchase():
         
     except Exception as e:
         print(f"Error processing purchase: {e}")
-        return jsonify({'error': str(e)}), 400
+        return refuse(str(e), 400)
 
 # Utility route to clean up products_by_user collection
 @app.route('/admin/cleanup-products', methods=['GET', 'POST'])
@@ -4421,6 +4447,7 @@ def cleanup_products():
     if request.method == 'POST':
         # Delete all products without proper structure (missing name field)
         result = products_by_user.delete_many({'name': {'$exists': False}})
+        data_changed('products_by_user')
         return jsonify({
             'success': True,
             'deleted_count': result.deleted_count,
@@ -4476,6 +4503,7 @@ def labor_register():
     
     result = users.insert_one(user)
     if result.inserted_id:
+        data_changed('users')
         # Send welcome email
         if send_welcome_email(email, name):
             flash('Registration successful! Welcome email sent.', 'success')
@@ -4659,7 +4687,14 @@ def view_cart():
             current_user['_id'] = str(current_user['_id'])
     except Exception:
         pass
-    return render_template('cart.html', cart=cart, cart_total=cart_total, current_user=current_user)
+    # Frequently bought together with the basket (see co_purchase.py)
+    frequently_bought = []
+    try:
+        frequently_bought = co_purchase.together(db, [item.get('product_id') for item in cart.values()], 4)
+    except Exception as e:
+        print(f"Error loading basket recommendations: {e}")
+    return render_template('cart.html', cart=cart, cart_total=cart_total, current_user=current_user,
+                           frequently_bought=frequently_bought)
 
 # Guest cart routes
 @app.route('/cart/guest-add', methods=['POST'])
@@ -4802,6 +4837,7 @@ def user_purchase():
             total_amount += line_total
 
         # ── Save purchases & reduce stock ─────────────────────────────
+        sale_lines = []
         for p in purchases:
             item = p['item']
             rec = {
@@ -4828,21 +4864,22 @@ def user_purchase():
                 'status':         'confirmed',
                 'sold_by_name':   'Self',
             }
-            # Save to both collections so admin analytics + user history both work
-            user_data_bought.insert_one(dict(rec))
-            products_sold.insert_one(dict(rec))
+            sale_lines.append(rec)
 
             # Decrease stock
-            products_update.update_one(
-                {'_id': ObjectId(item['product_id'])},
-                {'$inc': {f'variants.{p["variant_index"]}.stock': -int(item['quantity'])}}
-            )
+            adjust_variant_stock(products_update, ObjectId(item['product_id']),
+                                 p['variant_index'], -int(item['quantity']))
+        stock_changed('products_update', [line['product_id'] for line in sale_lines])
+        # Recorded once; projected into user_data_bought + products_sold
+        # so admin analytics and user history both work
+        record_sale(sale_lines, 'user')
 
         # ── Update user purchase counters ─────────────────────────────
         upd = {'$set': {'last_purchase': now}, '$inc': {'total_purchases': 1}}
         users.update_one({'_id': uid}, upd)
         if users_update is not None:
             users_update.update_one({'_id': uid}, upd)
+        data_changed('user_data_bought', 'products_sold', 'products_update', 'users', 'users_update')
 
         # ── Send confirmation email ───────────────────────────────────
         if user_email:
@@ -4986,14 +5023,13 @@ def guest_purchase():
         # Process all purchases
         for purchase in purchases:
             # Update stock
-            products_update.update_one(
-                {'_id': purchase['product_id']},
-                {'$inc': {f'variants.{purchase["variant_index"]}.stock': -purchase['quantity']}}
-            )
+            adjust_variant_stock(products_update, purchase['product_id'],
+                                 purchase['variant_index'], -purchase['quantity'])
 
-            # Save purchase record
-            products_sold.insert_one(purchase)
-            products_by_user.insert_one(purchase)
+        stock_changed('products_update', [purchase['product_id'] for purchase in purchases])
+        # Save purchase records (products_sold and products_by_user, as before)
+        record_sale(purchases, 'guest')
+        data_changed('products_sold', 'products_by_user', 'products_update', 'users')
 
         # Send confirmation email
         try:
@@ -5079,6 +5115,7 @@ def purchase_product():
         user = users.find_one({'_id': ObjectId(session['user_id'])})
         purchases = []
         total_amount = 0
+        order_id = f'ORD{datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S")}'
 
         # Verify stock and create purchase records
         for cart_key, item in cart.items():
@@ -5091,6 +5128,7 @@ def purchase_product():
                 return jsonify({'error': f'Not enough stock for {item["product_name"]} ({variant["quantity"]})'}, 400)
 
             purchase = {
+                'order_id': order_id,
                 'user_id': ObjectId(session['user_id']),
                 'product_id': ObjectId(item['product_id']),
                 'product_name': item['product_name'],
@@ -5110,14 +5148,8 @@ def purchase_product():
         order_details = "Order Summary:\n\n"
         for purchase in purchases:
             # Update stock
-            products_update.update_one(
-                {'_id': purchase['product_id']},
-                {'$inc': {f'variants.{purchase["variant_index"]}.stock': -purchase['quantity']}}
-            )
-
-            # Save purchase records
-            products_sold.insert_one(purchase)
-            products_by_user.insert_one(purchase)
+            adjust_variant_stock(products_update, purchase['product_id'],
+                                 purchase['variant_index'], -purchase['quantity'])
 
             # Add to email details
             order_details += (
@@ -5127,6 +5159,10 @@ def purchase_product():
                 f"Subtotal: Rs {purchase['total']}\n"
             )
 
+        stock_changed('products_update', [purchase['product_id'] for purchase in purchases])
+        record_sale(purchases, 'cart')
+        data_changed('products_sold', 'products_by_user', 'products_update')
+
         order_details += (
             "----------------------------------------\n"
             f"Total Amount: Rs {total_amount}\n"
@@ -5303,8 +5339,10 @@ def admin_get_products_list():
 @app.route('/admin/send-test-notifications-all', methods=['POST'])
 @admin_required
 def admin_send_test_notifications_all():
-    # Send festival offer emails to ALL users
+    # Send festival offer emails to ALL users, or to the RFM segments named in
+    # the JSON body ({"segments": [...]}, see customer_segments.py)
     try:
+        segments = (request.get_json(silent=True) or {}).get('segments', [])
         # Get current month to find relevant festivals
         current_month = datetime.datetime.now().strftime('%B')
         
@@ -5337,8 +5375,11 @@ def admin_send_test_notifications_all():
                 if current_festivals:
                     break
         
-        # Get all users with email addresses
-        all_users = list(users.find({'email': {'$exists': True, '$ne': ''}}))
+        # Get all users with email addresses (one indexed query per segment if targeted)
+        if segments:
+            all_users = customer_segments.recipients(db, segments)
+        else:
+            all_users = list(users.find({'email': {'$exists': True, '$ne': ''}}))
 
         # If TEST_RECIPIENT_EMAILS is configured, restrict to those addresses only
         original_count = len(all_users)
@@ -5354,6 +5395,11 @@ def admin_send_test_notifications_all():
                 'error': 'No users matched the configured TEST_RECIPIENT_EMAILS whitelist',
                 'original_user_count': original_count
             }), 400
+
+        # Recently bought products from the stored customer profiles, in one query
+        recent_products = {str(c['_id']): c.get('recent_products', []) for c in
+                           customer_segments.recipients(db, user_ids=[u['_id'] for u in all_users],
+                                                        projection={'recent_products': 1})}
         
         success_count = 0
         failed_count = 0
@@ -5364,9 +5410,6 @@ def admin_send_test_notifications_all():
                 user_email = user.get('email')
                 user_name = user.get('name', 'Valued Customer')
                 
-                # Get user's purchase history
-                user_purchases = list(products_by_user.find({'user_id': user['_id']}).limit(5))
-                
                 # Create personalized email content
                 festival_info = current_festivals[0] if current_festivals else {
                     'name': 'Special Sale',
@@ -5374,9 +5417,7 @@ def admin_send_test_notifications_all():
                     'discount': '20-30%'
                 }
 
-                purchased_products = []
-                if user_purchases:
-                    purchased_products = [p.get('product_name', 'Product') for p in user_purchases[:3]]
+                purchased_products = recent_products.get(str(user['_id']), [])[:3]
 
                 html_body = render_template(
                     'email_festival_offer.html',
@@ -5413,21 +5454,23 @@ def admin_send_test_notifications_all():
 @app.route('/admin/send-personalized-offers', methods=['POST'])
 @admin_required
 def admin_send_personalized_offers():
-    # Send personalized product offers to users based on their purchase history
+    # Send personalized product offers to customers from their stored RFM
+    # profile (see customer_segments.py): top category, recent products and
+    # spend come from one query per segment instead of per-user history scans.
     try:
-        data = request.get_json()
-        target_users = data.get('user_ids', [])  # If empty, send to all users
-        
-        # Get users to send offers to
-        if target_users:
-            query = {'_id': {'$in': [ObjectId(uid) for uid in target_users]}, 'email': {'$exists': True, '$ne': ''}}
-        else:
-            query = {'email': {'$exists': True, '$ne': ''}}
-        
-        all_users = list(users.find(query))
+        data = request.get_json() or {}
+        target_users = data.get('user_ids', [])  # If empty, send to the chosen segments
+        segments = data.get('segments', [])      # If both are empty, send to all customers
+
+        # Segments are built by the background segmenter only; scoring every
+        # customer inside the request would race it
+        if db[customer_segments.SEGMENT_COLLECTION].estimated_document_count() == 0:
+            return jsonify({'success': False, 'error': 'Customer segments are not built yet. '
+                            'Try again in a few minutes.'}), 503
+        recipients = customer_segments.recipients(db, segments, target_users or None)
         
-        if not all_users:
-            return jsonify({'success': False, 'error': 'No users with email addresses found'}), 400
+        if not recipients:
+            return jsonify({'success': False, 'error': 'No customers with email addresses and purchases found'}), 400
         
         success_count = 0
         failed_count = 0
@@ -5448,46 +5491,36 @@ def admin_send_personalized_offers():
                 'name': 'Special Sale',
                 'discount': '20-30%'
             }
+
+        # Category products, fetched once per category, top up the
+        # frequently-bought-together picks for the customer's recent products
+        category_products = {}
         
         # Send personalized emails
-        for user in all_users:
+        for customer in recipients:
             try:
-                user_email = user.get('email')
-                user_name = user.get('name', 'Valued Customer')
-                
-                # Get user's purchase history
-                user_purchases = list(products_by_user.find({'user_id': user['_id']}).sort('_id', -1).limit(10))
-                
-                if not user_purchases:
-                    # Skip users with no purchase history
-                    continue
+                user_email = customer.get('email')
+                user_name = customer.get('name') or 'Valued Customer'
+                top_category = customer.get('top_category') or 'General'
+                purchased = customer.get('recent_products', [])
                 
-                # Analyze purchase patterns
-                purchased_categories = {}
-                purchased_products = []
-                total_spent = 0
-                
-                for purchase in user_purchases:
-                    purchased_products.append(purchase.get('product_name', 'Product'))
-                    category = purchase.get('category', 'General')
-                    purchased_categories[category] = purchased_categories.get(category, 0) + 1
-                    total_spent += purchase.get('price', 0) * purchase.get('quantity', 1)
-                
-                # Find top category
-                top_category = max(purchased_categories, key=purchased_categories.get) if purchased_categories else 'General'
-                
-                # Get recommended products from the same category
-                recommended_products = list(products_update.find({'category': top_category}).limit(5))
+                recommended = co_purchase.together(db, purchased, 5)
+                if len(recommended) < 5:
+                    if top_category not in category_products:
+                        category_products[top_category] = list(products_update.find({'category': top_category}).limit(10))
+                    picked = {r['name'] for r in recommended}.union(purchased)
+                    recommended += [p for p in category_products[top_category] if p.get('name') not in picked]
+                    recommended = recommended[:5]
                 
                 # Create personalized email using template
                 html_body = render_template(
                     'email_personalized_offers.html',
                     user_name=user_name,
-                    user_purchases=user_purchases,
-                    total_spent=total_spent,
+                    order_count=customer.get('orders', 0),
+                    total_spent=customer.get('monetary', 0),
                     top_category=top_category,
-                    purchased_products=purchased_products,
-                    recommended_products=recommended_products,
+                    purchased_products=purchased,
+                    recommended_products=recommended,
                     current_festival=current_festival,
                 )
                 
@@ -5498,7 +5531,7 @@ def admin_send_personalized_offers():
                     failed_count += 1
                     
             except Exception as e:
-                print(f"Error sending personalized offer to {user.get('email', 'unknown')}: {e}")
+                print(f"Error sending personalized offer to {customer.get('email', 'unknown')}: {e}")
                 failed_count += 1
         
         return jsonify({
@@ -5550,8 +5583,17 @@ def _rag_query(question: str) -> str:
         week_start  = today_start - datetime.timedelta(days=7)
         month_start = today_start.replace(day=1)
 
+        # In-memory sales columns answer the sales sections when loaded (see sales_columns.py)
+        store = sales_column_store.fresh(db) if sales_column_store is not None else None
+
         # ── Sales / revenue queries ──────────────────────────────────
-        if any(w in q for w in ['sale','revenue','sold','purchase','order','total','today','weekly','monthly','income','earning']):
+        if store is not None and any(w in q for w in ['sale','revenue','sold','purchase','order','total','today','weekly','monthly','income','earning']):
+            for label, start in (("TODAY'S", today_start), ("THIS WEEK'S", week_start),
+                                 ("THIS MONTH'S", month_start), ("ALL-TIME", None)):
+                t = store.period_totals(start)
+                ctx_parts.append(f"{label} SALES: count={t['orders']}, revenue=Rs {t['revenue']:.2f}")
+
+        elif any(w in q for w in ['sale','revenue','sold','purchase','order','total','today','weekly','monthly','income','earning']):
             # Today
             today_pipe = [
                 {'$match': {'purchase_date': {'$gte': today_start}}},
@@ -5583,22 +5625,23 @@ def _rag_query(question: str) -> str:
 
         # ── Top products ─────────────────────────────────────────────
         if any(w in q for w in ['product','top','best','popular','sell','item','category']):
-            top_pipe = [
-                {'$group': {'_id': '$product_name', 'units': {'$sum': '$quantity'}, 'revenue': {'$sum': '$total'}}},
-                {'$sort': {'revenue': -1}},
-                {'$limit': 8}
-            ]
-            rows = list(db.user_data_bought.aggregate(top_pipe))
+            if store is not None:
+                rows = store.top_keys('product', limit=8)
+            else:
+                rows = sales_topk.top(db, 'product', 8)
             if rows:
                 ctx_parts.append("TOP PRODUCTS BY REVENUE:\n" +
                     "\n".join([f"  • {r['_id']}: {r['units']} units, Rs {r['revenue']:.2f}" for r in rows]))
 
             # Category breakdown
-            cat_pipe = [
-                {'$group': {'_id': '$category', 'revenue': {'$sum': '$total'}, 'count': {'$sum': 1}}},
-                {'$sort': {'revenue': -1}}, {'$limit': 6}
-            ]
-            cats = list(db.user_data_bought.aggregate(cat_pipe))
+            if store is not None:
+                cats = [dict(c, count=c['orders']) for c in store.top_keys('category', limit=6)]
+            else:
+                cat_pipe = [
+                    {'$group': {'_id': '$category', 'revenue': {'$sum': '$total'}, 'count': {'$sum': 1}}},
+                    {'$sort': {'revenue': -1}}, {'$limit': 6}
+                ]
+                cats = list(db.user_data_bought.aggregate(cat_pipe))
             if cats:
                 ctx_parts.append("TOP CATEGORIES:\n" +
                     "\n".join([f"  • {c['_id'] or 'Uncategorized'}: Rs {c['revenue']:.2f} ({c['count']} orders)" for c in cats]))
@@ -5609,19 +5652,15 @@ def _rag_query(question: str) -> str:
                 count += db[col].count_documents({})
             ctx_parts.append(f"TOTAL PRODUCTS IN INVENTORY: {count}")
 
-            # Low stock (< 10 units)
-            low_stock = []
-            for col in ['products_update', 'products']:
-                for p in db[col].find({}, {'name': 1, 'variants': 1, 'stock': 1}):
-                    name = p.get('name', '?')
-                    if p.get('variants'):
-                        for v in p['variants']:
-                            if (v.get('stock') or 0) < 10:
-                                low_stock.append(f"{name} ({v.get('quantity','?')}): {v.get('stock',0)} left")
-                    elif (p.get('stock') or 0) < 10:
-                        low_stock.append(f"{name}: {p.get('stock',0)} left")
-            if low_stock:
-                ctx_parts.append("LOW STOCK ITEMS (<10):\n" + "\n".join([f"  • {x}" for x in low_stock[:10]]))
+            # Low stock, lowest first, from the low-stock view
+            low_stock_lines = [
+                f"{item['product_name'] or '?'} ({item['variant'] or '?'}): {item['stock']} left"
+                if item['variant_index'] is not None else f"{item['product_name'] or '?'}: {item['stock']} left"
+                for item in low_stock.items(db, 10, sources=('products_update', 'products'))
+            ]
+            if low_stock_lines:
+                ctx_parts.append(f"LOW STOCK ITEMS (<{low_stock.LOW_STOCK_THRESHOLD}):\n" +
+                                 "\n".join([f"  • {x}" for x in low_stock_lines]))
 
         # ── Users / customers ────────────────────────────────────────
         if any(w in q for w in ['user','customer','register','signup','member','buyer','new','people']):
@@ -5648,10 +5687,10 @@ def _rag_query(question: str) -> str:
             ctx_parts.append(f"NEW USERS THIS WEEK: {new_week}")
 
             # Top buyers
-            top_buyers = list(db.user_data_bought.aggregate([
-                {'$group': {'_id': '$user_name', 'spent': {'$sum': '$total'}, 'orders': {'$sum': 1}}},
-                {'$sort': {'spent': -1}}, {'$limit': 5}
-            ]))
+            if store is not None:
+                top_buyers = [dict(b, spent=b['revenue']) for b in store.top_keys('user', limit=5)]
+            else:
+                top_buyers = [dict(b, spent=b['revenue']) for b in sales_topk.top(db, 'user', 5)]
             if top_buyers:
                 ctx_parts.append("TOP BUYERS:\n" +
                     "\n".join([f"  • {b['_id']}: Rs {b['spent']:.2f} ({b['orders']} orders)" for b in top_buyers]))
@@ -5665,26 +5704,29 @@ def _rag_query(question: str) -> str:
             ctx_parts.append(f"TOTAL WORKERS: {w_count}")
 
             # Top workers by sales
-            top_workers = list(db.user_data_bought.aggregate([
-                {'$match': {'sold_by_name': {'$exists': True, '$ne': None}}},
-                {'$group': {'_id': '$sold_by_name', 'revenue': {'$sum': '$total'}, 'count': {'$sum': 1}}},
-                {'$sort': {'revenue': -1}}, {'$limit': 5}
-            ]))
+            if store is not None:
+                top_workers = [dict(w, count=w['orders']) for w in store.top_keys('worker') if w['_id'] is not None][:5]
+            else:
+                top_workers = [dict(w, count=w['orders']) for w in sales_topk.top(db, 'worker', 5)]
             if top_workers:
                 ctx_parts.append("TOP WORKERS BY SALES:\n" +
                     "\n".join([f"  • {w['_id']}: Rs {w['revenue']:.2f} ({w['count']} sales)" for w in top_workers]))
 
         # ── Daily trend ──────────────────────────────────────────────
         if any(w in q for w in ['trend','daily','per day','chart','graph','last 7','last seven','week']):
-            daily_pipe = [
-                {'$match': {'purchase_date': {'$gte': week_start}}},
-                {'$group': {
-                    '_id': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$purchase_date'}},
-                    'revenue': {'$sum': '$total'}, 'count': {'$sum': 1}
-                }},
-                {'$sort': {'_id': 1}}
-            ]
-            days = list(db.user_data_bought.aggregate(daily_pipe))
+            if store is not None:
+                days = [{'_id': p['bucket'].strftime('%Y-%m-%d'), 'revenue': p['value'], 'count': p['count']}
+                        for p in store.trend(week_start, today_start) if p['count']]
+            else:
+                daily_pipe = [
+                    {'$match': {'purchase_date': {'$gte': week_start}}},
+                    {'$group': {
+                        '_id': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$purchase_date'}},
+                        'revenue': {'$sum': '$total'}, 'count': {'$sum': 1}
+                    }},
+                    {'$sort': {'_id': 1}}
+                ]
+                days = list(db.user_data_bought.aggregate(daily_pipe))
             if days:
                 ctx_parts.append("DAILY SALES (last 7 days):\n" +
                     "\n".join([f"  {d['_id']}: Rs {d['revenue']:.2f} ({d['count']} orders)" for d in days]))
@@ -5839,19 +5881,25 @@ def admin_ai_chat_send():
 @app.route('/api/ai-chat-sessions')
 @admin_required
 def ai_chat_sessions_list():
-    # Return all AI chat sessions (title + session_id + updated_at), newest first.
+    # Return AI chat sessions (title + session_id + updated_at), newest first,
+    # one keyset page at a time (?after=<next_cursor>).
     try:
         if admin_ai_chats is None:
-            return jsonify([])
-        docs = list(admin_ai_chats.find(
-            {}, {'session_id': 1, 'title': 1, 'updated_at': 1, '_id': 0}
-        ).sort('updated_at', -1).limit(50))
+            return jsonify({'sessions': [], 'next_cursor': None})
+        limit = max(1, min(request.args.get('limit', 50, type=int), 200))
+        result = keyset.page(admin_ai_chats, limit, field='updated_at',
+                             projection={'session_id': 1, 'title': 1, 'updated_at': 1},
+                             after=request.args.get('after'))
+        docs = result['items']
         for d in docs:
+            d.pop('_id', None)
             if hasattr(d.get('updated_at'), 'strftime'):
                 d['updated_at'] = d['updated_at'].strftime('%d %b %Y, %H:%M')
-        return jsonify(docs)
+        return jsonify({'sessions': docs, 'next_cursor': result['next']})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        return jsonify([])
+        return jsonify({'sessions': [], 'next_cursor': None})
 
 
 @app.route('/api/ai-chat-sessions/<session_id>')
@@ -6337,13 +6385,13 @@ def project_assistant():
         # 3. Product count query
         if wants_count and any(keyword in question for keyword in product_keywords):
             try:
-                low_stock = products_update.count_documents({'variants.stock': {'$lt': 10}}) if products_update is not None else 0
+                low_stock_count = low_stock.count_products(db) if products_update is not None else 0
                 return jsonify({
                     'answer': (
                         "Product Statistics:\n\n"
                         f"Total products: {total_products}\n"
-                        f"Low stock items: {low_stock}\n"
-                        f"Well stocked: {total_products - low_stock}\n\n"
+                        f"Low stock items: {low_stock_count}\n"
+                        f"Well stocked: {total_products - low_stock_count}\n\n"
                         "Check Product Reports for detailed inventory."
                     )
                 })
@@ -6365,17 +6413,8 @@ def project_assistant():
         # 5. Top products query
         if (wants_list or 'top' in question or 'best' in question) and any(keyword in question for keyword in product_keywords):
             try:
-                # Get top selling products from database
-                top_products_pipeline = [
-                    {'$group': {
-                        '_id': '$product_name',
-                        'total_sold': {'$sum': '$quantity'},
-                        'revenue': {'$sum': '$total'}
-                    }},
-                    {'$sort': {'total_sold': -1}},
-                    {'$limit': 5}
-                ]
-                top_prods = list(products_sold.aggregate(top_products_pipeline)) if products_sold is not None else []
+                # Best sellers by units from the streaming top-K summaries
+                top_prods = [dict(p, total_sold=p['units']) for p in sales_topk.top(db, 'product_units', 5)]
                 
                 if top_prods:
                     lines = [
@@ -6412,14 +6451,12 @@ def project_assistant():
         # 7. Low stock alert query
         if 'low stock' in question or 'out of stock' in question or 'reorder' in question:
             try:
-                low_stock_products = list(products_update.find(
-                    {'variants.stock': {'$lt': 10}}
-                ).limit(5)) if products_update is not None else []
+                low_stock_products = low_stock.items(db, 5) if products_update is not None else []
                 
                 if low_stock_products:
                     lines = [
-                        f"• {prod['name']} - {prod['variants'][0]['stock']} units left"
-                        for prod in low_stock_products if prod.get('variants')
+                        f"• {prod['product_name']} - {prod['stock']} units left"
+                        for prod in low_stock_products
                     ]
                     products_text = "\n".join(lines)
                     return jsonify({
@@ -0,0 +1,167 @@
+"""
+bench_columnar_cache.py
+-----------------------
+Benchmark: MongoDB pipelines vs. the in-memory columnar sales cache.
+
+For each row count, loads that many synthetic sale lines into a throwaway
+database on a local mongod, loads them into `sales_columns.SalesColumns`, and
+times the dashboard-style queries both ways:
+
+    period     revenue / orders / units for the last 30 days
+    category   revenue per category, all time
+    product    top 8 products by revenue, last 30 days
+    trend      daily revenue for the last 30 days
+
+"mongo" runs the $match/$group pipelines over user_data_bought that
+business_stats_api and _rag_query used before the caches; "columns" answers
+from the NumPy arrays.
+
+Usage:
+    python benchmarks/bench_columnar_cache.py                       # 1M and 10M rows
+    python benchmarks/bench_columnar_cache.py --rows 1000000 --uri mongodb://localhost:27017
+    python benchmarks/bench_columnar_cache.py --columns-only        # no mongod needed
+
+The target database (default `saless_bench`) is dropped before and after each size.
+Requires NumPy.
+"""
+
+import argparse
+import datetime
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sales_columns  # noqa: E402
+
+if sales_columns.np is None:
+    sys.exit("NumPy is required for this benchmark.")
+
+PRODUCTS = [(f'Product {i}', f'Category {i % 12}', 15.0 + i * 3.25) for i in range(400)]
+USERS = [f'Customer {i}' for i in range(20000)]
+WORKERS = [f'Worker {i}' for i in range(25)] + ['Self']
+
+
+def synthetic_batches(rows: int, days: int = 730, batch: int = 10000):
+    random.seed(7)
+    now = datetime.datetime.now().replace(microsecond=0)
+    produced = 0
+    while produced < rows:
+        size = min(batch, rows - produced)
+        docs = []
+        for _ in range(size):
+            name, category, price = random.choice(PRODUCTS)
+            qty = random.randint(1, 5)
+            docs.append({
+                'purchase_date': now - datetime.timedelta(seconds=random.randint(0, days * 86400)),
+                'total': round(price * qty, 2), 'quantity': qty, 'category': category,
+                'product_name': name, 'user_name': random.choice(USERS),
+                'sold_by_name': random.choice(WORKERS),
+            })
+        produced += size
+        yield docs
+
+
+def mongo_queries(coll):
+    today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    since = today - datetime.timedelta(days=29)
+    return {
+        'period': lambda: list(coll.aggregate([
+            {'$match': {'purchase_date': {'$gte': since}}},
+            {'$group': {'_id': None, 'revenue': {'$sum': '$total'}, 'orders': {'$sum': 1},
+                        'units': {'$sum': '$quantity'}}}])),
+        'category': lambda: list(coll.aggregate([
+            {'$group': {'_id': '$category', 'revenue': {'$sum': '$total'}, 'count': {'$sum': 1}}},
+            {'$sort': {'revenue': -1}}])),
+        'product': lambda: list(coll.aggregate([
+            {'$match': {'purchase_date': {'$gte': since}}},
+            {'$group': {'_id': '$product_name', 'revenue': {'$sum': '$total'}, 'units': {'$sum': '$quantity'}}},
+            {'$sort': {'revenue': -1}}, {'$limit': 8}])),
+        'trend': lambda: list(coll.aggregate([
+            {'$match': {'purchase_date': {'$gte': since}}},
+            {'$group': {'_id': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$purchase_date'}},
+                        'revenue': {'$sum': '$total'}}},
+            {'$sort': {'_id': 1}}])),
+    }
+
+
+def column_queries(store):
+    today = datetime.datetime.now()
+    since = today - datetime.timedelta(days=29)
+    return {
+        'period': lambda: store.period_totals(since, today),
+        'category': lambda: store.top_keys('category'),
+        'product': lambda: store.top_keys('product', since, today, limit=8),
+        'trend': lambda: store.trend(since, today),
+    }
+
+
+def timed(fn, repeat: int) -> float:
+    fn()  # warm-up
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(samples)
+
+
+def run_size(rows: int, args, client) -> None:
+    budget_mb = max(sales_columns.MEMORY_BUDGET_MB, rows * sales_columns.BYTES_PER_ROW // (1024 * 1024) + 64)
+    store = sales_columns.SalesColumns(budget_mb=budget_mb)
+    print(f"\n=== {rows:,} rows ===")
+
+    mongo = None
+    t0 = time.perf_counter()
+    if client is not None:
+        client.drop_database(args.database)
+        coll = client[args.database][sales_columns.SOURCE_COLLECTION]
+        for docs in synthetic_batches(rows):
+            coll.insert_many(docs, ordered=False)
+        coll.create_index('purchase_date')
+        print(f"  mongo insert:  {time.perf_counter() - t0:8.1f} s")
+        t0 = time.perf_counter()
+        store.load(client[args.database])
+        mongo = mongo_queries(coll)
+    else:
+        for docs in synthetic_batches(rows):
+            store._append_batch(docs)
+        store.ready = True
+    print(f"  columns load:  {time.perf_counter() - t0:8.1f} s   ({store.stats()['bytes'] / 1e6:,.0f} MB)")
+
+    columns = column_queries(store)
+    print(f"  {'query':<10} {'mongo ms':>10} {'columns ms':>11} {'speed-up':>9}")
+    for name, fn in columns.items():
+        col_ms = timed(fn, args.repeat)
+        if mongo is not None:
+            mongo_ms = timed(mongo[name], args.repeat)
+            print(f"  {name:<10} {mongo_ms:>10.2f} {col_ms:>11.3f} {mongo_ms / col_ms:>8.0f}x")
+        else:
+            print(f"  {name:<10} {'-':>10} {col_ms:>11.3f} {'-':>9}")
+
+    if client is not None:
+        client.drop_database(args.database)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the columnar sales cache against MongoDB')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1_000_000, 10_000_000])
+    parser.add_argument('--uri', default=os.getenv('BENCH_MONGO_URI', 'mongodb://localhost:27017'))
+    parser.add_argument('--database', default='saless_bench')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--columns-only', action='store_true', help='Skip MongoDB; time the cache alone')
+    args = parser.parse_args()
+
+    client = None
+    if not args.columns_only:
+        from pymongo import MongoClient
+        client = MongoClient(args.uri, serverSelectionTimeoutMS=3000)
+    for rows in args.rows:
+        run_size(rows, args, client)
+
+
+if __name__ == '__main__':
+    main()
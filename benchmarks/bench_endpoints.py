@@ -0,0 +1,228 @@
+"""
+bench_endpoints.py
+------------------
+Benchmark suite: the heavy analytics endpoints at 100K / 1M / 10M sale lines.
+
+For each scale, fills a throwaway database on a local mongod with
+`synthetic_data.generate()`, then calls every heavy endpoint through the
+Flask test client and records:
+
+    p50_ms / p95_ms   latency over --iterations calls
+    round_trips       MongoDB commands per call (median), via a command listener
+    peak_rss_mb       process peak RSS after the endpoint ran
+
+Each endpoint is measured *cold* and *warm*. Cold clears the in-process
+result cache before every call. Closed-day partials are kept, as they are in
+production. Warm repeats the same call.
+
+The report is written as JSON. With --baseline, every cold p50 is compared
+with the stored report and the run exits 1 when one is more than --tolerance
+times slower, so it can gate CI.
+
+Usage:
+    python benchmarks/bench_endpoints.py                                  # 100k, 1m
+    python benchmarks/bench_endpoints.py --scales 100k 1m 10m --report bench.json
+    python benchmarks/bench_endpoints.py --scales 100k --save-baseline benchmarks/baseline.json
+    python benchmarks/bench_endpoints.py --scales 100k --baseline benchmarks/baseline.json
+
+The app is pointed at --database via MONGODB_URL / MONGODB_DATABASE with
+BACKGROUND_JOBS=0. The database is dropped at the end unless --keep-data.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import time
+
+from pymongo import monitoring
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic_data  # noqa: E402
+
+SCALES = {'100k': 100_000, '1m': 1_000_000, '10m': 10_000_000}
+
+
+class RoundTripCounter(monitoring.CommandListener):
+    """Counts commands sent to the server (aggregate, find, getMore, ...)."""
+
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        if event.command_name not in ('hello', 'isMaster', 'ping', 'endSessions'):
+            self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def endpoints() -> list:
+    # (name, url) pairs; ranges end today like the dashboards' defaults
+    today = datetime.date.today()
+    d30 = (today - datetime.timedelta(days=29)).isoformat()
+    d90 = (today - datetime.timedelta(days=89)).isoformat()
+    d365 = (today - datetime.timedelta(days=364)).isoformat()
+    t = today.isoformat()
+    return [
+        ('business-stats 30d', '/api/business-stats?days=30'),
+        ('business-stats 365d', '/api/business-stats?days=365'),
+        ('analytics 30d', f'/api/analytics?start_date={d30}&end_date={t}'),
+        ('analytics 365d', f'/api/analytics?start_date={d365}&end_date={t}'),
+        ('chart-data 90d', f'/api/chart-data?from={d90}&to={t}'),
+        ('chart-data 365d', f'/api/chart-data?from={d365}&to={t}'),
+        ('admin dashboard', '/admin/dashboard'),
+        ('notifications', '/api/notifications'),
+        ('analytics pdf 365d', f'/api/export-analytics-pdf?start_date={d365}&end_date={t}'),
+        ('business summary pdf', '/api/export-business-summary-pdf'),
+    ]
+
+
+def percentile(samples, q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if platform.system() == 'Darwin' else 1024), 1)
+
+
+def admin_client(app_module):
+    client = app_module.app.test_client()
+    with client.session_transaction() as s:
+        s['admin_id'] = 'bench'
+        s['admin_name'] = 'Bench'
+        s['admin_logged_in'] = True
+        s['last_activity'] = datetime.datetime.utcnow().timestamp()
+    return client
+
+
+def measure(app_module, client, counter, url: str, iterations: int, cold: bool) -> dict:
+    latencies, trips = [], []
+    status = None
+    for _ in range(iterations):
+        if cold:
+            app_module.analytics_cache.clear()
+        before = counter.count
+        t0 = time.perf_counter()
+        response = client.get(url)
+        latencies.append((time.perf_counter() - t0) * 1000)
+        trips.append(counter.count - before)
+        status = response.status_code
+    return {'p50_ms': round(percentile(latencies, 0.5), 2), 'p95_ms': round(percentile(latencies, 0.95), 2),
+            'round_trips': int(statistics.median(trips)), 'status': status}
+
+
+def reset_app_caches(app_module) -> None:
+    # Data was regenerated under the same database name: forget everything in-process
+    app_module.analytics_cache.clear()
+    app_module.closed_day_cache = app_module.closed_periods.ClosedDayCache()
+    if app_module.sales_column_store is not None:
+        app_module.sales_column_store.load(app_module.db)
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """Cold p50 regressions beyond `tolerance` x baseline: [(scale, endpoint, base_ms, now_ms)]."""
+    regressions = []
+    for scale, results in report['scales'].items():
+        for name, result in results['endpoints'].items():
+            base = baseline.get('scales', {}).get(scale, {}).get('endpoints', {}).get(name)
+            if not base:
+                continue
+            base_ms, now_ms = base['cold']['p50_ms'], result['cold']['p50_ms']
+            marker = ''
+            if base_ms > 0 and now_ms > tolerance * base_ms:
+                regressions.append((scale, name, base_ms, now_ms))
+                marker = '  << regression'
+            print(f"  {scale:>4} {name:<22} {base_ms:>9.1f} -> {now_ms:>9.1f} ms{marker}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the heavy analytics endpoints')
+    parser.add_argument('--scales', nargs='+', default=['100k', '1m'], choices=sorted(SCALES))
+    parser.add_argument('--uri', default=os.getenv('BENCH_MONGO_URI', 'mongodb://localhost:27017'))
+    parser.add_argument('--database', default='saless_bench')
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--report', default='bench_endpoints_report.json', help='Where to write the JSON report')
+    parser.add_argument('--baseline', help='Compare against this stored report')
+    parser.add_argument('--save-baseline', help='Also store this run as the baseline at this path')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='Allowed cold p50 slow-down vs baseline')
+    parser.add_argument('--keep-data', action='store_true', help='Leave the benchmark database in place')
+    args = parser.parse_args()
+
+    # Point the app at the benchmark database before it is imported
+    os.environ['MONGODB_URL'] = args.uri
+    os.environ['MONGODB_DATABASE'] = args.database
+    os.environ['BACKGROUND_JOBS'] = '0'
+    counter = RoundTripCounter()
+    monitoring.register(counter)
+
+    import app as app_module  # noqa: E402
+    if app_module.db is None:
+        sys.exit(f"Could not connect to {args.uri}")
+    app_module.app.config['TESTING'] = True
+    db = app_module.db
+
+    report = {
+        'generated_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'iterations': args.iterations,
+        'seed': args.seed,
+        'scales': {},
+    }
+    try:
+        for scale in args.scales:
+            print(f"\n=== {scale} sale lines ===")
+            t0 = time.time()
+            counts = synthetic_data.generate(db, SCALES[scale], seed=args.seed)
+            reset_app_caches(app_module)
+            results = {'rows': counts, 'generate_s': round(time.time() - t0, 1), 'endpoints': {}}
+            client = admin_client(app_module)
+            print(f"  {'endpoint':<22} {'cold p50':>9} {'p95':>9} {'trips':>6} {'warm p50':>9} {'trips':>6} {'rss MB':>8}")
+            for name, url in endpoints():
+                cold = measure(app_module, client, counter, url, args.iterations, cold=True)
+                warm = measure(app_module, client, counter, url, args.iterations, cold=False)
+                rss = peak_rss_mb()
+                results['endpoints'][name] = {'url': url, 'cold': cold, 'warm': warm, 'peak_rss_mb': rss}
+                flag = '' if cold['status'] == 200 else f"  (HTTP {cold['status']})"
+                print(f"  {name:<22} {cold['p50_ms']:>9.1f} {cold['p95_ms']:>9.1f} {cold['round_trips']:>6} "
+                      f"{warm['p50_ms']:>9.1f} {warm['round_trips']:>6} {rss:>8.1f}{flag}")
+            report['scales'][scale] = results
+    finally:
+        if not args.keep_data:
+            db.client.drop_database(args.database)
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nReport written to {args.report}")
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline stored at {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\nCold p50 vs baseline {args.baseline} (tolerance {args.tolerance}x):")
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} endpoint(s) regressed.")
+            sys.exit(1)
+        print("\nNo regressions.")
+
+
+if __name__ == '__main__':
+    main()
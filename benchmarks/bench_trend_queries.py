@@ -0,0 +1,147 @@
+"""
+bench_trend_queries.py
+----------------------
+Micro-benchmark: per-bucket trend loops vs. one time-bucketed pipeline.
+
+Loads synthetic sales into a throwaway database on a local mongod, then times
+the 7/30/90/365-day trends three ways and counts MongoDB round trips with a
+pymongo command listener:
+
+    loop      one aggregate per day (≤30d) or per 7-day window (>30d),
+              the way the dashboards used to build their charts
+    raw       timeseries.trend() over user_data_bought (one $group/$dateTrunc)
+    rollup    sales_rollups.trend() over the daily rollups
+
+Usage:
+    python benchmarks/bench_trend_queries.py
+    python benchmarks/bench_trend_queries.py --uri mongodb://localhost:27017 --days 400 --per-day 300
+
+The target database (default `saless_bench`) is dropped before and after the run.
+"""
+
+import argparse
+import datetime
+import os
+import random
+import statistics
+import sys
+import time
+
+from pymongo import MongoClient, monitoring
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sales_rollups  # noqa: E402
+import timeseries  # noqa: E402
+
+
+class RoundTripCounter(monitoring.CommandListener):
+    """Counts commands sent to the server (aggregate, find, getMore, ...)."""
+
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        if event.command_name not in ('hello', 'isMaster', 'ping', 'endSessions'):
+            self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def load_synthetic(db, days: int, per_day: int) -> None:
+    random.seed(42)
+    today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    products = [(f'Product {i}', f'Category {i % 6}', 20.0 + i * 7.5) for i in range(40)]
+    batch = []
+    for d in range(days):
+        day = today - datetime.timedelta(days=d)
+        for _ in range(per_day):
+            name, category, price = random.choice(products)
+            qty = random.randint(1, 4)
+            ts = day + datetime.timedelta(minutes=random.randint(0, 24 * 60 - 1))
+            batch.append({'product_name': name, 'category': category, 'quantity': qty,
+                          'price': price, 'total': round(price * qty, 2), 'purchase_date': ts})
+        if len(batch) >= 5000:
+            db.user_data_bought.insert_many(batch)
+            batch = []
+    if batch:
+        db.user_data_bought.insert_many(batch)
+    db.user_data_bought.create_index('purchase_date')
+    sales_rollups.backfill(db)
+
+
+def loop_trend(db, days: int) -> list:
+    """Legacy shape: one aggregate per day, or per 7-day window beyond 30 days."""
+    now = datetime.datetime.now()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    points = []
+    windows = ([(today - datetime.timedelta(days=i), 1) for i in range(days - 1, -1, -1)]
+               if days <= 30 else
+               [(today - datetime.timedelta(days=(w + 1) * 7 - 1), 7) for w in range(days // 7 - 1, -1, -1)])
+    for start, length in windows:
+        rows = list(db.user_data_bought.aggregate([
+            {'$match': {'purchase_date': {'$gte': start, '$lt': start + datetime.timedelta(days=length)}}},
+            {'$group': {'_id': None, 'total': {'$sum': '$total'}}},
+        ]))
+        points.append(rows[0]['total'] if rows else 0.0)
+    return points
+
+
+def raw_trend(db, days: int) -> list:
+    today = datetime.datetime.now()
+    unit = 'day' if days <= 30 else 'week'
+    return timeseries.trend(db.user_data_bought, today - datetime.timedelta(days=days - 1), today, unit)
+
+
+def rollup_trend(db, days: int) -> list:
+    today = datetime.datetime.now()
+    unit = 'day' if days <= 30 else 'week'
+    return sales_rollups.trend(db, today - datetime.timedelta(days=days - 1), today, unit)
+
+
+def measure(fn, db, days: int, counter: RoundTripCounter, repeat: int):
+    fn(db, days)  # warm-up
+    timings = []
+    trips = 0
+    for _ in range(repeat):
+        before = counter.count
+        t0 = time.perf_counter()
+        fn(db, days)
+        timings.append((time.perf_counter() - t0) * 1000)
+        trips = counter.count - before
+    return trips, statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark trend queries against a local mongod')
+    parser.add_argument('--uri', default=os.getenv('BENCH_MONGO_URI', 'mongodb://localhost:27017'))
+    parser.add_argument('--database', default='saless_bench')
+    parser.add_argument('--days', type=int, default=400, help='Days of synthetic history')
+    parser.add_argument('--per-day', type=int, default=200, help='Sale lines per day')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    counter = RoundTripCounter()
+    client = MongoClient(args.uri, event_listeners=[counter], serverSelectionTimeoutMS=3000)
+    client.drop_database(args.database)
+    db = client[args.database]
+
+    print(f"Loading {args.days * args.per_day:,} synthetic sale lines into {args.database} ...")
+    load_synthetic(db, args.days, args.per_day)
+
+    print(f"\n{'window':>7} {'method':>7} {'round trips':>12} {'median ms':>10}")
+    try:
+        for window in (7, 30, 90, 365):
+            for label, fn in (('loop', loop_trend), ('raw', raw_trend), ('rollup', rollup_trend)):
+                trips, ms = measure(fn, db, window, counter, args.repeat)
+                print(f"{window:>6}d {label:>7} {trips:>12} {ms:>10.2f}")
+    finally:
+        client.drop_database(args.database)
+
+
+if __name__ == '__main__':
+    main()
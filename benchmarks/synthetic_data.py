@@ -0,0 +1,227 @@
+"""
+synthetic_data.py
+-----------------
+Deterministic synthetic shop data for the benchmark suite.
+
+`generate()` writes ``users``, ``products_update``, ``user_data_bought`` and
+``products_sold`` in the shapes the checkout paths produce, then builds the
+derived state the app serves from: daily rollups and HyperLogLog sketches,
+demand EWMAs, top-K summaries, order-value digests, demand forecasts, cohort
+retention months, RFM customer segments, the co-purchase index, the
+low-stock view, the inventory valuation summary and the product-performance
+snapshot. The same seed, size and day produce the same data. Dates are
+anchored to today because the dashboards are.
+
+Distribution:
+    orders        1-4 lines each, spread over `days` days with a weekly cycle
+                  and mild growth toward today
+    products      `products` items in 12 categories; popularity is Zipf-like
+    customers     one per ~40 sale lines (at least 200); spend is Zipf-like
+    workers       8, plus self-checkout ('Self')
+
+Usage:
+    python benchmarks/synthetic_data.py --sales 100000               # into saless_bench
+    python benchmarks/synthetic_data.py --sales 1000000 --database saless_bench_1m
+"""
+
+import argparse
+import bisect
+import datetime
+import itertools
+import os
+import random
+import sys
+import time
+
+from bson import ObjectId
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import closed_periods  # noqa: E402
+import product_performance  # noqa: E402
+import result_cache  # noqa: E402
+import sales_rollups  # noqa: E402
+import customer_sketches  # noqa: E402
+import sales_spikes  # noqa: E402
+import sales_topk  # noqa: E402
+import order_digests  # noqa: E402
+import demand_forecast  # noqa: E402
+import cohorts  # noqa: E402
+import customer_segments  # noqa: E402
+import co_purchase  # noqa: E402
+import low_stock  # noqa: E402
+import inventory_summary  # noqa: E402
+import shared_cache  # noqa: E402
+
+CATEGORIES = ['Rice', 'Flour', 'Oils', 'Pulses', 'Sugar', 'Spices',
+              'Sauces', 'Nuts', 'Dairy', 'Snacks', 'Beverages', 'Household']
+VARIANTS = [('250g', 0.3), ('500g', 0.55), ('1kg', 1.0), ('2kg', 1.9), ('5kg', 4.5)]
+WORKERS = ['Gobi', 'Bhuvaneswari', 'Anandha', 'Karthi', 'Priya', 'Selva', 'Meena', 'Ravi']
+BATCH = 10000
+
+
+def _zipf_cumulative(n: int, s: float = 1.1) -> list:
+    return list(itertools.accumulate(1.0 / (rank ** s) for rank in range(1, n + 1)))
+
+
+def _pick(rng, items, cumulative):
+    return items[bisect.bisect(cumulative, rng.random() * cumulative[-1])]
+
+
+def _object_id(rng) -> ObjectId:
+    # Seeded ids keep the data (and its ordering) reproducible
+    return ObjectId(rng.getrandbits(96).to_bytes(12, 'big'))
+
+
+def _products(rng, count: int, now) -> list:
+    docs = []
+    for i in range(count):
+        base = round(rng.uniform(15, 500), 2)
+        docs.append({
+            '_id': _object_id(rng),
+            'name': f'Product {i:04d}',
+            'category': CATEGORIES[i % len(CATEGORIES)],
+            'variants': [{'quantity': label, 'price': round(base * factor, 2), 'stock': rng.randint(0, 120)}
+                         for label, factor in VARIANTS[:rng.randint(1, len(VARIANTS))]],
+            'created_at': now - datetime.timedelta(days=rng.randint(30, 900)),
+        })
+    return docs
+
+
+def _users(rng, count: int, now, days: int) -> list:
+    return [{
+        '_id': _object_id(rng),
+        'name': f'Customer {i:06d}',
+        'email': f'customer{i:06d}@bench.example',
+        'mobile': f'9{i:09d}',
+        'created_at': now - datetime.timedelta(days=rng.randint(0, days + 30), seconds=rng.randint(0, 86399)),
+        'total_purchases': 0,
+    } for i in range(count)]
+
+
+def _day_weights(days: int) -> list:
+    # Weekend bump and ~50% growth from the first day to today
+    today = datetime.date.today()
+    weights = []
+    for d in range(days):
+        day = today - datetime.timedelta(days=days - 1 - d)
+        weights.append((1.3 if day.weekday() >= 5 else 1.0) * (1.0 + 0.5 * d / max(days - 1, 1)))
+    return list(itertools.accumulate(weights))
+
+
+def sale_lines(rng, sales: int, days: int, products: list, users: list):
+    """Yield batches of sale lines (dicts without _id), `sales` lines in total."""
+    today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    now = datetime.datetime.now()
+    product_cdf = _zipf_cumulative(len(products))
+    user_cdf = _zipf_cumulative(len(users), 0.8)
+    day_cdf = _day_weights(days)
+    produced, order_no, batch = 0, 0, []
+    while produced < sales:
+        order_no += 1
+        day_index = bisect.bisect(day_cdf, rng.random() * day_cdf[-1])
+        ts = today - datetime.timedelta(days=days - 1 - day_index) + \
+            datetime.timedelta(seconds=rng.randint(8 * 3600, 22 * 3600))
+        if ts > now:
+            ts = now - datetime.timedelta(seconds=rng.randint(1, 3600))
+        user = _pick(rng, users, user_cdf)
+        worker = rng.choice(WORKERS + ['Self'])
+        for _ in range(min(rng.randint(1, 4), sales - produced)):
+            product = _pick(rng, products, product_cdf)
+            variant_index = rng.randrange(len(product['variants']))
+            variant = product['variants'][variant_index]
+            qty = rng.randint(1, 5)
+            batch.append({
+                'order_id': f'BENCH{order_no:09d}',
+                'user_id': str(user['_id']),
+                'user_name': user['name'],
+                'user_email': user['email'],
+                'product_id': str(product['_id']),
+                'product_name': product['name'],
+                'category': product['category'],
+                'variant': variant['quantity'],
+                'variant_index': variant_index,
+                'quantity': qty,
+                'price': variant['price'],
+                'total': round(variant['price'] * qty, 2),
+                'purchase_date': ts,
+                'date': ts,
+                'sold_by_name': worker,
+                'payment_status': 'completed',
+            })
+            produced += 1
+        if len(batch) >= BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def generate(db, sales: int, days: int = 365, products: int = 400, seed: int = 42, verbose: bool = True) -> dict:
+    """Drop and refill the benchmark collections in `db`; returns row counts."""
+    rng = random.Random(seed)
+    now = datetime.datetime.now()
+    started = time.time()
+    for name in ('users', 'products_update', 'user_data_bought', 'products_sold',
+                 sales_rollups.ROLLUP_COLLECTION, sales_spikes.STATE_COLLECTION,
+                 customer_sketches.SKETCH_COLLECTION,
+                 product_performance.SNAPSHOT_COLLECTION, closed_periods.CACHE_COLLECTION,
+                 sales_topk.TOPK_COLLECTION, order_digests.DIGEST_COLLECTION,
+                 demand_forecast.FORECAST_COLLECTION, cohorts.COHORT_COLLECTION,
+                 customer_segments.SEGMENT_COLLECTION, co_purchase.CO_PURCHASE_COLLECTION,
+                 low_stock.LOW_STOCK_COLLECTION, inventory_summary.SUMMARY_COLLECTION,
+                 result_cache.GENERATION_COLLECTION, shared_cache.CACHE_COLLECTION):
+        db.drop_collection(name)
+
+    product_docs = _products(rng, products, now)
+    user_docs = _users(rng, max(200, sales // 40), now, days)
+    db.products_update.insert_many(product_docs, ordered=False)
+    db.users.insert_many(user_docs, ordered=False)
+
+    written = 0
+    for n, batch in enumerate(sale_lines(rng, sales, days, product_docs, user_docs), 1):
+        db.user_data_bought.insert_many([dict(line) for line in batch], ordered=False)
+        db.products_sold.insert_many(batch, ordered=False)
+        written += len(batch)
+        if verbose and n % 10 == 0:
+            print(f"  … {written:,} sale lines ({time.time() - started:.0f}s)")
+
+    # Indexes the app creates at startup, then the derived state it serves from
+    db.products_sold.create_index([('date', -1), ('total', 1)])
+    db.user_data_bought.create_index('purchase_date')
+    sales_rollups.ensure_indexes(db)
+    sales_rollups.backfill(db)
+    customer_sketches.rebuild(db)
+    sales_spikes.rebuild(db)
+    sales_topk.rebuild(db)
+    order_digests.rebuild(db)
+    if demand_forecast.available():
+        demand_forecast.refresh(db)
+    cohorts.ensure_indexes(db)
+    cohorts.refresh(db)
+    customer_segments.ensure_indexes(db)
+    customer_segments.refresh(db)
+    co_purchase.ensure_indexes(db)
+    co_purchase.rebuild(db)
+    low_stock.ensure_indexes(db)
+    low_stock.rebuild(db)
+    inventory_summary.ensure_indexes(db)
+    inventory_summary.reconcile(db)
+    product_performance.refresh(db)
+    if verbose:
+        print(f"  Generated {written:,} sale lines, {len(user_docs):,} customers, "
+              f"{len(product_docs)} products in {time.time() - started:.0f}s")
+    return {'sales': written, 'users': len(user_docs), 'products': len(product_docs)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write deterministic synthetic shop data')
+    parser.add_argument('--sales', type=int, default=100_000, help='Sale lines to write')
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--products', type=int, default=400)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--uri', default=os.getenv('BENCH_MONGO_URI', 'mongodb://localhost:27017'))
+    parser.add_argument('--database', default='saless_bench')
+    args = parser.parse_args()
+    generate(MongoClient(args.uri)[args.database], args.sales, args.days, args.products, args.seed)
@@ -0,0 +1,288 @@
+"""
+closed_periods.py
+-----------------
+Closed-day memoization for date-range sales analytics over ``products_sold``.
+
+A sale line belongs to the calendar day of its stored ``date``, the same day
+the range filters of /api/analytics, the analytics PDF and /api/user-report
+use. A day is *closed* once it ended more than ``CLOSE_GRACE`` ago. Checkouts
+only ever write the current day, so a closed day's partial aggregate never
+changes:
+
+    {_id: 'YYYY-MM-DD', day, revenue, orders, units,
+     products:  [{product_id, product_name, revenue, units}],
+     customers: [{user_id, spent, orders, last_purchase}],
+     computed_at}
+
+`range_parts()` splits a request into its closed days and the open tail
+(today onwards). Closed days come from memory or from the
+``closed_day_aggregates`` collection. Days missing from both are computed in
+one aggregation and stored. The open tail is aggregated live. `merge()` then
+sums the parts, so a 365-day report reads 365 small documents once, and after
+that only today's sale lines.
+
+Scripts that insert or delete back-dated sale lines must call `invalidate()`
+for the days they touch, or run the CLI below.
+
+Usage:
+    python closed_periods.py --invalidate                          # drop every cached day
+    python closed_periods.py --invalidate --start 2025-01-01 --end 2025-03-31
+"""
+
+import argparse
+import datetime
+import os
+import sys
+import threading
+
+from pymongo import ReplaceOne
+
+import result_cache
+
+CACHE_COLLECTION = 'closed_day_aggregates'
+SOURCE_COLLECTION = 'products_sold'
+# A day stays open this long after midnight so in-flight checkouts land before it is frozen
+CLOSE_GRACE = datetime.timedelta(hours=1)
+MEMORY_DAYS = 1500              # days kept in process memory (~4 years)
+
+
+def day_key(day) -> str:
+    return day.strftime('%Y-%m-%d')
+
+
+def open_from(now=None) -> datetime.date:
+    """First day that is still open. Sale dates are stored both as local and UTC
+    wall-clock time, so the earlier of the two "today"s counts."""
+    local = now or datetime.datetime.now()
+    utc = datetime.datetime.utcnow() if now is None else now
+    return (min(local, utc) - CLOSE_GRACE).date()
+
+
+def split(start: datetime.date, end: datetime.date, now=None):
+    """Split [start, end] into (closed_days, open_range).
+
+    `closed_days` is a list of dates; `open_range` is (first, last) or None.
+    """
+    first_open = open_from(now)
+    closed, day = [], start
+    while day <= end and day < first_open:
+        closed.append(day)
+        day += datetime.timedelta(days=1)
+    return closed, ((day, end) if day <= end else None)
+
+
+# ── Computing partials ───────────────────────────────────────────────────────
+
+def _partials_pipeline(first: datetime.date, last: datetime.date) -> list:
+    start = datetime.datetime.combine(first, datetime.time())
+    end = datetime.datetime.combine(last + datetime.timedelta(days=1), datetime.time())
+    day = {'$dateToString': {'format': '%Y-%m-%d', 'date': '$date'}}
+    return [
+        {'$match': {'date': {'$gte': start, '$lt': end}, 'total': {'$ne': None}}},
+        {'$facet': {
+            'products': [
+                {'$group': {
+                    '_id': {'day': day, 'product_id': '$product_id'},
+                    'product_name': {'$first': '$product_name'},
+                    'revenue': {'$sum': '$total'},
+                    'units': {'$sum': '$quantity'},
+                    'orders': {'$sum': 1},
+                }},
+            ],
+            'customers': [
+                {'$group': {
+                    '_id': {'day': day, 'user_id': '$user_id'},
+                    'spent': {'$sum': '$total'},
+                    'orders': {'$sum': 1},
+                    'last_purchase': {'$max': '$date'},
+                }},
+            ],
+        }},
+    ]
+
+
+def _empty(day: datetime.date) -> dict:
+    return {'_id': day_key(day), 'day': day_key(day), 'revenue': 0.0, 'orders': 0, 'units': 0,
+            'products': [], 'customers': []}
+
+
+def compute(db, first: datetime.date, last: datetime.date) -> dict:
+    """Partials for every day in [first, last] from one aggregation: {'YYYY-MM-DD': partial}."""
+    parts = {}
+    day = first
+    while day <= last:
+        parts[day_key(day)] = _empty(day)
+        day += datetime.timedelta(days=1)
+
+    facets = next(db[SOURCE_COLLECTION].aggregate(_partials_pipeline(first, last), allowDiskUse=True), {})
+    for row in facets.get('products', []):
+        part = parts.get(row['_id'].get('day'))
+        if part is None:
+            continue
+        revenue = float(row.get('revenue') or 0)
+        units = int(row.get('units') or 0)
+        orders = int(row.get('orders') or 0)
+        part['revenue'] += revenue
+        part['units'] += units
+        part['orders'] += orders
+        part['products'].append({'product_id': row['_id'].get('product_id'),
+                                 'product_name': row.get('product_name'),
+                                 'revenue': revenue, 'units': units})
+    for row in facets.get('customers', []):
+        part = parts.get(row['_id'].get('day'))
+        if part is None:
+            continue
+        part['customers'].append({'user_id': row['_id'].get('user_id'),
+                                  'spent': float(row.get('spent') or 0),
+                                  'orders': int(row.get('orders') or 0),
+                                  'last_purchase': row.get('last_purchase')})
+    return parts
+
+
+# ── Closed-day cache ─────────────────────────────────────────────────────────
+
+class ClosedDayCache:
+    """Process-local layer over ``closed_day_aggregates``.
+
+    Memory is dropped whenever another process calls `invalidate()` (seen as a
+    new ``closed_day_aggregates`` generation in result_cache's counters).
+    """
+
+    def __init__(self, max_days: int = MEMORY_DAYS):
+        self.max_days = max_days
+        self.lock = threading.Lock()
+        self.days = {}
+        self.generation = None
+        self.hits = 0           # days served from memory
+        self.loaded = 0         # days read from MongoDB
+        self.computed = 0       # days aggregated from raw sale lines
+
+    def _check_generation(self, db) -> None:
+        (generation,) = result_cache.generations(db, (CACHE_COLLECTION,))
+        with self.lock:
+            if generation != self.generation:
+                self.days.clear()
+                self.generation = generation
+
+    def closed_parts(self, db, days) -> list:
+        """Partials for the closed `days` (list of dates), in order."""
+        if not days:
+            return []
+        self._check_generation(db)
+        keys = [day_key(d) for d in days]
+        with self.lock:
+            found = {k: self.days[k] for k in keys if k in self.days}
+        self.hits += len(found)
+
+        missing = [k for k in keys if k not in found]
+        if missing:
+            stored = {d['_id']: d for d in db[CACHE_COLLECTION].find({'_id': {'$in': missing}})}
+            self.loaded += len(stored)
+            found.update(stored)
+            missing = [k for k in missing if k not in stored]
+        if missing:
+            # One aggregation over the span of the missing days; store only those
+            first = datetime.date.fromisoformat(missing[0])
+            last = datetime.date.fromisoformat(missing[-1])
+            now = datetime.datetime.now()
+            fresh = {k: v for k, v in compute(db, first, last).items() if k in set(missing)}
+            db[CACHE_COLLECTION].bulk_write(
+                [ReplaceOne({'_id': k}, {**v, 'computed_at': now}, upsert=True) for k, v in fresh.items()],
+                ordered=False)
+            self.computed += len(fresh)
+            found.update(fresh)
+
+        with self.lock:
+            self.days.update(found)
+            while len(self.days) > self.max_days:
+                self.days.pop(next(iter(self.days)))
+        return [found[k] for k in keys]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'days_in_memory': len(self.days), 'memory_hits': self.hits,
+                    'loaded': self.loaded, 'computed': self.computed}
+
+
+def range_parts(db, cache: ClosedDayCache, start: datetime.date, end: datetime.date, now=None) -> list:
+    """Day partials covering [start, end]: cached closed days plus the open tail computed live."""
+    closed, open_range = split(start, end, now)
+    parts = cache.closed_parts(db, closed)
+    if open_range:
+        parts += list(compute(db, *open_range).values())
+    return parts
+
+
+def merge(parts) -> dict:
+    """Sum day partials.
+
+    Returns {'revenue', 'orders', 'units', 'sales_by_day': {'YYYY-MM-DD': revenue},
+    'products': {str(product_id): {...}}, 'customers': {str(user_id): {...}}}.
+    Product and customer entries keep their original id under
+    'product_id' / 'user_id'.
+    """
+    merged = {'revenue': 0.0, 'orders': 0, 'units': 0, 'sales_by_day': {}, 'products': {}, 'customers': {}}
+    for part in parts:
+        merged['revenue'] += part.get('revenue', 0.0)
+        merged['orders'] += part.get('orders', 0)
+        merged['units'] += part.get('units', 0)
+        if part.get('orders'):
+            merged['sales_by_day'][part['day']] = part['revenue']
+        for p in part.get('products', []):
+            m = merged['products'].setdefault(str(p['product_id']), {
+                'product_id': p['product_id'], 'product_name': p.get('product_name'), 'revenue': 0.0, 'units': 0})
+            m['revenue'] += p['revenue']
+            m['units'] += p['units']
+            m['product_name'] = m['product_name'] or p.get('product_name')
+        for c in part.get('customers', []):
+            m = merged['customers'].setdefault(str(c['user_id']), {
+                'user_id': c['user_id'], 'spent': 0.0, 'orders': 0, 'last_purchase': None})
+            m['spent'] += c['spent']
+            m['orders'] += c['orders']
+            if c.get('last_purchase') and (m['last_purchase'] is None or c['last_purchase'] > m['last_purchase']):
+                m['last_purchase'] = c['last_purchase']
+    return merged
+
+
+def invalidate(db, start: datetime.date = None, end: datetime.date = None) -> int:
+    """Forget cached days in [start, end] (all days when both are None) in every process.
+
+    Returns the number of stored days removed.
+    """
+    query = {}
+    if start or end:
+        query['_id'] = {}
+        if start:
+            query['_id']['$gte'] = day_key(start)
+        if end:
+            query['_id']['$lte'] = day_key(end)
+    deleted = db[CACHE_COLLECTION].delete_many(query).deleted_count
+    result_cache.bump(db, CACHE_COLLECTION)
+    return deleted
+
+
+# ── CLI ───────────────────────────────────────────────────────────────────────
+if __name__ == '__main__':
+    from pymongo import MongoClient
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description='Maintain the closed-day analytics cache')
+    parser.add_argument('--invalidate', action='store_true', help='Drop cached days (after back-dated writes)')
+    parser.add_argument('--start', type=str, default=None, help='First day YYYY-MM-DD (default: all)')
+    parser.add_argument('--end', type=str, default=None, help='Last day YYYY-MM-DD (default: all)')
+    args = parser.parse_args()
+
+    if not args.invalidate:
+        parser.error('choose --invalidate')
+
+    load_dotenv()
+    mongo_uri = (os.getenv('MONGO_URI') or os.getenv('MONGODB_URI') or
+                 os.getenv('MONGO_URL') or os.getenv('MONGODB_URL'))
+    if not mongo_uri:
+        print("ERROR: Set MONGO_URI (or MONGODB_URL) in your .env file.")
+        sys.exit(1)
+    target_db = MongoClient(mongo_uri)[os.getenv('MONGODB_DATABASE') or 'saless']
+    n = invalidate(target_db,
+                   datetime.date.fromisoformat(args.start) if args.start else None,
+                   datetime.date.fromisoformat(args.end) if args.end else None)
+    print(f"✅  Dropped {n} cached days.")
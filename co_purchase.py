@@ -0,0 +1,225 @@
+"""
+co_purchase.py
+--------------
+Item-to-item co-purchase index ("frequently bought together").
+
+A basket is the set of products in one order: the sale lines sharing an
+``order_id`` (and customer) in ``user_data_bought``, plus the orders that
+exist only in ``products_sold`` (the legacy cart route). Lines without an
+``order_id`` are orders of one line and form no pairs, so they are skipped.
+
+`rebuild()` counts pairs sparsely, in two passes in the Apriori style. The
+first pass counts the orders each product appears in. The second counts pairs
+of products that both reached ``MIN_SUPPORT`` orders, because no pair can
+beat the rarer of its two products. Baskets over ``MAX_BASKET`` products
+(bulk orders) are left out, since they would add a quadratic number of
+meaningless pairs. Each product keeps its ``TOP_N`` neighbours with at least
+``MIN_SUPPORT`` shared orders:
+
+    {_id: <product id as string>, product_id, product_name, category, orders,
+     neighbours: [{product_id, name, category, price, count, confidence, lift}],
+     built_at}
+
+``confidence`` is the share of this product's orders that also contain the
+neighbour, and ``lift`` is that share over the neighbour's overall share of
+orders. Neighbours carry their name and price, so a reader needs one indexed
+read (`together()`) and no product lookups. Each rebuild writes a new
+collection and renames it in (see staging.py).
+
+Environment:
+    CO_PURCHASE_MIN_SUPPORT   shared orders a pair needs to be stored (default 2)
+
+Usage:
+    python co_purchase.py --rebuild
+    python co_purchase.py --show "Basmati Rice"
+"""
+
+import argparse
+import collections
+import datetime
+import heapq
+import os
+import sys
+
+from pymongo import ASCENDING
+
+import staging
+
+CO_PURCHASE_COLLECTION = 'co_purchases'
+SOURCE_COLLECTIONS = ('user_data_bought', 'products_sold')
+PRODUCT_COLLECTION = 'products_update'
+MIN_SUPPORT = int(os.getenv('CO_PURCHASE_MIN_SUPPORT', '2'))
+MAX_BASKET = 50
+TOP_N = 10
+BATCH = 1000
+
+
+def ensure_indexes(db, name: str = CO_PURCHASE_COLLECTION) -> None:
+    db[name].create_index([('product_name', ASCENDING)])
+
+
+# ── Counting ─────────────────────────────────────────────────────────────────
+
+def _baskets(db):
+    # Yield each order's set of product names, once per (customer, order)
+    seen = set()
+    pipeline = [
+        {'$match': {'order_id': {'$nin': [None, '']}, 'product_name': {'$nin': [None, '']}}},
+        {'$group': {'_id': {'user': '$user_id', 'order': '$order_id'},
+                    'items': {'$addToSet': '$product_name'}}},
+    ]
+    for name in SOURCE_COLLECTIONS:
+        for row in db[name].aggregate(pipeline, allowDiskUse=True, batchSize=BATCH):
+            key = (str(row['_id'].get('user')), str(row['_id']['order']))
+            if key in seen:
+                continue
+            seen.add(key)
+            yield row['items']
+
+
+def count_pairs(baskets, min_support: int = MIN_SUPPORT, max_basket: int = MAX_BASKET):
+    """Count product and pair support over `baskets` (iterables of item keys).
+
+    Returns (orders, item counts, pair counts), where pair keys are
+    ``(a, b)`` with ``a < b`` and only pairs with at least `min_support`
+    orders are kept.
+    """
+    items = collections.Counter()
+    kept = []
+    orders = 0
+    for basket in baskets:
+        basket = set(basket)
+        orders += 1
+        items.update(basket)
+        if 1 < len(basket) <= max_basket:
+            kept.append(basket)
+
+    pairs = collections.Counter()
+    for basket in kept:
+        frequent = sorted(item for item in basket if items[item] >= min_support)
+        for i, a in enumerate(frequent):
+            for b in frequent[i + 1:]:
+                pairs[(a, b)] += 1
+    return orders, items, {pair: n for pair, n in pairs.items() if n >= min_support}
+
+
+def top_neighbours(orders: int, items, pairs, top_n: int = TOP_N) -> dict:
+    """{item: [(neighbour, count, confidence, lift)]}, most shared orders first."""
+    adjacent = collections.defaultdict(list)
+    for (a, b), n in pairs.items():
+        adjacent[a].append((n, b))
+        adjacent[b].append((n, a))
+    result = {}
+    for item, candidates in adjacent.items():
+        best = heapq.nlargest(top_n, candidates, key=lambda c: (c[0], -items[c[1]]))
+        result[item] = [(other, n, n / items[item], n * orders / (items[item] * items[other]))
+                        for n, other in best]
+    return result
+
+
+# ── Build ────────────────────────────────────────────────────────────────────
+
+def _products(db, names) -> dict:
+    # {product name: product summary} for the names still in the catalogue
+    found = {}
+    names = list(names)
+    for i in range(0, len(names), BATCH):
+        cursor = db[PRODUCT_COLLECTION].find({'name': {'$in': names[i:i + BATCH]}},
+                                             {'name': 1, 'category': 1, 'variants': 1})
+        for product in cursor:
+            variants = product.get('variants') or [{}]
+            found.setdefault(product['name'], {
+                'product_id': str(product['_id']),
+                'name': product['name'],
+                'category': product.get('category', 'General'),
+                'price': variants[0].get('price'),
+            })
+    return found
+
+
+def rebuild(db, now=None) -> int:
+    """Recount every basket and replace the index. Returns products indexed."""
+    stamp = now or datetime.datetime.now()
+    orders, items, pairs = count_pairs(_baskets(db))
+    neighbours = top_neighbours(orders, items, pairs)
+    products = _products(db, neighbours)
+
+    docs = []
+    for name, best in neighbours.items():
+        product = products.get(name)
+        if product is None:
+            continue
+        rows = [{**products[other], 'count': n, 'confidence': round(confidence, 4), 'lift': round(lift, 3)}
+                for other, n, confidence, lift in best if other in products]
+        if not rows:
+            continue
+        docs.append({
+            '_id': product['product_id'],
+            'product_id': product['product_id'],
+            'product_name': name,
+            'category': product['category'],
+            'orders': items[name],
+            'neighbours': rows,
+            'built_at': stamp,
+        })
+    # Built aside and renamed in, so the rebuild each worker runs at start-up
+    # cannot delete another worker's rows
+    return staging.replace(db, CO_PURCHASE_COLLECTION, docs, ensure_indexes)
+
+
+# ── Readers ──────────────────────────────────────────────────────────────────
+
+def together(db, products, n: int = 5) -> list:
+    """Products frequently bought with `products` (ids or names), best first.
+
+    One indexed read. With several products (a basket) the neighbours'
+    confidences are summed, and the products themselves are left out.
+    """
+    keys = [str(p) for p in products if p]
+    if not keys:
+        return []
+    docs = db[CO_PURCHASE_COLLECTION].find(
+        {'$or': [{'_id': {'$in': keys}}, {'product_name': {'$in': keys}}]},
+        {'product_id': 1, 'product_name': 1, 'neighbours': 1})
+    exclude = set(keys)
+    scores, rows = {}, {}
+    for doc in docs:
+        exclude.update((doc['product_id'], doc['product_name']))
+        for row in doc.get('neighbours', []):
+            pid = row['product_id']
+            scores[pid] = scores.get(pid, 0.0) + row['confidence']
+            rows.setdefault(pid, row)
+    ranked = sorted((pid for pid in scores if pid not in exclude and rows[pid]['name'] not in exclude),
+                    key=lambda pid: (-scores[pid], -rows[pid]['count']))
+    return [{**rows[pid], 'score': round(scores[pid], 4)} for pid in ranked[:n]]
+
+
+# ── CLI ───────────────────────────────────────────────────────────────────────
+if __name__ == '__main__':
+    from pymongo import MongoClient
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description='Maintain the frequently-bought-together index')
+    parser.add_argument('--rebuild', action='store_true', help='Recount every basket and replace the index')
+    parser.add_argument('--show', metavar='PRODUCT', help='Print the neighbours of a product id or name')
+    parser.add_argument('--top', type=int, default=TOP_N, help='Neighbours shown by --show')
+    args = parser.parse_args()
+
+    if not (args.rebuild or args.show):
+        parser.error('choose --rebuild and/or --show')
+
+    load_dotenv()
+    mongo_uri = (os.getenv('MONGO_URI') or os.getenv('MONGODB_URI') or
+                 os.getenv('MONGO_URL') or os.getenv('MONGODB_URL'))
+    if not mongo_uri:
+        print("ERROR: Set MONGO_URI (or MONGODB_URL) in your .env file.")
+        sys.exit(1)
+    target_db = MongoClient(mongo_uri)[os.getenv('MONGODB_DATABASE') or 'saless']
+
+    if args.rebuild:
+        ensure_indexes(target_db)
+        print(f"✅  Indexed {rebuild(target_db)} products.")
+    if args.show:
+        for row in together(target_db, [args.show], args.top):
+            print(f"  {row['name']:<40} {row['count']:>6} orders  "
+                  f"confidence {row['confidence']:.2f}  lift {row['lift']:.2f}")
@@ -0,0 +1,352 @@
+"""
+cohorts.py
+----------
+Monthly customer cohorts: retention and repeat-purchase matrices.
+
+A customer's cohort is the shop-local month of ``created_at`` (or of the
+``_id`` timestamp when a record has none), across ``users`` and
+``users_update``. An order is the set of sale lines sharing an ``order_id``,
+or a single line without one, as in order_digests.py.
+
+``cohort_stats`` holds two kinds of small documents:
+
+    {_id: 'cohort:YYYY-MM', kind: 'cohort', month, size, closed}
+    {_id: 'activity:YYYY-MM', kind: 'activity', month, closed,
+     cohorts: {'YYYY-MM': {active, orders, new_buyers, repeaters}}}
+
+An activity document counts, per cohort, the customers who ordered in that
+month (``active``), their orders, those whose first order was that month
+(``new_buyers``) and those whose second order was (``repeaters``). None of
+these change once the month has ended. `refresh()` therefore stores ended
+months once and recomputes only the open month. It streams that month's
+customers in chunks of ``CHUNK``. For each chunk it fetches their cohorts and
+counts their orders before the month, capped at two. Only customers active in
+the open month are read, never every customer's full history. A sale written
+into an ended month (seeders, imports) drops that month's document, and the
+next refresh rebuilds it.
+
+`matrix()` assembles the retention matrix from these documents: one
+``activity`` document per month plus one ``cohort`` document per cohort.
+
+Usage:
+    python cohorts.py --refresh           # store ended months, recompute the open one
+    python cohorts.py --rebuild           # drop everything and recompute from scratch
+    python cohorts.py --show --months 12
+"""
+
+import argparse
+import datetime
+import os
+import sys
+
+from bson import ObjectId
+from pymongo import ASCENDING, ReplaceOne
+
+import timeseries
+
+COHORT_COLLECTION = 'cohort_stats'
+SOURCE_COLLECTION = 'user_data_bought'
+USER_COLLECTIONS = ('users', 'users_update')
+CHUNK = 5000
+METRICS = ('active', 'orders', 'new_buyers', 'repeaters')
+
+
+def month_key(day) -> str:
+    return day.strftime('%Y-%m')
+
+
+def _month_start(value):
+    day = timeseries.local_day(value)
+    return None if day is None else day.replace(day=1)
+
+
+def _next_month(month):
+    return (month + datetime.timedelta(days=32)).replace(day=1)
+
+
+def _offset(cohort: str, month: str) -> int:
+    return (int(month[:4]) - int(cohort[:4])) * 12 + int(month[5:7]) - int(cohort[5:7])
+
+
+def _this_month(now=None):
+    return _month_start(now or datetime.datetime.utcnow())
+
+
+def ensure_indexes(db) -> None:
+    db[COHORT_COLLECTION].create_index([('kind', ASCENDING), ('month', ASCENDING)])
+    db[SOURCE_COLLECTION].create_index([('user_id', ASCENDING), ('purchase_date', ASCENDING)])
+
+
+# ── Inputs ───────────────────────────────────────────────────────────────────
+
+def _cohort_of(user: dict):
+    created = user.get('created_at')
+    if not isinstance(created, datetime.datetime) and isinstance(user.get('_id'), ObjectId):
+        created = user['_id'].generation_time.replace(tzinfo=None)
+    month = _month_start(created) if isinstance(created, datetime.datetime) else None
+    return None if month is None else month_key(month)
+
+
+def _id_forms(user_ids) -> list:
+    # Sale lines store the customer id as an ObjectId or as its string
+    forms = []
+    for uid in user_ids:
+        forms.append(uid)
+        if ObjectId.is_valid(uid):
+            forms.append(ObjectId(uid))
+    return forms
+
+
+def _cohorts(db, user_ids) -> dict:
+    keys = [ObjectId(u) for u in user_ids if ObjectId.is_valid(u)]
+    found = {}
+    for name in USER_COLLECTIONS:
+        for user in db[name].find({'_id': {'$in': keys}}, {'created_at': 1}):
+            found.setdefault(str(user['_id']), _cohort_of(user))
+    return found
+
+
+def _orders_before(db, user_ids, before) -> dict:
+    # {user id: orders before `before`}, capped at 2 (all a first/second order test needs)
+    pipeline = [
+        {'$match': {'user_id': {'$in': _id_forms(user_ids)},
+                    'purchase_date': {'$type': 'date', '$lt': timeseries.to_utc(before)}}},
+        {'$group': {'_id': {'user': '$user_id', 'order': {'$ifNull': ['$order_id', '$_id']}}}},
+        {'$group': {'_id': '$_id.user', 'orders': {'$sum': 1}}},
+    ]
+    counts = {}
+    for row in db[SOURCE_COLLECTION].aggregate(pipeline, allowDiskUse=True):
+        uid = str(row['_id'])
+        counts[uid] = min(counts.get(uid, 0) + row['orders'], 2)
+    return counts
+
+
+def _active_customers(db, start):
+    # Yield (user id, [order times]) for every customer with an order since `start`
+    pipeline = [
+        {'$match': {'user_id': {'$nin': [None, '']},
+                    'purchase_date': {'$type': 'date', '$gte': timeseries.to_utc(start)}}},
+        {'$group': {'_id': {'user': '$user_id', 'order': {'$ifNull': ['$order_id', '$_id']}},
+                    'at': {'$min': '$purchase_date'}}},
+        {'$group': {'_id': '$_id.user', 'orders': {'$push': '$at'}}},
+    ]
+    merged = {}
+    for row in db[SOURCE_COLLECTION].aggregate(pipeline, allowDiskUse=True, batchSize=CHUNK):
+        # An id stored both as ObjectId and as string is one customer
+        merged.setdefault(str(row['_id']), []).extend(row['orders'])
+        if len(merged) >= CHUNK:
+            yield from merged.items()
+            merged = {}
+    yield from merged.items()
+
+
+def _chunks(items, size: int = CHUNK):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# ── Refresh ──────────────────────────────────────────────────────────────────
+
+def _activity(db, start) -> dict:
+    # {month: {cohort: {metric: count}}} for every month from `start` on
+    months = {}
+    for chunk in _chunks(_active_customers(db, start)):
+        user_ids = [uid for uid, _ in chunk]
+        cohorts = _cohorts(db, user_ids)
+        prior = _orders_before(db, [u for u in user_ids if cohorts.get(u)], start)
+        for uid, times in chunk:
+            cohort = cohorts.get(uid)
+            if cohort is None:
+                continue
+            times = sorted(times)
+            seen = set()
+            for n, at in enumerate(times, prior.get(uid, 0)):
+                key = month_key(_month_start(at))
+                row = months.setdefault(key, {}).setdefault(cohort, dict.fromkeys(METRICS, 0))
+                row['orders'] += 1
+                if key not in seen:
+                    seen.add(key)
+                    row['active'] += 1
+                if n == 0:
+                    row['new_buyers'] += 1
+                elif n == 1:
+                    row['repeaters'] += 1
+    return months
+
+
+def _sizes(db, start=None) -> dict:
+    # {cohort: customers}, streaming the customers who may have joined since `start`
+    query = {}
+    if start is not None:
+        since = timeseries.to_utc(start)
+        query = {'$or': [{'created_at': {'$gte': since}}, {'_id': {'$gte': ObjectId.from_datetime(since)}}]}
+    sizes = {}
+    first = None if start is None else month_key(start)
+    for name in USER_COLLECTIONS:
+        for user in db[name].find(query, {'created_at': 1}).batch_size(CHUNK):
+            cohort = _cohort_of(user)
+            if cohort is not None and (first is None or cohort >= first):
+                sizes[cohort] = sizes.get(cohort, 0) + 1
+    return sizes
+
+
+def _first_sale_month(db):
+    doc = next(iter(db[SOURCE_COLLECTION].find({'purchase_date': {'$type': 'date'}}, {'purchase_date': 1})
+                    .sort('purchase_date', 1).limit(1)), None)
+    return None if doc is None else _month_start(doc['purchase_date'])
+
+
+def refresh(db, now=None) -> dict:
+    """Store the ended months not stored yet and recompute the open month.
+
+    Returns {'activity': months written, 'cohorts': cohorts written}.
+    """
+    coll = db[COHORT_COLLECTION]
+    this_month = _this_month(now)
+    stamp = datetime.datetime.now()
+    closed = {d['_id'] for d in coll.find({'closed': True}, {'_id': 1})}
+    ops = []
+
+    # Cohort sizes: from the month after the last stored ended cohort
+    last_cohort = max((k[len('cohort:'):] for k in closed if k.startswith('cohort:')), default=None)
+    since = None
+    if last_cohort is not None:
+        since = _next_month(datetime.datetime.strptime(last_cohort, '%Y-%m'))
+    sizes = _sizes(db, since)
+    for cohort, size in sizes.items():
+        month = datetime.datetime.strptime(cohort, '%Y-%m')
+        ops.append(ReplaceOne({'_id': f'cohort:{cohort}'}, {
+            'kind': 'cohort', 'month': cohort, 'size': size, 'closed': month < this_month,
+            'computed_at': stamp}, upsert=True))
+    written_cohorts = len(ops)
+
+    # Activity: from the first month with sales that is not stored as ended
+    month = _first_sale_month(db)
+    while month is not None and month < this_month and f'activity:{month_key(month)}' in closed:
+        month = _next_month(month)
+    if month is not None:
+        activity = _activity(db, month)
+        while month <= this_month:
+            key = month_key(month)
+            ops.append(ReplaceOne({'_id': f'activity:{key}'}, {
+                'kind': 'activity', 'month': key, 'closed': month < this_month,
+                'cohorts': activity.get(key, {}), 'computed_at': stamp}, upsert=True))
+            month = _next_month(month)
+    if ops:
+        coll.bulk_write(ops, ordered=False)
+    return {'activity': len(ops) - written_cohorts, 'cohorts': written_cohorts}
+
+
+def record_sales(db, records, now=None) -> int:
+    """Drop the stored ended months that freshly written sale lines fall in.
+
+    Checkouts land in the open month, so this is a no-op for them. Returns the
+    number of documents dropped.
+    """
+    this_month = _this_month(now)
+    months = {month_key(m) for m in (_month_start(r.get('purchase_date')) for r in records)
+              if m is not None and m < this_month}
+    if not months:
+        return 0
+    return db[COHORT_COLLECTION].delete_many(
+        {'_id': {'$in': [f'activity:{m}' for m in months]}}).deleted_count
+
+
+def rebuild(db, now=None) -> dict:
+    db[COHORT_COLLECTION].delete_many({})
+    return refresh(db, now)
+
+
+# ── Readers ──────────────────────────────────────────────────────────────────
+
+def matrix(db, months: int = 12, now=None) -> dict:
+    """Retention matrix of the last `months` cohorts.
+
+    Each cohort row has its ``size``, then ``active[k]`` customers who ordered
+    k months after joining and ``retention[k]`` as a percentage of ``size``.
+    ``buyers`` is customers with at least one order and ``repeaters`` those
+    with at least two. ``repeat_rate`` is repeaters as a percentage of
+    buyers. The totals row covers every cohort shown.
+    """
+    this_month = _this_month(now)
+    first = this_month
+    for _ in range(max(months, 1) - 1):
+        first = (first - datetime.timedelta(days=1)).replace(day=1)
+    first_key = month_key(first)
+    docs = list(db[COHORT_COLLECTION].find({'month': {'$gte': first_key}}))
+    rows = {d['month']: {'cohort': d['month'], 'size': d.get('size', 0)} for d in docs if d['kind'] == 'cohort'}
+    width = _offset(first_key, month_key(this_month)) + 1
+    for row in rows.values():
+        row.update(active=[0] * (width - _offset(first_key, row['cohort'])), orders=0, buyers=0, repeaters=0)
+    computed_at = None
+    for doc in docs:
+        if doc['kind'] != 'activity':
+            continue
+        computed_at = max(computed_at or doc['computed_at'], doc['computed_at'])
+        for cohort, counts in doc.get('cohorts', {}).items():
+            row = rows.get(cohort)
+            if row is None:
+                continue
+            offset = _offset(cohort, doc['month'])
+            if 0 <= offset < len(row['active']):
+                row['active'][offset] += counts.get('active', 0)
+            row['orders'] += counts.get('orders', 0)
+            row['buyers'] += counts.get('new_buyers', 0)
+            row['repeaters'] += counts.get('repeaters', 0)
+
+    cohorts = []
+    for cohort in sorted(rows):
+        row = rows[cohort]
+        size = row['size']
+        row['retention'] = [round(100.0 * n / size, 1) if size else 0.0 for n in row['active']]
+        row['repeat_rate'] = round(100.0 * row['repeaters'] / row['buyers'], 1) if row['buyers'] else 0.0
+        cohorts.append(row)
+    buyers = sum(r['buyers'] for r in cohorts)
+    repeaters = sum(r['repeaters'] for r in cohorts)
+    return {
+        'cohorts': cohorts,
+        'totals': {'customers': sum(r['size'] for r in cohorts), 'buyers': buyers, 'repeaters': repeaters,
+                   'repeat_rate': round(100.0 * repeaters / buyers, 1) if buyers else 0.0},
+        'computed_at': computed_at,
+    }
+
+
+# ── CLI ───────────────────────────────────────────────────────────────────────
+if __name__ == '__main__':
+    from pymongo import MongoClient
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description='Maintain the monthly cohort retention matrices')
+    parser.add_argument('--refresh', action='store_true', help='Store ended months and recompute the open one')
+    parser.add_argument('--rebuild', action='store_true', help='Drop the stored months and recompute everything')
+    parser.add_argument('--show', action='store_true', help='Print the retention matrix')
+    parser.add_argument('--months', type=int, default=12, help='Cohorts shown by --show')
+    args = parser.parse_args()
+
+    if not (args.refresh or args.rebuild or args.show):
+        parser.error('choose --refresh, --rebuild and/or --show')
+
+    load_dotenv()
+    mongo_uri = (os.getenv('MONGO_URI') or os.getenv('MONGODB_URI') or
+                 os.getenv('MONGO_URL') or os.getenv('MONGODB_URL'))
+    if not mongo_uri:
+        print("ERROR: Set MONGO_URI (or MONGODB_URL) in your .env file.")
+        sys.exit(1)
+    target_db = MongoClient(mongo_uri)[os.getenv('MONGODB_DATABASE') or 'saless']
+
+    if args.refresh or args.rebuild:
+        ensure_indexes(target_db)
+        written = rebuild(target_db) if args.rebuild else refresh(target_db)
+        print(f"✅  Wrote {written['activity']} activity months and {written['cohorts']} cohorts.")
+    if args.show:
+        result = matrix(target_db, args.months)
+        for row in result['cohorts']:
+            cells = ' '.join(f"{p:5.1f}" for p in row['retention'])
+            print(f"  {row['cohort']}  {row['size']:>6}  repeat {row['repeat_rate']:5.1f}%  | {cells}")
+        print(f"  Overall repeat purchase rate: {result['totals']['repeat_rate']}%")
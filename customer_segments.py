@@ -0,0 +1,301 @@
+"""
+customer_segments.py
+--------------------
+Batch RFM (recency, frequency, monetary) segmentation of every customer.
+
+`refresh()` reads ``user_data_bought`` with two aggregations: one row per
+customer order, and one row per customer, category and product. Each
+customer is then scored 1-5 on each axis by quintile (mid-rank, so ties
+score alike) against all other customers:
+
+    R   days since the last order (fewer is better)
+    F   number of orders (an order is the lines sharing an ``order_id``)
+    M   total spend
+
+With NumPy the scores are a couple of sorts and ``searchsorted`` calls over
+all customers at once. Without it the same ranks come from ``bisect``. The
+first rule in ``SEGMENTS`` that matches R and FM = round((F + M) / 2) names
+the segment.
+
+One document per customer goes to ``customer_segments``:
+
+    {_id: <user id as string>, user_id, name, email, segment, segment_label,
+     r, f, m, rfm: 'RFM', recency_days, orders, monetary, first_purchase,
+     last_purchase, top_category, top_categories, recent_products, scored_at}
+
+``segment`` is indexed, so a campaign picks its recipients with one query
+per segment (`recipients()`) instead of analysing each customer's history
+inside the request. Each refresh builds a new collection and renames it in
+(see staging.py).
+
+Usage:
+    python customer_segments.py --refresh
+    python customer_segments.py --summary
+"""
+
+import argparse
+import bisect
+import datetime
+import os
+import sys
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+
+import staging
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency
+    np = None
+
+SEGMENT_COLLECTION = 'customer_segments'
+SOURCE_COLLECTION = 'user_data_bought'
+USER_COLLECTIONS = ('users', 'users_update')
+BATCH = 1000
+TOP_CATEGORIES = 3
+RECENT_PRODUCTS = 5
+
+# (segment, label, rule on (r, fm, orders)); the first match wins
+SEGMENTS = [
+    ('champions', 'Champions', lambda r, fm, n: r >= 4 and fm >= 4),
+    ('new_customers', 'New Customers', lambda r, fm, n: r >= 4 and n == 1),
+    ('potential_loyalists', 'Potential Loyalists', lambda r, fm, n: r >= 4),
+    ('loyal', 'Loyal Customers', lambda r, fm, n: r == 3 and fm >= 4),
+    ('needs_attention', 'Needs Attention', lambda r, fm, n: r == 3 and fm == 3),
+    ('about_to_sleep', 'About to Sleep', lambda r, fm, n: r == 3),
+    ('at_risk', 'At Risk', lambda r, fm, n: fm >= 4),
+    ('hibernating', 'Hibernating', lambda r, fm, n: r == 2),
+    ('lost', 'Lost', lambda r, fm, n: True),
+]
+SEGMENT_LABELS = {name: label for name, label, _ in SEGMENTS}
+
+
+def ensure_indexes(db, name: str = SEGMENT_COLLECTION) -> None:
+    coll = db[name]
+    coll.create_index([('segment', ASCENDING), ('monetary', DESCENDING)])
+    coll.create_index([('email', ASCENDING)])
+    coll.create_index([('last_purchase', DESCENDING)])
+
+
+# ── Scoring ──────────────────────────────────────────────────────────────────
+
+def quintiles(values) -> list:
+    """Score each value 1-5 by its mid-rank percentile: the share of values below it
+    plus half the share equal to it. Ties score alike and sit mid-way, so a value
+    everyone shares scores 3.
+    """
+    n = len(values)
+    if not n:
+        return []
+    if np is not None:
+        arr = np.asarray(values, dtype=np.float64)
+        ordered = np.sort(arr)
+        lo = np.searchsorted(ordered, arr, side='left')
+        hi = np.searchsorted(ordered, arr, side='right')
+        return np.minimum(1 + (5 * (lo + hi)) // (2 * n), 5).astype(int).tolist()
+    ordered = sorted(values)
+    return [min(1 + (5 * (bisect.bisect_left(ordered, v) + bisect.bisect_right(ordered, v))) // (2 * n), 5)
+            for v in values]
+
+
+def segment_of(r: int, f: int, m: int, orders: int) -> str:
+    fm = int((f + m) / 2 + 0.5)
+    for name, _, rule in SEGMENTS:
+        if rule(r, fm, orders):
+            return name
+    return SEGMENTS[-1][0]
+
+
+# ── Inputs ───────────────────────────────────────────────────────────────────
+
+def _orders(db) -> dict:
+    # {user id: {'orders', 'monetary', 'first', 'last', 'name', 'email'}}
+    pipeline = [
+        {'$match': {'user_id': {'$nin': [None, '']}, 'purchase_date': {'$type': 'date'}}},
+        {'$group': {
+            '_id': {'user': '$user_id', 'order': {'$ifNull': ['$order_id', '$_id']}},
+            'total': {'$sum': {'$ifNull': ['$total', 0]}},
+            'at': {'$max': '$purchase_date'},
+            'name': {'$max': '$user_name'},
+            'email': {'$max': {'$ifNull': ['$user_email', '$buyer_email']}},
+        }},
+        {'$group': {
+            '_id': '$_id.user',
+            'orders': {'$sum': 1},
+            'monetary': {'$sum': '$total'},
+            'first': {'$min': '$at'},
+            'last': {'$max': '$at'},
+            'name': {'$max': '$name'},
+            'email': {'$max': '$email'},
+        }},
+    ]
+    customers = {}
+    for row in db[SOURCE_COLLECTION].aggregate(pipeline, allowDiskUse=True):
+        uid = str(row['_id'])
+        seen = customers.get(uid)
+        if seen is None:
+            customers[uid] = {**row, 'monetary': float(row['monetary'] or 0)}
+            continue
+        # The same customer stored once as ObjectId and once as string
+        seen['orders'] += row['orders']
+        seen['monetary'] += float(row['monetary'] or 0)
+        seen['first'] = min(seen['first'], row['first'])
+        seen['last'] = max(seen['last'], row['last'])
+        seen['name'] = seen['name'] or row['name']
+        seen['email'] = seen['email'] or row['email']
+    return customers
+
+
+def _preferences(db) -> dict:
+    # {user id: (top categories by spend, most recently bought products)}
+    pipeline = [
+        {'$match': {'user_id': {'$nin': [None, '']}, 'purchase_date': {'$type': 'date'}}},
+        {'$group': {
+            '_id': {'user': '$user_id', 'category': '$category', 'product': '$product_name'},
+            'spend': {'$sum': {'$ifNull': ['$total', 0]}},
+            'last': {'$max': '$purchase_date'},
+        }},
+    ]
+    spend, recent = {}, {}
+    for row in db[SOURCE_COLLECTION].aggregate(pipeline, allowDiskUse=True):
+        uid = str(row['_id']['user'])
+        category = row['_id'].get('category') or 'General'
+        by_category = spend.setdefault(uid, {})
+        by_category[category] = by_category.get(category, 0.0) + float(row['spend'] or 0)
+        product = row['_id'].get('product')
+        if product:
+            by_product = recent.setdefault(uid, {})
+            by_product[product] = max(by_product.get(product, row['last']), row['last'])
+    return {uid: (sorted(cats, key=cats.get, reverse=True)[:TOP_CATEGORIES],
+                  sorted(recent.get(uid, {}), key=recent.get(uid, {}).get, reverse=True)[:RECENT_PRODUCTS])
+            for uid, cats in spend.items()}
+
+
+def _profiles(db, user_ids) -> dict:
+    # {user id: {'name', 'email'}} from the customer collections, in $in batches
+    profiles = {}
+    keys = [ObjectId(u) for u in user_ids if ObjectId.is_valid(u)]
+    for i in range(0, len(keys), BATCH):
+        for name in USER_COLLECTIONS:
+            for user in db[name].find({'_id': {'$in': keys[i:i + BATCH]}}, {'name': 1, 'email': 1}):
+                profiles.setdefault(str(user['_id']), user)
+    return profiles
+
+
+# ── Refresh ──────────────────────────────────────────────────────────────────
+
+def refresh(db, now=None) -> int:
+    """Score every customer with a purchase and store their segments.
+
+    Customers with no purchases left are removed. Returns the number of
+    customers scored.
+    """
+    now = now or datetime.datetime.utcnow()
+    customers = _orders(db)
+    stamp = datetime.datetime.now()
+    if not customers:
+        return staging.replace(db, SEGMENT_COLLECTION, [])
+    uids = list(customers)
+    rows = [customers[u] for u in uids]
+    recency = [max((now - row['last']).days, 0) for row in rows]
+    r_scores = quintiles([-d for d in recency])
+    f_scores = quintiles([row['orders'] for row in rows])
+    m_scores = quintiles([row['monetary'] for row in rows])
+    preferences = _preferences(db)
+    profiles = _profiles(db, uids)
+
+    docs = []
+    for i, uid in enumerate(uids):
+        row, profile = rows[i], profiles.get(uid, {})
+        r, f, m = r_scores[i], f_scores[i], m_scores[i]
+        segment = segment_of(r, f, m, row['orders'])
+        categories, products = preferences.get(uid, ([], []))
+        docs.append({
+            '_id': uid,
+            'user_id': row['_id'],
+            'name': profile.get('name') or row.get('name'),
+            'email': profile.get('email') or row.get('email'),
+            'segment': segment,
+            'segment_label': SEGMENT_LABELS[segment],
+            'r': r, 'f': f, 'm': m,
+            'rfm': f'{r}{f}{m}',
+            'recency_days': recency[i],
+            'orders': row['orders'],
+            'monetary': round(row['monetary'], 2),
+            'first_purchase': row['first'],
+            'last_purchase': row['last'],
+            'top_category': categories[0] if categories else 'General',
+            'top_categories': categories,
+            'recent_products': products,
+            'scored_at': stamp,
+        })
+    # Built aside and renamed in, so overlapping refreshes cannot delete each other's rows
+    return staging.replace(db, SEGMENT_COLLECTION, docs, ensure_indexes)
+
+
+# ── Readers ──────────────────────────────────────────────────────────────────
+
+def recipients(db, segments=None, user_ids=None, projection=None) -> list:
+    """Scored customers with an email, one query per segment (every customer if neither is given).
+
+    `user_ids`, when given, restricts to those customers instead.
+    """
+    coll = db[SEGMENT_COLLECTION]
+    has_email = {'email': {'$nin': [None, '']}}
+    if user_ids is not None:
+        return list(coll.find({'_id': {'$in': [str(u) for u in user_ids]}, **has_email}, projection))
+    if not segments:
+        return list(coll.find(has_email, projection))
+    found = []
+    for segment in segments:
+        found.extend(coll.find({'segment': segment, **has_email}, projection).sort('monetary', DESCENDING))
+    return found
+
+
+def summary(db) -> list:
+    """Customers, spend and average recency per segment, in ``SEGMENTS`` order."""
+    rows = {row['_id']: row for row in db[SEGMENT_COLLECTION].aggregate([
+        {'$group': {'_id': '$segment', 'customers': {'$sum': 1}, 'monetary': {'$sum': '$monetary'},
+                    'orders': {'$sum': '$orders'}, 'recency_days': {'$avg': '$recency_days'},
+                    'scored_at': {'$max': '$scored_at'}}},
+    ])}
+    out = []
+    for name, label, _ in SEGMENTS:
+        row = rows.get(name)
+        if row:
+            out.append({'segment': name, 'label': label, 'customers': row['customers'],
+                        'monetary': round(float(row['monetary'] or 0), 2), 'orders': row['orders'],
+                        'avg_recency_days': round(float(row['recency_days'] or 0), 1),
+                        'scored_at': row['scored_at']})
+    return out
+
+
+# ── CLI ───────────────────────────────────────────────────────────────────────
+if __name__ == '__main__':
+    from pymongo import MongoClient
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description='Maintain the RFM customer segments')
+    parser.add_argument('--refresh', action='store_true', help='Score every customer and store the segments')
+    parser.add_argument('--summary', action='store_true', help='Print customers per segment')
+    args = parser.parse_args()
+
+    if not (args.refresh or args.summary):
+        parser.error('choose --refresh and/or --summary')
+
+    load_dotenv()
+    mongo_uri = (os.getenv('MONGO_URI') or os.getenv('MONGODB_URI') or
+                 os.getenv('MONGO_URL') or os.getenv('MONGODB_URL'))
+    if not mongo_uri:
+        print("ERROR: Set MONGO_URI (or MONGODB_URL) in your .env file.")
+        sys.exit(1)
+    target_db = MongoClient(mongo_uri)[os.getenv('MONGODB_DATABASE') or 'saless']
+
+    if args.refresh:
+        ensure_indexes(target_db)
+        print(f"✅  Scored {refresh(target_db)} customers.")
+    if args.summary:
+        for row in summary(target_db):
+            print(f"  {row['label']:<20} {row['customers']:>7} customers  ₹{row['monetary']:>12,.2f}  "
+                  f"{row['avg_recency_days']:>6} days since last order")
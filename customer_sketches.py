@@ -0,0 +1,171 @@
+"""
+customer_sketches.py
+--------------------
+Per-day HyperLogLog sketches of the customers in ``products_sold``, for the
+approximate "active customers" figure on /api/analytics and its PDF.
+
+The exact figure counts distinct ``user_id`` values over ``products_sold``
+lines with a ``total`` (see closed_periods.py and sales_analytics.py), so the
+sketches are folded from exactly those lines: `sales_facts.project()` calls
+`record_lines()` with every copy it writes to ``products_sold``, and a day is
+the calendar day of the stored ``date``, as in the closed-day partials. Order
+headers (no ``total``) are skipped, like the exact count skips them.
+
+One document per day: ``{_id: <midnight>, registers: {index: rank}}`` (see
+hll.py). Registers only grow (``$max``), so re-projecting a line is harmless.
+A range is estimated by merging its day sketches (±hll.ERROR_BOUND).
+
+Usage:
+    python customer_sketches.py --rebuild                 # rebuild from products_sold (run once after deploying)
+    python customer_sketches.py --check --days 30         # estimate vs exact count
+"""
+
+import argparse
+import datetime
+import os
+import sys
+
+from pymongo import DeleteMany, ReplaceOne, UpdateOne
+
+import hll
+
+SKETCH_COLLECTION = 'customer_day_sketches'
+SOURCE_COLLECTION = 'products_sold'
+CUSTOMER_FIELD = 'user_id'
+
+
+def day_of(value):
+    """Midnight of the stored calendar day of `value` (UTC for aware datetimes)."""
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return value.replace(hour=0, minute=0, second=0, microsecond=0)
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    return None
+
+
+def build_sketches(lines) -> dict:
+    """Per-day registers of the customers in `lines`: {day: {index: rank}}."""
+    sketches = {}
+    for line in lines:
+        when = line.get('date')
+        if line.get('total') is None or not isinstance(when, datetime.datetime):
+            continue
+        hll.add(sketches.setdefault(day_of(when), {}), line.get(CUSTOMER_FIELD))
+    return sketches
+
+
+def record_lines(db, lines) -> int:
+    """Fold ``products_sold`` lines into their day sketches (one bulk round trip).
+
+    Returns the number of day documents touched.
+    """
+    sketches = build_sketches(lines)
+    ops = [UpdateOne({'_id': day}, {'$max': {f'registers.{i}': rank for i, rank in registers.items()}},
+                     upsert=True)
+           for day, registers in sketches.items()]
+    if ops:
+        db[SKETCH_COLLECTION].bulk_write(ops, ordered=False)
+    return len(ops)
+
+
+def _day_filter(start=None, end=None) -> dict:
+    # Inclusive day range on the sketch `_id`.
+    rng = {}
+    if start is not None:
+        rng['$gte'] = day_of(start)
+    if end is not None:
+        rng['$lte'] = day_of(end)
+    return {'_id': rng} if rng else {}
+
+
+def distinct_customers(db, start=None, end=None) -> int:
+    """Approximate distinct customers over the inclusive day range (see hll.ERROR_BOUND)."""
+    merged = {}
+    for d in db[SKETCH_COLLECTION].find(_day_filter(start, end), {'registers': 1}):
+        hll.merge(merged, d.get('registers'))
+    return hll.estimate(merged)
+
+
+# ── Rebuild & check ──────────────────────────────────────────────────────────
+
+def _source_match(start=None, end=None) -> dict:
+    # The lines the exact count reads, over whole days.
+    rng = {'$type': 'date'}
+    bounds = _day_filter(start, end).get('_id', {})
+    if '$gte' in bounds:
+        rng['$gte'] = bounds['$gte']
+    if '$lte' in bounds:
+        rng['$lt'] = bounds['$lte'] + datetime.timedelta(days=1)
+    return {'date': rng, 'total': {'$ne': None}}
+
+
+def rebuild(db, start=None, end=None) -> int:
+    """Rebuild the sketches for the inclusive day range (everything if open).
+
+    Days left without sales are removed. Returns the number of day sketches.
+    """
+    day = {'$dateToString': {'format': '%Y-%m-%d', 'date': '$date'}}
+    sketches = {}
+    for row in db[SOURCE_COLLECTION].aggregate([
+        {'$match': _source_match(start, end)},
+        {'$group': {'_id': {'day': day, 'customer': f'${CUSTOMER_FIELD}'}}},
+    ], allowDiskUse=True):
+        key = datetime.datetime.strptime(row['_id']['day'], '%Y-%m-%d')
+        hll.add(sketches.setdefault(key, {}), row['_id'].get('customer'))
+    stale = {**_day_filter(start, end)}
+    stale.setdefault('_id', {})['$nin'] = list(sketches)
+    ops = [DeleteMany(stale)]
+    ops += [ReplaceOne({'_id': d}, {'registers': registers}, upsert=True) for d, registers in sketches.items()]
+    db[SKETCH_COLLECTION].bulk_write(ops, ordered=True)
+    return len(sketches)
+
+
+def check(db, start=None, end=None) -> dict:
+    """Compare the estimate for a range with the exact distinct count over ``products_sold``.
+
+    Returns {exact, estimate, error, within_bound}; `error` is relative to the
+    exact count and `within_bound` compares it with hll.ERROR_BOUND.
+    """
+    rows = list(db[SOURCE_COLLECTION].aggregate([
+        {'$match': _source_match(start, end)},
+        {'$group': {'_id': f'${CUSTOMER_FIELD}'}},
+        {'$count': 'n'},
+    ], allowDiskUse=True))
+    exact = rows[0]['n'] if rows else 0
+    estimate = distinct_customers(db, start, end)
+    error = abs(estimate - exact) / exact if exact else float(estimate > 0)
+    return {'exact': exact, 'estimate': estimate, 'error': error, 'within_bound': error <= hll.ERROR_BOUND}
+
+
+# ── CLI ───────────────────────────────────────────────────────────────────────
+if __name__ == '__main__':
+    from pymongo import MongoClient
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description='Rebuild or verify the per-day customer sketches')
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild sketches from products_sold')
+    parser.add_argument('--check', action='store_true', help='Compare the estimate with the exact count')
+    parser.add_argument('--days', type=int, default=None, help='Limit to the last N days')
+    args = parser.parse_args()
+
+    if not (args.rebuild or args.check):
+        parser.error('choose --rebuild and/or --check')
+
+    load_dotenv()
+    mongo_uri = (os.getenv('MONGO_URI') or os.getenv('MONGODB_URI') or
+                 os.getenv('MONGO_URL') or os.getenv('MONGODB_URL'))
+    if not mongo_uri:
+        print("ERROR: Set MONGO_URI (or MONGODB_URL) in your .env file.")
+        sys.exit(1)
+    target_db = MongoClient(mongo_uri)[os.getenv('MONGODB_DATABASE') or 'saless']
+
+    start_date = datetime.date.today() - datetime.timedelta(days=args.days - 1) if args.days else None
+    if args.rebuild:
+        print(f"✅  Rebuilt {rebuild(target_db, start_date)} day sketches.")
+    if args.check:
+        report = check(target_db, start_date)
+        print(f"Exact {report['exact']:,}, estimate {report['estimate']:,} "
+              f"({report['error']:.2%} off, bound {hll.ERROR_BOUND:.2%})")
+        sys.exit(0 if report['within_bound'] else 1)
@@ -0,0 +1,473 @@
+"""
+demand_forecast.py
+------------------
+Batch demand forecasts behind the restock recommendations.
+
+`refresh()` reads daily unit sales per product variant for the last
+``HISTORY_DAYS`` days into one ``series × days`` NumPy matrix with a single
+aggregation. It fits additive Holt-Winters smoothing (damped trend, weekly
+season) to every series at once:
+
+    ŷ(t)  = level + φ·trend + season[t mod 7]
+    e     = y(t) − ŷ(t)
+    level ← level + φ·trend + α·e      trend ← φ·trend + αβ·e      season ← season + γ·e
+
+Every (α, β, γ) in ``GRID`` is stored on a leading axis of the state arrays,
+so one pass over the days updates all series under all parameter sets. Each
+series then keeps the parameters with the smallest one-step squared error.
+The only Python loop is over days, so 10K series × 730 days fits in about a
+second.
+
+Festivals come from the dated calendar in festival_notifications.py and the
+admin's ``custom_festivals``. A product matches a festival by keyword,
+category or (custom festivals) exact name, as in the festival
+recommendations. On a matched product's festival days the smoother does not
+learn from the sale, so a Diwali rush does not inflate the baseline. The
+ratio of actual to baseline sales on those days is the product's festival
+uplift, shrunk towards the configured boost (``FESTIVAL_UPLIFT`` or the
+festival's ``boost_percentage``) when there is little history. Forecast days
+inside an upcoming festival window are multiplied by it.
+
+One document per series goes to ``forecasts``:
+
+    {_id: '<product_id>:<variant_index|->', product_id, product_name, category,
+     variant_index, variant, stock, forecast: [units per day, HORIZON_DAYS],
+     demand_7d, demand_28d, days_of_cover, reorder_qty, rmse, festival,
+     festival_uplift, model: {alpha, beta, gamma}, generated_at}
+
+``reorder_qty`` is an order-up-to quantity: forecast demand over the lead
+time plus the review period, plus ``SERVICE_Z`` one-step RMSEs of safety
+stock scaled by √(lead + review), minus the stock on hand.
+
+NumPy is optional: without it `available()` is False and callers keep their
+rule-of-thumb advice.
+
+Environment:
+    FORECAST_HISTORY_DAYS=730      days of history fitted
+    FORECAST_LEAD_DAYS=7           supplier lead time
+    FORECAST_REVIEW_DAYS=7         days between restock reviews
+    FORECAST_SERVICE_Z=1.65        safety-stock z-score (~95 % service level)
+    FESTIVAL_UPLIFT=30             default festival boost in percent
+
+Usage:
+    python demand_forecast.py --refresh          # fit and store forecasts now
+    python demand_forecast.py --show 20          # lowest days of cover first
+"""
+
+import argparse
+import datetime
+import math
+import os
+import sys
+
+from bson import ObjectId
+from pymongo import ASCENDING
+
+import sales_rollups
+import staging
+import timeseries
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency
+    np = None
+
+FORECAST_COLLECTION = 'forecasts'
+HISTORY_DAYS = int(os.getenv('FORECAST_HISTORY_DAYS', '730'))
+HORIZON_DAYS = 28
+LEAD_DAYS = int(os.getenv('FORECAST_LEAD_DAYS', '7'))
+REVIEW_DAYS = int(os.getenv('FORECAST_REVIEW_DAYS', '7'))
+SERVICE_Z = float(os.getenv('FORECAST_SERVICE_Z', '1.65'))
+FESTIVAL_UPLIFT = float(os.getenv('FESTIVAL_UPLIFT', '30'))
+
+SEASON = 7
+DAMPING = 0.98
+# Days at the start of a series that are smoothed but not scored
+WARMUP_DAYS = 14
+# (alpha, beta, gamma) candidates fitted side by side
+GRID = [(a, b, g) for a in (0.05, 0.15, 0.4) for b in (0.0, 0.05) for g in (0.0, 0.1, 0.3)]
+# Days the dated calendar's festivals pull shopping forward
+FESTIVAL_LEAD_DAYS = 5
+# Festival uplift prior is worth this many days of a product's average sales
+FESTIVAL_PRIOR_DAYS = 7
+UPLIFT_RANGE = (0.5, 4.0)
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def available() -> bool:
+    """True when NumPy is importable."""
+    return np is not None
+
+
+def ensure_indexes(db, name: str = FORECAST_COLLECTION) -> None:
+    coll = db[name]
+    coll.create_index([('product_id', ASCENDING)])
+    coll.create_index([('days_of_cover', ASCENDING)])
+
+
+# ── Model ────────────────────────────────────────────────────────────────────
+
+def fit(y, festival=None, first=None, horizon: int = HORIZON_DAYS, priors=None) -> dict:
+    """Fit every row of `y` (series × days, units per day) and forecast `horizon` days.
+
+    `festival` is an optional boolean mask (series × days + horizon) of festival
+    days and `priors` the per-series uplift those days are expected to bring
+    (default ``FESTIVAL_UPLIFT``). `first` is the day index each series starts
+    at (default: its first sale). Returns arrays keyed 'forecast' (series ×
+    horizon), 'rmse', 'uplift', 'params' (index into ``GRID``) and 'baseline'
+    (mean units per counted day).
+    """
+    y = np.asarray(y, dtype=np.float32)
+    n_series, n_days = y.shape
+    if first is None:
+        sold = y > 0
+        first = np.where(sold.any(axis=1), sold.argmax(axis=1), n_days)
+    first = np.asarray(first)
+    grid = np.array(GRID, dtype=np.float32)
+    alpha, alpha_beta, gamma = (grid[:, 0:1], (grid[:, 0] * grid[:, 1])[:, None], grid[:, 2:3])
+    n_combos = len(GRID)
+
+    # Day-major copies, so each step reads one contiguous row
+    obs_by_day = np.ascontiguousarray(y.T)
+    counted = np.arange(n_days)[:, None] >= (first + WARMUP_DAYS)[None, :]
+    if festival is not None:
+        fest_by_day = np.ascontiguousarray(festival[:, :n_days].T)
+        counted &= ~fest_by_day
+        fest_days = fest_by_day.any(axis=1)
+    counted = counted.astype(np.float32)
+
+    # Start each series at the mean of its first two weeks
+    cum = np.concatenate([np.zeros((n_series, 1), dtype=np.float64), np.cumsum(y, axis=1, dtype=np.float64)], axis=1)
+    lo = np.minimum(first, n_days)
+    hi = np.minimum(first + WARMUP_DAYS, n_days)
+    start_level = ((cum[np.arange(n_series), hi] - cum[np.arange(n_series), lo])
+                   / np.maximum(hi - lo, 1)).astype(np.float32)
+
+    level = np.repeat(start_level[None, :], n_combos, axis=0)
+    trend = np.zeros_like(level)
+    season = np.zeros((SEASON, n_combos, n_series), dtype=np.float32)
+    sse = np.zeros_like(level)
+    fest_expected = np.zeros_like(level)
+    fest_actual = np.zeros(n_series, dtype=np.float64)
+    err = np.empty_like(level)
+    base = np.empty_like(level)
+
+    for t in range(n_days):
+        s = season[t % SEASON]
+        np.multiply(trend, DAMPING, out=trend)
+        np.add(level, trend, out=base)
+        # err = y - (base + s)
+        np.subtract(obs_by_day[t], base, out=err)
+        err -= s
+        if festival is not None and fest_days[t]:
+            hit = fest_by_day[t]
+            fest_expected += np.where(hit, base + s, 0)
+            fest_actual += np.where(hit, obs_by_day[t], 0)
+            # Festival sales do not move the baseline
+            err[:, hit] = 0
+        sse += err * err * counted[t]
+        np.add(base, alpha * err, out=level)
+        trend += alpha_beta * err
+        s += gamma * err
+
+    rows = np.arange(n_series)
+    best = sse.argmin(axis=0)
+    n_counted = np.maximum(counted.sum(axis=0), 1)
+    rmse = np.sqrt(sse[best, rows] / n_counted)
+
+    steps = np.arange(1, horizon + 1)
+    damp = np.cumsum(DAMPING ** steps)
+    season_ahead = season[(n_days + steps - 1) % SEASON][:, best, rows].T
+    forecast = level[best, rows][:, None] + trend[best, rows][:, None] * damp[None, :] + season_ahead
+    np.maximum(forecast, 0, out=forecast)
+
+    baseline = np.maximum((cum[:, -1] - cum[rows, lo]) / np.maximum(n_days - lo, 1), 0)
+    uplift = np.ones(n_series)
+    if festival is not None:
+        prior = 1 + (FESTIVAL_UPLIFT if priors is None else np.asarray(priors)) / 100.0
+        weight = FESTIVAL_PRIOR_DAYS * np.maximum(baseline, 1e-3)
+        uplift = (fest_actual + weight * prior) / (np.maximum(fest_expected[best, rows], 0) + weight)
+        uplift = np.clip(uplift, *UPLIFT_RANGE)
+        forecast = np.where(festival[:, n_days:n_days + horizon], forecast * uplift[:, None], forecast)
+    return {'forecast': forecast, 'rmse': rmse, 'uplift': uplift, 'params': best, 'baseline': baseline}
+
+
+def cover_and_reorder(forecast, rmse, stock, lead: int = LEAD_DAYS, review: int = REVIEW_DAYS):
+    """Days the stock lasts under `forecast` and the order-up-to reorder quantity, per series.
+
+    Days of cover is NaN for series with no forecast demand. Demand past the
+    horizon is extrapolated at the horizon's mean rate.
+    """
+    stock = np.maximum(np.asarray(stock, dtype=np.float64), 0)
+    cum = np.cumsum(forecast, axis=1)
+    horizon = forecast.shape[1]
+    rate = cum[:, -1] / horizon
+    covered = (cum <= stock[:, None]).sum(axis=1).astype(np.float64)
+    # Part of the day on which stock runs out, or extrapolation past the horizon
+    idx = np.minimum(covered.astype(int), horizon - 1)
+    prev = np.where(idx > 0, cum[np.arange(len(stock)), idx - 1], 0)
+    day_demand = forecast[np.arange(len(stock)), idx]
+    partial = np.where(day_demand > 0, (stock - prev) / np.where(day_demand > 0, day_demand, 1), 0)
+    beyond = (stock - cum[:, -1]) / np.where(rate > 0, rate, 1)
+    cover = np.where(covered >= horizon, horizon + beyond, covered + np.clip(partial, 0, 1))
+    cover = np.where(rate > 0, cover, np.nan)
+
+    span = lead + review
+    demand = cum[:, min(span, horizon) - 1] + rate * max(span - horizon, 0)
+    target = demand + SERVICE_Z * rmse * math.sqrt(span)
+    reorder = np.ceil(np.maximum(target - stock, 0))
+    return cover, reorder
+
+
+# ── Inputs ───────────────────────────────────────────────────────────────────
+
+def festival_calendar(db, boosts=None) -> list:
+    """Dated festival windows: [{name, start, end, products, categories, names, boost}].
+
+    `boosts` maps festival names to a boost percentage (e.g. app.INDIAN_FESTIVALS);
+    others get ``FESTIVAL_UPLIFT``.
+    """
+    boosts = boosts or {}
+    calendar = []
+    try:
+        from festival_notifications import INDIAN_FESTIVALS_2026
+    except ImportError:
+        INDIAN_FESTIVALS_2026 = {}
+    for name, f in INDIAN_FESTIVALS_2026.items():
+        day = timeseries.bucket_start(f['date'])
+        calendar.append({'name': name, 'start': day - datetime.timedelta(days=FESTIVAL_LEAD_DAYS), 'end': day,
+                         'products': f.get('products', []), 'categories': f.get('categories', []),
+                         'names': [], 'boost': boosts.get(name, FESTIVAL_UPLIFT)})
+    for cf in db.custom_festivals.find({}, {'name': 1, 'start_date': 1, 'end_date': 1, 'products': 1}):
+        start, end = cf.get('start_date'), cf.get('end_date')
+        if not isinstance(start, datetime.datetime) or not isinstance(end, datetime.datetime):
+            continue
+        calendar.append({'name': cf.get('name', 'Festival Offer'),
+                         'start': timeseries.local_day(start), 'end': timeseries.local_day(end),
+                         'products': [], 'categories': [], 'names': [p for p in cf.get('products', []) if p],
+                         'boost': boosts.get(cf.get('name'), FESTIVAL_UPLIFT)})
+    return calendar
+
+
+def _festival_matches(festival: dict, name: str, category: str) -> bool:
+    lowered = (name or '').lower()
+    return (name in festival['names']
+            or any(k.lower() in lowered for k in festival['products'])
+            or category in festival['categories'])
+
+
+def _catalogue(db) -> tuple:
+    by_id, by_name = {}, {}
+    for p in db.products_update.find({}, {'name': 1, 'category': 1, 'variants': 1, 'stock': 1}):
+        by_id[str(p['_id'])] = p
+        if p.get('name'):
+            by_name.setdefault(p['name'], p)
+    return by_id, by_name
+
+
+def _daily_units(db, start, end) -> list:
+    # One row per (product id, product name, variant index) with parallel lists of
+    # epoch days (shop-local) and units sold on them
+    local = {'date': '$purchase_date', 'timezone': timeseries.SHOP_TIMEZONE}
+    day = {'$dateFromParts': {'year': {'$year': local}, 'month': {'$month': local}, 'day': {'$dayOfMonth': local}}}
+    pipeline = [
+        {'$match': sales_rollups.raw_match(start, end)},
+        {'$group': {
+            '_id': {'pid': '$product_id', 'name': '$product_name', 'variant': '$variant_index', 'day': day},
+            'units': {'$sum': '$quantity'},
+        }},
+        {'$group': {
+            '_id': {'pid': '$_id.pid', 'name': '$_id.name', 'variant': '$_id.variant'},
+            'days': {'$push': {'$floor': {'$divide': [{'$subtract': ['$_id.day', _EPOCH]}, 86400000]}}},
+            'units': {'$push': '$units'},
+        }},
+    ]
+    return list(db[sales_rollups.SOURCE_COLLECTION].aggregate(pipeline, allowDiskUse=True))
+
+
+def _resolve(rows, by_id, by_name) -> dict:
+    # Map aggregation rows onto catalogue series {(product_id, variant_index | None): [rows]}.
+    # Lines without a usable variant index count against the whole product, and then
+    # so do all of that product's lines, so its stock is never split two ways.
+    resolved = []
+    for row in rows:
+        key = row['_id']
+        doc = by_id.get(str(key.get('pid'))) if key.get('pid') is not None else None
+        doc = doc or by_name.get(key.get('name'))
+        if doc is None:
+            continue
+        variants = doc.get('variants') or []
+        variant = key.get('variant')
+        if not (isinstance(variant, int) and 0 <= variant < len(variants)):
+            variant = 0 if len(variants) == 1 else None
+        resolved.append((str(doc['_id']), variant, row))
+    whole = {pid for pid, variant, _ in resolved if variant is None}
+    series = {}
+    for pid, variant, row in resolved:
+        series.setdefault((pid, None if pid in whole else variant), []).append(row)
+    return series
+
+
+def _stock(doc: dict, variant) -> int:
+    variants = [v for v in (doc.get('variants') or []) if isinstance(v, dict)]
+    try:
+        if variant is not None:
+            return int(variants[variant].get('stock', 0) or 0)
+        if variants:
+            return sum(int(v.get('stock', 0) or 0) for v in variants)
+        return int(doc.get('stock', 0) or 0)
+    except (TypeError, ValueError, IndexError):
+        return 0
+
+
+def _variant_label(doc: dict, variant):
+    if variant is None:
+        return None
+    v = (doc.get('variants') or [])[variant]
+    return v.get('quantity') or v.get('label') or v.get('size') if isinstance(v, dict) else None
+
+
+# ── Refresh ──────────────────────────────────────────────────────────────────
+
+def refresh(db, now=None, boosts=None) -> int:
+    """Fit every product variant sold in the last ``HISTORY_DAYS`` days and store the forecasts.
+
+    History ends yesterday, so the forecast starts today. The forecasts replace
+    ``forecasts`` as a whole (see staging.py), so series that are no longer
+    sold or no longer in the catalogue drop out. Returns the number of
+    forecast documents written.
+    """
+    if np is None:
+        raise RuntimeError('demand_forecast needs NumPy')
+    today = timeseries.local_day(now or datetime.datetime.utcnow())
+    start = today - datetime.timedelta(days=HISTORY_DAYS)
+    end = today - datetime.timedelta(days=1)
+    by_id, by_name = _catalogue(db)
+    series = _resolve(_daily_units(db, start, end), by_id, by_name)
+    keys = sorted(series, key=lambda k: (k[0], -1 if k[1] is None else k[1]))
+    stamp = datetime.datetime.now()
+    if not keys:
+        return staging.replace(db, FORECAST_COLLECTION, [])
+
+    origin = (start - _EPOCH).days
+    y = np.zeros((len(keys), HISTORY_DAYS), dtype=np.float32)
+    for i, key in enumerate(keys):
+        for row in series[key]:
+            cols = np.asarray(row['days'], dtype=np.int64) - origin
+            ok = (cols >= 0) & (cols < HISTORY_DAYS)
+            np.add.at(y[i], cols[ok], np.asarray(row['units'], dtype=np.float32)[ok])
+
+    docs = [by_id[pid] for pid, _ in keys]
+    festival = np.zeros((len(keys), HISTORY_DAYS + HORIZON_DAYS), dtype=bool)
+    priors = np.full(len(keys), FESTIVAL_UPLIFT)
+    upcoming = [None] * len(keys)
+    for f in festival_calendar(db, boosts):
+        lo = max((f['start'] - start).days, 0)
+        hi = min((f['end'] - start).days + 1, HISTORY_DAYS + HORIZON_DAYS)
+        if hi <= lo:
+            continue
+        for i, doc in enumerate(docs):
+            if _festival_matches(f, doc.get('name'), doc.get('category')):
+                festival[i, lo:hi] = True
+                priors[i] = max(priors[i], f['boost'])
+                if hi > HISTORY_DAYS and upcoming[i] is None:
+                    upcoming[i] = f['name']
+
+    fitted = fit(y, festival if festival.any() else None, priors=priors)
+    stock = np.array([_stock(doc, variant) for doc, (_, variant) in zip(docs, keys)], dtype=np.float64)
+    cover, reorder = cover_and_reorder(fitted['forecast'], fitted['rmse'], stock)
+
+    rounded = np.round(fitted['forecast'], 2)
+    forecasts = []
+    for i, (pid, variant) in enumerate(keys):
+        doc = docs[i]
+        a, b, g = GRID[int(fitted['params'][i])]
+        forecast = fitted['forecast'][i]
+        forecasts.append({
+            '_id': f"{pid}:{'-' if variant is None else variant}",
+            'product_id': doc['_id'],
+            'product_name': doc.get('name'),
+            'category': doc.get('category'),
+            'variant_index': variant,
+            'variant': _variant_label(doc, variant),
+            'stock': int(stock[i]),
+            'forecast': rounded[i].tolist(),
+            'demand_7d': round(float(forecast[:7].sum()), 1),
+            'demand_28d': round(float(forecast.sum()), 1),
+            'days_of_cover': None if math.isnan(cover[i]) else round(float(cover[i]), 1),
+            'reorder_qty': int(reorder[i]),
+            'rmse': round(float(fitted['rmse'][i]), 3),
+            'festival': upcoming[i],
+            'festival_uplift': round(float(fitted['uplift'][i]), 2),
+            'model': {'alpha': a, 'beta': b, 'gamma': g},
+            'generated_at': stamp,
+        })
+    # Built aside and renamed in, so overlapping refreshes cannot delete each other's rows
+    return staging.replace(db, FORECAST_COLLECTION, forecasts, ensure_indexes)
+
+
+# ── Readers ──────────────────────────────────────────────────────────────────
+
+def restock(db, limit: int = 10) -> list:
+    """Series that need a reorder, fewest days of cover first."""
+    query = {'reorder_qty': {'$gt': 0}, 'days_of_cover': {'$ne': None}}
+    return list(db[FORECAST_COLLECTION].find(query, {'forecast': 0}).sort('days_of_cover', ASCENDING).limit(limit))
+
+
+def for_products(db, product_ids) -> dict:
+    """Forecasts summed over variants: {product_id str: {demand_7d, demand_28d, days_of_cover, reorder_qty, stock}}.
+
+    `days_of_cover` is the smallest over the product's variants.
+    """
+    keys = [ObjectId(p) if ObjectId.is_valid(str(p)) else p for p in product_ids]
+    out = {}
+    for f in db[FORECAST_COLLECTION].find({'product_id': {'$in': keys}}, {'forecast': 0}):
+        row = out.setdefault(str(f['product_id']), {'demand_7d': 0.0, 'demand_28d': 0.0, 'reorder_qty': 0,
+                                                     'stock': 0, 'days_of_cover': None, 'festival': None})
+        row['demand_7d'] += f.get('demand_7d') or 0
+        row['demand_28d'] += f.get('demand_28d') or 0
+        row['reorder_qty'] += f.get('reorder_qty') or 0
+        row['stock'] += f.get('stock') or 0
+        row['festival'] = row['festival'] or f.get('festival')
+        if f.get('days_of_cover') is not None:
+            row['days_of_cover'] = min(f['days_of_cover'], row['days_of_cover'] or f['days_of_cover'])
+    return out
+
+
+# ── CLI ───────────────────────────────────────────────────────────────────────
+if __name__ == '__main__':
+    import time
+
+    from pymongo import MongoClient
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description='Fit and inspect per-product demand forecasts')
+    parser.add_argument('--refresh', action='store_true', help='Fit every sold product variant and store forecasts')
+    parser.add_argument('--show', type=int, default=None, metavar='N', help='Print the N most urgent restocks')
+    args = parser.parse_args()
+
+    if not (args.refresh or args.show):
+        parser.error('choose --refresh and/or --show')
+    if np is None:
+        print("ERROR: demand_forecast needs NumPy (pip install numpy).")
+        sys.exit(1)
+
+    load_dotenv()
+    mongo_uri = (os.getenv('MONGO_URI') or os.getenv('MONGODB_URI') or
+                 os.getenv('MONGO_URL') or os.getenv('MONGODB_URL'))
+    if not mongo_uri:
+        print("ERROR: Set MONGO_URI (or MONGODB_URL) in your .env file.")
+        sys.exit(1)
+    target_db = MongoClient(mongo_uri)[os.getenv('MONGODB_DATABASE') or 'saless']
+
+    if args.refresh:
+        started = time.perf_counter()
+        ensure_indexes(target_db)
+        written = refresh(target_db)
+        print(f"✅  Wrote {written} forecasts in {time.perf_counter() - started:.1f}s.")
+    if args.show:
+        for f in restock(target_db, args.show):
+            variant = f" ({f['variant']})" if f.get('variant') else ''
+            print(f"  {f['product_name']}{variant}: stock {f['stock']}, {f['days_of_cover']} days of cover, "
+                  f"reorder {f['reorder_qty']}")
@@ -0,0 +1,223 @@
+"""
+inventory_summary.py
+--------------------
+Stock quantity and valuation per product collection, overall and per
+category, kept current with ``$inc`` deltas.
+
+``inventory_summary`` holds one small document per (source, category) plus
+one overall document per source:
+
+    {_id: '<source>:*', source, category: None, quantity, value, variants, products, updated_at}
+    {_id: '<source>:<category>', source, category, quantity, value, variants, products, updated_at}
+
+A variant contributes ``min(stock, STOCK_CAP)`` units and that many times its
+price. This is the capped figure the dashboard has always shown. The cap
+makes deltas depend on the old stock, so writers pass the stock before and
+after the write:
+
+    record_variant()   one variant's stock moved (checkouts, restock, worker sales)
+    record_product()   a product was added, merged, replaced or deleted
+
+Each call sends its overall and category increments in one bulk write.
+`reconcile()` recomputes every source from scratch and replaces the stored
+documents. It returns the drift it found, so a missed write or a write made
+outside the app shows up in the log instead of going unnoticed.
+
+Usage:
+    python inventory_summary.py --reconcile
+    python inventory_summary.py --show
+"""
+
+import argparse
+import datetime
+import os
+import sys
+
+from pymongo import ASCENDING, ReplaceOne, UpdateOne
+
+SUMMARY_COLLECTION = 'inventory_summary'
+SOURCES = ('products_update', 'products', 'products_by_user')
+STOCK_CAP = 1024
+METRICS = ('quantity', 'value', 'variants', 'products')
+DRIFT_TOLERANCE = 0.01
+BATCH = 1000
+
+
+def ensure_indexes(db) -> None:
+    db[SUMMARY_COLLECTION].create_index([('source', ASCENDING), ('category', ASCENDING)])
+
+
+def _category(product) -> str:
+    return (product or {}).get('category') or 'Uncategorized'
+
+
+def _units(stock) -> int:
+    try:
+        return min(int(stock or 0), STOCK_CAP)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _price(variant) -> float:
+    try:
+        return float(variant.get('price') or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def contribution(product) -> dict:
+    """{quantity, value, variants, products} that `product` adds to its category."""
+    totals = dict.fromkeys(METRICS, 0)
+    if not product:
+        return totals
+    totals['products'] = 1
+    for variant in product.get('variants') or []:
+        if isinstance(variant, dict):
+            units = _units(variant.get('stock', 0))
+            totals['quantity'] += units
+            totals['value'] += units * _price(variant)
+            totals['variants'] += 1
+    return totals
+
+
+# ── Deltas ───────────────────────────────────────────────────────────────────
+
+def _apply(db, source: str, deltas: dict, now=None) -> None:
+    # deltas: {category: {metric: delta}}; the overall document gets their sum
+    overall = dict.fromkeys(METRICS, 0)
+    ops = []
+    stamp = now or datetime.datetime.now()
+    for category, delta in deltas.items():
+        delta = {m: v for m, v in delta.items() if v}
+        if not delta:
+            continue
+        for metric, value in delta.items():
+            overall[metric] += value
+        ops.append(UpdateOne({'_id': f'{source}:{category}'}, {
+            '$inc': delta, '$set': {'source': source, 'category': category, 'updated_at': stamp}}, upsert=True))
+    overall = {m: v for m, v in overall.items() if v}
+    if overall:
+        ops.append(UpdateOne({'_id': f'{source}:*'}, {
+            '$inc': overall, '$set': {'source': source, 'category': None, 'updated_at': stamp}}, upsert=True))
+    if ops:
+        db[SUMMARY_COLLECTION].bulk_write(ops, ordered=False)
+
+
+def record_variant(db, source: str, product: dict, variant_index: int, old_stock, new_stock) -> None:
+    """Fold one variant's stock change (`old_stock` → `new_stock`) into the summary."""
+    variants = product.get('variants') or []
+    variant = variants[variant_index] if 0 <= variant_index < len(variants) else {}
+    units = _units(new_stock) - _units(old_stock)
+    _apply(db, source, {_category(product): {'quantity': units, 'value': units * _price(variant)}})
+
+
+def record_product(db, source: str, before: dict = None, after: dict = None) -> None:
+    """Fold a product write into the summary: `before` is None for an insert
+    and `after` is None for a delete."""
+    deltas = {}
+    for product, sign in ((before, -1), (after, 1)):
+        if product:
+            row = deltas.setdefault(_category(product), dict.fromkeys(METRICS, 0))
+            for metric, value in contribution(product).items():
+                row[metric] += sign * value
+    _apply(db, source, deltas)
+
+
+# ── Reconcile ────────────────────────────────────────────────────────────────
+
+def compute(db, source: str) -> dict:
+    """{category: totals} for `source`, recomputed from every product."""
+    totals = {}
+    for product in db[source].find({}, {'category': 1, 'variants': 1}).batch_size(BATCH):
+        row = totals.setdefault(_category(product), dict.fromkeys(METRICS, 0))
+        for metric, value in contribution(product).items():
+            row[metric] += value
+    return totals
+
+
+def reconcile(db, sources=SOURCES, now=None) -> dict:
+    """Recompute `sources` and replace the stored documents.
+
+    Returns {source: {metric: stored - actual}} for the overall documents
+    that were off by more than ``DRIFT_TOLERANCE``.
+    """
+    coll = db[SUMMARY_COLLECTION]
+    stamp = now or datetime.datetime.now()
+    drift = {}
+    for source in sources:
+        stored = {d['_id']: d for d in coll.find({'source': source})}
+        categories = compute(db, source)
+        overall = dict.fromkeys(METRICS, 0)
+        ops = []
+        for category, totals in categories.items():
+            for metric, value in totals.items():
+                overall[metric] += value
+            ops.append(ReplaceOne({'_id': f'{source}:{category}'}, {
+                'source': source, 'category': category, **totals, 'updated_at': stamp}, upsert=True))
+        ops.append(ReplaceOne({'_id': f'{source}:*'}, {
+            'source': source, 'category': None, **overall, 'updated_at': stamp}, upsert=True))
+        previous = stored.get(f'{source}:*')
+        if previous is not None:
+            off = {m: round(previous.get(m, 0) - overall[m], 2) for m in METRICS
+                   if abs(previous.get(m, 0) - overall[m]) > DRIFT_TOLERANCE}
+            if off:
+                drift[source] = off
+        coll.bulk_write(ops, ordered=False)
+        gone = [key for key in stored if key != f'{source}:*' and key[len(source) + 1:] not in categories]
+        if gone:
+            coll.delete_many({'_id': {'$in': gone}})
+    return drift
+
+
+# ── Readers ──────────────────────────────────────────────────────────────────
+
+def read(db, source: str = 'products_update') -> dict:
+    """{'overall': totals, 'categories': [totals with category]} in one query.
+
+    ``overall`` is None until the source has been reconciled or written once.
+    """
+    overall, categories = None, []
+    for doc in db[SUMMARY_COLLECTION].find({'source': source}):
+        totals = {m: doc.get(m, 0) for m in METRICS}
+        if doc.get('category') is None:
+            overall = totals
+        else:
+            categories.append({'category': doc['category'], **totals})
+    categories.sort(key=lambda c: c['value'], reverse=True)
+    return {'overall': overall, 'categories': categories}
+
+
+# ── CLI ───────────────────────────────────────────────────────────────────────
+if __name__ == '__main__':
+    from pymongo import MongoClient
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description='Maintain the inventory valuation summary')
+    parser.add_argument('--reconcile', action='store_true', help='Recompute from every product and report drift')
+    parser.add_argument('--show', action='store_true', help='Print the products_update summary')
+    args = parser.parse_args()
+
+    if not (args.reconcile or args.show):
+        parser.error('choose --reconcile and/or --show')
+
+    load_dotenv()
+    mongo_uri = (os.getenv('MONGO_URI') or os.getenv('MONGODB_URI') or
+                 os.getenv('MONGO_URL') or os.getenv('MONGODB_URL'))
+    if not mongo_uri:
+        print("ERROR: Set MONGO_URI (or MONGODB_URL) in your .env file.")
+        sys.exit(1)
+    target_db = MongoClient(mongo_uri)[os.getenv('MONGODB_DATABASE') or 'saless']
+
+    if args.reconcile:
+        ensure_indexes(target_db)
+        found = reconcile(target_db)
+        for source, off in found.items():
+            print(f"⚠️  {source} had drifted (stored - actual): {off}")
+        print("✅  Inventory summary reconciled." if not found else "✅  Drift corrected.")
+    if args.show:
+        summary = read(target_db)
+        for row in summary['categories']:
+            print(f"  {row['category']:<24} {row['quantity']:>10,} units  Rs {row['value']:>14,.2f}")
+        if summary['overall']:
+            print(f"  {'Total':<24} {summary['overall']['quantity']:>10,} units  "
+                  f"Rs {summary['overall']['value']:>14,.2f}")
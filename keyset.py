@@ -0,0 +1,105 @@
+"""
+keyset.py
+---------
+Keyset ("seek") pagination with opaque cursor tokens.
+
+``.skip(n)`` makes the server walk past and discard ``n`` documents, so deep
+pages cost more the deeper they are. A keyset page asks for the rows after the
+last one shown instead. With ``field`` descending and ``_id`` as tie-break:
+
+    {'$or': [{field: {'$lt': v}}, {field: v, '_id': {'$lt': last_id}}]}
+
+An index on ``(field, _id)`` answers that with one seek, on any page. The
+position goes to the client as an opaque token: the last row's
+``[field value, _id]`` in extended JSON, base64url-encoded. ``after`` walks
+forward from a token and ``before`` walks back.
+
+`page()` reads one collection. `merged_page()` reads several collections with
+the same sort, such as ``users`` and ``users_update``. It heap-merges their
+cursors lazily and stops after ``per_page`` rows. A document found in more
+than one collection (same ``_id``) is shown once. Each cursor is limited to
+``per_page + 1`` rows, because a row past that cannot be on the page.
+
+Both return ``{'items': [...], 'next': token or None, 'prev': token or None}``.
+The sort ``field`` must be present on every row it pages over.
+"""
+
+import base64
+import heapq
+
+from bson import json_util
+from pymongo import DESCENDING
+
+
+def encode_cursor(doc: dict, field: str = '_id') -> str:
+    raw = json_util.dumps([doc.get(field), doc['_id']]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token: str) -> list:
+    """[field value, _id] from a token; ValueError if it is not one of ours."""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json_util.loads(raw)
+    except Exception as e:
+        raise ValueError(f'Invalid page cursor: {token!r}') from e
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError(f'Invalid page cursor: {token!r}')
+    return values
+
+
+def _seek(field: str, direction: int, token: str) -> dict:
+    value, last_id = decode_cursor(token)
+    op = '$lt' if direction < 0 else '$gt'
+    if field == '_id':
+        return {'_id': {op: last_id}}
+    return {'$or': [{field: {op: value}}, {field: value, '_id': {op: last_id}}]}
+
+
+def _cursor(collection, query, projection, field, direction, token, limit):
+    if token:
+        seek = _seek(field, direction, token)
+        query = {'$and': [query, seek]} if query else seek
+    sort = [(field, direction)] if field == '_id' else [(field, direction), ('_id', direction)]
+    return collection.find(query or {}, projection).sort(sort).limit(limit).batch_size(limit)
+
+
+def _result(rows: list, per_page: int, field: str, after, before) -> dict:
+    # `rows` holds up to per_page + 1 rows read in the walking direction
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if before:
+        rows.reverse()
+    first_token = encode_cursor(rows[0], field) if rows else None
+    last_token = encode_cursor(rows[-1], field) if rows else None
+    if before:
+        return {'items': rows, 'next': last_token or before, 'prev': first_token if more else None}
+    return {'items': rows, 'next': last_token if more else None, 'prev': first_token if after else None}
+
+
+def page(collection, per_page: int, field: str = '_id', direction: int = DESCENDING,
+         query: dict = None, projection: dict = None, after: str = None, before: str = None) -> dict:
+    """One page of `collection` sorted by (`field`, _id) in `direction`."""
+    walk = -direction if before else direction
+    rows = list(_cursor(collection, query, projection, field, walk, before or after, per_page + 1))
+    return _result(rows, per_page, field, after, before)
+
+
+def merged_page(collections, per_page: int, field: str = '_id', direction: int = DESCENDING,
+                query: dict = None, projection: dict = None, after: str = None, before: str = None) -> dict:
+    """One page of the union of `collections`, each sorted by (`field`, _id)."""
+    walk = -direction if before else direction
+    cursors = [_cursor(c, query, projection, field, walk, before or after, per_page + 1)
+               for c in collections if c is not None]
+    rows, seen = [], set()
+    merged = heapq.merge(*cursors, key=lambda d: (d.get(field), d['_id']), reverse=walk < 0)
+    for doc in merged:
+        if doc['_id'] in seen:
+            continue
+        seen.add(doc['_id'])
+        rows.append(doc)
+        if len(rows) > per_page:
+            break
+    for cursor in cursors:
+        cursor.close()
+    return _result(rows, per_page, field, after, before)
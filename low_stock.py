@@ -0,0 +1,181 @@
+"""
+low_stock.py
+------------
+Maintained low-stock view: one ``low_stock_items`` document per product
+variant whose stock is under ``LOW_STOCK_THRESHOLD``.
+
+    {_id: '<source>:<product id>:<variant index>', source, product_id,
+     product_name, category, variant_index, variant, stock, updated_at}
+
+``source`` is the product collection (``products_update``, ``products`` or
+``products_by_user``). A product without variants but with a top-level
+``stock`` (older ``products`` documents) is one row with ``variant_index``
+None. A variant without a stock counts as 0, as the old scans did.
+
+Every stock write calls `sync()` with the products it touched. `sync()`
+re-reads just those products and upserts or drops their rows, so ``$inc``,
+``$set`` and deletes are all handled the same way. Counts and lists are then
+range queries on the ``(source, stock)`` index, whatever the catalogue size.
+`rebuild()` rescans every product and picks up writes made outside the app
+(seeders, imports). The app runs it on a schedule.
+
+Readers take a ``threshold`` up to ``LOW_STOCK_THRESHOLD`` (rows above the
+configured threshold are not kept).
+
+Environment:
+    LOW_STOCK_THRESHOLD   variants with less stock than this are tracked (default 10)
+
+Usage:
+    python low_stock.py --rebuild
+    python low_stock.py --show 20
+"""
+
+import argparse
+import datetime
+import os
+import sys
+
+from bson import ObjectId
+from pymongo import ASCENDING, DeleteMany, ReplaceOne
+
+LOW_STOCK_COLLECTION = 'low_stock_items'
+SOURCES = ('products_update', 'products', 'products_by_user')
+LOW_STOCK_THRESHOLD = int(os.getenv('LOW_STOCK_THRESHOLD', '10'))
+BATCH = 1000
+PROJECTION = {'name': 1, 'category': 1, 'variants': 1, 'stock': 1}
+
+
+def ensure_indexes(db) -> None:
+    coll = db[LOW_STOCK_COLLECTION]
+    coll.create_index([('source', ASCENDING), ('stock', ASCENDING)])
+    coll.create_index([('stock', ASCENDING)])
+    coll.create_index([('product_id', ASCENDING)])
+
+
+def _stock(value) -> int:
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def low_variants(product: dict, threshold: int = LOW_STOCK_THRESHOLD) -> list:
+    """[(variant index or None, variant label, stock)] under `threshold`."""
+    variants = product.get('variants')
+    if not variants:
+        if 'stock' not in product:
+            return []
+        stock = _stock(product['stock'])
+        return [(None, '', stock)] if stock < threshold else []
+    return [(i, v.get('quantity', ''), _stock(v.get('stock')))
+            for i, v in enumerate(variants)
+            if isinstance(v, dict) and _stock(v.get('stock')) < threshold]
+
+
+def _rows(source: str, product: dict, stamp) -> list:
+    pid = str(product['_id'])
+    return [ReplaceOne({'_id': f'{source}:{pid}:{"" if i is None else i}'}, {
+        'source': source,
+        'product_id': pid,
+        'product_name': product.get('name', ''),
+        'category': product.get('category', 'Uncategorized'),
+        'variant_index': i,
+        'variant': label,
+        'stock': stock,
+        'updated_at': stamp,
+    }, upsert=True) for i, label, stock in low_variants(product)]
+
+
+# ── Maintenance ──────────────────────────────────────────────────────────────
+
+def sync(db, source: str, product_ids) -> int:
+    """Refresh the rows of `product_ids` in `source` after a stock write.
+
+    Returns the number of low-stock variants those products now have.
+    """
+    ids = {str(p) for p in product_ids if p is not None}
+    if not ids:
+        return 0
+    keys = [ObjectId(p) if ObjectId.is_valid(p) else p for p in ids]
+    stamp = datetime.datetime.now()
+    ops = [DeleteMany({'source': source, 'product_id': {'$in': list(ids)}})]
+    for product in db[source].find({'_id': {'$in': keys}}, PROJECTION):
+        ops.extend(_rows(source, product, stamp))
+    db[LOW_STOCK_COLLECTION].bulk_write(ops, ordered=True)
+    return len(ops) - 1
+
+
+def rebuild(db) -> int:
+    """Rescan every product collection; returns the low-stock variants found."""
+    coll = db[LOW_STOCK_COLLECTION]
+    stamp = datetime.datetime.now()
+    written = 0
+    for source in SOURCES:
+        ops = []
+        for product in db[source].find({}, PROJECTION).batch_size(BATCH):
+            ops.extend(_rows(source, product, stamp))
+            if len(ops) >= BATCH:
+                coll.bulk_write(ops, ordered=False)
+                written += len(ops)
+                ops = []
+        if ops:
+            coll.bulk_write(ops, ordered=False)
+            written += len(ops)
+    coll.delete_many({'updated_at': {'$lt': stamp}})
+    return written
+
+
+# ── Readers ──────────────────────────────────────────────────────────────────
+
+def _query(threshold, sources) -> dict:
+    query = {'stock': {'$lt': min(threshold or LOW_STOCK_THRESHOLD, LOW_STOCK_THRESHOLD)}}
+    if sources:
+        query['source'] = {'$in': list(sources)}
+    return query
+
+
+def count(db, threshold: int = None, sources=('products_update',)) -> int:
+    """Low-stock variants in `sources`."""
+    return db[LOW_STOCK_COLLECTION].count_documents(_query(threshold, sources))
+
+
+def count_products(db, threshold: int = None, sources=('products_update',)) -> int:
+    """Products in `sources` with at least one low-stock variant."""
+    return len(db[LOW_STOCK_COLLECTION].distinct('product_id', _query(threshold, sources)))
+
+
+def items(db, limit: int = 0, threshold: int = None, sources=('products_update',)) -> list:
+    """Low-stock variants in `sources`, lowest stock first."""
+    cursor = db[LOW_STOCK_COLLECTION].find(_query(threshold, sources), {'_id': 0}).sort(
+        [('stock', ASCENDING), ('product_name', ASCENDING)])
+    return list(cursor.limit(limit) if limit else cursor)
+
+
+# ── CLI ───────────────────────────────────────────────────────────────────────
+if __name__ == '__main__':
+    from pymongo import MongoClient
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description='Maintain the low-stock view')
+    parser.add_argument('--rebuild', action='store_true', help='Rescan every product collection')
+    parser.add_argument('--show', type=int, metavar='N', help='Print the N lowest-stock variants')
+    args = parser.parse_args()
+
+    if not (args.rebuild or args.show):
+        parser.error('choose --rebuild and/or --show N')
+
+    load_dotenv()
+    mongo_uri = (os.getenv('MONGO_URI') or os.getenv('MONGODB_URI') or
+                 os.getenv('MONGO_URL') or os.getenv('MONGODB_URL'))
+    if not mongo_uri:
+        print("ERROR: Set MONGO_URI (or MONGODB_URL) in your .env file.")
+        sys.exit(1)
+    target_db = MongoClient(mongo_uri)[os.getenv('MONGODB_DATABASE') or 'saless']
+
+    if args.rebuild:
+        ensure_indexes(target_db)
+        print(f"✅  {rebuild(target_db)} variants under {LOW_STOCK_THRESHOLD} in stock.")
+    if args.show:
+        for row in items(target_db, args.show, sources=SOURCES):
+            label = f"{row['product_name']} ({row['variant']})" if row['variant'] else row['product_name']
+            print(f"  {row['stock']:>5}  {label:<50} {row['source']}")
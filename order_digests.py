@@ -0,0 +1,357 @@
+"""
+order_digests.py
+----------------
+Order-value and units-per-order distributions from mergeable t-digests.
+
+An order is the set of sale lines one customer bought under an ``order_id``
+(ids have one-second resolution, so two checkouts in the same second share
+one; co_purchase.py keys baskets the same way). A line without one counts as
+an order of its own, the same unit ``avg_order_value`` divides by.
+Every checkout folds its orders into one document per shop-local day of
+``order_value_digests``:
+
+    {_id: 'YYYY-MM-DD', kind: 'day', day, version,
+     all:        {order_value: <digest>, units: <digest>},
+     categories: [{category, order_value: <digest>, units: <digest>}]}
+
+Digests are described in tdigest.py. A category digest holds each order's
+lines in that category, which is the order's basket for that category.
+Day documents are rewritten with a compare-and-swap on ``version``, like
+sales_topk.py.
+
+A date range is the merge of its pieces. Each full calendar month that has
+ended is one stored ``{_id: 'YYYY-MM', kind: 'month'}`` document, built the
+first time it is needed. The remaining days are at most two partial months.
+Any range therefore reads a bounded number of small documents, whatever the
+sales volume. A write to an ended month drops that month's document.
+
+Usage:
+    python order_digests.py --rebuild                  # rebuild every day from user_data_bought
+    python order_digests.py --rebuild --days 90
+    python order_digests.py --show --start 2025-01-01 --end 2025-03-31
+"""
+
+import argparse
+import datetime
+import os
+import sys
+
+from pymongo import ReplaceOne
+from pymongo.errors import DuplicateKeyError
+
+import sales_rollups
+import tdigest
+import timeseries
+
+DIGEST_COLLECTION = 'order_value_digests'
+SOURCE_COLLECTION = 'user_data_bought'
+METRICS = ('order_value', 'units')
+PERCENTILES = (0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99)
+MAX_INTEGER_BINS = 50           # units histograms get one bin per value up to this many
+CAS_RETRIES = 8
+
+
+def day_key(day) -> str:
+    return day.strftime('%Y-%m-%d')
+
+
+def month_key(day) -> str:
+    return day.strftime('%Y-%m')
+
+
+def _empty() -> dict:
+    return {metric: tdigest.new() for metric in METRICS}
+
+
+def _category_map(doc) -> dict:
+    return {c['category']: {m: c[m] for m in METRICS} for c in (doc or {}).get('categories', [])}
+
+
+def _category_list(categories: dict) -> list:
+    return [{'category': name, **digests} for name, digests in categories.items()]
+
+
+# ── Writing ──────────────────────────────────────────────────────────────────
+
+def build_orders(records) -> dict:
+    """Group sale lines into orders: {day: [{'value', 'units', 'categories': {category: [value, units]}}]}."""
+    orders = {}
+    for i, rec in enumerate(records):
+        values = sales_rollups.line_values(rec)
+        day = timeseries.local_day(rec.get('purchase_date') or rec.get('date'))
+        if values is None or day is None:
+            continue
+        revenue, units = values
+        key = (str(rec.get('user_id')), rec['order_id']) if rec.get('order_id') else ('line', i)
+        order = orders.setdefault(day, {}).setdefault(key, {'value': 0.0, 'units': 0, 'categories': {}})
+        order['value'] += revenue
+        order['units'] += units
+        basket = order['categories'].setdefault(rec.get('category'), [0.0, 0])
+        basket[0] += revenue
+        basket[1] += units
+    return {day: list(by_key.values()) for day, by_key in orders.items()}
+
+
+def _fold(all_digests: dict, categories: dict, orders) -> None:
+    # Add `orders` to the day's digests in place, one compression per digest
+    tdigest.add_many(all_digests['order_value'], [o['value'] for o in orders])
+    tdigest.add_many(all_digests['units'], [o['units'] for o in orders])
+    baskets = {}
+    for order in orders:
+        for category, (value, units) in order['categories'].items():
+            pair = baskets.setdefault(category, ([], []))
+            pair[0].append(value)
+            pair[1].append(units)
+    for category, (values, units) in baskets.items():
+        digests = categories.setdefault(category, _empty())
+        tdigest.add_many(digests['order_value'], values)
+        tdigest.add_many(digests['units'], units)
+
+
+def _apply(coll, day, orders, doc, now) -> None:
+    # Compare-and-swap one day document; re-read and retry when another writer won
+    _id = day_key(day)
+    for _ in range(CAS_RETRIES):
+        all_digests = (doc or {}).get('all') or _empty()
+        categories = _category_map(doc)
+        _fold(all_digests, categories, orders)
+        version = (doc or {}).get('version', 0)
+        body = {'kind': 'day', 'day': day, 'version': version + 1, 'updated_at': now,
+                'all': all_digests, 'categories': _category_list(categories)}
+        if doc is None:
+            try:
+                coll.insert_one({'_id': _id, **body})
+                return
+            except DuplicateKeyError:
+                pass
+        elif coll.replace_one({'_id': _id, 'version': version}, body).matched_count:
+            return
+        doc = coll.find_one({'_id': _id})
+    raise RuntimeError(f"order_digests: gave up updating {_id} after {CAS_RETRIES} attempts")
+
+
+def record_orders(db, records, now=None) -> int:
+    """Fold freshly inserted sale lines into the day digests.
+
+    Returns the number of day documents written.
+    """
+    by_day = build_orders(records)
+    if not by_day:
+        return 0
+    coll = db[DIGEST_COLLECTION]
+    docs = {d['_id']: d for d in coll.find({'_id': {'$in': [day_key(d) for d in by_day]}})}
+    stamp = datetime.datetime.now()
+    for day, orders in by_day.items():
+        _apply(coll, day, orders, docs.get(day_key(day)), stamp)
+    current = month_key(timeseries.local_day(now or datetime.datetime.utcnow()))
+    ended = sorted({month_key(d) for d in by_day if month_key(d) < current})
+    if ended:
+        # Back-dated lines: the stored month digests they fall in are stale
+        coll.delete_many({'_id': {'$in': ended}})
+    return len(by_day)
+
+
+# ── Readers ──────────────────────────────────────────────────────────────────
+
+def _month_doc(coll, key: str, now) -> dict:
+    # Merge an ended month's day documents into one stored month document
+    all_digests, categories = _empty(), {}
+    for d in coll.find({'kind': 'day', '_id': {'$gte': f'{key}-01', '$lte': f'{key}-31'}}):
+        for metric in METRICS:
+            all_digests[metric] = tdigest.merge(all_digests[metric], d['all'][metric])
+        for name, digests in _category_map(d).items():
+            into = categories.setdefault(name, _empty())
+            for metric in METRICS:
+                into[metric] = tdigest.merge(into[metric], digests[metric])
+    doc = {'kind': 'month', 'all': all_digests, 'categories': _category_list(categories), 'built_at': now}
+    coll.replace_one({'_id': key}, doc, upsert=True)
+    return doc
+
+
+def _pieces(start: datetime.date, end: datetime.date, current_month: str):
+    # ([ended months fully inside the range], [remaining day keys])
+    months, days = [], []
+    day = start
+    while day <= end:
+        first = day.replace(day=1)
+        next_month = (first + datetime.timedelta(days=32)).replace(day=1)
+        if day == first and next_month - datetime.timedelta(days=1) <= end and month_key(day) < current_month:
+            months.append(month_key(day))
+            day = next_month
+            continue
+        days.append(day_key(day))
+        day += datetime.timedelta(days=1)
+    return months, days
+
+
+def range_digests(db, start, end, category=None, now=None) -> dict:
+    """Merged {'order_value': digest, 'units': digest} for the inclusive day range.
+
+    With `category` set, only that category's baskets are counted.
+    """
+    now = now or datetime.datetime.utcnow()
+    start, end = sales_rollups.day_start(start).date(), sales_rollups.day_start(end).date()
+    months, days = _pieces(start, end, month_key(timeseries.local_day(now)))
+    coll = db[DIGEST_COLLECTION]
+    if category is None:
+        projection = {'all': 1}
+    else:
+        projection = {'categories': {'$elemMatch': {'category': category}}}
+    docs = list(coll.find({'_id': {'$in': months + days}}, projection))
+    found = {d['_id'] for d in docs}
+    for key in months:
+        if key not in found:
+            docs.append(_month_doc(coll, key, datetime.datetime.now()))
+
+    merged = _empty()
+    for doc in docs:
+        digests = doc.get('all') if category is None else _category_map(doc).get(category)
+        for metric in METRICS:
+            if digests and digests.get(metric):
+                merged[metric] = tdigest.merge(merged[metric], digests[metric])
+    return merged
+
+
+def _edges(digest: dict, bins: int, integer: bool) -> list:
+    low, high = digest['min'], digest['max']
+    if integer and high - low + 1 <= MAX_INTEGER_BINS:
+        return [v - 0.5 for v in range(int(low), int(high) + 2)]
+    # Equal-width bins up to p99, plus one bin for the tail beyond it
+    top = tdigest.quantile(digest, 0.99)
+    if top is None or top <= low:
+        top = high
+    width = (top - low) / max(bins, 1) or 1.0
+    edges = [low + i * width for i in range(bins + 1)]
+    if high > edges[-1]:
+        edges.append(high)
+    return edges
+
+
+def describe(digest: dict, bins: int = 20, integer: bool = False) -> dict:
+    """Count, mean, min/max, percentiles and a histogram of one digest."""
+    if not digest['count']:
+        return {'count': 0, 'mean': 0, 'min': None, 'max': None, 'percentiles': {}, 'histogram': []}
+    edges = _edges(digest, bins, integer)
+    counts = tdigest.histogram(digest, edges)
+    return {
+        'count': int(digest['count']),
+        'mean': round(digest['sum'] / digest['count'], 2),
+        'min': digest['min'],
+        'max': digest['max'],
+        'percentiles': {f'p{int(q * 100)}': round(tdigest.quantile(digest, q), 2) for q in PERCENTILES},
+        'histogram': [{'from': round(lo, 2), 'to': round(hi, 2), 'count': int(round(c))}
+                      for lo, hi, c in zip(edges, edges[1:], counts)],
+    }
+
+
+def distribution(db, start, end, category=None, bins: int = 20, now=None) -> dict:
+    """Order-value and units-per-order summaries for the inclusive day range."""
+    merged = range_digests(db, start, end, category, now)
+    return {'order_value': describe(merged['order_value'], bins),
+            'units': describe(merged['units'], bins, integer=True)}
+
+
+# ── Rebuild ──────────────────────────────────────────────────────────────────
+
+def _raw_baskets(db, start=None, end=None):
+    # Yield (day, [orders]) from the raw sales collection, one day at a time
+    local = {'date': '$purchase_date', 'timezone': timeseries.SHOP_TIMEZONE}
+    pipeline = [
+        {'$match': sales_rollups.raw_match(start, end)},
+        {'$group': {
+            '_id': {'day': {'$dateFromParts': {'year': {'$year': local},
+                                               'month': {'$month': local},
+                                               'day': {'$dayOfMonth': local}}},
+                    'user': '$user_id',
+                    'order': {'$ifNull': ['$order_id', '$_id']},
+                    'category': '$category'},
+            'value': {'$sum': '$total'},
+            'units': {'$sum': '$quantity'},
+        }},
+        {'$sort': {'_id.day': 1}},
+    ]
+    day, orders = None, {}
+    for row in db[SOURCE_COLLECTION].aggregate(pipeline, allowDiskUse=True):
+        if row['_id']['day'] != day:
+            if orders:
+                yield day, list(orders.values())
+            day, orders = row['_id']['day'], {}
+        key = (str(row['_id'].get('user')), row['_id']['order'])
+        order = orders.setdefault(key, {'value': 0.0, 'units': 0, 'categories': {}})
+        value, units = float(row['value'] or 0), int(row['units'] or 0)
+        order['value'] += value
+        order['units'] += units
+        order['categories'][row['_id'].get('category')] = [value, units]
+    if orders:
+        yield day, list(orders.values())
+
+
+def rebuild(db, start=None, end=None) -> int:
+    """Rebuild the day digests in the inclusive day range (everything if open) from raw sales.
+
+    Like the rollup backfill, checkouts that land for today while it runs can
+    be lost. Returns the number of day documents written.
+    """
+    coll = db[DIGEST_COLLECTION]
+    query = {'kind': 'day'}
+    if start is not None or end is not None:
+        query['_id'] = {}
+        if start is not None:
+            query['_id']['$gte'] = day_key(start)
+        if end is not None:
+            query['_id']['$lte'] = day_key(end)
+    coll.delete_many(query)
+    coll.delete_many({'kind': 'month'})
+    now = datetime.datetime.now()
+    ops, written = [], 0
+    for day, orders in _raw_baskets(db, start, end):
+        all_digests, categories = _empty(), {}
+        _fold(all_digests, categories, orders)
+        ops.append(ReplaceOne({'_id': day_key(day)},
+                              {'kind': 'day', 'day': day, 'version': 1, 'updated_at': now,
+                               'all': all_digests, 'categories': _category_list(categories)}, upsert=True))
+        written += 1
+        if len(ops) >= 100:
+            coll.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        coll.bulk_write(ops, ordered=False)
+    return written
+
+
+# ── CLI ───────────────────────────────────────────────────────────────────────
+if __name__ == '__main__':
+    from pymongo import MongoClient
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description='Maintain the order-value t-digests')
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild day digests from user_data_bought')
+    parser.add_argument('--days', type=int, default=None, help='Limit the rebuild to the last N days')
+    parser.add_argument('--show', action='store_true', help='Print percentiles for a date range')
+    parser.add_argument('--start', type=str, default=None, help='Start date YYYY-MM-DD (default: 30 days ago)')
+    parser.add_argument('--end', type=str, default=None, help='End date YYYY-MM-DD (default: today)')
+    parser.add_argument('--category', type=str, default=None)
+    args = parser.parse_args()
+
+    if not (args.rebuild or args.show):
+        parser.error('choose --rebuild and/or --show')
+
+    load_dotenv()
+    mongo_uri = (os.getenv('MONGO_URI') or os.getenv('MONGODB_URI') or
+                 os.getenv('MONGO_URL') or os.getenv('MONGODB_URL'))
+    if not mongo_uri:
+        print("ERROR: Set MONGO_URI (or MONGODB_URL) in your .env file.")
+        sys.exit(1)
+    target_db = MongoClient(mongo_uri)[os.getenv('MONGODB_DATABASE') or 'saless']
+
+    if args.rebuild:
+        start_date = datetime.date.today() - datetime.timedelta(days=args.days - 1) if args.days else None
+        print(f"✅  Rebuilt {rebuild(target_db, start_date)} day digests.")
+    if args.show:
+        end_date = datetime.date.fromisoformat(args.end) if args.end else datetime.date.today()
+        start_date = datetime.date.fromisoformat(args.start) if args.start else end_date - datetime.timedelta(days=29)
+        report = distribution(target_db, start_date, end_date, args.category)
+        for metric in METRICS:
+            r = report[metric]
+            print(f"  {metric}: {r['count']:,} orders, mean {r['mean']}, " +
+                  ', '.join(f"{k}={v}" for k, v in r['percentiles'].items()))
@@ -0,0 +1,176 @@
+"""
+product_performance.py
+----------------------
+Materialized product-performance snapshot.
+
+`compute()` ranks products over the last 90 days with one server-side
+aggregation over ``products_sold`` plus one batched ``$in`` fetch of product
+metadata from ``products_update``. `refresh()` stores the result as a single
+document in ``analytics_snapshots`` (``_id='product_performance'``), which a
+background job keeps fresh so the public insight / notification endpoints
+only do one ``_id`` lookup.
+
+Usage:
+    python product_performance.py            # recompute and store the snapshot now
+"""
+
+import datetime
+import os
+import sys
+
+from bson import ObjectId
+
+SNAPSHOT_COLLECTION = 'analytics_snapshots'
+SNAPSHOT_ID = 'product_performance'
+ANALYSIS_DAYS = 90
+FALLBACK_SAMPLE = 100   # rows analysed when the window has no sales at all
+
+
+def _sales_pipeline(match: dict, sample: int = None) -> list:
+    pipeline = [{'$match': match}]
+    if sample:
+        pipeline.append({'$limit': sample})
+    pipeline += [
+        {'$group': {
+            '_id': '$product_id',
+            'revenue': {'$sum': {'$ifNull': ['$total', 0]}},
+            'quantity_sold': {'$sum': {'$ifNull': ['$quantity', 0]}},
+            'customers': {'$addToSet': '$user_id'},
+            'order_count': {'$sum': 1},
+        }},
+        {'$project': {
+            'revenue': 1,
+            'quantity_sold': 1,
+            'order_count': 1,
+            'customer_count': {'$size': '$customers'},
+        }},
+    ]
+    return pipeline
+
+
+def _lookup_key(product_id):
+    text = str(product_id)
+    return ObjectId(text) if len(text) == 24 and ObjectId.is_valid(text) else product_id
+
+
+def _rank(results: list) -> dict:
+    # Sort by customer engagement (customer count is priority, then revenue)
+    results.sort(key=lambda x: (x['customer_count'], x['revenue']), reverse=True)
+
+    total_products = len(results)
+    fifth = max(1, total_products // 5)
+
+    # Top 20% by customer engagement
+    top_performers = results[:fifth]
+    for product in top_performers:
+        if product['customer_count'] >= 3:
+            recommended_increase = min(30 + (product['customer_count'] * 2), 50)
+            product['action'] = f"Increase stock by {recommended_increase}% - High demand product"
+        else:
+            product['action'] = "Monitor closely - Growing popularity"
+
+    # Bottom 20% by customer engagement and revenue
+    poor_performers = results[-fifth:]
+    for product in poor_performers:
+        if product['customer_count'] <= 1 and product['revenue'] < 50:
+            product['action'] = "Consider reducing stock by 50% - Low demand"
+        elif product['customer_count'] <= 1:
+            product['action'] = "Reduce stock by 30% and consider promotion"
+        else:
+            product['action'] = "Review pricing strategy"
+
+    return {
+        'top_performers': top_performers,
+        'poor_performers': poor_performers,
+        'analysis_period': f'{ANALYSIS_DAYS} days',
+        'total_products_analyzed': total_products,
+    }
+
+
+def compute(db, now=None) -> dict:
+    """Rank products by customer engagement over the last `ANALYSIS_DAYS` days.
+
+    Returns the same shape the insight endpoints serve. `top_performers` and
+    `poor_performers` are empty when no sold product could be matched to
+    ``products_update``; `error` is set when there are no sales at all.
+    """
+    now = now or datetime.datetime.now()
+    since = now - datetime.timedelta(days=ANALYSIS_DAYS)
+
+    stats = list(db.products_sold.aggregate(_sales_pipeline({'date': {'$gte': since}}), allowDiskUse=True))
+    if not stats:
+        # No recent sales: fall back to a sample of historical ones
+        stats = list(db.products_sold.aggregate(_sales_pipeline({}, FALLBACK_SAMPLE), allowDiskUse=True))
+    stats = [s for s in stats if s['_id'] not in (None, '')]
+    if not stats:
+        return {'top_performers': [], 'poor_performers': [], 'error': 'No sales data found'}
+
+    # One batched metadata fetch instead of a find_one per product
+    keys = {str(s['_id']): _lookup_key(s['_id']) for s in stats}
+    products = {
+        str(p['_id']): p
+        for p in db.products_update.find({'_id': {'$in': list(keys.values())}}, {'name': 1, 'category': 1})
+    }
+
+    results = []
+    for s in stats:
+        product_id = str(s['_id'])
+        product_info = products.get(str(keys[product_id]))
+        if not product_info:
+            continue
+        revenue = float(s.get('revenue', 0))
+        order_count = int(s.get('order_count', 0))
+        results.append({
+            'product_id': product_id,
+            'name': product_info.get('name', 'Unknown Product'),
+            'category': product_info.get('category', 'Unknown'),
+            'revenue': revenue,
+            'quantity_sold': int(s.get('quantity_sold', 0)),
+            'customer_count': int(s.get('customer_count', 0)),
+            'order_count': order_count,
+            'avg_order_value': revenue / order_count if order_count > 0 else 0,
+        })
+
+    if not results:
+        return {'top_performers': [], 'poor_performers': [],
+                'analysis_period': f'{ANALYSIS_DAYS} days', 'total_products_analyzed': 0}
+    return _rank(results)
+
+
+def refresh(db, now=None) -> dict:
+    """Recompute the snapshot and store it; returns the stored payload."""
+    now = now or datetime.datetime.now()
+    data = compute(db, now)
+    db[SNAPSHOT_COLLECTION].replace_one(
+        {'_id': SNAPSHOT_ID},
+        {'_id': SNAPSHOT_ID, 'computed_at': now, 'data': data},
+        upsert=True,
+    )
+    return data
+
+
+def load(db, max_age: datetime.timedelta = None):
+    """Return the stored snapshot payload, or None if missing or older than `max_age`."""
+    doc = db[SNAPSHOT_COLLECTION].find_one({'_id': SNAPSHOT_ID})
+    if not doc:
+        return None
+    if max_age is not None and doc.get('computed_at') and \
+            datetime.datetime.now() - doc['computed_at'] > max_age:
+        return None
+    return doc.get('data')
+
+
+# ── CLI ───────────────────────────────────────────────────────────────────────
+if __name__ == '__main__':
+    from pymongo import MongoClient
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    mongo_uri = (os.getenv('MONGO_URI') or os.getenv('MONGODB_URI') or
+                 os.getenv('MONGO_URL') or os.getenv('MONGODB_URL'))
+    if not mongo_uri:
+        print("ERROR: Set MONGO_URI (or MONGODB_URL) in your .env file.")
+        sys.exit(1)
+    target_db = MongoClient(mongo_uri)[os.getenv('MONGODB_DATABASE') or 'saless']
+    result = refresh(target_db)
+    print(f"✅  Stored product performance for {result.get('total_products_analyzed', 0)} products.")
@@ -0,0 +1,140 @@
+"""
+result_cache.py
+---------------
+Write-invalidated result cache for the analytics endpoints.
+
+Every collection an endpoint reads has a *generation* counter in
+``data_generations`` ({_id: <collection>, generation: int}). Write paths call
+`bump()` after they modify a collection. A cached result is stored together
+with the generations it was computed at, and it is served only while they are
+all unchanged. Answers stay valid until the data they depend on changes, with no
+TTL to guess.
+
+The counters live in MongoDB, so a write made by any gunicorn worker or by a
+seeding script invalidates the cached results of every worker. A lookup costs
+one ``_id $in`` read of the counters. Keys also include the current date, so
+answers relative to "today" roll over at midnight even if nothing was written.
+
+Results are kept in a `shared_cache.SharedCache` namespace. A result computed
+by one worker is therefore served to the others from L2, and only a worker
+whose L1 copy is stale has to read it from there.
+
+Usage:
+    cache = ResultCache(store=shared_cache.backend(db))
+    data = cache.get_or_compute(db, 'business_stats', {'days': 30},
+                                ('user_data_bought', 'users'), lambda: compute())
+    result_cache.bump(db, 'user_data_bought', 'products_sold')   # after a write
+"""
+
+import datetime
+import threading
+
+from bson import json_util
+from pymongo import UpdateOne
+
+import shared_cache
+
+GENERATION_COLLECTION = 'data_generations'
+CACHE_NAMESPACE = 'analytics'
+MAX_ENTRIES = 256
+ENTRY_TTL = 2 * 24 * 3600       # keys carry the date, so older entries are dead anyway
+
+
+def bump(db, *names) -> None:
+    """Advance the generation of each collection in `names` (call after writing to them)."""
+    if db is None or not names:
+        return
+    now = datetime.datetime.now()
+    ops = [UpdateOne({'_id': name}, {'$inc': {'generation': 1}, '$set': {'updated_at': now}}, upsert=True)
+           for name in dict.fromkeys(names)]
+    db[GENERATION_COLLECTION].bulk_write(ops, ordered=False)
+
+
+def generations(db, names) -> tuple:
+    """Current generation of each collection in `names`, in order (0 if never bumped)."""
+    found = {d['_id']: d.get('generation', 0)
+             for d in db[GENERATION_COLLECTION].find({'_id': {'$in': list(names)}})}
+    return tuple(found.get(name, 0) for name in names)
+
+
+def normalize(params: dict) -> tuple:
+    """Hashable, order-independent form of request parameters.
+
+    Empty values are dropped. Lists, tuples and sets become sorted tuples, so
+    ``products=a,b`` and ``products=b,a`` share an entry once the caller splits
+    them.
+    """
+    items = []
+    for key, value in (params or {}).items():
+        if value is None or value == '' or value == []:
+            continue
+        if isinstance(value, (list, tuple, set, frozenset)):
+            value = tuple(sorted(str(v) for v in value))
+        items.append((key, value))
+    return tuple(sorted(items))
+
+
+class ResultCache:
+    """Shared cache of endpoint results validated against generation counters.
+
+    Cached values are shared between requests, so callers must treat them
+    as read-only.
+    """
+
+    def __init__(self, max_entries: int = MAX_ENTRIES, store=None):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # key -> {'generations': [...], 'value': result}
+        self.entries = shared_cache.SharedCache(CACHE_NAMESPACE, store, ttl=ENTRY_TTL, l1_entries=max_entries)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get_or_compute(self, db, endpoint: str, params: dict, depends_on, compute):
+        """Return the cached result for (endpoint, params), or `compute()` and cache it.
+
+        `depends_on` names the collections the result is derived from. The
+        generations are read *before* computing, so a write that lands during
+        the computation makes the stored entry stale straight away.
+        """
+        depends_on = tuple(depends_on)
+        key = f'{endpoint}:{json_util.dumps(normalize(params))}:{datetime.date.today().isoformat()}'
+        try:
+            current = list(generations(db, depends_on))
+        except Exception as e:
+            print(f"Result cache bypassed ({endpoint}): {e}")
+            return compute()
+
+        entry = self.entries.get(key)
+        if entry is not None and entry['generations'] != current:
+            # This worker's copy is stale; another may already have stored a fresh one
+            fresh = self.entries.get_entry(key)
+            entry = fresh[0] if fresh is not None else None
+        with self.lock:
+            if entry is not None:
+                if entry['generations'] == current:
+                    self.hits += 1
+                    return entry['value']
+                self.invalidations += 1
+            self.misses += 1
+
+        value = compute()
+        self.entries.set(key, {'generations': current, 'value': value})
+        return value
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        shared = self.entries.stats()
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': shared['l1_entries'],
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'shared': shared,
+            }
@@ -0,0 +1,116 @@
+"""
+sale_events.py
+--------------
+One entry point for recording sale lines, shared by the checkouts in app.py
+and the seed scripts.
+
+`record_order()` stores an order as facts (sales_facts.py projects the legacy
+copies) and, when the channel projects into ``user_data_bought``, folds the
+lines into every summary derived from that collection:
+
+    sales_rollups   daily revenue / orders / units buckets
+    sales_spikes    per-product demand EWMAs
+    sales_topk      best-seller, buyer and worker top-K summaries
+    order_digests   order-value and basket-size t-digests
+    cohorts         marks the cohort months the lines fall in as stale
+
+Each step is isolated: a failing summary is logged and the rest still run, and
+the sale itself is never rolled back. `rebuild()` recomputes all of them from
+the raw sales, for scripts that delete sale lines (or to repair drift).
+
+Environment:
+    MONGO_URI / MONGODB_URI / MONGO_URL / MONGODB_URL, MONGODB_DATABASE
+
+Usage:
+    python sale_events.py --rebuild
+"""
+
+import argparse
+import os
+import sys
+
+import cohorts
+import order_digests
+import result_cache
+import sales_facts
+import sales_rollups
+import sales_spikes
+import sales_topk
+
+# (name, fold, rebuild, what rebuild() counts) in the order they run
+SUMMARIES = (
+    ('sales rollups', sales_rollups.record_sales, sales_rollups.backfill, 'rollup buckets'),
+    ('demand EWMAs', sales_spikes.record_sales, sales_spikes.rebuild, 'products with demand averages'),
+    ('top-K summaries', sales_topk.record_sales, sales_topk.rebuild, 'top-K day summaries'),
+    ('order-value digests', order_digests.record_orders, order_digests.rebuild, 'order-value digests'),
+    ('cohort months', cohorts.record_sales, lambda db: cohorts.rebuild(db)['activity'], 'cohort months'),
+)
+
+
+def fold(db, records, log=print) -> list:
+    """Fold sale lines into every summary. Returns the names of failed steps."""
+    failed = []
+    if not records:
+        return failed
+    for name, record, _, _ in SUMMARIES:
+        try:
+            record(db, records)
+        except Exception as e:
+            failed.append(name)
+            log(f"Error updating {name}: {e}")
+    return failed
+
+
+def record_order(db, lines, channel: str, header: dict = None, bump: bool = True, log=print) -> list:
+    """Store an order's sale lines and fold them into the summaries.
+
+    Lines of channels that do not reach ``user_data_bought`` (the cart route)
+    are only stored: the summaries are all derived from that collection. With
+    `bump`, the result-cache generations of the collections written are
+    bumped; the app passes False and bumps its own wider set. Returns the
+    stored facts.
+    """
+    facts = sales_facts.record_order(db, lines, channel, header=header)
+    if not facts:
+        return facts
+    written = set(sales_facts.CHANNELS[channel])
+    if header:
+        written.add(sales_facts.HEADER_COLLECTION)
+    if 'user_data_bought' in written:
+        fold(db, lines, log)
+    if bump:
+        result_cache.bump(db, *sorted(written))
+    return facts
+
+
+def rebuild(db) -> list:
+    """Recompute every summary from the raw sales.
+
+    Returns ``[(what, count)]`` in the order they were rebuilt.
+    """
+    counts = [(what, rebuild_one(db)) for _, _, rebuild_one, what in SUMMARIES]
+    result_cache.bump(db, 'user_data_bought')
+    return counts
+
+
+if __name__ == '__main__':
+    from pymongo import MongoClient
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description='Rebuild the summaries derived from sale lines')
+    parser.add_argument('--rebuild', action='store_true', help='Recompute every summary from the raw sales')
+    args = parser.parse_args()
+
+    if not args.rebuild:
+        parser.error('choose --rebuild')
+
+    load_dotenv()
+    mongo_uri = (os.getenv('MONGO_URI') or os.getenv('MONGODB_URI') or
+                 os.getenv('MONGO_URL') or os.getenv('MONGODB_URL'))
+    if not mongo_uri:
+        print("ERROR: Set MONGO_URI (or MONGODB_URL) in your .env file.")
+        sys.exit(1)
+    target_db = MongoClient(mongo_uri)[os.getenv('MONGODB_DATABASE') or 'saless']
+
+    for what, count in rebuild(target_db):
+        print(f"✅  Rebuilt {count} {what}.")
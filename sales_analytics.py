@@ -0,0 +1,449 @@
+"""
+sales_analytics.py
+------------------
+Server-side sales aggregations behind the admin analytics, the chatbot and
+the customer pages; each reads the sale lines it needs in one aggregation.
+
+Period summary (``/api/analytics``):
+
+`period_summary()` runs one ``$facet`` aggregation over ``products_sold`` so
+the sale lines matched by the date / product / user filters are read once,
+instead of once per metric. Product and category figures share one facet that
+groups by ``product_id`` first and only then looks each product up in
+``products_update`` — one ``$lookup`` per product, not per sale row.
+
+`merged_summary()` builds the same fields from day partials merged by
+closed_periods.py. Product and customer metadata are fetched with
+`fetch_by_id()`: batched ``$in`` queries of ``FETCH_CHUNK`` ids.
+
+Legacy sale amounts (the chatbot's sales summaries and the auto-refreshed
+stats): `legacy_totals()` sums revenue and line counts with one ``$group``,
+parsing the mixed amount types old lines were stored with
+(`sale_amount_stages()`) inside the aggregation.
+
+Customer history (``/admin/user-details``): `customer_history()` runs one
+aggregation over a customer's lines in ``user_data_bought`` and
+``products_sold`` and returns the totals, top products, monthly spend and one
+page of the order table.
+"""
+
+import datetime
+
+from bson import ObjectId
+
+FETCH_CHUNK = 1000
+
+
+# Sale-line product/user ids are stored as strings; bad ids map to null instead
+# of failing the whole aggregation.
+def _object_id(expr):
+    return {'$convert': {'input': expr, 'to': 'objectId', 'onError': None, 'onNull': None}}
+
+
+def summary_pipeline(base_match: dict, top_customers: int = 100, count_customers: bool = True) -> list:
+    """Build the `$facet` pipeline; every facet works off the same matched lines."""
+    facets = {
+        'totals': [
+            {'$group': {
+                '_id': None,
+                'total_revenue': {'$sum': '$total'},
+                'total_orders': {'$sum': 1},
+                'total_units': {'$sum': '$quantity'},
+            }},
+        ],
+        'products': [
+            {'$group': {
+                '_id': '$product_id',
+                'product_name': {'$first': '$product_name'},
+                'total_revenue': {'$sum': '$total'},
+                'units_sold': {'$sum': '$quantity'},
+            }},
+            {'$addFields': {'product_object_id': _object_id('$_id')}},
+            {'$lookup': {
+                'from': 'products_update',
+                'localField': 'product_object_id',
+                'foreignField': '_id',
+                'as': 'product',
+            }},
+            {'$unwind': {'path': '$product', 'preserveNullAndEmptyArrays': True}},
+            {'$project': {
+                'product_name': 1,
+                'total_revenue': 1,
+                'units_sold': 1,
+                'category': {'$ifNull': ['$product.category', 'Other']},
+                'variants': {'$ifNull': ['$product.variants', []]},
+            }},
+            {'$sort': {'total_revenue': -1}},
+        ],
+        'top_customers': [
+            {'$group': {
+                '_id': '$user_id',
+                'total_spent': {'$sum': '$total'},
+                'orders': {'$sum': 1},
+            }},
+            {'$sort': {'total_spent': -1}},
+            {'$limit': top_customers},
+            {'$addFields': {'user_object_id': _object_id('$_id')}},
+            {'$lookup': {
+                'from': 'users',
+                'localField': 'user_object_id',
+                'foreignField': '_id',
+                'as': 'user',
+            }},
+            {'$unwind': {'path': '$user', 'preserveNullAndEmptyArrays': True}},
+            {'$project': {
+                'name': {'$ifNull': ['$user.name', 'Unknown']},
+                'email': {'$ifNull': ['$user.email', '']},
+                'orders': 1,
+                'total_spent': 1,
+            }},
+        ],
+        'trend': [
+            {'$group': {
+                '_id': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$date'}},
+                'total': {'$sum': '$total'},
+            }},
+        ],
+    }
+    if count_customers:
+        # Exact distinct count; grouping keeps one small doc per customer, never one big array
+        facets['active_customers'] = [
+            {'$group': {'_id': '$user_id'}},
+            {'$count': 'count'},
+        ]
+    return [{'$match': base_match}, {'$facet': facets}]
+
+
+def _stock(variants) -> int:
+    total = 0
+    for variant in variants or []:
+        if isinstance(variant, dict):
+            total += int(variant.get('stock', 0) or 0)
+    return total
+
+
+def period_summary(collection, base_match: dict, count_customers: bool = True) -> dict:
+    """Run the facet pipeline and shape it into the `/api/analytics` summary fields.
+
+    `sales_by_day` maps 'YYYY-MM-DD' to revenue; the caller fills empty days.
+    `active_customers` is None when `count_customers` is off (the caller
+    estimates it instead).
+    """
+    pipeline = summary_pipeline(base_match, count_customers=count_customers)
+    facets = next(collection.aggregate(pipeline, allowDiskUse=True), {})
+
+    totals = (facets.get('totals') or [{}])[0]
+    total_revenue = float(totals.get('total_revenue', 0) or 0)
+    total_orders = int(totals.get('total_orders', 0) or 0)
+    active = facets.get('active_customers') or []
+
+    return {
+        'total_revenue': total_revenue,
+        'total_orders': total_orders,
+        'total_units': int(totals.get('total_units', 0) or 0),
+        'avg_order_value': round(total_revenue / total_orders, 2) if total_orders > 0 else 0,
+        'active_customers': (int(active[0]['count']) if active else 0) if count_customers else None,
+        **_product_fields(facets.get('products', [])),
+        'top_customers': [
+            {
+                'name': c.get('name', 'Unknown'),
+                'email': c.get('email', ''),
+                'orders': int(c.get('orders', 0)),
+                'total_spent': float(c.get('total_spent', 0)),
+            }
+            for c in facets.get('top_customers', [])
+        ],
+        'sales_by_day': {r['_id']: float(r['total']) for r in facets.get('trend', [])},
+    }
+
+
+def _product_fields(rows) -> dict:
+    # all_products / top_products / category_sales from per-product rows
+    # ({product_name, total_revenue, units_sold, category, variants}), highest revenue first.
+    all_products = []
+    by_name = {}
+    by_category = {}
+    for p in rows:
+        revenue = float(p.get('total_revenue', 0) or 0)
+        units = int(p.get('units_sold', 0) or 0)
+        name = p.get('product_name')
+        category = p.get('category', 'Other')
+        all_products.append({
+            'name': name or 'Unknown',
+            'category': category,
+            'revenue': revenue,
+            'units_sold': units,
+            'stock': _stock(p.get('variants')),
+        })
+        # Top products are ranked per name, like the dashboard tables
+        named = by_name.setdefault(name, {'name': name, 'revenue': 0.0, 'units': 0})
+        named['revenue'] += revenue
+        named['units'] += units
+        by_category[category] = by_category.get(category, 0.0) + revenue
+
+    top_products = sorted(by_name.values(), key=lambda p: p['revenue'], reverse=True)[:10]
+    category_sales = [
+        {'category': c, 'revenue': r}
+        for c, r in sorted(by_category.items(), key=lambda item: item[1], reverse=True)
+    ]
+
+    return {'top_products': top_products, 'all_products': all_products, 'category_sales': category_sales}
+
+
+def _if_null(value, default):
+    # Python side of the pipeline's $ifNull
+    return default if value is None else value
+
+
+def lookup_key(value):
+    """ObjectId for 24-hex-char ids (sale lines store them as strings), else the value."""
+    text = str(value)
+    return ObjectId(text) if len(text) == 24 and ObjectId.is_valid(text) else value
+
+
+def fetch_by_id(collection, ids, projection: dict, chunk: int = FETCH_CHUNK) -> dict:
+    """Batched ``$in`` fetches: {str(id): document} for the given sale-line ids.
+
+    Ids go ``chunk`` at a time. `collection` may be a sequence of collections.
+    Ids missing from the first are looked up in the next (``users`` then
+    ``users_update``), so the first collection that has an id wins.
+    """
+    collections = collection if isinstance(collection, (list, tuple)) else [collection]
+    missing = list({lookup_key(i) for i in ids if i not in (None, '')})
+    found = {}
+    for coll in collections:
+        if coll is None or not missing:
+            continue
+        for i in range(0, len(missing), chunk):
+            for d in coll.find({'_id': {'$in': missing[i:i + chunk]}}, projection):
+                found[str(d['_id'])] = d
+        missing = [k for k in missing if str(k) not in found]
+    return found
+
+
+def merged_summary(db, merged: dict, top_customers: int = 100) -> dict:
+    """`period_summary` fields from partials merged by `closed_periods.merge`.
+
+    Category and stock are read live from ``products_update`` and customer
+    names from ``users``; only the sales figures come from the cache.
+    """
+    products = fetch_by_id(db.products_update, merged['products'].keys(), {'category': 1, 'variants': 1})
+    rows = []
+    for key, p in merged['products'].items():
+        info = products.get(key, {})
+        rows.append({'product_name': p['product_name'], 'total_revenue': p['revenue'],
+                     'units_sold': p['units'], 'category': _if_null(info.get('category'), 'Other'),
+                     'variants': _if_null(info.get('variants'), [])})
+    rows.sort(key=lambda r: r['total_revenue'], reverse=True)
+
+    ranked = sorted(merged['customers'].values(), key=lambda c: c['spent'], reverse=True)[:top_customers]
+    people = fetch_by_id(db.users, [c['user_id'] for c in ranked], {'name': 1, 'email': 1})
+
+    total_revenue = float(merged['revenue'])
+    total_orders = int(merged['orders'])
+    return {
+        'total_revenue': total_revenue,
+        'total_orders': total_orders,
+        'total_units': int(merged['units']),
+        'avg_order_value': round(total_revenue / total_orders, 2) if total_orders > 0 else 0,
+        'active_customers': len(merged['customers']),
+        **_product_fields(rows),
+        'top_customers': [
+            {
+                'name': _if_null(people.get(str(c['user_id']), {}).get('name'), 'Unknown'),
+                'email': _if_null(people.get(str(c['user_id']), {}).get('email'), ''),
+                'orders': int(c['orders']),
+                'total_spent': float(c['spent']),
+            }
+            for c in ranked
+        ],
+        'sales_by_day': dict(merged['sales_by_day']),
+    }
+
+
+# ── Legacy sale amounts ──────────────────────────────────────────────────────
+# Pipeline twins of app.py's safe_float / extract_numeric_value /
+# calculate_sale_amount, so the chatbot and cache totals can be summed
+# server-side over old sale lines (string prices, '1kg' quantities, no total).
+
+_NUMBER_TYPES = ['double', 'int', 'long', 'bool']
+
+
+def _to_double(expr, default=0.0):
+    return {'$convert': {'input': expr, 'to': 'double', 'onError': default, 'onNull': default}}
+
+
+def _strip_money(expr):
+    # Commas and '$' removed, surrounding whitespace trimmed
+    no_commas = {'$replaceAll': {'input': expr, 'find': ',', 'replacement': ''}}
+    return {'$trim': {'input': {'$replaceAll': {'input': no_commas, 'find': {'$literal': '$'}, 'replacement': ''}}}}
+
+
+def _number(expr, text_default):
+    # Numbers (and bools) convert; strings are stripped and converted, else `text_default`
+    return {'$switch': {'branches': [
+        {'case': {'$eq': [{'$type': expr}, 'string']}, 'then': _to_double(_strip_money(expr), text_default)},
+        {'case': {'$in': [{'$type': expr}, _NUMBER_TYPES]}, 'then': _to_double(expr)},
+    ], 'default': 0.0}}
+
+
+def _safe_float(expr):
+    # safe_float(): unparseable strings are 0
+    return _number(expr, 0.0)
+
+
+def _numeric_value(expr):
+    # extract_numeric_value(): an unparseable string reads as its first number ('1kg' -> 1)
+    first = {'$regexFind': {'input': _strip_money(expr), 'regex': r'[-+]?\d*\.\d+|\d+'}}
+    return _number(expr, {'$let': {'vars': {'found': first}, 'in': _to_double('$$found.match')}})
+
+
+def sale_amount_stages() -> list:
+    """Stages adding ``quantity_value`` and ``sale_amount`` to each sale line.
+
+    ``sale_amount`` is ``total_price`` when it is set (truthy), else
+    ``price × quantity_value``; the same rule as calculate_sale_amount().
+    """
+    total_price = {'$ifNull': ['$total_price', None]}
+    return [
+        {'$addFields': {'quantity_value': _numeric_value({'$ifNull': ['$quantity', 0]})}},
+        {'$addFields': {'sale_amount': {'$cond': [
+            {'$in': [total_price, [None, 0, '', False, []]]},
+            {'$multiply': [_safe_float('$price'), '$quantity_value']},
+            _safe_float(total_price),
+        ]}}},
+    ]
+
+
+def legacy_totals(collection, match: dict = None, since=None) -> dict:
+    """Revenue and line count of `collection` (optionally `match`ed) in one round trip.
+
+    Returns {'revenue', 'lines', 'since_revenue', 'since_lines'}; the
+    ``since_*`` figures cover lines whose ``date`` is at or after `since`.
+    """
+    recent = {'$gte': ['$date', since]} if since is not None else False
+    pipeline = [{'$match': match}] if match else []
+    pipeline += sale_amount_stages() + [
+        {'$group': {
+            '_id': None,
+            'revenue': {'$sum': '$sale_amount'},
+            'lines': {'$sum': 1},
+            'since_revenue': {'$sum': {'$cond': [recent, '$sale_amount', 0]}},
+            'since_lines': {'$sum': {'$cond': [recent, 1, 0]}},
+        }},
+    ]
+    totals = next(collection.aggregate(pipeline, allowDiskUse=True), {})
+    return {
+        'revenue': float(totals.get('revenue', 0) or 0),
+        'lines': int(totals.get('lines', 0) or 0),
+        'since_revenue': float(totals.get('since_revenue', 0) or 0),
+        'since_lines': int(totals.get('since_lines', 0) or 0),
+    }
+
+# ── Customer history ─────────────────────────────────────────────────────────
+
+def _line_date(now):
+    # purchase_date, else date; ISO strings are parsed and missing/bad dates count as `now`
+    raw = {'$ifNull': ['$purchase_date', '$date']}
+    parsed = {'$cond': [{'$eq': [{'$type': raw}, 'string']},
+                        {'$dateFromString': {'dateString': raw, 'onError': None, 'onNull': None}},
+                        raw]}
+    return {'$ifNull': [parsed, now]}
+
+
+def customer_history_pipeline(user_id, skip: int, limit: int, now) -> list:
+    """Per-customer `$facet` over ``user_data_bought`` plus ``products_sold``.
+
+    Both collections record the same sale in places, so lines are merged on
+    (order_id, product_id, variant_index) with the ``user_data_bought`` copy
+    kept. Totals, per-product and per-month sums, and one page of lines
+    (newest first) come back from the same pass.
+    """
+    match = {'$match': {'user_id': user_id}}
+    return [
+        match,
+        {'$addFields': {'_from': 0}},
+        {'$unionWith': {'coll': 'products_sold', 'pipeline': [match, {'$addFields': {'_from': 1}}]}},
+        {'$sort': {'_from': 1}},
+        {'$group': {
+            '_id': {
+                'order': {'$toString': {'$ifNull': ['$order_id', '']}},
+                'product': {'$toString': '$product_id'},
+                'variant': {'$toString': {'$ifNull': ['$variant_index', '']}},
+            },
+            'line': {'$first': '$$ROOT'},
+        }},
+        {'$replaceRoot': {'newRoot': '$line'}},
+        {'$addFields': {
+            'product_id': {'$toString': '$product_id'},
+            'quantity': {'$ifNull': ['$quantity', 1]},
+            'total': {'$ifNull': ['$total', {'$ifNull': ['$total_price', {'$multiply': [
+                {'$ifNull': ['$price', 0]}, {'$ifNull': ['$quantity', 1]}]}]}]},
+            'date': _line_date(now),
+        }},
+        {'$facet': {
+            'totals': [
+                {'$group': {
+                    '_id': None,
+                    'total_spent': {'$sum': '$total'},
+                    'total_orders': {'$sum': 1},
+                    'last_order': {'$max': '$date'},
+                }},
+            ],
+            'products': [
+                {'$group': {
+                    '_id': '$product_id',
+                    'name': {'$first': '$product_name'},
+                    'quantity': {'$sum': '$quantity'},
+                    'total_spent': {'$sum': '$total'},
+                }},
+                {'$sort': {'total_spent': -1}},
+                {'$limit': 5},
+            ],
+            'months': [
+                {'$group': {
+                    '_id': {'$dateToString': {'format': '%Y-%m', 'date': '$date'}},
+                    'total': {'$sum': '$total'},
+                }},
+                {'$sort': {'_id': 1}},
+            ],
+            'orders': [
+                {'$sort': {'date': -1, '_id': -1}},
+                {'$skip': skip},
+                {'$limit': limit},
+                {'$project': {'_from': 0}},
+            ],
+        }},
+    ]
+
+
+def customer_history(db, user_id, page: int = 1, per_page: int = 25, now=None) -> dict:
+    """Spend summary and one page of order lines for one customer.
+
+    Returns {'total_spent', 'total_orders', 'last_order', 'top_products',
+    'monthly_spending', 'orders'}. Top product names come from
+    ``products_update`` in one batched ``$in`` read, falling back to the
+    name on the sale line.
+    """
+    now = now or datetime.datetime.now()
+    pipeline = customer_history_pipeline(user_id, (max(page, 1) - 1) * per_page, per_page, now)
+    facets = next(db.user_data_bought.aggregate(pipeline, allowDiskUse=True), {})
+
+    totals = (facets.get('totals') or [{}])[0]
+    rows = facets.get('products', [])
+    names = fetch_by_id(db.products_update, [r['_id'] for r in rows], {'name': 1})
+    return {
+        'total_spent': float(totals.get('total_spent', 0) or 0),
+        'total_orders': int(totals.get('total_orders', 0) or 0),
+        'last_order': totals.get('last_order'),
+        'top_products': [
+            {
+                'name': names.get(r['_id'], {}).get('name') or r.get('name') or 'Unknown',
+                'quantity': int(r.get('quantity', 0) or 0),
+                'total_spent': float(r.get('total_spent', 0) or 0),
+            }
+            for r in rows
+        ],
+        'monthly_spending': {m['_id']: float(m['total']) for m in facets.get('months', [])},
+        'orders': facets.get('orders', []),
+    }
@@ -0,0 +1,311 @@
+"""
+sales_columns.py
+----------------
+Optional in-process columnar cache of ``user_data_bought``.
+
+Keeps the fields the dashboards filter and sum on as NumPy arrays:
+
+    day        int32   shop-local day (days since 1970-01-01)
+    total      float64
+    quantity   int64
+    category, product_name, user_name, sold_by_name
+               int32 codes into a per-column dictionary of strings
+
+Group-by and sum are vectorized (``np.bincount``), so a dashboard query over
+millions of sale lines is a few array passes instead of a MongoDB aggregation.
+
+The store loads once in the background, then pulls new sale lines by ``_id``
+whenever a read finds it older than the staleness bound. It reloads completely
+on a longer interval so edits and deletes show up eventually. If the data does
+not fit in the memory budget the store stays disabled and callers fall back to
+MongoDB.
+
+NumPy is optional: without it, or unless ``SALES_COLUMN_CACHE=1``, `enabled()`
+is False and nothing is loaded.
+
+Environment:
+    SALES_COLUMN_CACHE=1                   turn the cache on
+    SALES_COLUMN_CACHE_MB=256              memory budget for the arrays
+    SALES_COLUMN_STALENESS_SECONDS=5       max age before a read pulls new lines
+    SALES_COLUMN_RELOAD_MINUTES=60         full reload interval
+"""
+
+import datetime
+import os
+import threading
+import time
+
+from bson import ObjectId
+
+import timeseries
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency
+    np = None
+
+SOURCE_COLLECTION = 'user_data_bought'
+STRING_COLUMNS = ('category', 'product_name', 'user_name', 'sold_by_name')
+# rollup-style scope name -> column
+SCOPES = {'category': 'category', 'product': 'product_name',
+          'user': 'user_name', 'worker': 'sold_by_name'}
+BYTES_PER_ROW = 4 + 8 + 8 + 4 * len(STRING_COLUMNS)
+
+MEMORY_BUDGET_MB = int(os.getenv('SALES_COLUMN_CACHE_MB', '256'))
+STALENESS_SECONDS = float(os.getenv('SALES_COLUMN_STALENESS_SECONDS', '5'))
+RELOAD_MINUTES = float(os.getenv('SALES_COLUMN_RELOAD_MINUTES', '60'))
+# ObjectIds from other processes can be a little out of order; re-scan this far back
+SYNC_SLACK_SECONDS = 30
+
+_EPOCH = datetime.date(1970, 1, 1)
+
+
+def enabled() -> bool:
+    """True when NumPy is importable and the cache is switched on."""
+    return np is not None and os.getenv('SALES_COLUMN_CACHE', '').lower() in ('1', 'true', 'yes')
+
+
+def epoch_day(value) -> int:
+    """Days since 1970-01-01 of a (local) date or datetime."""
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    return (value - _EPOCH).days
+
+
+def _local_days(seconds):
+    # Vectorized shop-local day of naive-UTC epoch seconds. UTC offsets are looked
+    # up once per distinct hour, so DST changes are honoured without a per-row call.
+    if timeseries.SHOP_TIMEZONE == 'UTC' or len(seconds) == 0:
+        return (seconds // 86400).astype(np.int32)
+    hours, inverse = np.unique(seconds // 3600, return_inverse=True)
+    offsets = np.array([
+        int((timeseries.to_local(datetime.datetime(1970, 1, 1) + datetime.timedelta(hours=int(h)))
+             - (datetime.datetime(1970, 1, 1) + datetime.timedelta(hours=int(h)))).total_seconds())
+        for h in hours
+    ], dtype=np.int64)
+    return ((seconds + offsets[inverse]) // 86400).astype(np.int32)
+
+
+class SalesColumns:
+    """Append-only columnar copy of the sale lines; see the module docstring."""
+
+    def __init__(self, budget_mb: int = MEMORY_BUDGET_MB, staleness: float = STALENESS_SECONDS,
+                 reload_minutes: float = RELOAD_MINUTES):
+        self.budget_mb = budget_mb
+        self.max_rows = budget_mb * 1024 * 1024 // BYTES_PER_ROW
+        self.staleness = staleness
+        self.reload_after = reload_minutes * 60
+        self.lock = threading.RLock()
+        self.ready = False
+        self.over_budget = False
+        self.loaded_at = None
+        self.synced_at = None
+        self._reset()
+
+    def _reset(self, capacity: int = 1024):
+        self.n = 0
+        self.cols = {
+            'day': np.zeros(capacity, dtype=np.int32),
+            'total': np.zeros(capacity, dtype=np.float64),
+            'quantity': np.zeros(capacity, dtype=np.int64),
+        }
+        for name in STRING_COLUMNS:
+            self.cols[name] = np.zeros(capacity, dtype=np.int32)
+        self.values = {name: [None] for name in STRING_COLUMNS}    # code 0 is "missing"
+        self.codes = {name: {None: 0} for name in STRING_COLUMNS}
+        self._watermark = None
+        self._tail_ids = set()
+
+    # ── Loading ──────────────────────────────────────────────────────────────
+
+    def _encode(self, name, value):
+        codes = self.codes[name]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(self.values[name])
+            self.values[name].append(value)
+        return code
+
+    def _append_batch(self, docs) -> None:
+        rows = []
+        for d in docs:
+            ts = d.get('purchase_date')
+            if not isinstance(ts, datetime.datetime) or d.get('total') is None:
+                continue
+            try:
+                total = float(d['total'])
+            except (TypeError, ValueError):
+                continue
+            try:
+                qty = int(d.get('quantity') or 0)
+            except (TypeError, ValueError):
+                qty = 0
+            seconds = int((ts - datetime.datetime(1970, 1, 1)).total_seconds())
+            rows.append((seconds, total, qty, [self._encode(c, d.get(c)) for c in STRING_COLUMNS]))
+        if not rows:
+            return
+        if self.n + len(rows) > self.max_rows:
+            self.over_budget = True
+            raise MemoryError(f"sales column cache would exceed {self.max_rows:,} rows")
+        need = self.n + len(rows)
+        if need > len(self.cols['total']):
+            capacity = max(need, 2 * len(self.cols['total']))
+            for name, arr in self.cols.items():
+                grown = np.zeros(capacity, dtype=arr.dtype)
+                grown[:self.n] = arr[:self.n]
+                self.cols[name] = grown
+        sl = slice(self.n, need)
+        self.cols['day'][sl] = _local_days(np.array([r[0] for r in rows], dtype=np.int64))
+        self.cols['total'][sl] = [r[1] for r in rows]
+        self.cols['quantity'][sl] = [r[2] for r in rows]
+        for i, name in enumerate(STRING_COLUMNS):
+            self.cols[name][sl] = [r[3][i] for r in rows]
+        self.n = need
+
+    def _scan(self, collection, query, batch_size: int = 5000):
+        projection = {'purchase_date': 1, 'total': 1, 'quantity': 1, **{c: 1 for c in STRING_COLUMNS}}
+        keep = datetime.timedelta(seconds=2 * SYNC_SLACK_SECONDS)
+        batch = []
+        for doc in collection.find(query, projection).batch_size(batch_size):
+            _id = doc.get('_id')
+            if isinstance(_id, ObjectId):
+                if _id in self._tail_ids:
+                    continue
+                gen = _id.generation_time.replace(tzinfo=None)
+                if self._watermark is None or gen > self._watermark:
+                    self._watermark = gen
+                # Only ids a later sync can re-scan need remembering
+                if gen >= self._watermark - keep:
+                    self._tail_ids.add(_id)
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                self._append_batch(batch)
+                batch = []
+        self._append_batch(batch)
+        # Forget ids that can no longer be re-scanned
+        if self._watermark is not None:
+            floor = self._watermark - keep
+            self._tail_ids = {i for i in self._tail_ids if i.generation_time.replace(tzinfo=None) >= floor}
+
+    def load(self, db) -> bool:
+        """(Re)load every sale line. Returns False if it does not fit the budget.
+
+        The copy is built off to the side and swapped in, so readers keep
+        seeing the previous data until the reload is complete.
+        """
+        staging = SalesColumns(self.budget_mb, self.staleness, self.reload_after / 60)
+        try:
+            staging._scan(db[SOURCE_COLLECTION], {})
+        except MemoryError as e:
+            print(f"Sales column cache disabled: {e}")
+            with self.lock:
+                self._reset()
+                self.ready = False
+                self.over_budget = True
+            return False
+        with self.lock:
+            self.n, self.cols = staging.n, staging.cols
+            self.values, self.codes = staging.values, staging.codes
+            self._watermark, self._tail_ids = staging._watermark, staging._tail_ids
+            self.over_budget = False
+            self.ready = True
+            self.loaded_at = self.synced_at = time.monotonic()
+        # Catch lines written while the copy was being built
+        self.sync(db)
+        return True
+
+    def sync(self, db) -> None:
+        """Pull sale lines inserted since the last load/sync."""
+        with self.lock:
+            if not self.ready:
+                return
+            query = {}
+            if self._watermark is not None:
+                since = self._watermark - datetime.timedelta(seconds=SYNC_SLACK_SECONDS)
+                query = {'_id': {'$gte': ObjectId.from_datetime(since)}}
+            try:
+                self._scan(db[SOURCE_COLLECTION], query)
+            except MemoryError as e:
+                print(f"Sales column cache disabled: {e}")
+                self._reset()
+                self.ready = False
+                return
+            self.synced_at = time.monotonic()
+
+    def mark_stale(self) -> None:
+        """Make the next read pull new lines (call after writing sales in-process)."""
+        self.synced_at = None
+
+    def fresh(self, db):
+        """Return self once within the staleness bound, or None if unusable."""
+        if not self.ready:
+            return None
+        now = time.monotonic()
+        if self.loaded_at is not None and now - self.loaded_at > self.reload_after:
+            # Full reload in the background; keep answering from the current copy
+            self.loaded_at = now
+            threading.Thread(target=self.load, args=(db,), daemon=True).start()
+        if self.synced_at is None or now - self.synced_at > self.staleness:
+            self.sync(db)
+        return self if self.ready else None
+
+    # ── Queries (same shapes as the sales_rollups readers) ───────────────────
+
+    def _snapshot(self):
+        with self.lock:
+            n = self.n
+            # Dictionaries are append-only, so every code in the slice is already in them
+            return {k: v[:n] for k, v in self.cols.items()}, dict(self.values)
+
+    @staticmethod
+    def _mask(cols, start=None, end=None):
+        mask = np.ones(len(cols['total']), dtype=bool)
+        if start is not None:
+            mask &= cols['day'] >= epoch_day(start)
+        if end is not None:
+            mask &= cols['day'] <= epoch_day(end)
+        return mask
+
+    def period_totals(self, start=None, end=None) -> dict:
+        cols, _ = self._snapshot()
+        mask = self._mask(cols, start, end)
+        return {'revenue': float(cols['total'][mask].sum()), 'orders': int(mask.sum()),
+                'units': int(cols['quantity'][mask].sum())}
+
+    def top_keys(self, scope, start=None, end=None, limit=None) -> list:
+        cols, values = self._snapshot()
+        column = SCOPES[scope]
+        mask = self._mask(cols, start, end)
+        codes = cols[column][mask]
+        size = len(values[column])
+        revenue = np.bincount(codes, weights=cols['total'][mask], minlength=size)
+        units = np.bincount(codes, weights=cols['quantity'][mask], minlength=size)
+        orders = np.bincount(codes, minlength=size)
+        present = np.nonzero(orders)[0]
+        order = present[np.argsort(-revenue[present], kind='stable')]
+        if limit:
+            order = order[:int(limit)]
+        return [{'_id': values[column][i], 'revenue': float(revenue[i]), 'orders': int(orders[i]),
+                 'units': int(units[i])} for i in order]
+
+    def trend(self, start, end, unit: str = 'day') -> list:
+        cols, _ = self._snapshot()
+        buckets = timeseries.bucket_range(start, end, unit)
+        starts = np.array([epoch_day(b) for b in buckets], dtype=np.int32)
+        mask = self._mask(cols, start, end)
+        idx = np.searchsorted(starts, cols['day'][mask], side='right') - 1
+        revenue = np.bincount(idx, weights=cols['total'][mask], minlength=len(buckets))
+        orders = np.bincount(idx, minlength=len(buckets))
+        return [{'bucket': b, 'value': float(revenue[i]), 'count': int(orders[i])}
+                for i, b in enumerate(buckets)]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'ready': self.ready,
+                'rows': self.n,
+                'max_rows': self.max_rows,
+                'bytes': int(sum(v.nbytes for v in self.cols.values())),
+                'over_budget': self.over_budget,
+                'seconds_since_sync': None if self.synced_at is None else round(time.monotonic() - self.synced_at, 1),
+            }
@@ -0,0 +1,254 @@
+"""
+sales_facts.py
+--------------
+Canonical ``sales`` fact collection: one document per sale line, one
+``insert_many`` per order.
+
+Checkouts used to write each line to two or three collections, and the copies
+differed by path. Each fact now records the legacy collections its line must
+still appear in (``projections``) and carries ``pending: True`` until a
+projector has written those copies. The flag is on the fact itself, so it is
+stored atomically with the sale (a transactional outbox without transactions).
+Projection upserts each copy under the fact's ``_id`` and only then clears the
+flag, so running it twice is harmless:
+
+    user     user_data_bought, products_sold                  (/user/purchase)
+    guest    products_sold, products_by_user                  (/guest/purchase)
+    worker   user_data_bought, plus the order header in products_sold
+    cart     products_sold, products_by_user                  (legacy cart route)
+    seed     user_data_bought                                 (seed_daily_sales.py)
+
+Checkouts project their own order straight away. A background sweeper calls
+`project_pending()` to finish anything a crash left behind.
+
+`migrate()` folds the existing legacy collections into ``sales``. Copies of the
+same line (same customer, product, quantity, total and timestamp) are matched
+one-to-one across collections and become one fact. Migrated facts have no
+projections, because their legacy copies already exist.
+
+Usage:
+    python sales_facts.py --migrate        # fold legacy sale lines into `sales` (idempotent)
+    python sales_facts.py --project        # project facts still pending
+    python sales_facts.py --stats
+"""
+
+import argparse
+import collections
+import datetime
+import os
+import sys
+
+from bson import ObjectId
+from pymongo import ASCENDING, ReplaceOne
+
+import customer_sketches
+
+FACT_COLLECTION = 'sales'
+LEGACY_COLLECTIONS = ('user_data_bought', 'products_sold', 'products_by_user')
+HEADER_COLLECTION = 'products_sold'
+CHANNELS = {
+    'user': ('user_data_bought', 'products_sold'),
+    'guest': ('products_sold', 'products_by_user'),
+    'worker': ('user_data_bought',),
+    'cart': ('products_sold', 'products_by_user'),
+    'seed': ('user_data_bought',),
+}
+# Bookkeeping that stays on the fact and is not copied into projections
+FACT_FIELDS = ('channel', 'projections', 'pending', 'order_header', 'recorded_at', 'legacy', 'fp')
+BATCH = 1000
+
+
+def ensure_indexes(db) -> None:
+    coll = db[FACT_COLLECTION]
+    coll.create_index([('date', ASCENDING)])
+    coll.create_index([('user_id', ASCENDING), ('date', ASCENDING)])
+    coll.create_index([('product_id', ASCENDING), ('date', ASCENDING)])
+    coll.create_index([('order_id', ASCENDING)], sparse=True)
+    coll.create_index([('pending', ASCENDING)], sparse=True)
+    coll.create_index([('fp', ASCENDING)])
+    for name in LEGACY_COLLECTIONS:
+        coll.create_index([(f'legacy.{name}', ASCENDING)], sparse=True)
+
+
+def fingerprint(line) -> str:
+    """Identity of a sale line across its legacy copies."""
+    when = line.get('purchase_date') or line.get('date')
+    if isinstance(when, datetime.datetime):
+        # MongoDB keeps milliseconds; match what a round trip returns
+        when = when.replace(microsecond=when.microsecond // 1000 * 1000, tzinfo=None).isoformat()
+    try:
+        total = f"{float(line.get('total') or 0):.2f}"
+    except (TypeError, ValueError):
+        total = str(line.get('total'))
+    return '|'.join([str(line.get('user_id')), str(line.get('product_id')),
+                     str(line.get('quantity')), total, str(when)])
+
+
+def legacy_view(fact: dict) -> dict:
+    """The document a projection writes: the fact without its bookkeeping."""
+    return {k: v for k, v in fact.items() if k not in FACT_FIELDS}
+
+
+# ── Writing ──────────────────────────────────────────────────────────────────
+
+def record_order(db, lines, channel: str, header: dict = None, now=None) -> list:
+    """Store an order's sale lines as facts (one insert_many) and project them.
+
+    Every fact gets both ``date`` and ``purchase_date`` (whichever the line
+    had). `header`, for worker sales, is projected once per order. A failed
+    projection is left to `project_pending()`. Returns the stored facts.
+    """
+    if not lines:
+        return []
+    now = now or datetime.datetime.now()
+    projections = list(CHANNELS[channel])
+    facts = []
+    for line in lines:
+        when = line.get('date') or line.get('purchase_date') or now
+        fact = {**line, '_id': ObjectId(), 'date': when, 'purchase_date': line.get('purchase_date') or when,
+                'channel': channel, 'projections': projections, 'pending': True, 'recorded_at': now}
+        fact['fp'] = fingerprint(fact)
+        facts.append(fact)
+    if header:
+        facts[0]['order_header'] = {**header, '_id': ObjectId()}
+    db[FACT_COLLECTION].insert_many(facts, ordered=True)
+    try:
+        project(db, facts, now)
+    except Exception as e:
+        print(f"Sales projection deferred to the sweeper: {e}")
+    return facts
+
+
+def project(db, facts, now=None) -> set:
+    """Write the legacy copies of `facts` and clear their pending flag.
+
+    Lines copied into ``products_sold`` are also folded into the customer
+    sketches (customer_sketches.py), which must follow that collection.
+    Returns the names of the collections written.
+    """
+    ops = collections.defaultdict(list)
+    sold = []
+    for fact in facts:
+        view = legacy_view(fact)
+        for name in fact.get('projections', []):
+            ops[name].append(ReplaceOne({'_id': fact['_id']}, view, upsert=True))
+        if customer_sketches.SOURCE_COLLECTION in fact.get('projections', []):
+            sold.append(view)
+        header = fact.get('order_header')
+        if header:
+            ops[HEADER_COLLECTION].append(ReplaceOne({'_id': header['_id']}, header, upsert=True))
+    for name, writes in ops.items():
+        db[name].bulk_write(writes, ordered=False)
+    # Before clearing `pending`, so the sweeper retries a failed fold
+    customer_sketches.record_lines(db, sold)
+    db[FACT_COLLECTION].update_many({'_id': {'$in': [f['_id'] for f in facts]}},
+                                    {'$unset': {'pending': ''}, '$set': {'projected_at': now or datetime.datetime.now()}})
+    return set(ops)
+
+
+def project_pending(db, batch: int = BATCH) -> set:
+    """Project every fact still pending, oldest first; returns the collections written."""
+    written = set()
+    while True:
+        facts = list(db[FACT_COLLECTION].find({'pending': True}).sort('_id', ASCENDING).limit(batch))
+        if not facts:
+            return written
+        written |= project(db, facts)
+
+
+# ── Migration ────────────────────────────────────────────────────────────────
+
+def _legacy_lines(db, name: str):
+    # Sale-line documents of a legacy collection. Worker order headers
+    # ('items') and catalogue entries ('variants') are not lines.
+    query = {}
+    if name != 'user_data_bought':
+        query = {'product_id': {'$exists': True}, 'items': {'$exists': False}, 'variants': {'$exists': False}}
+    return db[name].find(query).sort('_id', ASCENDING).batch_size(BATCH)
+
+
+def _migrate_batch(db, name: str, docs: list, stats: dict) -> None:
+    coll = db[FACT_COLLECTION]
+    ids = [d['_id'] for d in docs]
+    done = {f['_id'] for f in coll.find({'_id': {'$in': ids}}, {'_id': 1})}
+    done |= {f['legacy'][name] for f in coll.find({f'legacy.{name}': {'$in': ids}}, {f'legacy.{name}': 1})}
+    for doc in docs:
+        if doc['_id'] in done:
+            stats['skipped'] += 1
+            continue
+        fp = fingerprint(doc)
+        # Another copy of the same line already became a fact: link to it
+        matched = coll.find_one_and_update(
+            {'fp': fp, f'legacy.{name}': {'$exists': False}, 'channel': 'migrated'},
+            {'$set': {f'legacy.{name}': doc['_id']}})
+        if matched:
+            stats['linked'] += 1
+            continue
+        when = doc.get('date') or doc.get('purchase_date')
+        fact = {**doc, 'date': when, 'purchase_date': doc.get('purchase_date') or when,
+                'channel': 'migrated', 'projections': [], 'legacy': {name: doc['_id']}, 'fp': fp}
+        coll.update_one({'_id': doc['_id']}, {'$setOnInsert': fact}, upsert=True)
+        stats['created'] += 1
+
+
+def migrate(db, verbose: bool = True) -> dict:
+    """Fold the sale lines of the legacy collections into ``sales`` without double counting.
+
+    Safe to re-run: documents already migrated, or written by the projector,
+    are skipped. Returns {collection: {'created', 'linked', 'skipped'}}.
+    """
+    ensure_indexes(db)
+    report = {}
+    for name in LEGACY_COLLECTIONS:
+        stats = report[name] = {'created': 0, 'linked': 0, 'skipped': 0}
+        batch = []
+        for doc in _legacy_lines(db, name):
+            batch.append(doc)
+            if len(batch) >= BATCH:
+                _migrate_batch(db, name, batch, stats)
+                batch = []
+        if batch:
+            _migrate_batch(db, name, batch, stats)
+        if verbose:
+            print(f"  {name}: {stats['created']:,} new facts, {stats['linked']:,} matched copies, "
+                  f"{stats['skipped']:,} already migrated")
+    return report
+
+
+def stats(db) -> dict:
+    coll = db[FACT_COLLECTION]
+    by_channel = {row['_id']: row['count'] for row in coll.aggregate([
+        {'$group': {'_id': '$channel', 'count': {'$sum': 1}}}])}
+    return {'facts': sum(by_channel.values()), 'by_channel': by_channel,
+            'pending': coll.count_documents({'pending': True})}
+
+
+# ── CLI ───────────────────────────────────────────────────────────────────────
+if __name__ == '__main__':
+    from pymongo import MongoClient
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description='Maintain the canonical sales fact collection')
+    parser.add_argument('--migrate', action='store_true', help='Fold legacy sale lines into sales')
+    parser.add_argument('--project', action='store_true', help='Project pending facts')
+    parser.add_argument('--stats', action='store_true', help='Print fact counts')
+    args = parser.parse_args()
+
+    if not (args.migrate or args.project or args.stats):
+        parser.error('choose --migrate, --project and/or --stats')
+
+    load_dotenv()
+    mongo_uri = (os.getenv('MONGO_URI') or os.getenv('MONGODB_URI') or
+                 os.getenv('MONGO_URL') or os.getenv('MONGODB_URL'))
+    if not mongo_uri:
+        print("ERROR: Set MONGO_URI (or MONGODB_URL) in your .env file.")
+        sys.exit(1)
+    target_db = MongoClient(mongo_uri)[os.getenv('MONGODB_DATABASE') or 'saless']
+
+    if args.migrate:
+        migrate(target_db)
+    if args.project:
+        written = project_pending(target_db)
+        print(f"✅  Projected pending facts into {', '.join(sorted(written)) or 'nothing'}.")
+    if args.stats:
+        print(stats(target_db))
@@ -0,0 +1,302 @@
+"""
+sales_rollups.py
+----------------
+Incrementally maintained daily sales rollups.
+
+Every checkout path folds its sale lines into the ``sales_daily_rollups``
+collection with ``$inc``, so the dashboards can read pre-summed day buckets
+instead of re-aggregating ``user_data_bought`` on every page load.
+
+One document per (day, scope, key):
+    scope='total'     key=''              whole-shop totals for the day
+    scope='category'  key=<category>      per-category totals
+    scope='product'   key=<product_name>  per-product totals
+
+Each document holds ``revenue`` (sum of ``total``), ``orders`` (number of
+sale lines) and ``units`` (sum of ``quantity``), matching what the old
+``$group`` pipelines over ``user_data_bought`` returned. (Approximate distinct
+customers come from customer_sketches.py, which follows ``products_sold`` like
+the exact count does.)
+
+Usage:
+    python sales_rollups.py --backfill                 # rebuild everything
+    python sales_rollups.py --backfill --days 30       # rebuild last 30 days
+    python sales_rollups.py --check                    # compare against raw sales
+    python sales_rollups.py --check --start 2025-01-01 --end 2025-06-30
+"""
+
+import argparse
+import datetime
+import os
+import sys
+
+from pymongo import ASCENDING, UpdateOne
+
+import timeseries
+
+ROLLUP_COLLECTION = 'sales_daily_rollups'
+SOURCE_COLLECTION = 'user_data_bought'
+
+# (scope, field on the raw sale line that becomes the rollup key)
+SCOPES = (
+    ('total', None),
+    ('category', 'category'),
+    ('product', 'product_name'),
+)
+
+
+def ensure_indexes(db) -> None:
+    """Create the indexes the rollup writers and readers rely on."""
+    coll = db[ROLLUP_COLLECTION]
+    coll.create_index([('day', ASCENDING), ('scope', ASCENDING), ('key', ASCENDING)], unique=True)
+    coll.create_index([('scope', ASCENDING), ('day', ASCENDING)])
+
+
+def day_start(value):
+    """Midnight of the day `value` falls on, or None for non-datetime values."""
+    if isinstance(value, datetime.datetime):
+        return value.replace(hour=0, minute=0, second=0, microsecond=0)
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    return None
+
+
+def line_values(rec):
+    """Return (revenue, units) for a sale line, or None if it carries no total."""
+    total = rec.get('total')
+    if total is None:
+        return None
+    try:
+        revenue = float(total)
+    except (TypeError, ValueError):
+        return None
+    try:
+        units = int(rec.get('quantity', 0) or 0)
+    except (TypeError, ValueError):
+        units = 0
+    return revenue, units
+
+
+def build_increments(records) -> dict:
+    """Pre-sum sale lines into {(day, scope, key): {revenue, orders, units}}."""
+    buckets = {}
+    for rec in records:
+        values = line_values(rec)
+        day = timeseries.local_day(rec.get('purchase_date') or rec.get('date'))
+        if values is None or day is None:
+            continue
+        revenue, units = values
+        for scope, field in SCOPES:
+            key = rec.get(field) if field else ''
+            b = buckets.setdefault((day, scope, key), {'revenue': 0.0, 'orders': 0, 'units': 0})
+            b['revenue'] += revenue
+            b['orders'] += 1
+            b['units'] += units
+    return buckets
+
+
+def record_sales(db, records) -> int:
+    """Fold freshly inserted sale lines into the rollups (one bulk round trip).
+
+    Returns the number of rollup documents touched.
+    """
+    buckets = build_increments(records)
+    if not buckets:
+        return 0
+    ops = [
+        UpdateOne({'day': day, 'scope': scope, 'key': key}, {'$inc': inc}, upsert=True)
+        for (day, scope, key), inc in buckets.items()
+    ]
+    db[ROLLUP_COLLECTION].bulk_write(ops, ordered=False)
+    return len(ops)
+
+
+# ── Readers ──────────────────────────────────────────────────────────────────
+
+def _day_filter(start=None, end=None) -> dict:
+    # Inclusive day range on the rollup `day` field.
+    rng = {}
+    if start is not None:
+        rng['$gte'] = day_start(start)
+    if end is not None:
+        rng['$lte'] = day_start(end)
+    return {'day': rng} if rng else {}
+
+
+def period_totals(db, start=None, end=None) -> dict:
+    """Shop-wide revenue / orders / units for the inclusive day range (all time if open)."""
+    match = {'scope': 'total', **_day_filter(start, end)}
+    rows = list(db[ROLLUP_COLLECTION].aggregate([
+        {'$match': match},
+        {'$group': {'_id': None, 'revenue': {'$sum': '$revenue'},
+                    'orders': {'$sum': '$orders'}, 'units': {'$sum': '$units'}}}
+    ]))
+    if not rows:
+        return {'revenue': 0.0, 'orders': 0, 'units': 0}
+    return {'revenue': float(rows[0]['revenue']), 'orders': int(rows[0]['orders']),
+            'units': int(rows[0]['units'])}
+
+
+def trend(db, start, end, unit: str = 'day') -> list:
+    """Gap-filled shop revenue per day / week / month, see `timeseries.trend`."""
+    # Rollup days are already shop-local midnights, so truncate them as stored.
+    return timeseries.trend(db[ROLLUP_COLLECTION], start, end, unit, date_field='day',
+                            value_field='revenue', count_field='orders',
+                            match={'scope': 'total'}, timezone='UTC')
+
+
+def top_keys(db, scope, start=None, end=None, limit=None) -> list:
+    """Per-key totals for `scope` ('category' or 'product'), highest revenue first."""
+    pipeline = [
+        {'$match': {'scope': scope, **_day_filter(start, end)}},
+        {'$group': {'_id': '$key', 'revenue': {'$sum': '$revenue'},
+                    'orders': {'$sum': '$orders'}, 'units': {'$sum': '$units'}}},
+        {'$sort': {'revenue': -1}},
+    ]
+    if limit:
+        pipeline.append({'$limit': int(limit)})
+    return list(db[ROLLUP_COLLECTION].aggregate(pipeline))
+
+
+class RollupReader:
+    """The readers above bound to one database, with the same method names as
+    the in-memory `sales_columns.SalesColumns` store so callers can use either."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def period_totals(self, start=None, end=None) -> dict:
+        return period_totals(self.db, start, end)
+
+    def trend(self, start, end, unit: str = 'day') -> list:
+        return trend(self.db, start, end, unit)
+
+    def top_keys(self, scope, start=None, end=None, limit=None) -> list:
+        return top_keys(self.db, scope, start, end, limit)
+
+
+# ── Backfill & consistency check ─────────────────────────────────────────────
+
+def raw_match(start=None, end=None) -> dict:
+    match = {'total': {'$exists': True, '$ne': None}, 'purchase_date': {'$type': 'date'}}
+    if start is not None:
+        match['purchase_date']['$gte'] = timeseries.to_utc(day_start(start))
+    if end is not None:
+        match['purchase_date']['$lt'] = timeseries.to_utc(day_start(end) + datetime.timedelta(days=1))
+    return match
+
+
+def raw_buckets(db, scope, field, start=None, end=None):
+    # Yield (day, key, revenue, orders, units) straight from the raw sales collection,
+    # with days cut in the shop timezone like the incremental writer does.
+    local = {'date': '$purchase_date', 'timezone': timeseries.SHOP_TIMEZONE}
+    pipeline = [
+        {'$match': raw_match(start, end)},
+        {'$group': {
+            '_id': {'day': {'$dateFromParts': {'year': {'$year': local},
+                                               'month': {'$month': local},
+                                               'day': {'$dayOfMonth': local}}},
+                    'key': f'${field}' if field else ''},
+            'revenue': {'$sum': '$total'},
+            'orders': {'$sum': 1},
+            'units': {'$sum': '$quantity'},
+        }},
+    ]
+    for row in db[SOURCE_COLLECTION].aggregate(pipeline, allowDiskUse=True):
+        yield (row['_id']['day'], row['_id'].get('key'), float(row['revenue']),
+               int(row['orders']), int(row['units']))
+
+
+def backfill(db, start=None, end=None, batch_size: int = 1000) -> int:
+    """Rebuild rollups for the inclusive day range (everything if open) from raw sales.
+
+    Run it once after deploying, or after bulk-deleting raw sales. Checkouts
+    that land while it runs for today's bucket can be lost, so prefer a quiet
+    moment or re-run for just today afterwards.
+    """
+    ensure_indexes(db)
+    coll = db[ROLLUP_COLLECTION]
+    coll.delete_many(_day_filter(start, end))
+    written = 0
+    for scope, field in SCOPES:
+        batch = []
+        for day, key, revenue, orders, units in raw_buckets(db, scope, field, start, end):
+            batch.append({'day': day, 'scope': scope, 'key': key,
+                          'revenue': revenue, 'orders': orders, 'units': units})
+            if len(batch) >= batch_size:
+                coll.insert_many(batch, ordered=False)
+                written += len(batch)
+                batch = []
+        if batch:
+            coll.insert_many(batch, ordered=False)
+            written += len(batch)
+    return written
+
+
+def check_consistency(db, start=None, end=None, tolerance: float = 0.01) -> dict:
+    """Compare rollups against the raw sales collection.
+
+    Returns {'checked': <buckets compared>, 'mismatches': [...]} where each
+    mismatch names the bucket, the field and both values.
+    """
+    mismatches = []
+    checked = 0
+    for scope, field in SCOPES:
+        raw = {(day, key): (rev, orders, units)
+               for day, key, rev, orders, units in raw_buckets(db, scope, field, start, end)}
+        rolled = {
+            (d['day'], d.get('key')): (float(d.get('revenue', 0)), int(d.get('orders', 0)), int(d.get('units', 0)))
+            for d in db[ROLLUP_COLLECTION].find({'scope': scope, **_day_filter(start, end)})
+        }
+        for bucket in raw.keys() | rolled.keys():
+            checked += 1
+            want = raw.get(bucket, (0.0, 0, 0))
+            got = rolled.get(bucket, (0.0, 0, 0))
+            for name, w, g in zip(('revenue', 'orders', 'units'), want, got):
+                if abs(w - g) > tolerance:
+                    mismatches.append({
+                        'day': bucket[0].strftime('%Y-%m-%d'), 'scope': scope, 'key': bucket[1],
+                        'field': name, 'rollup': g, 'raw': w,
+                    })
+    return {'checked': checked, 'mismatches': mismatches}
+
+
+# ── CLI ───────────────────────────────────────────────────────────────────────
+if __name__ == '__main__':
+    from pymongo import MongoClient
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description='Backfill or verify sales_daily_rollups')
+    parser.add_argument('--backfill', action='store_true', help='Rebuild rollups from user_data_bought')
+    parser.add_argument('--check', action='store_true', help='Compare rollups against user_data_bought')
+    parser.add_argument('--days', type=int, default=None, help='Limit to the last N days')
+    parser.add_argument('--start', type=str, default=None, help='Start date YYYY-MM-DD')
+    parser.add_argument('--end', type=str, default=None, help='End date YYYY-MM-DD')
+    args = parser.parse_args()
+
+    if not (args.backfill or args.check):
+        parser.error('choose --backfill and/or --check')
+
+    load_dotenv()
+    mongo_uri = (os.getenv('MONGO_URI') or os.getenv('MONGODB_URI') or
+                 os.getenv('MONGO_URL') or os.getenv('MONGODB_URL'))
+    if not mongo_uri:
+        print("ERROR: Set MONGO_URI (or MONGODB_URL) in your .env file.")
+        sys.exit(1)
+    target_db = MongoClient(mongo_uri)[os.getenv('MONGODB_DATABASE') or 'saless']
+
+    end_date = datetime.date.fromisoformat(args.end) if args.end else None
+    start_date = datetime.date.fromisoformat(args.start) if args.start else None
+    if args.days and not start_date:
+        end_date = end_date or datetime.date.today()
+        start_date = end_date - datetime.timedelta(days=args.days - 1)
+
+    if args.backfill:
+        n = backfill(target_db, start_date, end_date)
+        print(f"✅  Rebuilt {n} rollup buckets.")
+    if args.check:
+        report = check_consistency(target_db, start_date, end_date)
+        print(f"Checked {report['checked']} buckets, {len(report['mismatches'])} mismatches.")
+        for m in report['mismatches'][:50]:
+            print(f"  ❌  {m['day']} {m['scope']}:{m['key']!r} {m['field']} rollup={m['rollup']} raw={m['raw']}")
+        sys.exit(1 if report['mismatches'] else 0)
@@ -0,0 +1,245 @@
+"""
+sales_spikes.py
+---------------
+Streaming per-product sales-spike detection.
+
+Each product keeps one state document in ``product_demand_ewma`` holding an
+exponentially weighted moving average (EWMA) of its daily units sold, plus the
+units sold so far on its latest day:
+
+    {_id: <product_id>, product_name, day_no, today_units, ewma, first_day_no}
+
+``ewma`` covers the completed days *before* ``day_no``. Checkouts fold their
+sale lines in with one atomic pipeline update per product, rolling the average
+forward when a new day starts. A product spikes when today's units exceed
+``SPIKE_RATIO`` times its EWMA, so alerting only reads the products that sold
+something today.
+
+Days are cut in the shop timezone (see timeseries.py); ``day_no`` is the
+proleptic ordinal of the local day.
+
+Usage:
+    python sales_spikes.py --backfill              # build state for products that have none
+    python sales_spikes.py --recompute             # rebuild all state from history
+    python sales_spikes.py --recompute --days 180
+    python sales_spikes.py --detect                # print today's spikes
+"""
+
+import argparse
+import datetime
+import os
+import sys
+
+from pymongo import ASCENDING, ReplaceOne, UpdateOne
+
+import timeseries
+
+STATE_COLLECTION = 'product_demand_ewma'
+SOURCE_COLLECTION = 'user_data_bought'
+
+SPAN_DAYS = int(os.getenv('SPIKE_EWMA_SPAN_DAYS', '14'))
+ALPHA = 2.0 / (SPAN_DAYS + 1)           # weight of the most recent completed day
+DECAY = 1.0 - ALPHA
+SPIKE_RATIO = float(os.getenv('SPIKE_RATIO', '2.0'))
+MIN_HISTORY_DAYS = 7                    # days of history before a product can spike
+MIN_SPIKE_UNITS = 3                     # ignore spikes on tiny volumes
+HISTORY_DAYS = 120                      # replay window; older days weigh < DECAY**120
+
+
+def ensure_indexes(db) -> None:
+    """Create the index the detector relies on."""
+    db[STATE_COLLECTION].create_index([('day_no', ASCENDING), ('today_units', ASCENDING)])
+
+
+def day_number(value):
+    """Ordinal of the shop-local day a stored timestamp falls on, or None."""
+    day = timeseries.local_day(value)
+    return day.toordinal() if day is not None else None
+
+
+def _units(rec) -> int:
+    try:
+        return int(rec.get('quantity', 0) or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def build_increments(records) -> dict:
+    """Pre-sum sale lines into {(product_id, day_no): {'units', 'product_name'}}."""
+    buckets = {}
+    for rec in records:
+        product_id = rec.get('product_id')
+        day_no = day_number(rec.get('purchase_date') or rec.get('date'))
+        if product_id in (None, '') or day_no is None:
+            continue
+        b = buckets.setdefault((str(product_id), day_no), {'units': 0, 'product_name': None})
+        b['units'] += _units(rec)
+        b['product_name'] = b['product_name'] or rec.get('product_name')
+    return buckets
+
+
+def fold(state: dict, day_no: int, units: int) -> dict:
+    """Pure-Python mirror of `_update_pipeline`: add `units` sold on `day_no` to `state`."""
+    cur = state.get('day_no', day_no)
+    ewma = state.get('ewma', 0.0)
+    today = state.get('today_units', 0)
+    if day_no > cur:
+        ewma = (ALPHA * today + DECAY * ewma) * DECAY ** (day_no - cur - 1)
+        today = units
+    elif day_no == cur:
+        today += units
+    else:
+        # Late line for a past day: the average is linear, so add its decayed weight
+        ewma += ALPHA * units * DECAY ** (cur - 1 - day_no)
+    return {**state, 'day_no': max(cur, day_no), 'ewma': ewma, 'today_units': today,
+            'first_day_no': min(state.get('first_day_no', day_no), day_no)}
+
+
+def _update_pipeline(day_no: int, units: int, product_name, now) -> list:
+    # Atomic server-side version of `fold`, safe under concurrent checkouts.
+    cur = {'$ifNull': ['$day_no', day_no]}
+    ewma = {'$ifNull': ['$ewma', 0.0]}
+    today = {'$ifNull': ['$today_units', 0]}
+    rolled = {'$multiply': [
+        {'$add': [{'$multiply': [ALPHA, today]}, {'$multiply': [DECAY, ewma]}]},
+        {'$pow': [DECAY, {'$subtract': [{'$subtract': [day_no, cur]}, 1]}]},
+    ]}
+    late = {'$add': [ewma, {'$multiply': [
+        ALPHA * units, {'$pow': [DECAY, {'$subtract': [{'$subtract': [cur, 1]}, day_no]}]}]}]}
+    fields = {
+        'ewma': {'$switch': {'branches': [
+            {'case': {'$gt': [day_no, cur]}, 'then': rolled},
+            {'case': {'$lt': [day_no, cur]}, 'then': late},
+        ], 'default': ewma}},
+        'today_units': {'$switch': {'branches': [
+            {'case': {'$gt': [day_no, cur]}, 'then': units},
+            {'case': {'$eq': [day_no, cur]}, 'then': {'$add': [today, units]}},
+        ], 'default': today}},
+        'day_no': {'$max': [cur, day_no]},
+        'first_day_no': {'$min': [{'$ifNull': ['$first_day_no', day_no]}, day_no]},
+        'updated_at': now,
+    }
+    if product_name:
+        fields['product_name'] = product_name
+    return [{'$set': fields}]
+
+
+def record_sales(db, records, now=None) -> int:
+    """Fold freshly inserted sale lines into the per-product EWMA state (one bulk write).
+
+    Returns the number of state documents touched.
+    """
+    now = now or datetime.datetime.now()
+    buckets = build_increments(records)
+    if not buckets:
+        return 0
+    # Apply days in order so a batch spanning midnight rolls forward cleanly
+    ops = [
+        UpdateOne({'_id': product_id}, _update_pipeline(day_no, b['units'], b['product_name'], now), upsert=True)
+        for (product_id, day_no), b in sorted(buckets.items(), key=lambda item: item[0][1])
+    ]
+    db[STATE_COLLECTION].bulk_write(ops, ordered=True)
+    return len(ops)
+
+
+# ── Detection ────────────────────────────────────────────────────────────────
+
+def detect(db, today=None, ratio: float = SPIKE_RATIO) -> list:
+    """Products whose units today exceed `ratio` times their EWMA, biggest jump first.
+
+    Returns [{'product_id', 'product_name', 'units', 'baseline'}]. Only the
+    state documents of products that sold today are read.
+    """
+    today_no = day_number(today or datetime.datetime.now())
+    spikes = []
+    for s in db[STATE_COLLECTION].find({'day_no': today_no, 'today_units': {'$gte': MIN_SPIKE_UNITS}}):
+        baseline = float(s.get('ewma', 0.0))
+        if baseline <= 0 or today_no - s.get('first_day_no', today_no) < MIN_HISTORY_DAYS:
+            continue
+        if s['today_units'] > ratio * baseline:
+            spikes.append({'product_id': s['_id'], 'product_name': s.get('product_name'),
+                           'units': int(s['today_units']), 'baseline': baseline})
+    spikes.sort(key=lambda x: x['units'] / x['baseline'], reverse=True)
+    return spikes
+
+
+# ── Backfill & recompute ─────────────────────────────────────────────────────
+
+def _daily_units(db, since):
+    # Yield (product_id, day_no, units, product_name) from raw sales, oldest day first.
+    local = {'date': '$purchase_date', 'timezone': timeseries.SHOP_TIMEZONE}
+    pipeline = [
+        {'$match': {'purchase_date': {'$type': 'date', '$gte': timeseries.to_utc(since)},
+                    'product_id': {'$nin': [None, '']}}},
+        {'$group': {
+            '_id': {'product_id': '$product_id',
+                    'day': {'$dateFromParts': {'year': {'$year': local},
+                                               'month': {'$month': local},
+                                               'day': {'$dayOfMonth': local}}}},
+            'units': {'$sum': '$quantity'},
+            'product_name': {'$last': '$product_name'},
+        }},
+        {'$sort': {'_id.day': 1}},
+    ]
+    for row in db[SOURCE_COLLECTION].aggregate(pipeline, allowDiskUse=True):
+        yield (str(row['_id']['product_id']), row['_id']['day'].toordinal(),
+               int(row.get('units') or 0), row.get('product_name'))
+
+
+def rebuild(db, days: int = HISTORY_DAYS, only_missing: bool = False, now=None) -> int:
+    """Replay the last `days` days of raw sales into fresh EWMA state.
+
+    With `only_missing` products that already have state are left alone
+    (backfill); otherwise every product's state is replaced (recompute).
+    Returns the number of state documents written.
+    """
+    now = now or datetime.datetime.now()
+    ensure_indexes(db)
+    since = datetime.datetime.combine(now.date() - datetime.timedelta(days=days - 1), datetime.time())
+    states = {}
+    for product_id, day_no, units, name in _daily_units(db, since):
+        state = fold(states.get(product_id, {}), day_no, units)
+        if name:
+            state['product_name'] = name
+        states[product_id] = state
+
+    coll = db[STATE_COLLECTION]
+    if only_missing:
+        existing = {d['_id'] for d in coll.find({'_id': {'$in': list(states)}}, {'_id': 1})}
+        states = {k: v for k, v in states.items() if k not in existing}
+    ops = [ReplaceOne({'_id': k}, {**v, '_id': k, 'updated_at': now}, upsert=True) for k, v in states.items()]
+    if ops:
+        coll.bulk_write(ops, ordered=False)
+    return len(ops)
+
+
+# ── CLI ───────────────────────────────────────────────────────────────────────
+if __name__ == '__main__':
+    from pymongo import MongoClient
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description='Maintain product_demand_ewma spike state')
+    parser.add_argument('--backfill', action='store_true', help='Build state for products without any')
+    parser.add_argument('--recompute', action='store_true', help='Rebuild all state from raw sales')
+    parser.add_argument('--detect', action='store_true', help="Print today's spikes")
+    parser.add_argument('--days', type=int, default=HISTORY_DAYS, help='History window to replay')
+    args = parser.parse_args()
+
+    if not (args.backfill or args.recompute or args.detect):
+        parser.error('choose --backfill, --recompute and/or --detect')
+
+    load_dotenv()
+    mongo_uri = (os.getenv('MONGO_URI') or os.getenv('MONGODB_URI') or
+                 os.getenv('MONGO_URL') or os.getenv('MONGODB_URL'))
+    if not mongo_uri:
+        print("ERROR: Set MONGO_URI (or MONGODB_URL) in your .env file.")
+        sys.exit(1)
+    target_db = MongoClient(mongo_uri)[os.getenv('MONGODB_DATABASE') or 'saless']
+
+    if args.recompute or args.backfill:
+        n = rebuild(target_db, args.days, only_missing=not args.recompute)
+        print(f"✅  Wrote EWMA state for {n} products.")
+    if args.detect:
+        for spike in detect(target_db):
+            print(f"  📈  {spike['product_name'] or spike['product_id']}: "
+                  f"{spike['units']} units today vs {spike['baseline']:.1f}/day")
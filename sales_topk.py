@@ -0,0 +1,279 @@
+"""
+sales_topk.py
+-------------
+Streaming top-K best sellers, buyers and workers.
+
+Every checkout path folds its sale lines into a per-day document of
+``sales_topk``. The document holds one Space-Saving summary (see
+spacesaving.py) per sketch:
+
+    product        product_name  ranked by revenue
+    product_units  product_name  ranked by units
+    user           user_name     ranked by revenue
+    worker         sold_by_name  ranked by revenue
+
+    {_id: 'YYYY-MM-DD', kind: 'day', day, version,
+     sketches: {<sketch>: {capacity, total, counters: [[key, weight, error, revenue, units, orders]]}}}
+
+Counters are stored as lists because product and customer names may contain
+'.' or '$'. A day document is rewritten with a compare-and-swap on
+``version``, so concurrent checkouts in different workers never lose each
+other's lines. One find and one write fold a checkout in.
+
+A rolling window (the last N days, or all time) is the merge of its day
+summaries. The closed days of a window are merged once per day and stored as
+``{_id: 'window:<sketch>:<N|all>', kind: 'window', through, summary}``. A
+request then merges that one summary with today's, so the answer costs O(K)
+whatever the length of the window. A write to a past day drops the stored
+windows. All-time windows roll forward a day at a time.
+
+Days are cut in the shop timezone, like the rollups (see timeseries.py).
+
+Usage:
+    python sales_topk.py --rebuild                 # rebuild every day from user_data_bought
+    python sales_topk.py --rebuild --days 30
+    python sales_topk.py --top product --window 30
+"""
+
+import argparse
+import datetime
+import os
+import sys
+
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+import sales_rollups
+import spacesaving
+import timeseries
+
+TOPK_COLLECTION = 'sales_topk'
+SOURCE_COLLECTION = 'user_data_bought'
+CAPACITY = int(os.getenv('SALES_TOPK_CAPACITY', str(spacesaving.CAPACITY)))
+
+# sketch -> (field on the raw sale line that is the key, metric it is ranked by)
+SKETCHES = {
+    'product': ('product_name', 'revenue'),
+    'product_units': ('product_name', 'units'),
+    'user': ('user_name', 'revenue'),
+    'worker': ('sold_by_name', 'revenue'),
+}
+# Sketches that ignore lines without a key (self-checkouts have no worker)
+SKIP_MISSING = ('worker',)
+CAS_RETRIES = 8
+
+
+def day_key(day) -> str:
+    return day.strftime('%Y-%m-%d')
+
+
+def _today(now=None):
+    return timeseries.local_day(now or datetime.datetime.utcnow())
+
+
+# ── Storage format ───────────────────────────────────────────────────────────
+
+def _encode(summary: dict) -> dict:
+    return {'capacity': summary['capacity'], 'total': summary['total'],
+            'counters': [[key, *counter] for key, counter in summary['counters'].items()]}
+
+
+def _decode(stored) -> dict:
+    if not stored:
+        return spacesaving.new(CAPACITY)
+    return {'capacity': stored.get('capacity', CAPACITY), 'total': stored.get('total', 0.0),
+            'counters': {row[0]: list(row[1:]) for row in stored.get('counters', [])}}
+
+
+# ── Writing ──────────────────────────────────────────────────────────────────
+
+def build_updates(records) -> dict:
+    """Group sale lines into {day: {sketch: [(key, weight, (revenue, units, orders))]}}."""
+    updates = {}
+    for rec in records:
+        values = sales_rollups.line_values(rec)
+        day = timeseries.local_day(rec.get('purchase_date') or rec.get('date'))
+        if values is None or day is None:
+            continue
+        revenue, units = values
+        metrics = {'revenue': revenue, 'units': units}
+        for name, (field, metric) in SKETCHES.items():
+            key = rec.get(field)
+            if key is None and name in SKIP_MISSING:
+                continue
+            updates.setdefault(day, {}).setdefault(name, []).append(
+                (key, metrics[metric], (revenue, units, 1)))
+    return updates
+
+
+def _apply(coll, day, items, doc, now) -> None:
+    # Compare-and-swap one day document; re-read and retry when another writer won
+    _id = day_key(day)
+    for _ in range(CAS_RETRIES):
+        stored = (doc or {}).get('sketches', {})
+        sketches = {name: _decode(stored.get(name)) for name in SKETCHES}
+        for name, lines in items.items():
+            for key, weight, extras in lines:
+                spacesaving.add(sketches[name], key, weight, extras)
+        version = (doc or {}).get('version', 0)
+        body = {'kind': 'day', 'day': day, 'version': version + 1, 'updated_at': now,
+                'sketches': {name: _encode(s) for name, s in sketches.items()}}
+        if doc is None:
+            try:
+                coll.insert_one({'_id': _id, **body})
+                return
+            except DuplicateKeyError:
+                pass
+        elif coll.replace_one({'_id': _id, 'version': version}, body).matched_count:
+            return
+        doc = coll.find_one({'_id': _id})
+    raise RuntimeError(f"sales_topk: gave up updating {_id} after {CAS_RETRIES} attempts")
+
+
+def record_sales(db, records, now=None) -> int:
+    """Fold freshly inserted sale lines into the day summaries.
+
+    Returns the number of day documents written.
+    """
+    updates = build_updates(records)
+    if not updates:
+        return 0
+    coll = db[TOPK_COLLECTION]
+    docs = {d['_id']: d for d in coll.find({'_id': {'$in': [day_key(d) for d in updates]}})}
+    stamp = datetime.datetime.now()
+    for day, items in updates.items():
+        _apply(coll, day, items, docs.get(day_key(day)), stamp)
+    if min(updates) < _today(now):
+        # Back-dated lines: stored windows no longer match their days
+        coll.delete_many({'kind': 'window'})
+    return len(updates)
+
+
+# ── Readers ──────────────────────────────────────────────────────────────────
+
+def _window(coll, sketch: str, days, today, doc) -> dict:
+    # Summary of the closed days of the window ending yesterday, stored once per day
+    through = day_key(today - datetime.timedelta(days=1))
+    if doc is not None and doc.get('through') == through:
+        return _decode(doc.get('summary'))
+    query = {'kind': 'day', '_id': {'$lte': through}}
+    if days is None and doc is not None and doc.get('through', '') < through:
+        merged = _decode(doc.get('summary'))
+        query['_id']['$gt'] = doc['through']
+    else:
+        merged = spacesaving.new(CAPACITY)
+        if days is not None:
+            query['_id']['$gte'] = day_key(today - datetime.timedelta(days=days - 1))
+    for d in coll.find(query, {f'sketches.{sketch}': 1}).sort('_id', 1):
+        merged = spacesaving.merge(merged, _decode(d.get('sketches', {}).get(sketch)), CAPACITY)
+    coll.replace_one({'_id': f'window:{sketch}:{days or "all"}'},
+                     {'kind': 'window', 'sketch': sketch, 'days': days, 'through': through,
+                      'summary': _encode(merged), 'built_at': datetime.datetime.now()}, upsert=True)
+    return merged
+
+
+def summary(db, sketch: str, start=None, now=None) -> dict:
+    """Space-Saving summary of `sketch` from the day of `start` (all time if None) to today."""
+    today = _today(now)
+    days = None
+    if start is not None:
+        days = max(1, (today - sales_rollups.day_start(start)).days + 1)
+    coll = db[TOPK_COLLECTION]
+    window_id = f'window:{sketch}:{days or "all"}'
+    docs = {d['_id']: d for d in coll.find({'_id': {'$in': [window_id, day_key(today)]}},
+                                           {'kind': 1, 'through': 1, 'summary': 1, f'sketches.{sketch}': 1})}
+    closed = _window(coll, sketch, days, today, docs.get(window_id))
+    current = docs.get(day_key(today), {}).get('sketches', {}).get(sketch)
+    return spacesaving.merge(closed, _decode(current), CAPACITY) if current else closed
+
+
+def top(db, sketch: str, n: int = 10, start=None, now=None) -> list:
+    """Approximate top `n` keys of `sketch` from `start` (all time if None) to today.
+
+    Rows look like `sales_rollups.top_keys()` rows: {'_id', 'revenue', 'units',
+    'orders'}, heaviest first. The ranked metric is an estimate at most
+    'error' above the truth. The other two only count lines seen while the
+    key was monitored, so they are lower bounds. 'guaranteed' marks keys
+    certainly in the true top `n`.
+    """
+    metric = SKETCHES[sketch][1]
+    rows = []
+    for key, c, guaranteed in spacesaving.top(summary(db, sketch, start, now), n):
+        row = {'_id': key, 'revenue': float(c[2]), 'units': int(c[3]), 'orders': int(c[4]),
+               'error': float(c[1]), 'guaranteed': guaranteed}
+        row[metric] = float(c[0]) if metric == 'revenue' else int(round(c[0]))
+        rows.append(row)
+    return rows
+
+
+# ── Rebuild ──────────────────────────────────────────────────────────────────
+
+def rebuild(db, start=None, end=None) -> int:
+    """Rebuild the day summaries in the inclusive day range (everything if open) from raw sales.
+
+    Like the rollup backfill, checkouts that land for today while it runs can
+    be lost. Returns the number of day documents written.
+    """
+    totals = {}
+    for name, (field, metric) in SKETCHES.items():
+        for day, key, revenue, orders, units in sales_rollups.raw_buckets(db, name, field, start, end):
+            if key is None and name in SKIP_MISSING:
+                continue
+            weight = revenue if metric == 'revenue' else units
+            totals.setdefault(day, {}).setdefault(name, {})[key] = [weight, revenue, units, orders]
+
+    coll = db[TOPK_COLLECTION]
+    query = {'kind': 'day'}
+    if start is not None or end is not None:
+        query['_id'] = {}
+        if start is not None:
+            query['_id']['$gte'] = day_key(start)
+        if end is not None:
+            query['_id']['$lte'] = day_key(end)
+    coll.delete_many(query)
+    coll.delete_many({'kind': 'window'})
+    now = datetime.datetime.now()
+    ops = []
+    for day, by_sketch in totals.items():
+        sketches = {name: _encode(spacesaving.from_exact(by_sketch.get(name, {}), CAPACITY)) for name in SKETCHES}
+        ops.append(UpdateOne({'_id': day_key(day)},
+                             {'$set': {'kind': 'day', 'day': day, 'sketches': sketches, 'updated_at': now},
+                              '$inc': {'version': 1}}, upsert=True))
+    for i in range(0, len(ops), 1000):
+        coll.bulk_write(ops[i:i + 1000], ordered=False)
+    return len(ops)
+
+
+# ── CLI ───────────────────────────────────────────────────────────────────────
+if __name__ == '__main__':
+    from pymongo import MongoClient
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description='Maintain the sales_topk heavy-hitter summaries')
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild day summaries from user_data_bought')
+    parser.add_argument('--days', type=int, default=None, help='Limit the rebuild to the last N days')
+    parser.add_argument('--top', choices=sorted(SKETCHES), help='Print the top keys of a sketch')
+    parser.add_argument('--window', type=int, default=None, help='Window in days for --top (default: all time)')
+    parser.add_argument('-n', type=int, default=10, help='Rows for --top')
+    args = parser.parse_args()
+
+    if not (args.rebuild or args.top):
+        parser.error('choose --rebuild and/or --top')
+
+    load_dotenv()
+    mongo_uri = (os.getenv('MONGO_URI') or os.getenv('MONGODB_URI') or
+                 os.getenv('MONGO_URL') or os.getenv('MONGODB_URL'))
+    if not mongo_uri:
+        print("ERROR: Set MONGO_URI (or MONGODB_URL) in your .env file.")
+        sys.exit(1)
+    target_db = MongoClient(mongo_uri)[os.getenv('MONGODB_DATABASE') or 'saless']
+
+    if args.rebuild:
+        start_date = datetime.date.today() - datetime.timedelta(days=args.days - 1) if args.days else None
+        print(f"✅  Rebuilt {rebuild(target_db, start_date)} day summaries.")
+    if args.top:
+        since = datetime.date.today() - datetime.timedelta(days=args.window - 1) if args.window else None
+        for i, row in enumerate(top(target_db, args.top, args.n, since), 1):
+            metric = SKETCHES[args.top][1]
+            mark = '' if row['guaranteed'] else '  (±{:.2f})'.format(row['error'])
+            print(f"  {i:>2}. {row['_id']}: {metric}={row[metric]}{mark}")
@@ -27,6 +27,9 @@ except ImportError:
     print("Missing dependencies. Run:  pip install pymongo python-dotenv")
     sys.exit(1)
 
+import sale_events
+import sales_facts
+
 load_dotenv()
 MONGO_URI = (os.getenv('MONGO_URI') or os.getenv('MONGODB_URI') or
              os.getenv('MONGO_URL') or os.getenv('MONGODB_URL'))
@@ -155,14 +158,13 @@ def seed(start: datetime.date, end: datetime.date, per_day_min: int, per_day_max
     users = load_users()
     print(f"  Loaded {len(products)} products and {len(users)} users from DB.\n")
 
-    collection = db['user_data_bought']
     current = start
     total_inserted = 0
 
     while current <= end:
         count = per_day_min if per_day_min == per_day_max else random.randint(per_day_min, per_day_max)
         records = build_records(current, products, users, count)
-        collection.insert_many(records)
+        sale_events.record_order(db, records, 'seed')
         total_inserted += len(records)
         print(f"  ✅  {current.strftime('%Y-%m-%d')}  →  {len(records)} sales inserted")
         current += datetime.timedelta(days=1)
@@ -196,11 +198,21 @@ def ensure_today_sales(min_sales: int = 50) -> int:
 
     needed = min_sales - current_count
     records = build_records(today, products, users, needed)
-    collection.insert_many(records)
+    sale_events.record_order(db, records, 'seed')
     print(f"  ✅ Inserted {needed} additional sales records for today.")
     return needed
 
 
+def clear_seeded():
+    """Delete every seeded sale line and rebuild the summaries without them."""
+    deleted = db['user_data_bought'].delete_many({'_seeded': True})
+    db[sales_facts.FACT_COLLECTION].delete_many({'_seeded': True})
+    print(f"🗑  Cleared {deleted.deleted_count} previously seeded records.")
+    for what, count in sale_events.rebuild(db):
+        print(f"📦  Rebuilt {count} {what}.")
+    print()
+
+
 # ── CLI ───────────────────────────────────────────────────────────────────────
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Seed daily sales data into user_data_bought')
@@ -229,8 +241,7 @@ if __name__ == '__main__':
     # Special mode: only ensure today has at least N sales
     if args.ensure_today:
         if args.clear:
-            deleted = db['user_data_bought'].delete_many({'_seeded': True})
-            print(f"🗑  Cleared {deleted.deleted_count} previously seeded records.\n")
+            clear_seeded()
         ensure_today_sales(args.min_today)
     else:
         end_date = datetime.date.fromisoformat(args.end) if args.end else today
@@ -243,8 +254,7 @@ if __name__ == '__main__':
         per_max = args.per_day if args.per_day else args.max_per_day
 
         if args.clear:
-            deleted = db['user_data_bought'].delete_many({'_seeded': True})
-            print(f"🗑  Cleared {deleted.deleted_count} previously seeded records.\n")
+            clear_seeded()
 
         print(f"📅  Seeding sales from {start_date} to {end_date} ({(end_date-start_date).days+1} days)")
         print(f"📊  {per_min}–{per_max} sales per day\n")
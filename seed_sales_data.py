@@ -10,9 +10,14 @@ Sales Sense AI analytics dashboard shows meaningful numbers:
   • Today          → 6–12 orders        (strong today-stats)
   • Products sold, top-products, category breakdown all populated
 
-Collections written:
-  user_data_bought  – one row per line-item (what /api/business-stats reads)
+Collections written (each transaction goes through sale_events.py, like a
+worker sale in the app):
+  sales             – one fact per line-item
+  user_data_bought  – one row per line-item
   products_sold     – one row per transaction (for total_orders count)
+  the summaries folded from user_data_bought – sales_daily_rollups (what
+  /api/business-stats and /api/analytics read), the demand EWMAs, top-K
+  best-sellers, order-value digests and cohort months
 
 Run:
     python seed_sales_data.py
@@ -25,6 +30,10 @@ import sys
 from dotenv import load_dotenv
 import pymongo
 
+import closed_periods
+import result_cache
+import sale_events
+
 # ──────────────────────────────────────────────
 # Load config from .env exactly like app.py does
 # ──────────────────────────────────────────────
@@ -182,6 +191,7 @@ today = now.replace(hour=0, minute=0, second=0, microsecond=0)
 
 all_purchase_docs = []
 all_sold_docs     = []
+all_orders        = []
 
 print(f"\n[INFO] Generating transactions for last 77 days…")
 
@@ -203,6 +213,7 @@ for days_ago in range(77, -1, -1):          # 77 → 0 (inclusive of today)
         precs, psold = build_transaction(ts)
         all_purchase_docs.extend(precs)
         all_sold_docs.append(psold)
+        all_orders.append((precs, psold))
 
 # ──────────────────────────────────────────────
 # Preview totals before inserting
@@ -243,15 +254,18 @@ if resp != "y":
     sys.exit(0)
 
 # ──────────────────────────────────────────────
-# Insert in bulk
+# Record each transaction
 # ──────────────────────────────────────────────
-print("\n[INFO] Inserting user_data_bought …")
-result1 = user_data_bought.insert_many(all_purchase_docs, ordered=False)
-print(f"[OK]   Inserted {len(result1.inserted_ids):,} purchase line-items")
-
-print("[INFO] Inserting products_sold …")
-result2 = products_sold_col.insert_many(all_sold_docs, ordered=False)
-print(f"[OK]   Inserted {len(result2.inserted_ids):,} sale transactions")
+print("\n[INFO] Recording transactions …")
+for precs, psold in all_orders:
+    sale_events.record_order(db, precs, "worker", header=psold, bump=False)
+print(f"[OK]   Recorded {len(all_orders):,} sale transactions "
+      f"({len(all_purchase_docs):,} purchase line-items)")
+
+# Invalidate the app's cached analytics (see result_cache.py); the sales are
+# back-dated, so the closed-day partials they fall on are dropped too
+result_cache.bump(db, "user_data_bought", "products_sold")
+closed_periods.invalidate(db)
 
 # ──────────────────────────────────────────────
 # Final summary
@@ -0,0 +1,375 @@
+"""
+shared_cache.py
+---------------
+Two-level cache and job-state store shared by every gunicorn worker.
+
+A `SharedCache` is one namespace of keys (``chat``, ``bulk_jobs``,
+``analytics``...). Reads try two levels:
+
+    L1  process-local LRU, bounded to ``l1_entries`` and trusted for at most
+        ``l1_ttl`` seconds (0 = always ask L2)
+    L2  a backend every worker sees:
+          MongoBackend    ``shared_cache`` collection, TTL index on expires_at
+          SQLiteBackend   one SQLite file (in /dev/shm when available), for a
+                          single box without a shared MongoDB
+          None            L1 only, the old per-process behaviour
+
+An entry is ``{value, version, expires_at}``. Every write bumps ``version``,
+so `compare_and_swap()` can replace a value only if nobody else wrote it
+since it was read, and ``expected=None`` means "only if absent" (a lease).
+Values travel through ``bson.json_util``, so they must be JSON/BSON shaped
+(tuples come back as lists). A value that cannot be encoded, or an L2 that is
+down, leaves the entry in L1 only and counts an error.
+
+L2 is kept to ``MAX_L2_ENTRIES`` per namespace. L2 hits stamp ``accessed_at``,
+and every ``TRIM_EVERY`` writes the least recently used entries over the bound
+are deleted.
+
+Environment:
+    SHARED_CACHE_BACKEND   mongo (default when MongoDB is connected), sqlite or local
+    SHARED_CACHE_PATH      SQLite file for the sqlite backend
+
+Usage:
+    backend = shared_cache.backend(db)
+    chat = shared_cache.SharedCache('chat', backend, ttl=90)
+    reply = chat.get_or_set(key, compute)
+    jobs = shared_cache.SharedCache('bulk_jobs', backend, ttl=86400, l1_ttl=0)
+"""
+
+import collections
+import datetime
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from bson import json_util
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+CACHE_COLLECTION = 'shared_cache'
+L1_ENTRIES = 1024
+MAX_L2_ENTRIES = 10000
+TRIM_EVERY = 200
+# Naive datetimes in, naive datetimes out (the app stores naive local/UTC times)
+JSON_OPTIONS = json_util.JSONOptions(tz_aware=False)
+_MISSING = object()
+
+
+def ensure_indexes(db) -> None:
+    coll = db[CACHE_COLLECTION]
+    coll.create_index([('expires_at', ASCENDING)], expireAfterSeconds=0)
+    coll.create_index([('namespace', ASCENDING), ('accessed_at', ASCENDING)])
+
+
+# ── L2 backends ──────────────────────────────────────────────────────────────
+# get() -> (encoded value, version) or None; set()/delete() return nothing;
+# cas() -> True if written; trim() drops the oldest-accessed over `keep`.
+
+class MongoBackend:
+    name = 'mongo'
+
+    def __init__(self, db):
+        self.coll = db[CACHE_COLLECTION]
+
+    @staticmethod
+    def _live(now):
+        return {'$or': [{'expires_at': None}, {'expires_at': {'$gt': now}}]}
+
+    def get(self, namespace, key):
+        now = datetime.datetime.utcnow()
+        doc = self.coll.find_one_and_update(
+            {'_id': f'{namespace}:{key}', **self._live(now)},
+            {'$set': {'accessed_at': now}}, projection={'value': 1, 'version': 1})
+        return (doc['value'], doc['version']) if doc else None
+
+    def _doc(self, namespace, value, expires_at, now):
+        return {'namespace': namespace, 'value': value, 'expires_at': expires_at, 'accessed_at': now}
+
+    def set(self, namespace, key, value, expires_at):
+        now = datetime.datetime.utcnow()
+        self.coll.update_one({'_id': f'{namespace}:{key}'},
+                             {'$set': self._doc(namespace, value, expires_at, now), '$inc': {'version': 1}},
+                             upsert=True)
+
+    def delete(self, namespace, key):
+        self.coll.delete_one({'_id': f'{namespace}:{key}'})
+
+    def cas(self, namespace, key, expected, value, expires_at):
+        now = datetime.datetime.utcnow()
+        doc = self._doc(namespace, value, expires_at, now)
+        if expected is None:
+            # Absent, or present but expired (the TTL monitor only runs once a minute)
+            try:
+                self.coll.replace_one({'_id': f'{namespace}:{key}', 'expires_at': {'$lte': now}},
+                                      {**doc, 'version': 1}, upsert=True)
+                return True
+            except DuplicateKeyError:
+                return False
+        result = self.coll.update_one({'_id': f'{namespace}:{key}', 'version': expected, **self._live(now)},
+                                      {'$set': doc, '$inc': {'version': 1}})
+        return result.matched_count == 1
+
+    def trim(self, namespace, keep):
+        stale = self.coll.find({'namespace': namespace}, {'_id': 1}).sort(
+            'accessed_at', -1).skip(keep).limit(TRIM_EVERY * 5)
+        ids = [d['_id'] for d in stale]
+        if ids:
+            self.coll.delete_many({'_id': {'$in': ids}})
+        return len(ids)
+
+    def clear(self, namespace):
+        self.coll.delete_many({'namespace': namespace})
+
+
+class SQLiteBackend:
+    name = 'sqlite'
+
+    def __init__(self, path=None):
+        shm = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self.path = path or os.path.join(shm, 'sales_sense_cache.sqlite3')
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS entries (namespace TEXT, key TEXT, value TEXT, '
+                          'version INTEGER, expires_at REAL, accessed_at REAL, PRIMARY KEY (namespace, key))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS entries_lru ON entries (namespace, accessed_at)')
+
+    @staticmethod
+    def _ts(expires_at):
+        return expires_at.replace(tzinfo=datetime.timezone.utc).timestamp() if expires_at else None
+
+    def get(self, namespace, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT value, version FROM entries WHERE namespace=? AND key=? '
+                                    'AND (expires_at IS NULL OR expires_at > ?)', (namespace, key, now)).fetchone()
+            if row:
+                self.conn.execute('UPDATE entries SET accessed_at=? WHERE namespace=? AND key=?',
+                                  (now, namespace, key))
+        return (row[0], row[1]) if row else None
+
+    def set(self, namespace, key, value, expires_at):
+        with self.lock:
+            self.conn.execute('INSERT INTO entries VALUES (?, ?, ?, 1, ?, ?) ON CONFLICT (namespace, key) DO '
+                              'UPDATE SET value=excluded.value, version=version + 1, '
+                              'expires_at=excluded.expires_at, accessed_at=excluded.accessed_at',
+                              (namespace, key, value, self._ts(expires_at), time.time()))
+
+    def delete(self, namespace, key):
+        with self.lock:
+            self.conn.execute('DELETE FROM entries WHERE namespace=? AND key=?', (namespace, key))
+
+    def cas(self, namespace, key, expected, value, expires_at):
+        now = time.time()
+        with self.lock:
+            if expected is None:
+                self.conn.execute('DELETE FROM entries WHERE namespace=? AND key=? AND expires_at <= ?',
+                                  (namespace, key, now))
+                cursor = self.conn.execute('INSERT OR IGNORE INTO entries VALUES (?, ?, ?, 1, ?, ?)',
+                                           (namespace, key, value, self._ts(expires_at), now))
+            else:
+                cursor = self.conn.execute(
+                    'UPDATE entries SET value=?, version=version + 1, expires_at=?, accessed_at=? '
+                    'WHERE namespace=? AND key=? AND version=? AND (expires_at IS NULL OR expires_at > ?)',
+                    (value, self._ts(expires_at), now, namespace, key, expected, now))
+        return cursor.rowcount == 1
+
+    def trim(self, namespace, keep):
+        with self.lock:
+            self.conn.execute('DELETE FROM entries WHERE expires_at <= ?', (time.time(),))
+            cursor = self.conn.execute(
+                'DELETE FROM entries WHERE namespace=? AND key IN (SELECT key FROM entries WHERE namespace=? '
+                'ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)', (namespace, namespace, keep))
+        return cursor.rowcount
+
+    def clear(self, namespace):
+        with self.lock:
+            self.conn.execute('DELETE FROM entries WHERE namespace=?', (namespace,))
+
+
+def backend(db=None, kind: str = None):
+    """The L2 backend named by SHARED_CACHE_BACKEND, or None for L1 only."""
+    kind = (kind or os.getenv('SHARED_CACHE_BACKEND') or ('mongo' if db is not None else 'local')).lower()
+    try:
+        if kind == 'mongo' and db is not None:
+            return MongoBackend(db)
+        if kind == 'sqlite':
+            return SQLiteBackend(os.getenv('SHARED_CACHE_PATH'))
+    except Exception as e:
+        print(f"Shared cache backend '{kind}' unavailable, using process memory: {e}")
+    return None
+
+
+# ── Two-level cache ──────────────────────────────────────────────────────────
+
+class SharedCache:
+    """One namespace of the shared cache: a bounded L1 over an optional L2.
+
+    `ttl` (seconds, None = no expiry) applies to both levels. Values handed
+    out may be shared with other callers, so treat them as read-only.
+    """
+
+    def __init__(self, namespace: str, store=None, ttl: float = None, l1_ttl: float = None,
+                 l1_entries: int = L1_ENTRIES, l2_entries: int = MAX_L2_ENTRIES):
+        self.namespace = namespace
+        self.store = store
+        self.ttl = ttl
+        self.l1_ttl = ttl if l1_ttl is None else l1_ttl
+        self.l1_entries = l1_entries
+        self.l2_entries = l2_entries
+        self.lock = threading.Lock()
+        self.l1 = collections.OrderedDict()     # key -> (value, version, trusted until)
+        self.metrics = collections.Counter()
+        self.writes = 0
+
+    def _expires_at(self, ttl):
+        ttl = self.ttl if ttl is None else ttl
+        return datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl) if ttl is not None else None
+
+    def _remember(self, key, value, version, ttl=None, sole_copy=False) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        if self.store is not None and self.l1_ttl is not None and not sole_copy:
+            # With an L2, L1 copies are only trusted for l1_ttl (unless L2 missed the write)
+            ttl = self.l1_ttl if ttl is None else min(ttl, self.l1_ttl)
+        until = time.monotonic() + ttl if ttl is not None else float('inf')
+        with self.lock:
+            if until <= time.monotonic():
+                self.l1.pop(key, None)
+                return
+            self.l1[key] = (value, version, until)
+            self.l1.move_to_end(key)
+            while len(self.l1) > self.l1_entries:
+                self.l1.popitem(last=False)
+                self.metrics['evictions'] += 1
+
+    def _lookup(self, key, use_l1):
+        with self.lock:
+            entry = self.l1.get(key)
+            if entry is not None:
+                if use_l1 and entry[2] > time.monotonic():
+                    self.l1.move_to_end(key)
+                    self.metrics['l1_hits'] += 1
+                    return entry[0], entry[1]
+                if entry[2] <= time.monotonic():
+                    del self.l1[key]
+        if self.store is not None:
+            try:
+                found = self.store.get(self.namespace, key)
+            except Exception as e:
+                self.metrics['errors'] += 1
+                print(f"Shared cache read failed ({self.namespace}): {e}")
+                found = None
+            if found is not None:
+                value, version = json_util.loads(found[0], json_options=JSON_OPTIONS), found[1]
+                self.metrics['l2_hits'] += 1
+                self._remember(key, value, version)
+                return value, version
+        elif not use_l1 and entry is not None and entry[2] > time.monotonic():
+            self.metrics['l1_hits'] += 1
+            return entry[0], entry[1]
+        self.metrics['misses'] += 1
+        return None
+
+    def get(self, key: str, default=None):
+        entry = self._lookup(key, use_l1=True)
+        return default if entry is None else entry[0]
+
+    def get_entry(self, key: str):
+        """(value, version) read from L2 (or L1 when there is none); or None.
+
+        The version is what `compare_and_swap` expects.
+        """
+        return self._lookup(key, use_l1=False)
+
+    def _write(self, key, value, ttl, write):
+        # Encode and run `write(encoded, expires_at)` against L2; returns (written, its result)
+        written, result = False, None
+        if self.store is not None:
+            try:
+                result = write(json_util.dumps(value, json_options=JSON_OPTIONS), self._expires_at(ttl))
+                written = True
+            except Exception as e:
+                self.metrics['errors'] += 1
+                print(f"Shared cache write failed ({self.namespace}): {e}")
+        self.writes += 1
+        if self.store is not None and self.writes % TRIM_EVERY == 0:
+            try:
+                self.metrics['l2_evictions'] += self.store.trim(self.namespace, self.l2_entries)
+            except Exception as e:
+                print(f"Shared cache trim failed ({self.namespace}): {e}")
+        return written, result
+
+    def set(self, key: str, value, ttl: float = None) -> None:
+        """Store `value` under `key` (overwriting), for `ttl` seconds or the namespace default.
+
+        If L2 rejects the write, the L1 copy is kept for the full `ttl` (even
+        past ``l1_ttl``): it is then the only copy this worker has.
+        """
+        written, _ = self._write(key, value, ttl, lambda raw, exp: self.store.set(self.namespace, key, raw, exp))
+        self.metrics['sets'] += 1
+        # With an L2 the new version is unknown after a blind write (get_entry() reads it there)
+        version = None
+        if self.store is None:
+            with self.lock:
+                old = self.l1.get(key)
+            version = (old[1] if old is not None and old[2] > time.monotonic() else 0) + 1
+        self._remember(key, value, version, ttl, sole_copy=not written)
+
+    def compare_and_swap(self, key: str, expected, value, ttl: float = None) -> bool:
+        """Write `value` only if the entry is still at version `expected`.
+
+        ``expected=None`` writes only if there is no live entry. Without an
+        L2 the check runs against L1 only.
+        """
+        if self.store is None:
+            entry = self.get_entry(key)
+            current = None if entry is None else entry[1]
+            ok = current == expected
+            if ok:
+                self._remember(key, value, (current or 0) + 1, ttl)
+        else:
+            ok = bool(self._write(key, value, ttl,
+                                  lambda raw, exp: self.store.cas(self.namespace, key, expected, raw, exp))[1])
+            with self.lock:
+                self.l1.pop(key, None)
+        self.metrics['cas_ok' if ok else 'cas_conflicts'] += 1
+        return ok
+
+    def delete(self, key: str) -> None:
+        with self.lock:
+            self.l1.pop(key, None)
+        if self.store is not None:
+            try:
+                self.store.delete(self.namespace, key)
+            except Exception as e:
+                self.metrics['errors'] += 1
+                print(f"Shared cache delete failed ({self.namespace}): {e}")
+
+    def get_or_set(self, key: str, compute, ttl: float = None):
+        """Cached value for `key`, or `compute()` stored under it."""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            self.set(key, value, ttl)
+        return value
+
+    def clear(self) -> None:
+        with self.lock:
+            self.l1.clear()
+        if self.store is not None:
+            self.store.clear(self.namespace)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.metrics['l1_hits'] + self.metrics['l2_hits'] + self.metrics['misses']
+            hits = self.metrics['l1_hits'] + self.metrics['l2_hits']
+            return {
+                'backend': self.store.name if self.store is not None else 'local',
+                'l1_entries': len(self.l1),
+                'l1_max_entries': self.l1_entries,
+                **{m: self.metrics[m] for m in ('l1_hits', 'l2_hits', 'misses', 'sets', 'cas_ok',
+                                                'cas_conflicts', 'evictions', 'l2_evictions', 'errors')},
+                'hit_rate': round(hits / lookups, 3) if lookups else None,
+            }
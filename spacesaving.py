@@ -0,0 +1,94 @@
+"""
+spacesaving.py
+--------------
+Minimal weighted Space-Saving summary for approximate top-K (heavy hitters).
+
+A summary monitors at most ``capacity`` keys. Each counter is a list
+``[weight, error, *extras]``. ``weight`` overestimates the key's true total by
+at most ``error``, so the true total lies in ``[weight - error, weight]``.
+When a new key arrives and every counter is taken, the smallest counter is
+evicted. The new key inherits the evicted weight as its error. ``extras`` are
+companion sums (e.g. units and orders next to revenue). They are only counted
+while the key is monitored, so they are lower bounds.
+
+Any key that is not monitored has a true total of at most `floor()`, which is
+never more than ``total / capacity``. Summaries merge (Agarwal et al.,
+"Mergeable Summaries") with the same guarantees. Each key missing from one
+side is charged that side's floor, and the merged result is cut back to
+``capacity``. So a date range is answered by merging one small summary per day.
+
+Summaries are plain dicts so they can be stored in MongoDB:
+    {'capacity': K, 'total': float, 'counters': {key: [weight, error, *extras]}}
+"""
+
+import heapq
+
+CAPACITY = 200
+
+
+def new(capacity: int = CAPACITY) -> dict:
+    return {'capacity': capacity, 'total': 0.0, 'counters': {}}
+
+
+def floor(summary: dict) -> float:
+    """Upper bound on the true total of any key the summary does not monitor."""
+    counters = summary['counters']
+    if len(counters) < summary['capacity'] or not counters:
+        return 0.0
+    return min(c[0] for c in counters.values())
+
+
+def add(summary: dict, key, weight: float, extras=()) -> dict:
+    """Fold one weighted occurrence of `key` into `summary` in place and return it."""
+    counters = summary['counters']
+    summary['total'] += weight
+    counter = counters.get(key)
+    if counter is not None:
+        counter[0] += weight
+        for i, value in enumerate(extras, 2):
+            counter[i] += value
+        return summary
+    if len(counters) < summary['capacity']:
+        counters[key] = [weight, 0.0, *extras]
+        return summary
+    victim = min(counters, key=lambda k: counters[k][0])
+    evicted = counters.pop(victim)[0]
+    counters[key] = [evicted + weight, evicted, *extras]
+    return summary
+
+
+def from_exact(totals: dict, capacity: int = CAPACITY) -> dict:
+    """Summary of exact per-key totals {key: [weight, *extras]}: the `capacity` largest, error 0.
+
+    Every dropped key weighs no more than the smallest kept one, so the
+    summary keeps the Space-Saving guarantees for later `add()` calls.
+    """
+    kept = heapq.nlargest(capacity, totals.items(), key=lambda kv: kv[1][0])
+    return {'capacity': capacity, 'total': float(sum(v[0] for v in totals.values())),
+            'counters': {k: [v[0], 0.0, *v[1:]] for k, v in kept}}
+
+
+def merge(a: dict, b: dict, capacity: int = None) -> dict:
+    """Summary of the union of the streams behind `a` and `b` (a new dict)."""
+    capacity = capacity or max(a['capacity'], b['capacity'])
+    floor_a, floor_b = floor(a), floor(b)
+    ca, cb = a['counters'], b['counters']
+    width = max([len(c) for c in ca.values()] + [len(c) for c in cb.values()] + [2])
+    merged = {}
+    for key in ca.keys() | cb.keys():
+        x = ca.get(key) or [floor_a, floor_a]
+        y = cb.get(key) or [floor_b, floor_b]
+        merged[key] = [(x[i] if i < len(x) else 0) + (y[i] if i < len(y) else 0) for i in range(width)]
+    kept = heapq.nlargest(capacity, merged.items(), key=lambda kv: kv[1][0])
+    return {'capacity': capacity, 'total': a['total'] + b['total'], 'counters': dict(kept)}
+
+
+def top(summary: dict, n: int) -> list:
+    """The `n` heaviest monitored keys: [(key, counter, guaranteed)], heaviest first.
+
+    `guaranteed` is True when the key is certainly among the true top `n`:
+    its lower bound beats the estimate of every key ranked after it.
+    """
+    ranked = heapq.nlargest(n + 1, summary['counters'].items(), key=lambda kv: kv[1][0])
+    threshold = ranked[n][1][0] if len(ranked) > n else floor(summary)
+    return [(key, counter, counter[0] - counter[1] >= threshold) for key, counter in ranked[:n]]
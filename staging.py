@@ -0,0 +1,61 @@
+"""
+staging.py
+----------
+Swap a fully rebuilt derived collection in at once.
+
+Collections recomputed from scratch (customer segments, co-purchases, demand
+forecasts) are written into a fresh ``<name>__build_<ObjectId>`` collection,
+indexed there, and renamed over ``<name>`` with ``dropTarget``. Readers see
+the old set or the new one, never a mix, and overlapping rebuilds (one per
+gunicorn worker, or a CLI run racing the background job) cannot delete each
+other's rows: each rename installs a complete set and the last one wins.
+
+A build whose process died before the rename leaves its staging collection
+behind; the next `replace()` of the same name drops it once it is older than
+``ABANDONED_AFTER``.
+"""
+
+import datetime
+
+from bson import ObjectId
+
+SEPARATOR = '__build_'
+ABANDONED_AFTER = datetime.timedelta(hours=6)
+BATCH = 1000
+
+
+def drop_abandoned(db, name: str, now=None) -> int:
+    """Drop staging collections of `name` older than ABANDONED_AFTER; returns how many."""
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    dropped = 0
+    for other in db.list_collection_names():
+        if not other.startswith(name + SEPARATOR):
+            continue
+        build_id = other[len(name + SEPARATOR):]
+        if ObjectId.is_valid(build_id) and now - ObjectId(build_id).generation_time > ABANDONED_AFTER:
+            db.drop_collection(other)
+            dropped += 1
+    return dropped
+
+
+def replace(db, name: str, docs: list, ensure_indexes=None) -> int:
+    """Replace every document of collection `name` with `docs` in one rename.
+
+    `ensure_indexes(db, staging_name)` builds the collection's indexes on the
+    staging copy before it goes live. Returns the number of documents.
+    """
+    drop_abandoned(db, name)
+    if not docs:
+        db[name].delete_many({})
+        return 0
+    staging = db[f'{name}{SEPARATOR}{ObjectId()}']
+    try:
+        for i in range(0, len(docs), BATCH):
+            staging.insert_many(docs[i:i + BATCH], ordered=False)
+        if ensure_indexes is not None:
+            ensure_indexes(db, staging.name)
+        staging.rename(name, dropTarget=True)
+    except Exception:
+        staging.drop()
+        raise
+    return len(docs)
@@ -0,0 +1,126 @@
+"""
+tdigest.py
+----------
+Minimal merging t-digest for approximate percentiles.
+
+A digest is a sorted list of centroids ``[mean, weight]``. The scale function
+``k(q) = δ/(2π)·asin(2q − 1)`` lets each centroid cover at most one unit of
+``k``. Centroids are therefore tiny near the minimum and maximum and widest
+at the median. Extreme percentiles stay accurate, and a digest never holds
+much more than ``δ`` centroids however many values it has seen. Digests merge
+by re-compressing the union of their centroids, so per-day digests add up to
+any date range.
+
+With ``COMPRESSION = 100`` the median is typically within ~1 % of rank and
+p99 within ~0.1 %.
+
+Digests are plain dicts so they can be stored in MongoDB:
+    {'compression', 'count', 'sum', 'min', 'max', 'centroids': [[mean, weight], ...]}
+"""
+
+import bisect
+import math
+
+COMPRESSION = 100
+
+
+def new(compression: int = COMPRESSION) -> dict:
+    return {'compression': compression, 'count': 0, 'sum': 0.0, 'min': None, 'max': None, 'centroids': []}
+
+
+def _k(q: float, compression: int) -> float:
+    return compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+
+def _k_inverse(k: float, compression: int) -> float:
+    return (math.sin(min(max(k * 2 * math.pi / compression, -math.pi / 2), math.pi / 2)) + 1) / 2
+
+
+def _compress(centroids: list, compression: int) -> list:
+    # One left-to-right pass merging neighbours while they fit in one unit of k
+    centroids = sorted(centroids)
+    if len(centroids) <= 1:
+        return [list(c) for c in centroids]
+    total = sum(w for _, w in centroids)
+    merged = [list(centroids[0])]
+    done = 0.0
+    limit = total * _k_inverse(_k(0.0, compression) + 1, compression)
+    for mean, weight in centroids[1:]:
+        last = merged[-1]
+        if done + last[1] + weight <= limit:
+            last[0] += (mean - last[0]) * weight / (last[1] + weight)
+            last[1] += weight
+        else:
+            done += last[1]
+            limit = total * _k_inverse(_k(done / total, compression) + 1, compression)
+            merged.append([mean, weight])
+    return merged
+
+
+def add_many(digest: dict, values) -> dict:
+    """Fold `values` into `digest` in place (one compression) and return it."""
+    values = [float(v) for v in values]
+    if not values:
+        return digest
+    digest['count'] += len(values)
+    digest['sum'] += sum(values)
+    low, high = min(values), max(values)
+    digest['min'] = low if digest['min'] is None else min(digest['min'], low)
+    digest['max'] = high if digest['max'] is None else max(digest['max'], high)
+    digest['centroids'] = _compress(digest['centroids'] + [[v, 1] for v in values], digest['compression'])
+    return digest
+
+
+def merge(a: dict, b: dict) -> dict:
+    """Digest of the union of the values behind `a` and `b` (a new dict)."""
+    if not b['count']:
+        return {**a, 'centroids': [list(c) for c in a['centroids']]}
+    if not a['count']:
+        return {**b, 'centroids': [list(c) for c in b['centroids']]}
+    compression = max(a['compression'], b['compression'])
+    return {
+        'compression': compression,
+        'count': a['count'] + b['count'],
+        'sum': a['sum'] + b['sum'],
+        'min': min(a['min'], b['min']),
+        'max': max(a['max'], b['max']),
+        'centroids': _compress(a['centroids'] + b['centroids'], compression),
+    }
+
+
+def quantile(digest: dict, q: float):
+    """Approximate value at quantile `q` (0..1), or None for an empty digest."""
+    centroids = digest['centroids']
+    if not centroids:
+        return None
+    n = digest['count']
+    target = min(max(q, 0.0), 1.0) * n
+    # Interpolate between centroid centres, pinned to min at rank 0 and max at rank n
+    prev_rank, prev_mean = 0.0, digest['min']
+    seen = 0.0
+    for mean, weight in centroids:
+        rank = seen + weight / 2
+        if target <= rank:
+            if rank == prev_rank:
+                return mean
+            return prev_mean + (mean - prev_mean) * (target - prev_rank) / (rank - prev_rank)
+        prev_rank, prev_mean = rank, mean
+        seen += weight
+    if n == prev_rank:
+        return digest['max']
+    return prev_mean + (digest['max'] - prev_mean) * (target - prev_rank) / (n - prev_rank)
+
+
+def histogram(digest: dict, edges: list) -> list:
+    """Approximate counts for the bins [edges[i], edges[i+1]) (the last bin is closed).
+
+    Each centroid's weight goes to the bin holding its mean, which is exact for
+    repeated values such as units per order.
+    """
+    counts = [0] * max(len(edges) - 1, 0)
+    if not counts:
+        return counts
+    for mean, weight in digest['centroids']:
+        i = bisect.bisect_right(edges, mean) - 1
+        counts[min(max(i, 0), len(counts) - 1)] += weight
+    return counts
@@ -0,0 +1,120 @@
+"""
+timeseries.py
+-------------
+Shared time-bucketed trend queries.
+
+`trend()` returns every day / week / month bucket of a date range from a
+single ``$group`` over ``$dateTrunc`` (one MongoDB round trip), and fills the
+buckets that had no rows with zeros so charts always get a continuous series.
+
+Buckets are cut in the shop's timezone, set with the ``SHOP_TIMEZONE`` env var
+(IANA name, e.g. ``Asia/Kolkata``). Stored datetimes are naive and MongoDB
+treats them as UTC; the default of ``UTC`` therefore keeps the old behaviour of
+bucketing on the stored wall-clock value.
+
+Weeks start on Monday. Requires MongoDB 5.0+ for ``$dateTrunc``.
+"""
+
+import datetime
+import os
+from zoneinfo import ZoneInfo
+
+SHOP_TIMEZONE = os.getenv('SHOP_TIMEZONE') or 'UTC'
+UNITS = ('day', 'week', 'month')
+
+
+def _zone(timezone=None):
+    return ZoneInfo(timezone or SHOP_TIMEZONE)
+
+
+def to_local(value, timezone=None):
+    """Naive UTC datetime (as stored) -> naive wall-clock datetime in the shop timezone."""
+    return value.replace(tzinfo=datetime.timezone.utc).astimezone(_zone(timezone)).replace(tzinfo=None)
+
+
+def to_utc(value, timezone=None):
+    """Naive shop-local datetime -> naive UTC datetime for querying stored values."""
+    return value.replace(tzinfo=_zone(timezone)).astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def local_day(value, timezone=None):
+    """Shop-local midnight of the day a stored timestamp falls on, or None for non-dates."""
+    if isinstance(value, datetime.datetime):
+        return bucket_start(to_local(value, timezone))
+    if isinstance(value, datetime.date):
+        return bucket_start(value)
+    return None
+
+
+def bucket_start(value, unit: str = 'day'):
+    """Start of the day / week / month containing the (local, naive) `value`."""
+    day = datetime.datetime(value.year, value.month, value.day)
+    if unit == 'day':
+        return day
+    if unit == 'week':
+        return day - datetime.timedelta(days=day.weekday())
+    if unit == 'month':
+        return day.replace(day=1)
+    raise ValueError(f"unit must be one of {UNITS}, got {unit!r}")
+
+
+def next_bucket(start, unit: str = 'day'):
+    """Start of the bucket that follows the one beginning at `start`."""
+    if unit == 'day':
+        return start + datetime.timedelta(days=1)
+    if unit == 'week':
+        return start + datetime.timedelta(weeks=1)
+    if unit == 'month':
+        return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    raise ValueError(f"unit must be one of {UNITS}, got {unit!r}")
+
+
+def bucket_range(start, end, unit: str = 'day') -> list:
+    """Every bucket start from the bucket holding `start` to the one holding `end`."""
+    buckets = []
+    current = bucket_start(start, unit)
+    last = bucket_start(end, unit)
+    while current <= last:
+        buckets.append(current)
+        current = next_bucket(current, unit)
+    return buckets
+
+
+def trend(collection, start, end, unit: str = 'day', date_field: str = 'purchase_date',
+          value_field: str = 'total', count_field=None, match=None, timezone=None) -> list:
+    """Sum `value_field` per bucket over the inclusive local day range [start, end].
+
+    Returns ``[{'bucket': <local bucket start>, 'value': float, 'count': int}]``
+    in order, one entry per bucket including empty ones. `count` is the number
+    of matching documents, or the sum of `count_field` when given. Buckets at
+    the edges only include the days inside the range.
+    """
+    tz = timezone or SHOP_TIMEZONE
+    first = bucket_start(start)
+    stop = bucket_start(end) + datetime.timedelta(days=1)
+
+    query = dict(match or {})
+    query[date_field] = {'$gte': to_utc(first, tz), '$lt': to_utc(stop, tz)}
+    trunc = {'date': f'${date_field}', 'unit': unit, 'timezone': tz}
+    if unit == 'week':
+        trunc['startOfWeek'] = 'monday'
+
+    pipeline = [
+        {'$match': query},
+        {'$group': {
+            '_id': {'$dateTrunc': trunc},
+            'value': {'$sum': f'${value_field}'},
+            'count': {'$sum': f'${count_field}' if count_field else 1},
+        }},
+    ]
+    found = {to_local(row['_id'], tz): row for row in collection.aggregate(pipeline)}
+
+    series = []
+    for bucket in bucket_range(first, end, unit):
+        row = found.get(bucket, {})
+        series.append({
+            'bucket': bucket,
+            'value': float(row.get('value', 0) or 0),
+            'count': int(row.get('count', 0) or 0),
+        })
+    return series